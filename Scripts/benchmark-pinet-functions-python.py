@@ -0,0 +1,310 @@
+#!python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#Benchmarks for the hot paths in pinet-functions-python.py using synthetic, school sized data.
+#Everything is generated inside a temporary root, nothing on the real system is read or written and
+#no network access is needed.
+#
+#Examples
+#   python3 benchmark-pinet-functions-python.py --output baseline.json
+#   python3 benchmark-pinet-functions-python.py --baseline baseline.json --output latest.json
+#   python3 benchmark-pinet-functions-python.py --sizes 100,1000 --only getUsers
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = [100, 1000, 5000, 20000]
+CONFIG_SIZES = [20, 500, 5000]
+APT_PACKAGES = 20000
+QUADRATIC_LIMIT = 5000  #previousImport is O(n^2), larger sizes are only run with --full
+
+SYSTEM_USERS = [
+    ("root", 0, 0, "/root", "/bin/bash"),
+    ("daemon", 1, 1, "/usr/sbin", "/usr/sbin/nologin"),
+    ("bin", 2, 2, "/bin", "/usr/sbin/nologin"),
+    ("sys", 3, 3, "/dev", "/usr/sbin/nologin"),
+    ("www-data", 33, 33, "/var/www", "/usr/sbin/nologin"),
+    ("nobody", 65534, 65534, "/nonexistent", "/usr/sbin/nologin"),
+]
+SYSTEM_GROUPS = ["adm", "dialout", "cdrom", "audio", "users", "video", "games", "plugdev", "input"]
+
+
+def loadPinetFunctions(root):
+    """
+    Imports pinet-functions-python.py and points the bash data transfer file and command log into the temporary root.
+    """
+    scriptsFolder = os.path.dirname(os.path.abspath(__file__))
+    if scriptsFolder not in sys.path:
+        sys.path.insert(0, scriptsFolder)
+    pinetFunctions = __import__("pinet-functions-python")
+    os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+    os.makedirs(os.path.join(root, "var", "log"), exist_ok=True)
+    pinetFunctions.DATA_TRANSFER_FILEPATH = os.path.join(root, "tmp", "ltsptmp")
+    pinetFunctions.COMMAND_LOG_FILEPATH = os.path.join(root, "var", "log", "pinet.log")
+    return pinetFunctions
+
+
+class syntheticServer():
+    """
+    Builds a fake PiNet server filesystem under root with the given number of users.
+    """
+
+    def __init__(self, root, users, homes=True):
+        super(syntheticServer, self).__init__()
+        self.root = root
+        self.users = users
+        self.random = random.Random(users)
+        self.names = ["pupil%05d" % i for i in range(users)]
+        for folder in ["etc", "home", "move", "tmp", "var/log", "opt/ltsp/armhf/var/lib/apt/lists", "opt/ltsp/armhf/var/lib/dpkg"]:
+            os.makedirs(self.path(folder), exist_ok=True)
+        self.writeAccounts()
+        self.writeMigration()
+        self.writeCSV()
+        self.writeConfigs()
+        self.writeAptLists()
+        self.writeCopySources()
+        if homes:
+            self.writeHomes()
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def writeLines(self, lines, *parts):
+        with open(self.path(*parts), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def accountLines(self, names, firstUID):
+        passwd, group, shadow, gshadow = [], [], [], []
+        for name, uid, gid, home, shell in SYSTEM_USERS:
+            passwd.append("%s:x:%d:%d:%s:%s:%s" % (name, uid, gid, name, home, shell))
+            group.append("%s:x:%d:" % (name, gid))
+            shadow.append("%s:*:16000:0:99999:7:::" % name)
+            gshadow.append("%s:*::" % name)
+        for index, name in enumerate(SYSTEM_GROUPS):
+            group.append("%s:x:%d:%s" % (name, 4 + index, ",".join(names)))
+            gshadow.append("%s:!::%s" % (name, ",".join(names)))
+        for index, name in enumerate(names):
+            uid = firstUID + index
+            passwd.append("%s:x:%d:%d:,,,:/home/%s:/bin/bash" % (name, uid, uid, name))
+            group.append("%s:x:%d:" % (name, uid))
+            shadow.append("%s:$6$%08x$%s:16500:0:99999:7:::" % (name, self.random.getrandbits(32), "x" * 86))
+            gshadow.append("%s:!::" % name)
+        group.append("pupil:x:2122:" + ",".join(names))
+        group.append("teacher:x:2123:")
+        return passwd, group, shadow, gshadow
+
+    def writeAccounts(self):
+        for item, lines in zip(["passwd", "group", "shadow", "gshadow"], self.accountLines(self.names, 1001)):
+            self.writeLines(lines, "etc", item)
+
+    def writeMigration(self):
+        #Half the users being imported already exist on the new server
+        half = len(self.names) // 2
+        migrating = self.names[half:] + ["moved%05d" % i for i in range(half)]
+        for item, lines in zip(["passwd", "group", "shadow", "gshadow"], self.accountLines(migrating, 1001 + half)):
+            self.writeLines(lines, "move", item + ".mig")
+
+    def writeCSV(self):
+        lines = []
+        for index, name in enumerate(self.names):
+            if index % 3 == 0:
+                lines.append(name + ",")
+            else:
+                lines.append("%s,pass%06d" % (name, self.random.randint(0, 999999)))
+        self.writeLines(lines, "import.csv")
+
+    def writeConfigs(self):
+        for size in CONFIG_SIZES:
+            lines = ["Setting%05d=%d" % (i, i) for i in range(size - 1)]
+            lines.append("ReleaseChannel=Stable")
+            self.writeLines(lines, "etc", "pinet-%d" % size)
+
+    def writeAptLists(self):
+        packages, status = [], []
+        for i in range(APT_PACKAGES):
+            stanza = ["Package: package%05d" % i, "Priority: optional", "Section: misc",
+                      "Installed-Size: %d" % self.random.randint(10, 50000), "Architecture: armhf",
+                      "Version: 1.%d-%d" % (i % 17, i % 5), "Description: Synthetic package %d" % i, ""]
+            packages.extend(stanza)
+            if i % 10 == 0:
+                status.extend(stanza[:1] + ["Status: install ok installed"] + stanza[1:])
+        self.writeLines(packages, "opt/ltsp/armhf/var/lib/apt/lists", "mirrordirector.raspbian.org_raspbian_dists_wheezy_main_binary-armhf_Packages")
+        self.writeLines(status, "opt/ltsp/armhf/var/lib/dpkg", "status")
+
+    def writeCopySources(self):
+        os.makedirs(self.path("copy", "python_games"), exist_ok=True)
+        for i in range(20):
+            with open(self.path("copy", "python_games", "game%02d.py" % i), "w") as f:
+                f.write("# Synthetic game\n" * 200)
+        self.writeLines(["file:///home/shared/Maths Maths", "file:///home/shared/Science Science"], "copy", ".gtk-bookmarks")
+
+    def writeHomes(self):
+        for name in self.names:
+            home = self.path("home", name)
+            os.makedirs(os.path.join(home, "Desktop"))
+            os.makedirs(os.path.join(home, "handin"))
+            for i in range(self.random.randint(0, 3)):
+                with open(os.path.join(home, "handin", "work%d.py" % i), "w") as f:
+                    f.write("print('hello')\n" * 20)
+
+    def resetAccounts(self):
+        self.writeAccounts()
+
+
+class benchmarkCase():
+    """
+    A single timed operation. setup runs before every repeat and is not included in the time.
+    """
+
+    def __init__(self, name, size, function, setup=None):
+        super(benchmarkCase, self).__init__()
+        self.name = name
+        self.size = size
+        self.function = function
+        self.setup = setup
+
+    @property
+    def key(self):
+        return "%s/%d" % (self.name, self.size)
+
+    def run(self, repeat):
+        times = []
+        for i in range(repeat):
+            if self.setup is not None:
+                self.setup()
+            started = time.perf_counter()
+            self.function()
+            times.append(time.perf_counter() - started)
+        times.sort()
+        return {"name": self.name, "size": self.size, "best": times[0], "median": times[len(times) // 2], "runs": times}
+
+
+def buildCases(pinetFunctions, server, full=False):
+    users = server.users
+    cases = []
+
+    passwd = server.path("etc", "passwd")
+    cases.append(benchmarkCase("getUsers", users, lambda: pinetFunctions.getUsers(passwdFile=passwd)))
+
+    if users <= QUADRATIC_LIMIT or full:
+        cases.append(benchmarkCase("previousImport", users,
+                                   lambda: pinetFunctions.previousImport(server.path("move"), server.path("etc")),
+                                   setup=server.resetAccounts))
+
+    csvPath = server.path("import.csv")
+    cases.append(benchmarkCase("importFromCSV-dry-run", users, lambda: pinetFunctions.importFromCSV(csvPath, "default", dryRun=True)))
+
+    chown = os.geteuid() == 0
+    homeRoot = server.path("home")
+    bookmarks = server.path("copy", ".gtk-bookmarks")
+    games = server.path("copy", "python_games")
+    cases.append(benchmarkCase("copyToUsers-file", users,
+                               lambda: pinetFunctions.copyToUsers(bookmarks, ".gtk-bookmarks", homeRoot=homeRoot, passwdFile=passwd, chown=chown)))
+    cases.append(benchmarkCase("copyToUsers-folder", users,
+                               lambda: pinetFunctions.copyToUsers(games, "python_games", homeRoot=homeRoot, passwdFile=passwd, chown=chown)))
+    return cases
+
+
+def buildFileCases(pinetFunctions, server):
+    cases = []
+    for size in CONFIG_SIZES:
+        config = server.path("etc", "pinet-%d" % size)
+        cases.append(benchmarkCase("getConfigParameter", size, lambda config=config: pinetFunctions.getConfigParameter(config, "ReleaseChannel=")))
+        cases.append(benchmarkCase("replaceLineOrAdd", size, lambda config=config: pinetFunctions.replaceLineOrAdd(config, "ReleaseChannel", "ReleaseChannel=Dev")))
+    packages = server.path("opt/ltsp/armhf/var/lib/apt/lists", "mirrordirector.raspbian.org_raspbian_dists_wheezy_main_binary-armhf_Packages")
+    cases.append(benchmarkCase("getConfigParameter-apt-lists", APT_PACKAGES, lambda: pinetFunctions.getConfigParameter(packages, "Package: package19999")))
+    status = server.path("opt/ltsp/armhf/var/lib/dpkg", "status")
+    cases.append(benchmarkCase("checkIfFileContains-dpkg-status", APT_PACKAGES // 10, lambda: pinetFunctions.checkIfFileContains(status, "Package: package19990")))
+    return cases
+
+
+def compareResults(current, baseline, threshold):
+    """
+    Prints a comparison of two result sets. Returns the list of keys that got slower than threshold allows.
+    """
+    regressions = []
+    print("")
+    print("%-45s %12s %12s %8s" % ("Comparison with baseline", "baseline", "current", "ratio"))
+    for key in sorted(current["results"]):
+        if key not in baseline["results"]:
+            continue
+        before = baseline["results"][key]["best"]
+        after = current["results"][key]["best"]
+        ratio = after / before if before > 0 else 1.0
+        note = ""
+        if ratio > threshold:
+            note = "slower"
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            note = "faster"
+        print("%-45s %11.4fs %11.4fs %7.2fx %s" % (key, before, after, ratio, note))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmark pinet-functions-python.py with synthetic school sized data.")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES), help="Comma separated numbers of users")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times each case is timed, the best time is compared")
+    parser.add_argument("--only", default="", help="Only run cases whose name contains this text")
+    parser.add_argument("--full", action="store_true", help="Also run the quadratic previousImport at every size")
+    parser.add_argument("--output", help="Save the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare the results with a JSON file saved by an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Ratio above which a case counts as slower than the baseline")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with 1 if any case is slower than the baseline")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary root for inspection")
+    options = parser.parse_args(arguments)
+
+    sizes = [int(size) for size in options.sizes.split(",") if size]
+    root = tempfile.mkdtemp(prefix="pinet-benchmark-")
+    results = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+               "platform": platform.platform(), "repeat": options.repeat, "results": {}}
+    try:
+        pinetFunctions = loadPinetFunctions(root)
+        print("%-45s %12s %12s" % ("Case", "best", "median"))
+        for index, size in enumerate(sizes):
+            serverRoot = os.path.join(root, "server-%d" % size)
+            started = time.perf_counter()
+            server = syntheticServer(serverRoot, size)
+            print("(generated %d users in %.1fs)" % (size, time.perf_counter() - started))
+            cases = buildCases(pinetFunctions, server, options.full)
+            if index == 0:
+                cases = buildFileCases(pinetFunctions, server) + cases
+            for case in cases:
+                if options.only and options.only not in case.name:
+                    continue
+                result = case.run(options.repeat)
+                results["results"][case.key] = result
+                print("%-45s %11.4fs %11.4fs" % (case.key, result["best"], result["median"]))
+            if not options.keep:
+                shutil.rmtree(serverRoot)
+    finally:
+        if options.keep:
+            print("Temporary root kept at " + root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Results saved to " + options.output)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compareResults(results, baseline, options.threshold)
+        if regressions and options.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,18 +11,11 @@
 
 #PiNet is a utility for setting up and configuring a Linux Terminal Server Project (LTSP) network for Raspberry Pi's
 
-from logging import debug, info, warning, basicConfig, INFO, DEBUG, WARNING
-basicConfig(level=WARNING)
+#Bash calls this script for every small check, so only sys and os are imported up front.
+#Everything else is imported inside the functions that need it.
 import sys, os
-from subprocess import Popen, PIPE, check_output
-import time
-import shutil
-import pwd, grp
-from copy import deepcopy
-import random
 #from gettext import gettext as _
 #gettext.textdomain(pinetPython)
-import gettext
 # Set up message catalog access
 #t = gettext.translation('pinetPython', 'locale', fallback=True)
 #_ = t.ugettext
@@ -31,8 +24,13 @@ def _(placeholder):
     #GNU Gettext placeholder
     return(placeholder)
 
-DATA_TRANSFER_FILEPATH = "/tmp/ltsptmp"
+DATA_TRANSFER_FILEPATH = os.environ.get("PINET_DATA_FILE", "/tmp/ltsptmp")  #Set per task when several run at once (see pinetTasks.py)
 PINET_CONF_FILEPATH = "/etc/pinet"
+COMMAND_LOG_FILEPATH = "/var/log/pinet.log"
+
+APT_TIMEOUT = 60 * 60  #Large installs (wolfram-engine, libreoffice) can take a long time on slow connections
+APT_UPDATE_TIMEOUT = 10 * 60
+NETWORK_TIMEOUT = 60
 
 RepositoryBase="https://github.com/pinet/"
 RepositoryName="pinet"
@@ -43,6 +41,45 @@ RawRepository=RawRepositoryBase + RepositoryName
 RawBootRepository=RawRepositoryBase + BootRepository
 ReleaseBranch = "master"
 configFileData = {}
+PythonModules = ["pinetRunner.py", "pinetFiles.py", "pinetShared.py", "pinetProvision.py", "pinetUpgrade.py", "pinetUsage.py", "pinetUpdates.py", "pinetStats.py", "pinetChroots.py", "pinetPasswords.py", "pinetRetire.py", "pinetHandin.py", "pinetSnapshots.py", "pinetBootStorm.py", "pinetCompression.py", "pinetSlim.py", "pinetLayers.py", "pinetJournal.py", "pinetTasks.py", "pinetGolden.py", "pinetDedup.py", "pinetJobs.py", "pinetGallery.py"]
+commands = {}
+logger = None
+
+
+def getLogger():
+    """
+    Sets up logging the first time something is logged. Most commands never log anything.
+    """
+    global logger
+    if logger is None:
+        import logging
+        logging.basicConfig(level=logging.WARNING)
+        logger = logging.getLogger()
+    return logger
+
+def debug(message, *args):
+    getLogger().debug(message, *args)
+
+def info(message, *args):
+    getLogger().info(message, *args)
+
+def warning(message, *args):
+    getLogger().warning(message, *args)
+
+def runCommand(command, **options):
+    """
+    pinetRunner pulls in subprocess and threading, so it is only imported by commands that run something.
+    """
+    import pinetRunner
+    return pinetRunner.runCommand(command, **options)
+
+def runBatch(commands, **options):
+    import pinetRunner
+    return pinetRunner.runBatch(commands, **options)
+
+def retryPolicy(*args, **options):
+    import pinetRunner
+    return pinetRunner.retryPolicy(*args, **options)
 
 
 class softwarePackage():
@@ -63,29 +100,36 @@ class softwarePackage():
         self.installType = installType
         self.installCommands = installCommands
 
-    def installPackage(self):
+    def installPackage(self, target=None):
+        """
+        Installs the package into target (a pinetChroots.chrootTarget), or the default chroot.
+        Epoptes and ScratchGPIO also change the server, so that part is only done along with the default chroot.
+        """
         debug("Installing " +  self.name)
         debug(self.installCommands)
-        if len(self.installCommands) > 0:
-            programs = " ".join(self.installCommands)
-        else:
-            programs = self.installCommands
+        isDefault = target is None or target.name == chrootTargets("default")[0].name
+        programs = " ".join(self.installCommands).split()
         if self.installType == "pip":
             self.marked = False
-            py2 = runBash("ltsp-chroot pip install -U " + programs)
-            py3 = runBash("ltsp-chroot pip3 install -U " + programs)
-            return
+            py2 = ltspChroot(["pip", "install", "-U"] + programs, timeout=APT_TIMEOUT, target=target)
+            py3 = ltspChroot(["pip3", "install", "-U"] + programs, timeout=APT_TIMEOUT, target=target)
+            return py2 or py3
         elif self.installType == "apt":
             self.marked = False
-            return runBash("ltsp-chroot apt-get install " + programs + " -y")
+            return ltspChroot(["apt-get", "install", "-y"] + programs, timeout=APT_TIMEOUT, target=target)
         elif self.installType == "script":
             for i in self.installCommands:
-                runBash("ltsp-chroot --arch armhf " + i)
+                ltspChroot(i, timeout=APT_TIMEOUT, target=target)
             self.marked = False
         elif self.installType == "epoptes":
-            installEpoptes()
+            if isDefault:
+                installEpoptes()
+            else:
+                ltspChroot(["apt-get", "install", "-y", "epoptes-client", "--no-install-recommends"], timeout=APT_TIMEOUT, target=target)
+                ltspChroot(["epoptes-client", "-c"], timeout=NETWORK_TIMEOUT, target=target)
         elif self.installType == "scratchGPIO":
-            installScratchGPIO()
+            if isDefault:
+                installScratchGPIO()
         else:
             print(_("Error in installing") + " " + self.name + " " + _("due to invalid install type."))
             self.marked = False
@@ -128,43 +172,76 @@ class softwarePackage():
                 done = True
         debug(self.marked, self.installType, self.installCommands, self.name)
 
-def runBash(command):
-    if type(command) == str:
-        p = Popen("sudo " + command, shell=True)
-        p.wait()
-        return p.returncode
+def runBash(command, timeout=None, retry=None, echo=True, name=""):
+    """
+    Runs a command through pinetRunner.runCommand and returns its return code.
+    Argument lists are run directly, strings are passed to the shell.
+    Echoed commands are left on the terminal as before, so apt and dpkg can ask questions, and are logged in the PiNet
+    command log with their exit code. name prefixes the output instead, for commands running alongside others.
+    """
+    attached = echo and not name
+    if isinstance(command, str):
+        if os.geteuid() != 0:
+            command = "sudo " + command
+        result = runCommand(command, shell=True, timeout=timeout, retry=retry, echo=echo, logPath=COMMAND_LOG_FILEPATH, name=name, attached=attached)
     else:
-        p = Popen(command)
-        p.wait()
-        return p.returncode
-
-def runBashOutput(command):
-    output = check_output("sudo " + command, shell=True)
-    return output
-
-def getUsers(includeRoot=False):
+        if os.geteuid() != 0:
+            command = ["sudo"] + list(command)
+        result = runCommand(command, timeout=timeout, retry=retry, echo=echo, logPath=COMMAND_LOG_FILEPATH, name=name, attached=attached)
+    return result.returncode
+
+def getPasswdEntries(passwdFile=None):
+    """
+    Returns the passwd database as a list of [name, password, uid, gid, gecos, home, shell] lists.
+    Reads the system database with pwd unless a passwd style file is given.
+    """
+    if passwdFile is None:
+        import pwd
+        return [list(p) for p in pwd.getpwall()]
+    entries = []
+    for line in getList(passwdFile):
+        fields = line.split(":")
+        if len(fields) >= 7:
+            entries.append([fields[0], fields[1], int(fields[2]), int(fields[3]), fields[4], fields[5], fields[6]])
+    return entries
+
+def getUsers(includeRoot=False, passwdFile=None):
     users = []
-    for p in pwd.getpwall():
+    for p in getPasswdEntries(passwdFile):
         if (len(str(p[2])) > 3) and (str(p[5])[0:5] == "/home"): #or (str(p[5])[0:5] == "/root"):
             users.append(p[0].lower())
     return users
 
-def ltspChroot(command):
-    runBash("ltsp-chroot --arch armhf " + command)
+def chrootTargets(names="all"):
+    """
+    The client image chroots to work on, see pinetChroots.selectTargets. Without a chroot registry this is just armhf.
+    """
+    import pinetChroots
+    return pinetChroots.selectTargets(names)
+
+def ltspChroot(command, timeout=None, retry=None, target=None):
+    """
+    Runs a command inside a chroot, the default (Raspbian armhf) one unless target is given.
+    command can be an argument list or a string, which is split like the shell would.
+    """
+    if isinstance(command, str):
+        import shlex
+        command = shlex.split(command)
+    if target is None:
+        target = chrootTargets("default")[0]
+        return runBash(target.command(*command), timeout=timeout, retry=retry)
+    return runBash(target.command(*command), timeout=timeout, retry=retry, name=target.name)
 
 def installPackage(toInstall, update=False, upgrade=False, InstallOnServer=False):
-    toInstall = toInstall.split(" ")
-    totalPackages = ""
-    for i in range(0, len(toInstall)):
-        totalPackages = totalPackages + " " + toInstall[i]
+    totalPackages = toInstall.split()
     if update:
-        runBash("apt-get update")
+        runBash(["apt-get", "update"], timeout=APT_UPDATE_TIMEOUT, retry=retryPolicy(3))
     if update:
-        runBash("apt-get upgrade -y")
+        runBash(["apt-get", "upgrade", "-y"], timeout=APT_TIMEOUT)
     if InstallOnServer:
-        runBash("apt-get install -y " + str(totalPackages))
+        runBash(["apt-get", "install", "-y"] + totalPackages, timeout=APT_TIMEOUT)
     else:
-        ltspChroot("apt-get install -y " + str(totalPackages))
+        ltspChroot(["apt-get", "install", "-y"] + totalPackages, timeout=APT_TIMEOUT)
 
 
 def createTextFile(location, text):
@@ -333,7 +410,7 @@ def downloadFile(url, saveloc):
         import urllib.request
         req = urllib.request.Request(url)
         req.add_header('User-agent', 'Mozilla 5.10')
-        f = urllib.request.urlopen(req)
+        f = urllib.request.urlopen(req, timeout=NETWORK_TIMEOUT)
         text_file = open(saveloc, "wb")
         text_file.write(f.read())
         text_file.close()
@@ -421,19 +498,20 @@ def readReturn():
         print(text_file.read())
 
 def removeFile(file):
+    import shutil
     try:
         shutil.rmtree(file)
     except (OSError, IOError):
         pass
 
 def copyFile(src, dest):
+    import shutil
     shutil.copy(src, dest)
 
 #----------------Whiptail functions-----------------
 def whiptailBox(whiltailType, title, message, returnTrueFalse ,height = "8", width= "78", returnErr = False, other = ""):
     cmd = ["whiptail", "--title", title, "--"+whiltailType, message, height, width, other]
-    p = Popen(cmd,  stderr=PIPE)
-    out, err = p.communicate()
+    p = runCommand(cmd, interactive=True)
 
     if returnTrueFalse:
         if p.returncode == 0:
@@ -443,7 +521,7 @@ def whiptailBox(whiltailType, title, message, returnTrueFalse ,height = "8", wid
         else:
             return "ERROR"
     elif returnErr:
-        return err.decode()
+        return p.outputText()
     else:
         return p.returncode
 
@@ -454,11 +532,9 @@ def whiptailSelectMenu(title, message, items, height = "16", width = "78", other
         cmd.append(items[x])
         cmd.append("a")
     cmd.append("--noitem")
-    p = Popen(cmd,  stderr=PIPE)
-    out, err = p.communicate()
-    returnCode = p.returncode
-    if str(returnCode) == "0":
-        return(err)
+    p = runCommand(cmd, interactive=True)
+    if p.returncode == 0:
+        return(p.outputText())
     else:
         return("Cancel")
 
@@ -470,18 +546,15 @@ def whiptailCheckList(title, message, items):
         cmd.append(items[x][0])
         cmd.append(items[x][1])
         cmd.append("OFF")
-    p = Popen(cmd,  stderr=PIPE)
-    out, err = p.communicate()
-    returnCode = p.returncode
-    if str(returnCode) == "0":
-        return(err)
+    p = runCommand(cmd, interactive=True)
+    if p.returncode == 0:
+        return(p.outputText())
     else:
         return("Cancel")
 
 def whiptailBoxYesNo(title, message, returnTrueFalse ,height = "8", width= "78", returnErr = False, customYes = "", customNo = ""):
-    cmd = ["whiptail", "--title " + title,  "--yesno", message, height, width, "--yes-button " + customYes, "--no-button " + customNo]
-    p = Popen(cmd,  stderr=PIPE)
-    out, err = p.communicate()
+    cmd = ["whiptail", "--title", title,  "--yesno", message, height, width, "--yes-button", customYes, "--no-button", customNo]
+    p = runCommand(cmd, interactive=True)
 
     if returnTrueFalse:
         if p.returncode == 0:
@@ -491,7 +564,7 @@ def whiptailBoxYesNo(title, message, returnTrueFalse ,height = "8", width= "78",
         else:
             return "ERROR"
     elif returnErr:
-        return err.decode()
+        return p.outputText()
     else:
         return p.returncode
 
@@ -564,6 +637,8 @@ def internetFullStatusReport(timeoutLimit = 5, whiptail = False, returnStatus =
     """
     Full check of all sites used by PiNet. Only needed on initial install
     """
+    import shutil
+    import time
     sites = []
     sites.append([_("Main Raspbian repository"), "http://archive.raspbian.org/raspbian.public.key", ("Critical"), False])
     sites.append([_("Raspberry Pi Foundation repository"), "http://archive.raspberrypi.org/debian/raspberrypi.gpg.key", ("Critical"),False])
@@ -636,6 +711,9 @@ def updatePiNet():
         download = False
     if not downloadFile(RawRepository +"/" + ReleaseBranch + "/Scripts/pinet-functions-python.py", "/usr/local/bin/pinet-functions-python.py"):
         download = False
+    for module in PythonModules:
+        if not downloadFile(RawRepository +"/" + ReleaseBranch + "/Scripts/" + module, "/usr/local/bin/" + module):
+            download = False
     if download:
         print("----------------------")
         print(_("Update complete"))
@@ -678,94 +756,125 @@ def GetVersionNum(data):
             return version
 
 
+def updateSources():
+    return {"pinet": Repository + "/commits/" + ReleaseBranch + ".atom",
+            "bootFiles": RawBootRepository + "/" + ReleaseBranch + "/boot/version.txt",
+            "kernelUpdater": RawRepository + "/" + ReleaseBranch + "/Scripts/kernelCheckUpdate.sh"}
+
+def updateJobs():
+    """
+    Everything done when checking for updates. The stats upload and the check counter are sent at the same time.
+    """
+    import pinetUpdates
+    jobs = pinetUpdates.sourceJobs(updateSources())
+    jobs["stats"] = lambda timeout: sendStats(timeout)
+    jobs["counter"] = lambda timeout: pinetUpdates.fetch("http://bit.ly/pinetCheckCommits", timeout) and None
+    return jobs
+
+def updateCheckRefresh():
+    """
+    Runs all the update checks at once and caches the result. Started in the background when the cache is out of date.
+    """
+    import pinetUpdates
+    pinetUpdates.refresh(ReleaseBranch, updateJobs())
+
+def cachedUpdates():
+    """
+    The result of the last update check. Only waits for the checks if nothing has been cached for this release
+    channel yet, otherwise starts a refresh in the background if the cache is out of date and carries on.
+    """
+    import pinetUpdates
+    cache = pinetUpdates.loadCache()
+    mode = pinetUpdates.refreshMode(cache, ReleaseBranch)
+    if mode == "wait":
+        cache = pinetUpdates.refresh(ReleaseBranch, updateJobs())
+    elif mode == "background":
+        pinetUpdates.startBackgroundRefresh([sys.executable, os.path.abspath(__file__), "updateCheckRefresh"])
+    return cache
+
 def checkUpdate(currentVersion):
-    if not internet_on(5, False):
-        print(_("No Internet Connection"))
+    import pinetUpdates
+    latest = pinetUpdates.cachedValue(cachedUpdates(), "pinet")
+    if latest is None:
+        print(_("Unable to check for PiNet updates"))
         returnData(0)
-    import feedparser
-    import xml.etree.ElementTree
-    downloadFile("http://bit.ly/pinetCheckCommits", "/dev/null")
-    d = feedparser.parse(Repository +'/commits/' +ReleaseBranch + '.atom')
-    releases = []
-    data = (d.entries[0].content[0].get('value'))
-    data = ''.join(xml.etree.ElementTree.fromstring(data).itertext())
-    data = data.split("\n")
-    thisVersion = GetVersionNum(data)
-    #thisVersion = data[0].rstrip()
-    #thisVersion = thisVersion[8:len(thisVersion)]
-
-    if compareVersions(currentVersion, thisVersion):
+        return
+    if compareVersions(currentVersion, latest["version"]):
         whiptailBox("msgbox", _("Update detected"), _("An update has been detected for PiNet. Select OK to view the Release History."), False)
-        displayChangeLog(currentVersion)
+        displayChangeLog(currentVersion, latest["commits"])
     else:
         print(_("No PiNet software updates found"))
-        #print(thisVersion)
-        #print(currentVersion)
         returnData(0)
 
 
 
 def checkKernelFileUpdateWeb():
-    #downloadFile(RawRepository +"/" + ReleaseBranch + "/boot/version.txt", "/tmp/kernelVersion.txt")
-    downloadFile(RawBootRepository +"/" + ReleaseBranch + "/boot/version.txt", "/tmp/kernelVersion.txt")
-    import os.path
+    import pinetUpdates
+    bootFiles = pinetUpdates.cachedValue(cachedUpdates(), "bootFiles")
     user=os.environ['SUDO_USER']
     currentPath="/home/"+user+"/PiBoot/version.txt"
-    if (os.path.isfile(currentPath)) == True:
+    if bootFiles is not None and os.path.isfile(currentPath):
+        writeTextFile([str(bootFiles["version"])], "/tmp/kernelVersion.txt")  #Shown by the bash side
         current = int(getCleanList(currentPath)[0])
-        new = int(getCleanList("/tmp/kernelVersion.txt")[0])
-        if new > current:
+        if bootFiles["version"] > current:
             returnData(1)
             return False
-        else:
-            returnData(0)
-            print(_("No kernel updates found"))
-            return True
-    else:
-        returnData(0)
-        print(_("No kernel updates found"))
+    returnData(0)
+    print(_("No kernel updates found"))
+    return True
 
 def checkKernelUpdater():
-    downloadFile(RawRepository +"/" + ReleaseBranch + "/Scripts/kernelCheckUpdate.sh", "/tmp/kernelCheckUpdate.sh")
-
-    import os.path
-    if os.path.isfile("/opt/ltsp/armhf/etc/init.d/kernelCheckUpdate.sh"):
+    """
+    Installs the latest kernel updater into every chroot that has an older one (or none).
+    Passes 1 back to bash if any chroot was updated, so its image gets rebuilt.
+    """
+    import pinetUpdates
+    import pinetChroots
+    kernelUpdater = pinetUpdates.cachedValue(cachedUpdates(), "kernelUpdater")
+    if kernelUpdater is None or not os.path.isfile(pinetUpdates.KERNEL_UPDATER_FILEPATH):
+        returnData(0)
+        return True
+    outdated = [target for target in chrootTargets() if kernelUpdaterVersion(target) < kernelUpdater["version"]]
+    if not outdated:
+        returnData(0)
+        return True
+    report = pinetChroots.fanOut(outdated, installCheckKernelUpdater)
+    for line in report.summary():
+        print(line)
+    returnData(1)
+    return False
 
-        currentVersion = int(getConfigParameter("/opt/ltsp/armhf/etc/init.d/kernelCheckUpdate.sh", "version="))
-        newVersion = int(getConfigParameter("/tmp/kernelCheckUpdate.sh", "version="))
-        if currentVersion < newVersion:
-            installCheckKernelUpdater()
-            returnData(1)
-            return False
-        else:
-            returnData(0)
-            return True
-    else:
-        installCheckKernelUpdater()
-        returnData(1)
-        return False
+def kernelUpdaterVersion(target):
+    filepath = target.file("/etc/init.d/kernelCheckUpdate.sh")
+    if not os.path.isfile(filepath):
+        return -1
+    try:
+        return int(getConfigParameter(filepath, "version="))
+    except ValueError:
+        return -1
 
-def installCheckKernelUpdater():
+def installCheckKernelUpdater(target=None):
     import shutil
-    from subprocess import Popen, PIPE, STDOUT
-    shutil.copy("/tmp/kernelCheckUpdate.sh", "/opt/ltsp/armhf/etc/init.d/kernelCheckUpdate.sh")
-    Popen(['ltsp-chroot', '--arch', 'armhf', 'chmod', '755', '/etc/init.d/kernelCheckUpdate.sh'], stdout=PIPE, stderr=PIPE, stdin=PIPE)
-    process = Popen(['ltsp-chroot', '--arch', 'armhf', 'update-rc.d', 'kernelCheckUpdate.sh', 'defaults'], stdout=PIPE, stderr=PIPE, stdin=PIPE)
-    process.communicate()
+    import pinetUpdates
+    if target is None:
+        target = chrootTargets("default")[0]
+    shutil.copy(pinetUpdates.KERNEL_UPDATER_FILEPATH, target.file("/etc/init.d/kernelCheckUpdate.sh"))
+    result = runCommand(target.command('chmod', '755', '/etc/init.d/kernelCheckUpdate.sh'), inputText="", timeout=NETWORK_TIMEOUT, logPath=COMMAND_LOG_FILEPATH)
+    if not result.ok:
+        return result
+    return runCommand(target.command('update-rc.d', 'kernelCheckUpdate.sh', 'defaults'), inputText="", timeout=NETWORK_TIMEOUT, logPath=COMMAND_LOG_FILEPATH)
 
 #def importUsers():
 
-def displayChangeLog(version):
+def displayChangeLog(version, commits):
+    """
+    Shows the commit messages since version, from the commits cached by the last update check.
+    """
     version = "Release " + version
-    import feedparser
-    import xml.etree.ElementTree
-    d = feedparser.parse(Repository +'/commits/' +ReleaseBranch + '.atom')
     releases = []
-    for x in range(0, len(d.entries)):
-        data = (d.entries[x].content[0].get('value'))
-        data = ''.join(xml.etree.ElementTree.fromstring(data).itertext())
-        data = data.split("\n")
-        thisVersion = "Release " + GetVersionNum(data)
+    for x in range(0, len(commits)):
+        data = commits[x]
+        thisVersion = "Release " + str(GetVersionNum(data))
         #thisVersion = data[0].rstrip()
         if thisVersion == version:
             break
@@ -785,8 +894,7 @@ def displayChangeLog(version):
     for i in range(0, len(output)):
         thing = thing + output[i] + "\n"
     cmd = ["whiptail", "--title", _("Release history (Use arrow keys to scroll)") + " - " + version, "--scrolltext", "--"+"yesno", "--yes-button", _("Install ") + output[0], "--no-button", _("Cancel"), thing, "24", "78"]
-    p = Popen(cmd,  stderr=PIPE)
-    out, err = p.communicate()
+    p = runCommand(cmd, interactive=True)
     if p.returncode == 0:
         updatePiNet()
         returnData(1)
@@ -797,15 +905,15 @@ def displayChangeLog(version):
     else:
         return "ERROR"
 
-def previousImport():
+def previousImport(migDirectory="/root/move", etcDirectory="/etc"):
     items = ["passwd", "group", "shadow", "gshadow"]
     #items = ["group",]
     toAdd = []
     for x in range(0, len(items)):
         #migLoc = "/Users/Andrew/Documents/Code/pinetImportTest/" + items[x] + ".mig"
         #etcLoc = "/Users/Andrew/Documents/Code/pinetImportTest/" + items[x]
-        migLoc = "/root/move/" + items[x] + ".mig"
-        etcLoc = "/etc/" + items[x]
+        migLoc = os.path.join(migDirectory, items[x] + ".mig")
+        etcLoc = os.path.join(etcDirectory, items[x])
         debug("mig loc " + migLoc)
         debug("etc loc " + etcLoc)
         mig = getList(migLoc)
@@ -834,11 +942,15 @@ def previousImport():
         debug(etc)
         writeTextFile(etc, etcLoc)
 
-def importFromCSV(theFile, defaultPassword, test = True):
+def importFromCSV(theFile, defaultPassword, test = True, dryRun = False):
+    """
+    Imports users from a CSV file of username,password rows. Blank passwords are replaced with defaultPassword.
+    With dryRun, the file is only parsed and the list of [username, password] pairs is returned.
+    """
     import csv
     import os
     from sys import exit
-    import crypt
+    import pinetPasswords
     userData=[]
     if test == "True" or True:
         test = True
@@ -866,21 +978,21 @@ def importFromCSV(theFile, defaultPassword, test = True):
                 else:
                     password=defaultPassword
                 userData.append([user, password])
+            if dryRun:
+                return userData
             if test:
                 thing = ""
                 for i in range(0, len(userData)):
                     thing = thing + _("Username") + " - " + userData[i][0] + " : " + _("Password - ") + userData[i][1] + "\n"
                 cmd = ["whiptail", "--title", _("About to import (Use arrow keys to scroll)") ,"--scrolltext", "--"+"yesno", "--yes-button", _("Import") , "--no-button", _("Cancel"), thing, "24", "78"]
-                p = Popen(cmd,  stderr=PIPE)
-                out, err = p.communicate()
+                p = runCommand(cmd, interactive=True)
                 if p.returncode == 0:
+                    hashes = pinetPasswords.hashAll([password for user, password in userData])
                     for x in range(0, len(userData)):
                         user = userData[x][0]
-                        password = userData[x][1]
-                        encPass = crypt.crypt(password,"22")
+                        encPass = hashes[x]
                         cmd = ["useradd", "-m", "-s", "/bin/bash", "-p", encPass, user]
-                        p = Popen(cmd,  stderr=PIPE)
-                        out, err = p.communicate()
+                        runCommand(cmd, logPath=COMMAND_LOG_FILEPATH)
                         fixGroupSingle(user)
                         print("Import of " + user + " complete.")
                     whiptailBox("msgbox", _("Complete"), _("Importing of CSV data has been complete."), False)
@@ -889,12 +1001,251 @@ def importFromCSV(theFile, defaultPassword, test = True):
     else:
         print(_("Error! CSV file not found at") + " " + theFile)
 
+def addUser(username, password):
+    """
+    Creates a user with a home folder and a SHA-512 crypt password. The hash is written straight to /etc/shadow (see
+    pinetPasswords.py), so it is never passed back to bash or put on useradd's command line. Passes back 0 if it worked.
+    """
+    import pinetPasswords
+    returncode = runBash(["useradd", "-m", "-s", "/bin/bash", username])
+    if returncode == 0:
+        try:
+            if pinetPasswords.updateShadow({username: pinetPasswords.hashPassword(password)}):
+                returncode = 1
+        except (OSError, RuntimeError) as error:  #The shadow lock timed out, for example
+            print(str(error))
+            returncode = 1
+        if returncode != 0:
+            print(_("The account") + " " + username + " " + _("was created but has no password. Set one with Change-password"))
+    returnData(returncode)
+    return returncode
+
+def selectUsers(kind, value):
+    """
+    The users in a group (kind "group", leaving out the admin running PiNet), created in a year or month ("cohort",
+    for example 2015 or 2015-09), a comma separated list ("users") or a CSV file of username[,password] rows ("csv",
+    giving (username, password) pairs). Prints why and returns None if they can't be found.
+    """
+    import pinetPasswords
+    admin = os.environ.get("SUDO_USER", "")
+    if kind == "group":
+        try:
+            return [user for user in pinetPasswords.groupMembers(value, getPasswdEntries()) if user != admin]
+        except KeyError:
+            print(_("No group called") + " " + value)
+            return None
+    elif kind == "cohort":
+        import pinetRetire
+        return [user for user in pinetRetire.cohortMembers(value, getPasswdEntries()) if user != admin]
+    elif kind == "users":
+        return [user for user in value.split(",") if user]
+    elif kind == "csv":
+        try:
+            return pinetPasswords.readCSV(value)
+        except (OSError, IOError):
+            print(_("Error! CSV file not found at") + " " + value)
+            return None
+    print(_("Unknown kind of user list") + " " + kind)
+    return None
+
+def passwordReset(kind, value, password="", dryRun="False", slipPath=""):
+    """
+    Resets the passwords of everyone picked by kind and value (see selectUsers) in one go. Blank passwords are
+    replaced with password, or generated. Only normal users (with homes in /home) are changed.
+    Passes back the number of users that would change for a dry run, otherwise the path of the slip file.
+    """
+    import time
+    import pinetPasswords
+    admin = os.environ.get("SUDO_USER", "")
+    normalUsers = getUsers()
+    users = selectUsers(kind, value)
+    if users is None:
+        returnData("Error")
+        return
+    pairs = pinetPasswords.assignPasswords(users, password)
+    skipped = [user for user, newPassword in pairs if user.lower() not in normalUsers]
+    pairs = [(user, newPassword) for user, newPassword in pairs if user.lower() in normalUsers]
+    if skipped:
+        print(_("Not changed (not normal users)") + ": " + ", ".join(skipped))
+    changed, missing = pinetPasswords.resetPasswords(pairs, dryRun=dryRun == "True")
+    if dryRun == "True":
+        print(_("Passwords to reset") + ": " + ", ".join(changed))
+        returnData(len(changed))
+        return len(changed)
+    if missing:
+        print(_("Not in the shadow file") + ": " + ", ".join(missing))
+    if not slipPath:
+        folder = "/root"
+        if admin:
+            folder = "/home/" + admin
+        slipPath = os.path.join(folder, "pinet-passwords-" + time.strftime("%Y-%m-%d-%H%M") + ".txt")
+    title = ""
+    if kind == "group":
+        title = value
+    pinetPasswords.writeSlips([pair for pair in pairs if pair[0] in changed], slipPath, title)
+    if admin:
+        import pwd
+        entry = pwd.getpwnam(admin)
+        os.chown(slipPath, entry.pw_uid, entry.pw_gid)
+    print(str(len(changed)) + " " + _("passwords reset, slips written to") + " " + slipPath)
+    returnData(slipPath)
+    return slipPath
+
+def retireUsers(kind, value, dryRun="False"):
+    """
+    Removes the accounts of everyone picked by kind and value (see selectUsers), for example a leaving year group.
+    Only normal users are removed. The accounts go straight away and their home folders are archived in the
+    background (see pinetRetire.py). Passes back the number of users for a dry run, otherwise the batch name, or
+    Error if an account or home folder couldn't be dealt with (printed, with what was done).
+    """
+    import pinetRetire
+    users = selectUsers(kind, value)
+    if users is None:
+        returnData("Error")
+        return
+    normalUsers = getUsers()
+    admin = os.environ.get("SUDO_USER", "")
+    names = []
+    for user in users:
+        if isinstance(user, tuple):
+            user = user[0]
+        if user.lower() in normalUsers and user != admin:
+            names.append(user)
+        else:
+            print(_("Not removed (not a normal user)") + ": " + user)
+    if dryRun == "True" or not names:
+        print(_("Users to remove") + ": " + ", ".join(names))
+        returnData(len(names))
+        return len(names)
+    try:
+        manifest = pinetRetire.retireUsers(names)
+    except (OSError, RuntimeError) as error:  #The account files were locked, for example. Nothing was changed
+        print(_("No users were removed") + ": " + str(error))
+        returnData("Error")
+        return None
+    status = pinetRetire.batchStatus(manifest)
+    print(str(len(manifest["users"])) + " " + _("users removed") + ", " + str(status.get("staged", 0)) + " " + _("home folders will be archived to") + " " + pinetRetire.batchFolder(manifest["batch"]))
+    failed = False
+    for user in names:
+        if user not in manifest["users"]:
+            print(_("Account not removed") + ": " + user)
+            failed = True
+        elif manifest["users"][user]["state"] == "failed":
+            print(user + ": " + manifest["users"][user]["error"])
+            failed = True
+    if status.get("staged", 0):
+        pinetRetire.startBackgroundArchive([sys.executable, os.path.abspath(__file__), "retireArchive", manifest["batch"]])
+    if failed:
+        returnData("Error")
+        return None
+    returnData(manifest["batch"])
+    return manifest["batch"]
+
+def retireArchive(batch):
+    """
+    Archives and deletes the home folders of a batch of removed users. Started in the background by retireUsers.
+    """
+    import pinetRetire
+    pinetRetire.archiveBatch(batch)
+
+def retireStatus(batch=""):
+    """
+    Prints how the archiving of a batch of removed users is going, or lists the batches.
+    """
+    import pinetRetire
+    if not batch:
+        for name in pinetRetire.listBatches():
+            status = pinetRetire.batchStatus(pinetRetire.loadManifest(name))
+            print(name + "  " + ", ".join("%s %d" % (state, status[state]) for state in sorted(status)))
+        return
+    manifest = pinetRetire.loadManifest(batch)
+    for user in sorted(manifest["users"]):
+        record = manifest["users"][user]
+        print("%-20s %-10s %s" % (user, record["state"], record["error"] or record["archive"]))
+    returnData(pinetRetire.batchStatus(manifest).get("staged", 0))
+
+def retireRestore(batch, user):
+    """
+    Brings back a user removed in batch, with their home folder.
+    """
+    import pinetRetire
+    try:
+        home = pinetRetire.restoreUser(batch, user)
+    except (ValueError, RuntimeError) as error:
+        print(str(error))
+        returnData("Error")
+        return
+    print(user + " " + _("restored to") + " " + home)
+    returnData(home)
+
 def fixGroupSingle(username):
     groups = ["adm", "dialout", "cdrom", "audio", "users", "video", "games", "plugdev", "input", "pupil"]
     for x in range(0, len(groups)):
         cmd = ["usermod", "-a", "-G", groups[x], username]
-        p = Popen(cmd,  stderr=PIPE)
-        out, err = p.communicate()
+        runCommand(cmd, logPath=COMMAND_LOG_FILEPATH)
+
+def copyIntoHome(source, target, isFolder, delete):
+    """
+    One user's copy for copyToUsers. A symlink at target is removed with delete, otherwise the user is skipped, so it
+    is never followed. Returns True if it copied.
+    """
+    import shutil
+    if delete:
+        if os.path.islink(target) or os.path.isfile(target):
+            os.remove(target)
+        else:
+            removeFile(target)
+    makeFolder(os.path.dirname(target))
+    if isFolder:
+        if os.path.isdir(target) and not os.path.islink(target):
+            target = os.path.join(target, os.path.basename(source.rstrip("/")))
+        if os.path.islink(target):
+            return False
+        shutil.copytree(source, target, symlinks=True, dirs_exist_ok=True)
+    else:
+        if os.path.isdir(target) and not os.path.islink(target):
+            target = os.path.join(target, os.path.basename(source))
+        if os.path.islink(target):
+            return False
+        shutil.copyfile(source, target)
+    return True
+
+def copyToUsers(source, destination, skel=False, delete=True, homeRoot="/home", passwdFile=None, chown=True):
+    """
+    Copies a file or folder into every user's home folder at destination (relative to the home folder), optionally deleting
+    whatever is already there first. With chown, each copy is made as the user (see pinetFiles.runAs), so it is theirs
+    and a symlink in their home folder can't be used to write anywhere they couldn't. With skel, a copy is also added
+    to /etc/skel for new users. Python version of CopyToUsers in the main pinet script. Returns the number of users
+    copied to.
+    """
+    import shutil
+    import pinetFiles
+    users = getUsers(passwdFile=passwdFile)
+    isFolder = os.path.isdir(source)
+    copied = 0
+    for user in users:
+        target = os.path.join(homeRoot, user, destination)
+        try:
+            if chown and os.geteuid() == 0:
+                done = pinetFiles.runAs(user, copyIntoHome, source, target, isFolder, delete)
+            else:
+                done = copyIntoHome(source, target, isFolder, delete)
+        except (OSError, shutil.Error) as error:
+            print(_("Couldn't copy to") + " " + user + ": " + str(error))
+            continue
+        if done:
+            copied = copied + 1
+        else:
+            print(_("Skipped") + " " + user + ": " + target + " " + _("is a link"))
+    if skel:
+        target = os.path.join("/etc/skel", destination)
+        makeFolder(os.path.dirname(target))
+        if isFolder:
+            removeFile(target)
+            shutil.copytree(source, target, symlinks=True)
+        else:
+            shutil.copy(source, target)
+    return copied
 
 def checkIfFileContains(file, string):
     """
@@ -945,37 +1296,27 @@ def installEpoptes():
     Install Epoptes classroom management software. Key is making sure groups are correct.
     :return:
     """
-    runBash("apt-get install -y epoptes")
-    runBash("gpasswd -a root staff")
-    runBash("ltsp-chroot --arch armhf apt-get install -y epoptes-client --no-install-recommends")
-    runBash("ltsp-chroot --arch armhf epoptes-client -c")
+    #The server and the Raspbian chroot have separate package databases, so both installs can run at once
+    runBatch([("server", ["apt-get", "install", "-y", "epoptes"]),
+              ("raspbian", chrootTargets("default")[0].command("apt-get", "install", "-y", "epoptes-client", "--no-install-recommends"))],
+             timeout=APT_TIMEOUT, echo=True, logPath=COMMAND_LOG_FILEPATH)
+    runBash(["gpasswd", "-a", "root", "staff"])
+    ltspChroot(["epoptes-client", "-c"], timeout=NETWORK_TIMEOUT)
     replaceLineOrAdd("/etc/default/epoptes", "SOCKET_GROUP", "SOCKET_GROUP=teacher")
 
 def installScratchGPIO():
     """
-    ScratchGPIO installation process. Includes creating the desktop icon in all users and /etc/skel
+    ScratchGPIO installation process. Includes creating the desktop icon in /etc/skel, existing users are given it when they next log in
     """
+    import pinetProvision
     removeFile("/tmp/isgh7.sh")
-    removeFile("/opt/ltsp/armhf/usr/local/bin/isgh5.sh")
-    removeFile("/opt/ltsp/armhf/usr/local/bin/scratchSudo.sh")
-    removeFile("/opt/ltsp/armhf/usr/local/bin/isgh7.sh")
     downloadFile("http://bit.ly/1wxrqdp", "/tmp/isgh7.sh")
-    copyFile("/tmp/isgh7.sh", "/opt/ltsp/armhf/usr/local/bin/isgh7.sh")
-    replaceLineOrAdd("/opt/ltsp/armhf/usr/local/bin/scratchSudo.sh", "bash /usr/local/bin/isgh7.sh $SUDO_USER", "bash /usr/local/bin/isgh7.sh $SUDO_USER")
-    users = getUsers()
-    for u in users:
-        createTextFile("/home/" + u + "/Desktop/Install-scratchGPIO.desktop", """
-        [Desktop Entry]
-        Version=1.0
-        Name=Install ScratchGPIO
-        Comment=Install ScratchGPIO
-        Exec=sudo bash /usr/local/bin/scratchSudo.sh
-        Icon=scratch
-        Terminal=true
-        Type=Application
-        Categories=Utility;Application;
-        """)
-        os.chown("/home/" + u + "/Desktop/Install-scratchGPIO.desktop", pwd.getpwnam(u).pw_uid, grp.getgrnam(u).gr_gid)
+    for target in chrootTargets():
+        removeFile(target.file("/usr/local/bin/isgh5.sh"))
+        removeFile(target.file("/usr/local/bin/scratchSudo.sh"))
+        removeFile(target.file("/usr/local/bin/isgh7.sh"))
+        copyFile("/tmp/isgh7.sh", target.file("/usr/local/bin/isgh7.sh"))
+        replaceLineOrAdd(target.file("/usr/local/bin/scratchSudo.sh"), "bash /usr/local/bin/isgh7.sh $SUDO_USER", "bash /usr/local/bin/isgh7.sh $SUDO_USER")
     makeFolder("/etc/skel/Desktop")
     createTextFile("/etc/skel/Desktop/Install-scratchGPIO.desktop",
     """[Desktop Entry]
@@ -987,6 +1328,7 @@ def installScratchGPIO():
     Terminal=true
     Type=Application
     Categories=Utility;Application;""")
+    pinetProvision.addItem("scratchGPIO", "/etc/skel/Desktop/Install-scratchGPIO.desktop", "Desktop/Install-scratchGPIO.desktop")
 
 
 def installSoftwareList(holdOffInstall = False):
@@ -995,6 +1337,8 @@ def installSoftwareList(holdOffInstall = False):
     Builds a list of possible software to install (using softwarePackage class) then displays the list using checkbox Whiptail menu.
     Checks what options the user has collected, then saves the packages list to file (using pickle). If holdOffInstall is False, then runs installSoftwareFromFile().
     """
+    import shutil
+    import time
     software = []
     software.append(softwarePackage("Libreoffice", _("A free office suite, similar to Microsoft office"), "script", ["apt-get purge -y openjdk-6-jre-headless openjdk-7-jre-headless ca-certificates-java", "apt-get install -y libreoffice gcj-4.7-jre gcj-jre gcj-jre-headless libgcj13-awt"]))
     software.append(softwarePackage("Arduino-IDE", _("Programming environment for Arduino microcontrollers"), "apt", ["arduino",]))
@@ -1015,9 +1359,7 @@ def installSoftwareList(holdOffInstall = False):
     while done == False:
         whiptailBox("msgbox", _("Additional Software"), _("In the next window you can select additional software you wish to install. Use space bar to select applications and hit enter when you are finished."), False)
         result = (whiptailCheckList(_("Extra Software Submenu"), _("Select any software you want to install. Use space bar to select then enter to continue."), softwareList))
-        try:
-            result = result.decode("utf-8")
-        except AttributeError:
+        if result == "Cancel":
             return
         result = result.replace('"', '')
         if result != "Cancel":
@@ -1040,26 +1382,46 @@ def installSoftwareList(holdOffInstall = False):
     if holdOffInstall == False:
         installSoftwareFromFile()
 
-def installSoftwareFromFile(packages = None):
+def installSoftwareFromFile(packages = None, fresh=False):
     """
     Second part of installSoftwareList().
     Loads the pickle encoded list of softwarePackage objects then if they are marked to be installed, installs then.
+    fresh is for the full install, where the chroot is brand new: no snapshot is taken and the NBD image is left for
+    EnableNBD to build once every other step has finished with the chroot.
     """
-    needCompress = False
+    import pinetChroots
     if packages == None:
         packages = loadPickled()
+    marked = [i for i in packages if i.marked == True]
     for i in packages:
         if i.marked == True:
             print(_("Installing") + " " + str(i.name))
-            if needCompress == False:
-                ltspChroot("apt-get update")
-            i.installPackage()
-            i.marked = False
-            setConfigParameter("NBDBuildNeeded", "true")
-            needCompress = True
         else:
             debug("Not installing " + str(i.name))
-    if needCompress:
+    if not marked:
+        return
+    if not fresh:
+        snapshotBeforeChange(_("Before installing") + " " + ", ".join(i.name for i in marked))
+    def installAll(target):
+        ltspChroot(["apt-get", "update"], timeout=APT_UPDATE_TIMEOUT, retry=retryPolicy(3), target=target)
+        failed = [i.name for i in marked if i.installPackage(target) not in (None, 0)]
+        if failed:
+            raise RuntimeError(_("failed to install") + " " + ", ".join(failed))
+        return True
+    targets = chrootTargets()
+    if len(targets) == 1:
+        try:
+            installAll(None)
+        except RuntimeError as error:
+            print(str(error))
+    else:
+        report = pinetChroots.fanOut(targets, installAll)
+        for line in report.summary():
+            print(line)
+    for i in marked:
+        i.marked = False
+    setConfigParameter("NBDBuildNeeded", "true")
+    if not fresh:
         nbdRun()
 
 
@@ -1074,67 +1436,229 @@ def nbdRun():
             print("--------------------------------------------------------")
             print(_("Compressing the image, this will take roughly 5 minutes"))
             print("--------------------------------------------------------")
-            runBash("ltsp-update-image /opt/ltsp/armhf")
-            setConfigParameter("NBDBuildNeeded", "false")
+            if chrootRebuild():
+                setConfigParameter("NBDBuildNeeded", "false")
         else:
             whiptailBox("msgbox", _("WARNING"), _("Auto NBD compressing is disabled, for your changes to push to the Raspberry Pis, run NBD-recompress from main menu."), False)
 
-def generateServerID():
+def chrootRebuild(names="all"):
     """
-    Generates random server ID for use with stats system.
+    Rebuilds the NBD image of every chosen chroot that uses NBD, a couple at a time, and reports how long each took.
     """
-    ID = random.randint(10000000000,99999999999)
-    setConfigParameter("ServerID", str(ID))
+    import pinetChroots
+    targets = [target for target in chrootTargets(names) if target.nbd]
+    if len(targets) == 1:
+        ok = rebuildTarget(targets[0])
+    else:
+        report = pinetChroots.fanOut(targets, lambda target: rebuildTarget(target, target.name))
+        for line in report.summary():
+            print(line)
+        ok = report.ok
+    if ok:
+        returnData(0)
+    else:
+        returnData(1)
+    return ok
 
-def getIPAddress():
+def rebuildTarget(target, name="", squash=False):
     """
-    Get the PiNet server external IP address using the dnsdynamic.org IP address checker.
-    If there is any issues, defaults to returning 0.0.0.0.
+    Rebuilds one chroot's NBD image. With ImageLayers=true in /etc/pinet only what changed since the base image is
+    squashed, into a delta image (see pinetLayers.py). Returns True if it worked.
     """
+    import pinetLayers
+    import pinetUsage
+    if getConfigParameter("/etc/pinet", "ImageLayers=") != "true":
+        return runBash(target.rebuildCommand(), name=name) == 0
     try:
-        import urllib.request
-        import socket
-        with urllib.request.urlopen("http://myip.dnsdynamic.org/") as url:
-            IP = url.read().decode()
-            socket.inet_aton(IP)
-    except:
-        IP = "0.0.0.0"
-    return IP
+        if pinetLayers.unpatched(target):  #New boot files, so clients would only mount the old base
+            pinetLayers.enable(target)
+            print(target.name + ": " + _("boot files were replaced, adding the client script again and squashing the whole image"))
+            squash = True
+        build = pinetLayers.rebuild(target, squash=squash, logPath=COMMAND_LOG_FILEPATH)
+    except (OSError, RuntimeError) as error:
+        print(_("Image build failed") + ": " + str(error))
+        return False
+    print(pinetLayers.formatBuild(target.name, build, pinetUsage.formatSize))
+    return True
+
+def chrootInstall(names, packages):
+    """
+    Installs apt packages into the chosen chroots at the same time.
+    """
+    import pinetChroots
+    def install(target):
+        ltspChroot(["apt-get", "update"], timeout=APT_UPDATE_TIMEOUT, retry=retryPolicy(3), target=target)
+        return ltspChroot(["apt-get", "install", "-y"] + list(packages), timeout=APT_TIMEOUT, target=target)
+    report = pinetChroots.fanOut(chrootTargets(names), install)
+    for line in report.summary():
+        print(line)
+    if report.ok:
+        setConfigParameter("NBDBuildNeeded", "true")
+        returnData(0)
+    else:
+        returnData(1)
+    return report.ok
 
+def chrootList():
+    for target in chrootTargets():
+        nbd = "NFS"
+        if target.nbd:
+            nbd = "NBD"
+        print("%-20s %-8s %-4s %s" % (target.name, target.arch, nbd, target.path))
 
-def sendStats():
+def chrootAdd(name, arch="armhf", path="", nbd="true"):
     """
-    Upload anonymous stats to the secure PiNet server (over encrypted SSL).
+    Registers an extra chroot (built separately, for example with ltsp-build-client) so PiNet looks after it too.
     """
-    DisableMetrics = str(getConfigParameter("/etc/pinet", "DisableMetrics="))
-    ServerID = str(getConfigParameter("/etc/pinet", "ServerID="))
-    if ServerID == "None":
-        generateServerID()
-        ServerID = str(getConfigParameter("/etc/pinet", "ServerID="))
-    if DisableMetrics.lower() == "true":
-        PiNetVersion="0.0.0"
-        Users="0"
-        KernelVersion = "000"
-        ReleaseChannel = "0"
-        City = "Blank"
-        OrganisationType = "Blank"
-        OrganisationName = "Blank"
+    import pinetChroots
+    pinetChroots.addTarget(pinetChroots.chrootTarget(name, arch, path or None, nbd == "true"))
+
+def chrootRemove(name):
+    import pinetChroots
+    try:
+        pinetChroots.removeTarget(name)
+    except ValueError as error:
+        print(str(error))
+        returnData(1)
+        return
+    returnData(0)
+
+def snapshotBeforeChange(reason, targets=None):
+    """
+    Snapshots the chroots about to be changed, so a broken install can be rolled back (see pinetSnapshots.py), and
+    prunes old snapshots. Turned off with ChrootSnapshots=false in /etc/pinet. A snapshot failing never stops the change.
+    """
+    import pinetSnapshots
+    if getConfigParameter("/etc/pinet", "ChrootSnapshots=") == "false":
+        return
+    if targets is None:
+        targets = chrootTargets()
+    for target in targets:
+        try:
+            taken = pinetSnapshots.takeSnapshot(target.path, reason, target.name, logPath=COMMAND_LOG_FILEPATH)
+            pinetSnapshots.pruneSnapshots(target.path, targetName=target.name)
+        except (RuntimeError, OSError) as error:
+            print(_("WARNING - No snapshot of") + " " + target.name + ": " + str(error))
+            continue
+        print(_("Snapshot of") + " " + target.name + " " + _("taken in") + " " + "%.1fs (%s)" % (taken.duration, taken.method))
+
+def chrootSnapshot(names="default", reason=""):
+    snapshotBeforeChange(reason or _("Taken by hand"), chrootTargets(names))
+
+def chrootSnapshots(names="all"):
+    """
+    Lists the snapshots of the chosen chroots, with how each was made and how long it took.
+    """
+    import pinetSnapshots
+    for target in chrootTargets(names):
+        print(target.name)
+        for item in reversed(pinetSnapshots.listSnapshots(target.path, target.name)):
+            print("    " + item.summary())
+
+def chrootSnapshotPrune(names="all", keep="3"):
+    import pinetSnapshots
+    for target in chrootTargets(names):
+        for name in pinetSnapshots.pruneSnapshots(target.path, int(keep), target.name):
+            print(_("Deleted snapshot") + " " + target.name + " " + name)
+
+def chrootRollback(name, snapshotName):
+    """
+    Swaps a chroot back to one of its snapshots. The chroot as it was is kept as a snapshot too.
+    Passes 0 back to bash if it worked, when the image needs rebuilding, or 1 if not.
+    """
+    import pinetSnapshots
+    target = chrootTargets(name)[0]
+    try:
+        pinetSnapshots.rollback(target.path, snapshotName, target.name)
+    except (ValueError, RuntimeError, OSError) as error:
+        print(str(error))
+        returnData(1)
+        return False
+    setConfigParameter("NBDBuildNeeded", "true")
+    print(target.name + " " + _("rolled back to") + " " + snapshotName)
+    returnData(0)
+    return True
+
+def chrootRollbackMenu(name="default"):
+    """
+    Asks which snapshot to roll the chroot back to.
+    """
+    import pinetSnapshots
+    target = chrootTargets(name)[0]
+    snapshots = list(reversed(pinetSnapshots.listSnapshots(target.path, target.name)))
+    if not snapshots:
+        whiptailBox("msgbox", _("No snapshots"), _("There are no snapshots of the Raspbian image yet. One is taken before each software install or update."), False)
+        returnData(1)
+        return
+    items = [item.name + "  " + item.reason for item in snapshots]
+    choice = whiptailSelectMenu(_("Roll back"), _("Pick the snapshot to roll the Raspbian image back to"), items)
+    if choice == "Cancel":
+        returnData(1)
+        return
+    snapshotName = choice.split()[0]
+    if whiptailBox("yesno", _("Are you sure?"), _("Are you sure you want to roll the Raspbian image back to") + " " + snapshotName + "?", True):
+        chrootRollback(target.name, snapshotName)
     else:
-        PiNetVersion = str(getConfigParameter("/usr/local/bin/pinet", "version="))
-        Users = str(len(getUsers()))
-        if os.path.exists("/home/"+os.environ['SUDO_USER']+"/PiBoot/version.txt"):
-            KernelVersion = str(getCleanList("/home/"+os.environ['SUDO_USER']+"/PiBoot/version.txt")[0])
-        else:
-            KernelVersion = "000"
-        City = str(getConfigParameter("/etc/pinet", "City="))
-        OrganisationType = str(getConfigParameter("/etc/pinet", "OrganisationType="))
-        OrganisationName = str(getConfigParameter("/etc/pinet", "OrganisationName="))
-        ReleaseChannel = str(getConfigParameter("/etc/pinet", "ReleaseChannel="))
+        returnData(1)
+
+def generateServerID():
+    """
+    Generates random server ID for use with stats system.
+    """
+    import random
+    ID = random.randint(10000000000,99999999999)
+    setConfigParameter("ServerID", str(ID))
+
+def readConfigFile(filep=PINET_CONF_FILEPATH):
+    """
+    Reads every Option=Value line of the config file at once into configFileData.
+    """
+    global configFileData
+    configFileData = {}
+    if os.path.isfile(filep):
+        for line in getCleanList(filep):
+            if "=" in line:
+                option, value = line.split("=", 1)
+                configFileData[option] = value
+    return configFileData
 
-    IPAddress = getIPAddress()
+def statsFields():
+    config = readConfigFile()
+    if config.get("ServerID", "") == "":
+        generateServerID()
+        config = readConfigFile()
+    fields = {"ServerID": config.get("ServerID", "None")}
+    if config.get("DisableMetrics", "").lower() == "true":
+        fields.update({"PiNetVersion": "0.0.0", "Users": "0", "KernelVersion": "000", "ReleaseChannel": "0",
+                       "City": "Blank", "OrganisationType": "Blank", "OrganisationName": "Blank"})
+        return fields
+    versionPath = "/home/" + os.environ.get('SUDO_USER', "") + "/PiBoot/version.txt"
+    if os.environ.get('SUDO_USER') and os.path.exists(versionPath):
+        fields["KernelVersion"] = str(getCleanList(versionPath)[0])
+    else:
+        fields["KernelVersion"] = "000"
+    fields["PiNetVersion"] = str(getConfigParameter("/usr/local/bin/pinet", "version="))
+    fields["Users"] = str(len(getUsers()))
+    for option in ["City", "OrganisationType", "OrganisationName", "ReleaseChannel"]:
+        fields[option] = config.get(option, "None")
+    return fields
+
+def sendStats(flushTimeout=None):
+    """
+    Queues anonymous stats for the secure PiNet server (sent over encrypted SSL).
+    Queuing never waits for the network. The queue is then sent by a flusher in the background, or straight away
+    (within flushTimeout seconds) when already running in the background as part of the update check.
+    """
+    import pinetStats
+    pinetStats.enqueue(statsFields())
+    if flushTimeout is None:
+        pinetStats.startBackgroundFlush([sys.executable, os.path.abspath(__file__), "flushStats"])
+    else:
+        pinetStats.flush(timeout=flushTimeout)
 
-    command = 'curl --connect-timeout 2 --data "ServerID='+ ServerID + "&" + "PiNetVersion=" + PiNetVersion +  "&" + "Users=" + Users + "&" +  "KernelVersion=" + KernelVersion +  "&" +  "ReleaseChannel=" + ReleaseChannel + "&" + "IPAddress=" + IPAddress + "&" + "City=" + City + "&" + "OrganisationType=" + OrganisationType + "&" + "OrganisationName=" + OrganisationName + '"  https://secure.pinet.org.uk/pinetstatsv1.php -s -o /dev/null 2>&1'
-    runBash(command)
+def flushStats():
+    import pinetStats
+    pinetStats.flush()
 
 def checkStatsNotification():
     """
@@ -1158,9 +1682,7 @@ def askExtraStatsInfo():
     organisationType = whiptailSelectMenu(_("Organisation type"), _("What type of organisation are you setting PiNet up for? Leave on blank if you don't want to answer."), ["Blank", "School", "Non Commercial Organisation", "Commercial Organisation", "Raspberry Jam/Club", "N/A"])
     organisationName = whiptailBox("inputbox", _("School/organisation name"), _("What is the name of your organisation? Leave blank if you don't want to answer."), False, returnErr = True)
     whiptailBox("msgbox", _("Additional information"), _('Thanks for taking the time to read through (and if possible fill in) additional information. If you ever want to edit your information supplied, you can do so by selecting the "Other" menu and selecting "Edit-Information".'), False, height="11")
-    try:
-        organisationType = organisationType.decode("utf-8")
-    except:
+    if organisationType == "Cancel":
         organisationType = "Blank"
     if city == "":
         city = "Blank"
@@ -1177,49 +1699,956 @@ def askExtraStatsInfo():
     sendStats()
 
 
+#---------------- Shared folders -------------------
+
+def askSharedFolderLevel(name):
+    """
+    Asks whether pupils can write to a shared folder and records the answer in the shared folder registry.
+    """
+    import pinetShared
+    readOnly = whiptailBoxYesNo(_("Pupil write access"), _("Should") + " " + name + " " + _("be Read/Write access for students or read only?"), True, customYes=_("Read"), customNo=_("Read/Write"))
+    if readOnly is True:
+        return pinetShared.setFolder(name, "read", defaultBackend=sharedFolderBackend())
+    else:
+        return pinetShared.setFolder(name, "write", defaultBackend=sharedFolderBackend())
+
+def sharedFolderBackend():
+    """
+    The backend new shared folders use, bindfs unless SharedFolderBackend=acl is set in /etc/pinet.
+    """
+    if getConfigParameter(PINET_CONF_FILEPATH, "SharedFolderBackend=") == "acl":
+        return "acl"
+    return "bindfs"
+
+def sharedFolderReconcile():
+    """
+    Mounts, unmounts or remounts only the shared folders that do not match the registry.
+    Used by the bindfs-mount service at boot and after every change to the registry.
+    """
+    import pinetShared
+    plan = pinetShared.reconcile(logPath=COMMAND_LOG_FILEPATH)
+    for line in plan.summary():
+        print(line)
+    if plan.ok:
+        returnData(0)
+    else:
+        returnData(1)
+    return plan.ok
+
+def sharedFolderCheck():
+    """
+    Replacement for the bindfs line counting in CheckSharedFolderIntegrity.
+    Imports the old bindfs-mount script if there is one, then only asks about folders that have no registry entry at all.
+    Returns (and passes back to bash) the number of folders that had to be asked about.
+    """
+    import pinetShared
+    pinetShared.migrateLegacyScript()
+    unknown = pinetShared.unknownFolders()
+    if unknown:
+        whiptailBox("msgbox", _("WARNING!!"), _("Warning - Some of your shared folders have no permission level set. This may be because you imported shared folders from a previous system. You must select the correct permission level for these folders now.") + "\n\n" + ", ".join(unknown), False, height="12")
+        for name in unknown:
+            askSharedFolderLevel(name)
+            os.chown(os.path.join(pinetShared.SHARED_ROOT, name), -1, 0)
+    sharedFolderReconcile()
+    returnData(len(unknown))
+    return len(unknown)
+
+def sharedFolderSet(name, level):
+    import pinetShared
+    pinetShared.setFolder(name, level, defaultBackend=sharedFolderBackend())
+    return sharedFolderReconcile()
+
+def sharedFolderRemove(name):
+    import pinetShared
+    pinetShared.removeFolder(name)
+    return sharedFolderReconcile()
+
+def sharedFolderUnmountAll():
+    import pinetShared
+    batch = pinetShared.unmountAll(logPath=COMMAND_LOG_FILEPATH)
+    if batch.ok:
+        returnData(0)
+    else:
+        returnData(1)
+
+def sharedFolderMigrate(backend="acl", name=""):
+    """
+    Moves every shared folder (or just name) to the acl or bindfs backend, unmounting or mounting bindfs and giving the
+    folders their ACLs. Passes back 0 if it all worked, otherwise 1.
+    """
+    import pinetShared
+    if backend == "acl" and not pinetShared.aclSupported(pinetShared.SHARED_ROOT):
+        print(_("The filesystem /home/shared is on does not support ACLs, so the shared folders stay on bindfs"))
+        returnData(1)
+        return False
+    changed = pinetShared.setBackend(backend, [name] if name else None)
+    print(str(len(changed)) + " " + _("shared folders moved to") + " " + backend)
+    return sharedFolderReconcile()
+
+def sharedFolderRepair():
+    """
+    Gives every shared folder using ACLs its ACLs again, for files moved in from a home folder, which keep the
+    permissions they had. Run every night.
+    """
+    import pinetShared
+    plan = pinetShared.reconcile(logPath=COMMAND_LOG_FILEPATH, repair=True)
+    for line in plan.summary():
+        print(line)
+    returnData(0 if plan.ok else 1)
+    return plan.ok
+
+def sharedFolderBenchmark(files="1000"):
+    """
+    Compares creating, looking at, listing, reading and deleting small files in a folder using ACLs and in one mounted
+    with bindfs.
+    """
+    import pinetShared
+    print(_("Timing") + " " + files + " " + _("small files with each shared folder backend"))
+    results = pinetShared.benchmark(files=int(files), logPath=COMMAND_LOG_FILEPATH)
+    for line in pinetShared.formatBenchmark(results, int(files)):
+        print(line)
+    return results
+
+
+#---------------- Provisioning -------------------
+
+def provisionSession():
+    """
+    Run by pam_exec when a user logs in. Only does any work if the provisioning manifest changed since the user last logged in.
+    """
+    import pinetProvision
+    user = os.environ.get("PAM_USER", "")
+    if user == "" or os.environ.get("PAM_TYPE", "open_session") != "open_session":
+        return
+    if not pinetProvision.needsProvisioning(user):
+        return
+    if user.lower() not in getUsers():
+        return
+    pinetProvision.provisionUser(user)
+
+def provisionAdd(name, source, target, groups=""):
+    """
+    Adds a file or folder every user should have in their home folder, given to them at their next login.
+    groups is an optional comma separated list of groups the item is limited to.
+    """
+    import pinetProvision
+    groupList = [group for group in groups.split(",") if group]
+    pinetProvision.addItem(name, source, target, groupList)
+
+def provisionRemove(name):
+    import pinetProvision
+    pinetProvision.removeItem(name)
+
+def provisionReset(user):
+    import pinetProvision
+    pinetProvision.resetUser(user)
+
+
+#---------------- Upgrades -------------------
+
+def upgradeAll(addSoftwareFile=""):
+    """
+    Replacement for the apt-get lines in UpdateAll. Upgrades the server and the Raspbian chroot side by side, then checks
+    whether the packages in the AddSoftware bash function (saved to addSoftwareFile with declare -f) are all installed and current.
+    Passes 1 back to bash if AddSoftware needs running, 0 if not, or error if the upgrade could not start.
+    """
+    import pinetUpgrade
+    definition = ""
+    if addSoftwareFile and os.path.isfile(addSoftwareFile):
+        with open(addSoftwareFile) as f:
+            definition = f.read()
+    snapshotBeforeChange(_("Before Update-All"))
+    try:
+        report, needed = pinetUpgrade.runPipeline(definition, logPath=COMMAND_LOG_FILEPATH)
+    except RuntimeError as error:
+        whiptailBox("msgbox", _("Error"), str(error), False)
+        returnData("error")
+        return
+    for line in report.summary():
+        print(line)
+    if needed:
+        returnData(1)
+    else:
+        returnData(0)
+
+def upgradePhase(name, duration):
+    import pinetUpgrade
+    pinetUpgrade.recordPhase(name, duration)
+
+def upgradeChrootChanged():
+    import pinetUpgrade
+    if pinetUpgrade.chrootChanged():
+        returnData(1)
+    else:
+        returnData(0)
+
+def upgradeReport():
+    """
+    Shows how long each part of the update took.
+    """
+    import pinetUpgrade
+    report = pinetUpgrade.upgradeReport.load()
+    lines = [line for line in report.summary() if not line.startswith("    ")]
+    whiptailBox("msgbox", _("Update complete"), _("Updates are complete") + "\n\n" + "\n".join(lines), False, height=str(len(lines) + 9))
+
+
+#---------------- Disk usage -------------------
+
+def diskUsage(action="top", count="10"):
+    """
+    scan refreshes the /home usage index (run nightly by anacron). top, handin and growth print a table from the index
+    for the status screen, json prints the summary other tools read from /var/lib/pinet/usage.json.
+    """
+    import pinetUsage
+    if action == "scan":
+        index = pinetUsage.scanHomes(full=(count == "full"))
+        print(_("Scanned") + " " + str(len(index.users)) + " " + _("home folders in") + " " + "%.1fs" % index.duration)
+        returnData(pinetUsage.formatSize(index.total))
+        return
+    index = pinetUsage.usageIndex.load()
+    if action == "json":
+        import json
+        print(json.dumps(index.summary(int(count)), indent=1))
+        return
+    if not index.scanned:
+        print(_("No disk usage index yet, it is created overnight or with") + " pinet-functions-python.py diskUsage scan")
+        return
+    if action == "top":
+        rows = [(usage.user, pinetUsage.formatSize(usage.size)) for usage in index.topUsers(int(count))]
+    elif action == "handin":
+        rows = [(user, pinetUsage.formatSize(size)) for user, size in index.handinSizes()[:int(count)]]
+    elif action == "growth":
+        rows = [(usage.user, "+" + pinetUsage.formatSize(usage.growth)) for usage in index.growth(int(count))]
+    else:
+        print(_("Unknown disk usage action") + " " + action)
+        return
+    for user, size in rows:
+        print("%-39s- %s" % (user, size))
+
+
+def handinWatch():
+    """
+    Runs the handin watcher service (see pinetHandin.py) until it is stopped. Started by /etc/init.d/pinet-handin.
+    """
+    import signal
+    import pinetHandin
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  #So the index is saved on the way out
+    pinetHandin.watch()
+
+def handinStatus(user=""):
+    """
+    Prints who has handed in work, most recent first, from the handin watcher (or the index it last saved if it isn't
+    running). Passes back the number of pupils with something in their handin folder.
+    """
+    import time
+    import pinetHandin
+    import pinetUsage
+    request = "status"
+    if user:
+        request = "user " + user
+    result = pinetHandin.query(request)
+    if result is None:
+        print(_("The handin watcher has not run yet"))
+        returnData(0)
+        return
+    if not result["live"]:
+        print(_("The handin watcher is not running, showing its last saved index"))
+    pupils = result["pupils"]
+    handedIn = [name for name in pupils if pupils[name] and pupils[name]["files"]]
+    for name in sorted(handedIn, key=lambda name: (-pupils[name]["latest"], name)):
+        entry = pupils[name]
+        print("%-20s %5d %-8s %s  %s" % (name, entry["files"], pinetUsage.formatSize(entry["size"]), time.strftime("%d/%m %H:%M", time.localtime(entry["latest"])), entry["newest"]))
+    nothing = sorted(name for name in pupils if name not in handedIn)
+    if nothing:
+        print(_("Nothing handed in") + ": " + ", ".join(nothing))
+    returnData(len(handedIn))
+    return len(handedIn)
+
+
+#---------------- Boot load test -------------------
+
+def bootStorm(source="nbd", levels="1,5,10,20,30", patternFile="", label=""):
+    """
+    Simulates classrooms of Raspberry Pis starting at once (see pinetBootStorm.py). source is nbd (the local
+    nbd-server), local (the image file, as a stand-in for the network), an image path (for example on an NFS mount)
+    or an nbd://host:port/export address. Prints the results, compared with the last run against the same source,
+    and saves them. Passes back the path of the saved results.
+    """
+    import time
+    import pinetFiles
+    import pinetBootStorm
+    target = chrootTargets("default")[0]
+    if source == "nbd":
+        source = "nbd://localhost:" + str(pinetBootStorm.NBD_PORT) + "/ltsp_" + target.name
+    elif source == "local":
+        source = os.path.join(pinetBootStorm.IMAGE_FOLDER, target.name + ".img")
+    pattern = None
+    patternName = "synthetic"
+    if patternFile:
+        pattern = pinetBootStorm.loadPattern(patternFile)
+        patternName = os.path.basename(patternFile)
+    previous = None
+    for filepath in reversed(pinetBootStorm.listResults()):
+        result = pinetFiles.readJSON(filepath)
+        if isinstance(result, dict) and result.get("source") == source:
+            previous = result
+            break
+    try:
+        result = pinetBootStorm.runStorm(source, [int(level) for level in levels.split(",") if level], target.bootFiles, pattern, patternName, label=label)
+    except (OSError, RuntimeError) as error:
+        print(_("The load test could not start") + ": " + str(error))
+        returnData("Error")
+        return
+    for line in pinetBootStorm.formatResult(result):
+        print(line)
+    if previous is not None:
+        print("")
+        print(_("Compared with") + " " + time.strftime("%d/%m/%Y %H:%M", time.localtime(previous["created"])))
+        for line in pinetBootStorm.compareResults(previous, result):
+            print(line)
+    filepath = pinetBootStorm.saveResult(result)
+    returnData(filepath)
+    return filepath
+
+def bootStormCompare(first="", second=""):
+    """
+    Compares two saved load test results, the last two if none are given.
+    """
+    import pinetFiles
+    import pinetBootStorm
+    saved = pinetBootStorm.listResults()
+    if not first or not second:
+        if len(saved) < 2:
+            print(_("At least two load tests are needed to compare"))
+            return
+        first, second = saved[-2], saved[-1]
+    before = pinetFiles.readJSON(first)
+    after = pinetFiles.readJSON(second)
+    for line in pinetBootStorm.formatResult(before) + [""] + pinetBootStorm.formatResult(after) + [""] + pinetBootStorm.compareResults(before, after):
+        print(line)
+
+
+#---------------- Compression advisor -------------------
+
+def compressionAdvisor(targetName="default", sampleMB=""):
+    """
+    Runs trial builds of part of a chroot with several compressors and block sizes (see pinetCompression.py), prints
+    how they compare and offers to use the best one for image builds. Passes back the chosen profile, or None.
+    """
+    import pinetFiles
+    import pinetCompression
+    import pinetUsage
+    target = chrootTargets(targetName)[0]
+    sampleBytes = pinetCompression.SAMPLE_BYTES
+    if sampleMB:
+        sampleBytes = int(sampleMB) * 1024 * 1024
+    workFolder = os.path.join(os.path.dirname(target.path.rstrip("/")), ".pinet-compression-trial")  #Same disk as the chroot, for hard links
+    print(_("Building trial images from part of") + " " + target.path + ", " + _("this can take a few minutes"))
+    result = pinetCompression.advise(target.path, workFolder, sampleBytes=sampleBytes, logPath=COMMAND_LOG_FILEPATH)
+    pinetFiles.writeJSONAtomic(result, pinetCompression.RESULTS_FILEPATH)
+    print(_("Sample") + ": " + pinetUsage.formatSize(result["sampleBytes"]) + " " + _("of") + " " + pinetUsage.formatSize(result["totalBytes"]))
+    print("%-10s %8s %10s %12s %12s" % (_("Profile"), _("Ratio"), _("Image"), _("Build time"), _("Boot load")))
+    for trial in result["ranked"]:
+        print("%-10s %7.0f%% %10s %11.0fs %11.1fs" % (pinetCompression.profileName(trial["compressor"], trial["blockSize"]), trial["ratio"] * 100,
+                                                    pinetUsage.formatSize(trial["fullSize"]), trial["fullBuildTime"], trial["bootLoadTime"]))
+    for trial in result["failed"]:
+        print(pinetCompression.profileName(trial["compressor"], trial["blockSize"]) + ": " + trial["error"])
+    if not result["ranked"]:
+        print(_("No trial build worked, image builds are unchanged"))
+        returnData("None")
+        return None
+    best = result["ranked"][0]
+    name = pinetCompression.profileName(best["compressor"], best["blockSize"])
+    current = pinetCompression.loadProfile()
+    if current is not None and current == (best["compressor"], best["blockSize"]):
+        print(_("Image builds already use") + " " + name)
+        returnData(name)
+        return name
+    if whiptailBox("yesno", _("Compression advisor"), _("The best profile for this server is") + " " + name + ". " +
+                   _("Raspberry Pis should load what they need to boot in about") + " " + "%.0f" % best["bootLoadTime"] + " " +
+                   _("seconds and a full image build should take about") + " " + "%.0f" % (best["fullBuildTime"] / 60) + " " +
+                   _("minutes. Use it for image builds from now on?"), True, height="11"):
+        pinetCompression.saveProfile(best["compressor"], best["blockSize"])
+        setConfigParameter("CompressionProfile", name)
+        returnData(name)
+        return name
+    returnData("None")
+    return None
+
+def compressionProfile():
+    """
+    Prints the compression profile image builds use and the last advisor results.
+    """
+    import time
+    import pinetFiles
+    import pinetCompression
+    current = pinetCompression.loadProfile()
+    if current is None:
+        print(_("Image builds use the ltsp-update-image default compression"))
+    else:
+        print(_("Image builds use") + " " + pinetCompression.profileName(*current) + " (" + pinetCompression.profileOptions(*current) + ")")
+    result = pinetFiles.readJSON(pinetCompression.RESULTS_FILEPATH)
+    if isinstance(result, dict) and result.get("ranked"):
+        print(_("Last advised on") + " " + time.strftime("%d/%m/%Y %H:%M", time.localtime(result["created"])) + ": " +
+              ", ".join(pinetCompression.profileName(trial["compressor"], trial["blockSize"]) for trial in result["ranked"]))
+
+
+#---------------- Image slimming -------------------
+
+def chrootSlim(targetName="default", categories=""):
+    """
+    Shows what takes the space in a chroot (see pinetSlim.py) and which groups of files could be left out of its
+    image. categories is a comma separated list of groups to leave out, none to change nothing, or empty to ask.
+    Passes back how many exclude patterns were written, or None if nothing changed.
+    """
+    import pinetFiles
+    import pinetSlim
+    import pinetUsage
+    target = chrootTargets(targetName)[0]
+    print(_("Looking through") + " " + target.path + ", " + _("this can take a few minutes"))
+    report = pinetSlim.analyse(target.path)
+    pinetFiles.writeJSONAtomic(report, pinetSlim.reportPath(target.name))
+    for line in pinetSlim.formatReport(report, pinetUsage.formatSize):
+        print(line)
+    names = sorted(report["categories"])
+    if not categories:
+        items = []
+        for name in names:
+            category = report["categories"][name]
+            items.append([name, _(pinetSlim.CATEGORY_DESCRIPTIONS[name]) + ", " + pinetUsage.formatSize(category["compressedSize"]) + " " + _("smaller image")])
+        chosen = whiptailCheckList(_("Slim image"), _("Which of these should be left out of the Raspberry Pi image? They stay in the chroot. Use space bar to select then enter to continue."), items)
+        if chosen == "Cancel":
+            returnData("None")
+            return None
+        categories = ",".join(chosen.replace('"', '').split())
+    if categories == "none":
+        returnData("None")
+        return None
+    chosen = [name for name in categories.split(",") if name]
+    unknown = [name for name in chosen if name not in names]
+    if unknown:
+        print(_("Unknown groups") + ": " + ", ".join(unknown))
+        returnData("None")
+        return None
+    patterns = []
+    for name in chosen:
+        patterns = patterns + report["categories"][name]["patterns"]
+    if patterns == pinetSlim.readExcludes():
+        print(_("Image builds already leave these out"))
+        returnData("None")
+        return None
+    pinetSlim.writeExcludes(patterns)
+    setConfigParameter("NBDBuildNeeded", "true")
+    print(_("Left out of image builds from now on") + ": " + (", ".join(chosen) or _("nothing")))
+    returnData(len(patterns))
+    return len(patterns)
+
+
+#---------------- Image layers -------------------
+
+def imageLayers(action="status", names="all"):
+    """
+    enable, disable, squash or status for layered NBD images (see pinetLayers.py). Enabling sets up the delta export
+    and the Raspberry Pis' initrds, then builds a new base. squash folds the delta into a new base now.
+    Passes back 0 if it worked, otherwise 1.
+    """
+    import time
+    import pinetLayers
+    import pinetUsage
+    targets = [target for target in chrootTargets(names) if target.nbd]
+    ok = True
+    if action == "enable":
+        for target in targets:
+            try:
+                patched = pinetLayers.enable(target)
+            except (OSError, RuntimeError) as error:
+                print(target.name + ": " + str(error))
+                returnData(1)
+                return False
+            print(target.name + ": " + _("client script added to") + " " + ", ".join(os.path.basename(initrd) for initrd in patched))
+        setConfigParameter("ImageLayers", "true")
+        runBash(["service", "nbd-server", "restart"])
+        ok = all([rebuildTarget(target, squash=True) for target in targets])
+    elif action == "disable":
+        for target in targets:
+            pinetLayers.disable(target)
+        setConfigParameter("ImageLayers", "false")
+        runBash(["service", "nbd-server", "restart"])
+        ok = chrootRebuild(names)
+    elif action == "squash":
+        ok = all([rebuildTarget(target, squash=True) for target in targets])
+    else:
+        if getConfigParameter("/etc/pinet", "ImageLayers=") != "true":
+            print(_("Image layers are turned off, every rebuild squashes the whole chroot"))
+        for target in targets:
+            state = pinetLayers.loadState(target.name)
+            if "base" in state:
+                print(target.name + ": " + _("base built") + " " + time.strftime("%d/%m/%Y %H:%M", time.localtime(state["base"]["built"])) + ", " +
+                      pinetLayers.formatBuild(target.name, state["base"], pinetUsage.formatSize))
+            if "delta" in state:
+                print(pinetLayers.formatBuild(target.name, state["delta"], pinetUsage.formatSize))
+        returnData(0)
+        return True
+    if ok:
+        setConfigParameter("NBDBuildNeeded", "false")
+        returnData(0)
+    else:
+        returnData(1)
+    return ok
+
+
+#---------------- Install journal -------------------
+
+def journalStart(mode="fresh"):
+    """
+    Starts the full install journal (see pinetJournal.py), fresh or resuming the last install.
+    """
+    import pinetJournal
+    pinetJournal.start(mode)
+
+def journalBegin(step, inputs):
+    """
+    Passes back skip if the full install step is already done, otherwise run. inputs are what the step was run with.
+    """
+    import pinetJournal
+    decision = pinetJournal.begin(step, inputs)
+    if decision == "skip":
+        print(_("Already done, skipping") + " " + step)
+    returnData(decision)
+    return decision
+
+def journalEnd(step, returncode="0"):
+    import pinetJournal
+    pinetJournal.end(step, int(returncode))
+
+def journalFinish():
+    import pinetJournal
+    pinetJournal.finish()
+
+def journalStatus(verbose=""):
+    """
+    Passes back the step a stopped full install got to, or none. verbose prints every step.
+    """
+    import pinetJournal
+    current = pinetJournal.journal.load()
+    if verbose:
+        for line in pinetJournal.formatJournal(current):
+            print(line)
+    unfinished = current.unfinished()
+    if unfinished is None:
+        returnData("none")
+    else:
+        returnData(unfinished)
+    return unfinished
+
+
+#---------------- Task graphs -------------------
+
+def runTasks(flow, script="", workers=""):
+    """
+    Runs an install flow from pinetTasks.py through the install journal, several tasks at once, then prints the
+    critical path. Passes back 0 if every required task finished, otherwise 1.
+    """
+    import pinetTasks
+    import pinetJournal
+    tasks = pinetTasks.FLOWS[flow]
+    if not workers:
+        workers = getConfigParameter(PINET_CONF_FILEPATH, "TaskWorkers=")
+    try:
+        workers = max(1, int(workers))
+    except ValueError:
+        workers = pinetTasks.WORKERS
+    print(_("Running") + " " + str(len(tasks)) + " " + _("tasks") + ", " + str(workers) + " " + _("at a time") + ". " + _("Their output is logged in") + " " + pinetTasks.LOG_FOLDER)
+    result = pinetTasks.runGraph(tasks, lambda item: pinetTasks.runStep(item, script or pinetTasks.PINET_FILEPATH), workers=workers,
+                                 estimates=pinetTasks.loadEstimates(flow), journalPath=pinetJournal.JOURNAL_FILEPATH)
+    pinetTasks.saveResult(flow, result)
+    for line in pinetTasks.formatReport(tasks, result):
+        print(line)
+    ok = not any(state["status"] in ("failed", "blocked") for state in result["tasks"].values())
+    returnData(0 if ok else 1)
+    return ok
+
+def taskReport(flow="fullInstall"):
+    """
+    Prints how long each task of the last run of a flow took, and its critical path.
+    """
+    import pinetFiles
+    import pinetTasks
+    result = pinetFiles.readJSON(pinetTasks.historyPath(flow))
+    if result is None:
+        print(_("No record of a run of") + " " + flow)
+        return False
+    for line in pinetTasks.formatReport(pinetTasks.FLOWS[flow], result):
+        print(line)
+    return True
+
+
+#---------------- Golden chroot cache -------------------
+
+def goldenCacheFolder():
+    import pinetGolden
+    folder = getConfigParameter(PINET_CONF_FILEPATH, "GoldenCacheFolder=")
+    if folder == "None":
+        return pinetGolden.CACHE_FOLDER
+    return folder
+
+def goldenCacheEnabled():
+    return getConfigParameter(PINET_CONF_FILEPATH, "GoldenCache=") != "false"
+
+def goldenRestore(configPath, keyringPath, arch="armhf"):
+    """
+    Unpacks the chroot for arch from the golden chroot cache (see pinetGolden.py), if it has one built from the same
+    config and keys. Passes back restored, or build if ltsp-build-client needs to run.
+    """
+    import pinetGolden
+    import pinetChroots
+    if not goldenCacheEnabled():
+        returnData("build")
+        return False
+    key, details = pinetGolden.cacheKey(configPath, keyringPath, arch)
+    try:
+        manifest = pinetGolden.restore(os.path.join(pinetChroots.LTSP_ROOT, arch), key, goldenCacheFolder())
+    except (OSError, RuntimeError) as error:
+        print(_("The cached chroot can't be used, so it will be built") + ": " + str(error))
+        returnData("build")
+        return False
+    if manifest is None:
+        print(_("No cached chroot was built from this config, so it will be built"))
+        returnData("build")
+        return False
+    print(_("Chroot unpacked from the cache in") + " " + str(int(manifest["restores"][-1]["duration"])) + "s, " +
+          _("building it took") + " " + str(int(manifest["buildDuration"])) + "s")
+    returnData("restored")
+    return True
+
+def goldenExport(configPath, keyringPath, arch="armhf", buildSeconds="0"):
+    """
+    Saves the freshly built chroot for arch to the golden chroot cache, with how long building it took.
+    """
+    import pinetGolden
+    import pinetChroots
+    if not goldenCacheEnabled():
+        return False
+    key, details = pinetGolden.cacheKey(configPath, keyringPath, arch)
+    print(_("Saving the new chroot to the cache in") + " " + goldenCacheFolder())
+    try:
+        manifest = pinetGolden.export(os.path.join(pinetChroots.LTSP_ROOT, arch), key, details, float(buildSeconds), goldenCacheFolder())
+    except (OSError, RuntimeError) as error:
+        print(_("The chroot could not be saved to the cache") + ": " + str(error))
+        return False
+    print(_("Saved in") + " " + str(int(manifest["exportDuration"])) + "s")
+    return True
+
+def goldenStatus(verify=""):
+    """
+    Lists the chroots in the golden chroot cache. verify checks every archive against its checksum.
+    """
+    import pinetGolden
+    import pinetUsage
+    entries = pinetGolden.listEntries(goldenCacheFolder())
+    if not entries:
+        print(_("The chroot cache in") + " " + goldenCacheFolder() + " " + _("is empty"))
+    ok = True
+    for manifest in entries:
+        print(pinetGolden.formatEntry(manifest, pinetUsage.formatSize))
+        if verify:
+            problems = pinetGolden.verify(manifest, goldenCacheFolder())
+            for problem in problems:
+                print("    " + problem)
+            if not problems:
+                print("    " + _("all archives match their checksums"))
+            ok = ok and not problems
+    returnData(0 if ok else 1)
+    return ok
+
+
+#---------------- Home deduplication -------------------
+
+def dedupHomes(mode="report"):
+    """
+    Looks for files that are identical across the home folders (see pinetDedup.py). apply also makes the copies share
+    their data, where the filesystem can. Passes back how much sharing would reclaim, or None if it can't.
+    """
+    import pinetDedup
+    import pinetUsage
+    print(_("Looking for identical files in") + " " + pinetDedup.HOME_ROOT + ", " + _("this may take a while the first time"))
+    report = pinetDedup.run(apply=(mode == "apply"))
+    for line in pinetDedup.formatReport(report, pinetUsage.formatSize):
+        print(line)
+    reclaimable = report["duplicateSize"] - report["alreadyShared"] - report["reclaimed"]
+    if report["supported"] and reclaimable > 0:
+        returnData(reclaimable)
+    else:
+        returnData(None)
+    return report
+
+
+#---------------- Background jobs -------------------
+
+def lessonHours():
+    import pinetJobs
+    hours = getConfigParameter(PINET_CONF_FILEPATH, "LessonHours=")
+    if hours == "None":
+        return pinetJobs.LESSON_HOURS
+    return hours
+
+def jobsDaemon():
+    """
+    Runs the background job scheduler (see pinetJobs.py) until it is stopped. Started by /etc/init.d/pinet-jobs.
+    """
+    import signal
+    import pinetJobs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    maxRunning = getConfigParameter(PINET_CONF_FILEPATH, "JobsAtOnce=")
+    try:
+        maxRunning = max(1, int(maxRunning))
+    except ValueError:
+        maxRunning = pinetJobs.MAX_RUNNING
+    pinetJobs.serve(maxRunning=maxRunning, lessons=lessonHours())
+
+def jobSubmit(kind, *args):
+    """
+    Queues a command as a background job of a kind from pinetJobs.KINDS, for example
+    jobSubmit backup /bin/sh /usr/local/bin/pinet-backup.sh. Options such as --window="not lessons" go before the
+    command. If the job scheduler isn't running, the command is run now with the kind's limits. Passes back the job id,
+    or inline if it was run now.
+    """
+    import pinetJobs
+    try:
+        options, command = pinetJobs.parseOptions(args)
+        job = pinetJobs.newJob(kind, command, options)
+    except ValueError as error:
+        print(str(error))
+        returnData("Error")
+        return None
+    if os.environ.get("PINET_JOB") or not pinetJobs.daemonRunning():  #Already inside a job, or nothing to hand it to
+        returncode = pinetJobs.runInline(job)
+        returnData("inline")
+        return returncode
+    pinetJobs.submit(job)
+    print(_("Queued as job") + " " + job["id"] + ". " + _("pinet-functions-python.py jobStatus shows when it will run"))
+    returnData(job["id"])
+    return job["id"]
+
+def jobOffer(kind):
+    """
+    Passes back queue if a job of kind can't start now (during lessons, for example) and the job scheduler is running
+    to start it later, otherwise now.
+    """
+    import time
+    import pinetJobs
+    window = pinetJobs.parseWindow(pinetJobs.KINDS[kind]["window"], lessonHours())
+    if os.environ.get("PINET_JOB") or not pinetJobs.daemonRunning() or pinetJobs.windowOpen(window, time.time()):
+        returnData("now")
+        return False
+    returnData("queue")
+    return True
+
+def jobStatus():
+    """
+    Prints the running and queued background jobs, with why each queued job is waiting. Passes back how many there are.
+    """
+    import time
+    import pinetFiles
+    import pinetJobs
+    jobs = pinetJobs.loadJobs()
+    if not pinetJobs.daemonRunning():
+        print(_("The job scheduler is not running, so queued jobs will wait until it starts"))
+    if not jobs:
+        print(_("No background jobs are running or queued"))
+    for line in pinetJobs.formatStatus(jobs, pinetFiles.readJSON(os.path.join(pinetJobs.SPOOL_FOLDER, "status.json")), time.time(), lessonHours()):
+        print(line)
+    returnData(len(jobs))
+    return len(jobs)
+
+def jobHistory(count="20"):
+    """
+    Prints the last count background jobs, with how long each waited to start and how long it ran.
+    """
+    import pinetJobs
+    history = pinetJobs.loadHistory()
+    if not history:
+        print(_("No background jobs have run yet"))
+    for line in pinetJobs.formatHistory(history, int(count)):
+        print(line)
+    return history
+
+def jobCancel(jobId):
+    """
+    Cancels a queued or running background job. Passes back 0 if there was such a job, otherwise 1.
+    """
+    import pinetJobs
+    try:
+        found = pinetJobs.requestCancel(jobId, live=pinetJobs.daemonRunning())
+    except ValueError:
+        found = False
+    if found:
+        print(_("Job") + " " + jobId + " " + _("will be cancelled"))
+    else:
+        print(_("No queued or running job") + " " + jobId)
+    returnData(0 if found else 1)
+    return found
+
+
+#---------------- Screenshot gallery -------------------
+
+def galleryBuild(group="pupil", teacher=""):
+    """
+    Makes a contact sheet of the latest screenshots of everyone in group (see pinetGallery.py), in the teacher's home
+    folder so only they can see it. Passes back the path of the page.
+    """
+    import pwd
+    import pinetGallery
+    try:
+        entry = pwd.getpwnam(teacher)
+    except KeyError:
+        print(_("No such user") + " " + teacher)
+        returnData("Error")
+        return None
+    galleryFolder = os.path.join(entry.pw_dir, pinetGallery.GALLERY_FOLDER)
+    outputFolder = os.path.join(galleryFolder, group.replace("/", "_"))
+    if not os.path.isdir(outputFolder):
+        os.makedirs(outputFolder)
+    os.chmod(galleryFolder, 0o700)
+    summary = pinetGallery.build(group, outputFolder)
+    for path in (galleryFolder, outputFolder, os.path.join(outputFolder, "thumbs"), summary["page"]):  #Not the thumbnails, they can be links into the cache
+        os.chown(path, entry.pw_uid, entry.pw_gid)
+    print(_("Screenshots shown") + ": " + str(summary["shown"]) + " / " + str(summary["captures"]) + ", " + str(summary["members"]) + " " + _("members"))
+    print(_("New thumbnails") + ": " + str(summary["made"]) + " (" + str(round(summary["duration"], 1)) + "s)")
+    for error in summary["errors"]:
+        print(error)
+    returnData(summary["page"])
+    return summary["page"]
+
+def galleryMaintain():
+    """
+    The nightly screenshot pass, run from anacron as a background job. Removes screenshots older than ScreenshotMaxAge
+    days or over each user's ScreenshotQuota (in MB), and brings the thumbnail cache up to date.
+    """
+    import pinetGallery
+    maxAge = getConfigParameter(PINET_CONF_FILEPATH, "ScreenshotMaxAge=")
+    quota = getConfigParameter(PINET_CONF_FILEPATH, "ScreenshotQuota=")
+    try:
+        maxAge = float(maxAge)
+    except ValueError:
+        maxAge = pinetGallery.MAX_AGE
+    try:
+        quota = int(float(quota) * 1024 * 1024)
+    except ValueError:
+        quota = pinetGallery.QUOTA
+    summary = pinetGallery.maintain(maxAge=maxAge, quota=quota)
+    print(_("Screenshots removed") + ": " + str(summary["removed"]) + ", " + _("kept") + ": " + str(summary["captures"]) + ", " + _("new thumbnails") + ": " + str(summary["made"]))
+    for error in summary["errors"]:
+        print(error)
+    returnData(summary["removed"])
+    return summary
+
+
 #------------------------------Main program-------------------------
 
-if len(sys.argv) == 1:
-    print(_("This python script does nothing on its own, it must be passed stuff"))
-else:
-    getReleaseChannel()
-    if sys.argv[1] == "replaceLineOrAdd":
-        replaceLineOrAdd(sys.argv[2], sys.argv[3], sys.argv[4])
-    elif sys.argv[1] == "replaceBitOrAdd":
-        replaceBitOrAdd(sys.argv[2], sys.argv[3], sys.argv[4])
-    elif sys.argv[1] == "CheckInternet":
-        internet_on(sys.argv[2])
-    elif sys.argv[1] == "CheckUpdate":
-        checkUpdate(sys.argv[2])
-    elif sys.argv[1] == "CompareVersion":
-        compareVersions(sys.argv[2], sys.argv[3])
-    elif sys.argv[1] == "updatePiNet":
-        updatePiNet()
-    elif sys.argv[1] == "triggerInstall":
-        downloadFile("http://bit.ly/pinetinstall1", "/dev/null")
-    elif sys.argv[1] == "checkKernelFileUpdateWeb":
-        checkKernelFileUpdateWeb()
-    elif sys.argv[1] == "checkKernelUpdater":
-        checkKernelUpdater()
-    elif sys.argv[1] == "installCheckKernelUpdater":
-        installCheckKernelUpdater()
-    elif sys.argv[1] == "previousImport":
-        previousImport()
-    elif sys.argv[1] == "importFromCSV":
-        importFromCSV(sys.argv[2], sys.argv[3])
-    elif sys.argv[1] == "checkIfFileContainsString":
-        checkIfFileContains(sys.argv[2], sys.argv[3])
-    elif sys.argv[1] == "initialInstallSoftwareList":
-        installSoftwareList(True)
-    elif sys.argv[1] == "installSoftwareList":
-        installSoftwareList(False)
-    elif sys.argv[1] == "installSoftwareFromFile":
-        installSoftwareFromFile()
-    elif sys.argv[1] == "sendStats":
-        sendStats()
-    elif sys.argv[1] == "checkStatsNotification":
-        checkStatsNotification()
-    elif sys.argv[1] == "askExtraStatsInfo":
-        askExtraStatsInfo()
-    elif sys.argv[1] == "internetFullStatusCheck":
-        internetFullStatusCheck()
+def registerCommand(name, function, needsReleaseChannel=False):
+    """
+    Adds a command the bash script can call with "pinet-functions-python.py name arguments".
+    function is given the list of arguments after the command name.
+    Only commands with needsReleaseChannel read /etc/pinet to pick the GitHub branch before running.
+    """
+    commands[name] = (function, needsReleaseChannel)
+
+registerCommand("replaceLineOrAdd", lambda args: replaceLineOrAdd(args[0], args[1], args[2]))
+registerCommand("replaceBitOrAdd", lambda args: replaceBitOrAdd(args[0], args[1], args[2]))
+registerCommand("CheckInternet", lambda args: internet_on(args[0]))
+registerCommand("CheckUpdate", lambda args: checkUpdate(args[0]), True)
+registerCommand("updateCheckRefresh", lambda args: updateCheckRefresh(), True)
+registerCommand("CompareVersion", lambda args: compareVersions(args[0], args[1]))
+registerCommand("updatePiNet", lambda args: updatePiNet(), True)
+registerCommand("triggerInstall", lambda args: downloadFile("http://bit.ly/pinetinstall1", "/dev/null"))
+registerCommand("checkKernelFileUpdateWeb", lambda args: checkKernelFileUpdateWeb(), True)
+registerCommand("checkKernelUpdater", lambda args: checkKernelUpdater(), True)
+registerCommand("chrootList", lambda args: chrootList())
+registerCommand("chrootAdd", lambda args: chrootAdd(*args[:4]))
+registerCommand("chrootRemove", lambda args: chrootRemove(args[0]))
+registerCommand("chrootInstall", lambda args: chrootInstall(args[0], args[1:]))
+registerCommand("chrootRebuild", lambda args: chrootRebuild(args[0] if args else "all"))
+registerCommand("chrootSnapshot", lambda args: chrootSnapshot(*args[:2]))
+registerCommand("chrootSnapshots", lambda args: chrootSnapshots(*args[:1]))
+registerCommand("chrootSnapshotPrune", lambda args: chrootSnapshotPrune(*args[:2]))
+registerCommand("chrootRollback", lambda args: chrootRollback(args[0], args[1]))
+registerCommand("chrootRollbackMenu", lambda args: chrootRollbackMenu(*args[:1]))
+registerCommand("installCheckKernelUpdater", lambda args: installCheckKernelUpdater())
+registerCommand("previousImport", lambda args: previousImport())
+registerCommand("importFromCSV", lambda args: importFromCSV(args[0], args[1]))
+registerCommand("addUser", lambda args: addUser(args[0], args[1]))
+registerCommand("retireUsers", lambda args: retireUsers(*args[:3]))
+registerCommand("retireArchive", lambda args: retireArchive(args[0]))
+registerCommand("retireStatus", lambda args: retireStatus(*args[:1]))
+registerCommand("retireRestore", lambda args: retireRestore(args[0], args[1]))
+registerCommand("passwordReset", lambda args: passwordReset(*args[:5]))
+registerCommand("copyToUsers", lambda args: copyToUsers(args[0], args[1], args[2] == "True", args[3] == "True"))
+registerCommand("checkIfFileContainsString", lambda args: checkIfFileContains(args[0], args[1]))
+registerCommand("initialInstallSoftwareList", lambda args: installSoftwareList(True))
+registerCommand("installSoftwareList", lambda args: installSoftwareList(False))
+registerCommand("installSoftwareFromFile", lambda args: installSoftwareFromFile(fresh=args[:1] == ["fresh"]))
+registerCommand("sendStats", lambda args: sendStats())
+registerCommand("flushStats", lambda args: flushStats())
+registerCommand("checkStatsNotification", lambda args: checkStatsNotification())
+registerCommand("askExtraStatsInfo", lambda args: askExtraStatsInfo())
+registerCommand("internetFullStatusCheck", lambda args: internetFullStatusCheck())
+registerCommand("sharedFolderCheck", lambda args: sharedFolderCheck())
+registerCommand("sharedFolderSet", lambda args: sharedFolderSet(args[0], args[1]))
+registerCommand("sharedFolderRemove", lambda args: sharedFolderRemove(args[0]))
+registerCommand("sharedFolderReconcile", lambda args: sharedFolderReconcile())
+registerCommand("sharedFolderUnmountAll", lambda args: sharedFolderUnmountAll())
+registerCommand("sharedFolderMigrate", lambda args: sharedFolderMigrate(*args[:2]))
+registerCommand("sharedFolderRepair", lambda args: sharedFolderRepair())
+registerCommand("sharedFolderBenchmark", lambda args: sharedFolderBenchmark(*args[:1]))
+registerCommand("provisionSession", lambda args: provisionSession())
+registerCommand("provisionAdd", lambda args: provisionAdd(args[0], args[1], args[2], args[3] if len(args) > 3 else ""))
+registerCommand("provisionRemove", lambda args: provisionRemove(args[0]))
+registerCommand("provisionReset", lambda args: provisionReset(args[0]))
+registerCommand("upgradeAll", lambda args: upgradeAll(args[0] if args else ""))
+registerCommand("upgradePhase", lambda args: upgradePhase(args[0], args[1]))
+registerCommand("upgradeChrootChanged", lambda args: upgradeChrootChanged())
+registerCommand("upgradeReport", lambda args: upgradeReport())
+registerCommand("diskUsage", lambda args: diskUsage(*args[:2]))
+registerCommand("handinWatch", lambda args: handinWatch())
+registerCommand("handinStatus", lambda args: handinStatus(*args[:1]))
+registerCommand("bootStorm", lambda args: bootStorm(*args[:4]))
+registerCommand("bootStormCompare", lambda args: bootStormCompare(*args[:2]))
+registerCommand("compressionAdvisor", lambda args: compressionAdvisor(*args[:2]))
+registerCommand("compressionProfile", lambda args: compressionProfile())
+registerCommand("chrootSlim", lambda args: chrootSlim(*args[:2]))
+registerCommand("imageLayers", lambda args: imageLayers(*args[:2]))
+registerCommand("journalStart", lambda args: journalStart(*args[:1]))
+registerCommand("journalBegin", lambda args: journalBegin(args[0], args[1:]))
+registerCommand("journalEnd", lambda args: journalEnd(*args[:2]))
+registerCommand("journalFinish", lambda args: journalFinish())
+registerCommand("journalStatus", lambda args: journalStatus(*args[:1]))
+registerCommand("runTasks", lambda args: runTasks(*args[:3]))
+registerCommand("taskReport", lambda args: taskReport(*args[:1]))
+registerCommand("goldenRestore", lambda args: goldenRestore(*args[:3]))
+registerCommand("goldenExport", lambda args: goldenExport(*args[:4]))
+registerCommand("goldenStatus", lambda args: goldenStatus(*args[:1]))
+registerCommand("dedupHomes", lambda args: dedupHomes(*args[:1]))
+registerCommand("jobsDaemon", lambda args: jobsDaemon())
+registerCommand("jobSubmit", lambda args: jobSubmit(*args))
+registerCommand("jobOffer", lambda args: jobOffer(*args[:1]))
+registerCommand("jobStatus", lambda args: jobStatus())
+registerCommand("jobHistory", lambda args: jobHistory(*args[:1]))
+registerCommand("jobCancel", lambda args: jobCancel(*args[:1]))
+registerCommand("galleryBuild", lambda args: galleryBuild(*args[:2]))
+registerCommand("galleryMaintain", lambda args: galleryMaintain())
+
+
+def main(argv):
+    if len(argv) == 1:
+        print(_("This python script does nothing on its own, it must be passed stuff"))
+        return
+    if argv[1] not in commands:
+        return
+    function, needsReleaseChannel = commands[argv[1]]
+    if needsReleaseChannel:
+        getReleaseChannel()
+    function(argv[2:])
+
+if __name__ == "__main__":
+    main(sys.argv)
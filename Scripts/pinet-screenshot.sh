@@ -1,9 +1,9 @@
 #!/bin/sh
 
-version=1
+version=2
 
 result=$(zenity --forms --title="Screenshot" \
---text="A screenshot will be taken and stored in your home folder." \
+--text="A screenshot will be taken and stored in the Screenshots folder in your home folder." \
 --add-entry="Delay before screenshot taken in seconds")
 
 if [ ! -n "$result" ]; then
@@ -24,7 +24,9 @@ if [ $result -ge 60 ]; then
   --text="Time entry of $result seconds was too large."
   exit
 fi
-raspi2png --delay $result
+mkdir -p ~/Screenshots
+file=~/Screenshots/screenshot-$(date +%Y%m%d-%H%M%S).png
+raspi2png --delay $result --pngname "$file"
 zenity --info \
 --text="Screenshot complete.
-You can find it in /home/$USER/screenshot.png"
+You can find it in $file"
@@ -0,0 +1,376 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetBootStorm.py
+#Boot storm load test used by pinet-functions-python.py.
+#Choosing between NBD and NFS, or a compression setting, was guesswork, and nobody could say how many Raspberry Pis
+#could start at once before logging in got too slow. This simulates a classroom of Pis starting together. Each
+#simulated Pi reads the boot files, then replays the reads a Pi makes from the client image while booting, either
+#over NBD from the local nbd-server or from an image file (the local image as a stand-in, or a copy on an NFS mount).
+#It is run at several numbers of Pis at once and reports throughput, read latency and time to login at each. Results
+#are saved so runs before and after a change can be compared. Needs Python 3.5 or newer for async/await.
+
+import os
+import time
+import struct
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+RESULTS_FOLDER = "/var/lib/pinet/bootstorm"
+IMAGE_FOLDER = "/opt/ltsp/images"
+NBD_PORT = 10809
+LEVELS = [1, 5, 10, 20, 30]
+READ_SIZE = 128 * 1024
+BOOT_READ_BYTES = 160 * 1024 * 1024  #Roughly what a Raspbian desktop reads from its image between power on and the login screen
+CLIENT_TIMEOUT = 10 * 60
+
+#From the NBD protocol
+NBD_MAGIC = b"NBDMAGIC"
+NBD_OPTS_MAGIC = 0x49484156454F5054
+NBD_OLDSTYLE_MAGIC = 0x00420281861253
+NBD_FLAG_FIXED_NEWSTYLE = 1
+NBD_FLAG_NO_ZEROES = 2
+NBD_OPT_EXPORT_NAME = 1
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_DISC = 2
+
+
+#---------------- Read patterns -------------------
+
+def syntheticPattern(imageSize, totalBytes=BOOT_READ_BYTES, readSize=READ_SIZE, seed=1):
+    """
+    A made up boot read pattern for when none has been recorded: runs of sequential reads (a file being loaded)
+    separated by seeks to somewhere else in the image. Always the same for the same arguments.
+    Returns [(offset, length)].
+    """
+    import random
+    generator = random.Random(seed)
+    pattern = []
+    readSize = min(readSize, imageSize)
+    total = min(totalBytes, imageSize)
+    remaining = total
+    while remaining > 0:
+        offset = generator.randrange(0, max(1, imageSize - readSize)) // 4096 * 4096
+        for i in range(generator.randint(1, 32)):
+            if remaining <= 0 or offset + readSize > imageSize:
+                break
+            length = min(readSize, remaining)
+            pattern.append((offset, length))
+            offset = offset + length
+            remaining = remaining - length
+    return pattern
+
+
+def loadPattern(filepath):
+    """
+    A recorded pattern: a JSON list of [offset, length] pairs, or a text file with "offset length" (in bytes) on
+    each line, or blkparse output recorded on a Pi ("sector + sectors").
+    """
+    data = readJSON(filepath)
+    if isinstance(data, list):
+        return [(int(offset), int(length)) for offset, length in data]
+    import re
+    pattern = []
+    with open(filepath) as f:
+        for line in f:
+            sectors = re.search(r"(\d+) \+ (\d+)", line)
+            if sectors:
+                pattern.append((int(sectors.group(1)) * 512, int(sectors.group(2)) * 512))
+                continue
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].isdigit() and fields[1].isdigit():
+                pattern.append((int(fields[0]), int(fields[1])))
+    return pattern
+
+
+def bootFileList(folder):
+    files = []
+    for root, folders, names in os.walk(folder):
+        for name in sorted(names):
+            files.append(os.path.join(root, name))
+    return sorted(files)
+
+
+#---------------- Transports -------------------
+
+class fileSource():
+    """
+    Reads from an image file: the local image as a stand-in for the network, or one on an NFS mount.
+    Reads run on a thread pool so many simulated Pis can wait on the disk at once.
+    """
+
+    def __init__(self, path, executor):
+        super(fileSource, self).__init__()
+        self.path = path
+        self.executor = executor
+        self.fd = None
+
+    async def open(self, loop):
+        self.fd = await loop.run_in_executor(self.executor, os.open, self.path, os.O_RDONLY)
+
+    async def read(self, loop, offset, length):
+        return await loop.run_in_executor(self.executor, os.pread, self.fd, length, offset)
+
+    async def close(self, loop):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+
+class nbdSource():
+    """
+    A minimal NBD client, one connection per simulated Pi like the real nbd-client.
+    """
+
+    def __init__(self, host, port, exportName):
+        super(nbdSource, self).__init__()
+        self.host = host
+        self.port = port
+        self.exportName = exportName
+        self.reader = None
+        self.writer = None
+        self.handle = 0
+        self.exportSize = 0
+
+    async def open(self, loop):
+        import asyncio
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        greeting = await self.reader.readexactly(16)
+        if greeting[:8] != NBD_MAGIC:
+            raise RuntimeError("Not an NBD server")
+        magic = struct.unpack(">Q", greeting[8:])[0]
+        if magic == NBD_OLDSTYLE_MAGIC:
+            self.exportSize = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+            await self.reader.readexactly(4 + 124)
+            return
+        if magic != NBD_OPTS_MAGIC:
+            raise RuntimeError("Unknown NBD handshake")
+        serverFlags = struct.unpack(">H", await self.reader.readexactly(2))[0]
+        clientFlags = serverFlags & (NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES)
+        name = self.exportName.encode()
+        self.writer.write(struct.pack(">IQII", clientFlags, NBD_OPTS_MAGIC, NBD_OPT_EXPORT_NAME, len(name)) + name)
+        try:
+            reply = await self.reader.readexactly(10)
+        except asyncio.IncompleteReadError:
+            raise RuntimeError("The NBD server has no export called " + self.exportName)
+        self.exportSize = struct.unpack(">Q", reply[:8])[0]
+        if not clientFlags & NBD_FLAG_NO_ZEROES:
+            await self.reader.readexactly(124)
+
+    async def read(self, loop, offset, length):
+        self.handle = self.handle + 1
+        self.writer.write(struct.pack(">IHHQQI", NBD_REQUEST_MAGIC, 0, NBD_CMD_READ, self.handle, offset, length))
+        magic, error, handle = struct.unpack(">IIQ", await self.reader.readexactly(16))
+        if magic != NBD_REPLY_MAGIC or handle != self.handle:
+            raise RuntimeError("Bad NBD reply")
+        if error:
+            raise RuntimeError("NBD read error " + str(error))
+        return await self.reader.readexactly(length)
+
+    async def close(self, loop):
+        if self.writer is not None:
+            try:
+                self.writer.write(struct.pack(">IHHQQI", NBD_REQUEST_MAGIC, 0, NBD_CMD_DISC, 0, 0, 0))
+                self.writer.close()
+            except OSError:
+                pass
+            self.writer = None
+
+    def size(self):
+        return self.exportSize
+
+
+def parseSource(source):
+    """
+    source is nbd://host[:port]/export or the path of an image file. Returns (kind, details).
+    """
+    if source.startswith("nbd://"):
+        hostPort, exportName = (source[len("nbd://"):].split("/", 1) + [""])[:2]
+        host = hostPort
+        port = NBD_PORT
+        if ":" in hostPort:
+            host, port = hostPort.rsplit(":", 1)
+            port = int(port)
+        return "nbd", (host or "localhost", port, exportName)
+    return "file", source
+
+
+def makeSource(source, executor):
+    kind, details = parseSource(source)
+    if kind == "nbd":
+        return nbdSource(*details)
+    return fileSource(details, executor)
+
+
+#---------------- Running -------------------
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def bootOne(loop, source, executor, bootFiles, pattern, started):
+    """
+    One simulated Pi. Returns (bytes read, [read latencies], time to login, error).
+    """
+    bytesRead = 0
+    latencies = []
+    client = makeSource(source, executor)
+    try:
+        for filepath in bootFiles:
+            data = await loop.run_in_executor(executor, readWhole, filepath)
+            bytesRead = bytesRead + len(data)
+        await client.open(loop)
+        for offset, length in pattern:
+            before = time.monotonic()
+            data = await client.read(loop, offset, length)
+            latencies.append(time.monotonic() - before)
+            bytesRead = bytesRead + len(data)
+    except Exception as error:
+        return bytesRead, latencies, None, str(error) or type(error).__name__
+    finally:
+        await client.close(loop)
+    return bytesRead, latencies, time.monotonic() - started, ""
+
+
+def readWhole(filepath):
+    with open(filepath, "rb") as f:
+        return f.read()
+
+
+async def runLevel(loop, source, clients, bootFiles, pattern):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(4, clients)) as executor:
+        started = time.monotonic()
+        tasks = [bootOne(loop, source, executor, bootFiles, pattern, started) for i in range(clients)]
+        outcomes = await asyncio.wait_for(asyncio.gather(*tasks), CLIENT_TIMEOUT)
+        duration = time.monotonic() - started
+    latencies = []
+    logins = []
+    errors = []
+    total = 0
+    for bytesRead, clientLatencies, login, error in outcomes:
+        total = total + bytesRead
+        latencies.extend(clientLatencies)
+        if error:
+            errors.append(error)
+        else:
+            logins.append(login)
+    return {"clients": clients,
+            "duration": duration,
+            "bytes": total,
+            "throughput": total / max(duration, 1e-9),
+            "readP50": percentile(latencies, 0.5), "readP95": percentile(latencies, 0.95), "readP99": percentile(latencies, 0.99),
+            "loginP50": percentile(logins, 0.5), "loginP95": percentile(logins, 0.95), "loginMax": percentile(logins, 1.0),
+            "errors": len(errors), "firstError": (errors + [""])[0]}
+
+
+def dropCaches():
+    """
+    Empties the page cache so a local image is read from disk each level, like the first Pi to boot in the morning.
+    """
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except (OSError, IOError):
+        return False
+
+
+def runStorm(source, levels=LEVELS, bootFilesFolder="", pattern=None, patternName="synthetic", coldCache=True, label=""):
+    """
+    Runs the load test at each number of simulated Pis in levels. Returns the result, ready for saveResult.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.new_event_loop()
+    try:
+        if pattern is None:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                probe = makeSource(source, executor)
+                loop.run_until_complete(probe.open(loop))
+                size = probe.size()
+                loop.run_until_complete(probe.close(loop))
+            pattern = syntheticPattern(size)
+        bootFiles = []
+        if bootFilesFolder and os.path.isdir(bootFilesFolder):
+            bootFiles = bootFileList(bootFilesFolder)
+        results = []
+        for clients in levels:
+            if coldCache:
+                dropCaches()
+            results.append(loop.run_until_complete(runLevel(loop, source, clients, bootFiles, pattern)))
+    finally:
+        loop.close()
+    image = {}
+    kind, details = parseSource(source)
+    if kind == "file" and os.path.isfile(details):
+        stat = os.stat(details)
+        image = {"size": stat.st_size, "modified": stat.st_mtime}
+    return {"created": time.time(), "label": label, "source": source, "transport": kind, "image": image,
+            "pattern": patternName, "patternBytes": sum(length for offset, length in pattern), "bootFiles": len(bootFiles),
+            "levels": results}
+
+
+#---------------- Results -------------------
+
+def saveResult(result, folder=RESULTS_FOLDER):
+    filepath = os.path.join(folder, time.strftime("%Y%m%d-%H%M%S", time.localtime(result["created"])) + ".json")
+    writeJSONAtomic(result, filepath)
+    return filepath
+
+
+def listResults(folder=RESULTS_FOLDER):
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return []
+    return [os.path.join(folder, name) for name in sorted(names) if name.endswith(".json")]
+
+
+def formatResult(result):
+    lines = ["%s %s (%s pattern, %d MB per Pi)" % (result["transport"].upper(), result["source"], result["pattern"], result["patternBytes"] // (1024 * 1024))]
+    lines.append("%4s %9s %27s %23s %6s" % ("Pis", "MB/s", "read ms p50/p95/p99", "login s p50/p95/max", "errors"))
+    for level in result["levels"]:
+        lines.append("%4d %9.1f %9.1f %8.1f %8.1f %7.1f %7.1f %7.1f %6d" % (
+            level["clients"], level["throughput"] / (1024 * 1024),
+            level["readP50"] * 1000, level["readP95"] * 1000, level["readP99"] * 1000,
+            level["loginP50"], level["loginP95"], level["loginMax"], level["errors"]))
+    return lines
+
+
+def compareResults(before, after):
+    """
+    Lines comparing the time to login (95th percentile) and throughput of two results at each level they share.
+    """
+    lines = ["%4s %21s %21s" % ("Pis", "login s p95", "MB/s")]
+    earlier = {}
+    for level in before["levels"]:
+        earlier[level["clients"]] = level
+    for level in after["levels"]:
+        if level["clients"] not in earlier:
+            continue
+        old = earlier[level["clients"]]
+        lines.append("%4d %6.1f -> %6.1f %+5.0f%% %6.1f -> %6.1f %+5.0f%%" % (
+            level["clients"], old["loginP95"], level["loginP95"], change(old["loginP95"], level["loginP95"]),
+            old["throughput"] / (1024 * 1024), level["throughput"] / (1024 * 1024), change(old["throughput"], level["throughput"])))
+    return lines
+
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) * 100.0 / old
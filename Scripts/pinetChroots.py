@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetChroots.py
+#Client image (chroot) targets used by pinet-functions-python.py.
+#PiNet was written around a single Raspbian chroot in /opt/ltsp/armhf. Each chroot is now a target with its own
+#name, architecture, path, NBD setting and boot files, kept in a small registry. Software installs, kernel updater
+#checks and image rebuilds run on several targets at once, with a limit on how many run together, and report
+#how each target got on. A server with no registry has just the original armhf target.
+
+import os
+import json
+import time
+
+REGISTRY_FILEPATH = "/etc/pinet-chroots.json"
+LTSP_ROOT = "/opt/ltsp"
+DEFAULT_NAME = "armhf"
+WORKERS = 2  #Image rebuilds and installs are heavy on CPU and disk, so only a couple run at once
+
+
+class chrootTarget():
+    """
+    One client image. name is the folder in /opt/ltsp and what ltsp-chroot --arch and ltsp-update-image are given.
+    bootFiles is the folder holding the SD card boot files for Raspberry Pis using this image.
+    """
+
+    name = ""
+    arch = ""
+    path = ""
+    nbd = True
+    bootFiles = ""
+
+    def __init__(self, name, arch="armhf", path=None, nbd=True, bootFiles=None):
+        super(chrootTarget, self).__init__()
+        checkName(name)
+        self.name = name
+        self.arch = arch
+        self.path = path or os.path.join(LTSP_ROOT, name)
+        self.nbd = nbd
+        self.bootFiles = bootFiles or os.path.join(self.path, "bootfiles")
+
+    def command(self, *args):
+        return ["ltsp-chroot", "--arch", self.name] + list(args)
+
+    def file(self, filepath):
+        """
+        Where a path inside the chroot (such as /etc/init.d/kernelCheckUpdate.sh) is on the server.
+        """
+        return os.path.join(self.path, filepath.lstrip("/"))
+
+    def rebuildCommand(self):
+        return ["ltsp-update-image", self.path]
+
+    def toDict(self):
+        return {"name": self.name, "arch": self.arch, "path": self.path, "nbd": self.nbd, "bootFiles": self.bootFiles}
+
+
+def checkName(name):
+    if not name or "/" in name or name.startswith("."):
+        raise ValueError("Not a valid chroot name: " + repr(name))
+
+
+def defaultTarget():
+    return chrootTarget(DEFAULT_NAME)
+
+
+#---------------- Registry -------------------
+
+def loadTargets(registryPath=REGISTRY_FILEPATH):
+    """
+    All registered targets, the default one first.
+    """
+    try:
+        with open(registryPath) as f:
+            data = json.load(f)
+    except (OSError, IOError, ValueError):
+        return [defaultTarget()]
+    targets = []
+    for item in data.get("targets", []):
+        try:
+            targets.append(chrootTarget(item["name"], item.get("arch", "armhf"), item.get("path"), item.get("nbd", True), item.get("bootFiles")))
+        except (KeyError, ValueError):
+            continue
+    if not targets:
+        return [defaultTarget()]
+    return targets
+
+
+def saveTargets(targets, registryPath=REGISTRY_FILEPATH):
+    temporary = registryPath + ".new"
+    with open(temporary, "w") as f:
+        json.dump({"targets": [target.toDict() for target in targets]}, f, indent=1)
+    os.replace(temporary, registryPath)
+
+
+def addTarget(target, registryPath=REGISTRY_FILEPATH):
+    """
+    Adds or replaces a target. The first target in the registry is the default.
+    """
+    targets = [existing for existing in loadTargets(registryPath) if existing.name != target.name]
+    targets.append(target)
+    saveTargets(targets, registryPath)
+
+
+def removeTarget(name, registryPath=REGISTRY_FILEPATH):
+    """
+    Removes a target from the registry (the chroot itself is left alone). The default target can't be removed.
+    """
+    targets = loadTargets(registryPath)
+    if targets[0].name == name:
+        raise ValueError("The default chroot can't be removed")
+    remaining = [target for target in targets if target.name != name]
+    if len(remaining) == len(targets):
+        return False
+    saveTargets(remaining, registryPath)
+    return True
+
+
+def selectTargets(names="all", registryPath=REGISTRY_FILEPATH):
+    """
+    names is "all", "default", or a comma separated list of target names.
+    """
+    targets = loadTargets(registryPath)
+    if names in ("", "all"):
+        return targets
+    if names == "default":
+        return targets[:1]
+    wanted = names.split(",")
+    unknown = [name for name in wanted if name not in [target.name for target in targets]]
+    if unknown:
+        raise ValueError("Unknown chroot: " + ", ".join(unknown))
+    return [target for target in targets if target.name in wanted]
+
+
+#---------------- Running on several targets -------------------
+
+class targetResult():
+    """
+    How one target got on. value is whatever the operation returned.
+    """
+
+    def __init__(self, name, ok, duration, value=None, error=""):
+        super(targetResult, self).__init__()
+        self.name = name
+        self.ok = ok
+        self.duration = duration
+        self.value = value
+        self.error = error
+
+    def summary(self):
+        status = "ok"
+        if not self.ok:
+            status = "FAILED"
+            if self.error:
+                status = status + " (" + self.error + ")"
+        return "%-20s %8.1fs %s" % (self.name, self.duration, status)
+
+
+class fanOutResult():
+
+    def __init__(self, results, duration):
+        super(fanOutResult, self).__init__()
+        self.results = results
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return all(result.ok for result in self.results)
+
+    def result(self, name):
+        for result in self.results:
+            if result.name == name:
+                return result
+        return None
+
+    def summary(self):
+        lines = [result.summary() for result in self.results]
+        lines.append("%-20s %8.1fs" % ("Total", self.duration))
+        return lines
+
+
+def runOnTarget(target, operation):
+    started = time.time()
+    try:
+        value = operation(target)
+    except Exception as error:
+        return targetResult(target.name, False, time.time() - started, error=str(error) or type(error).__name__)
+    ok = bool(value)
+    if hasattr(value, "ok"):
+        ok = value.ok
+    elif isinstance(value, int) and not isinstance(value, bool):
+        ok = value == 0  #A return code
+    return targetResult(target.name, ok, time.time() - started, value)
+
+
+def fanOut(targets, operation, workers=WORKERS):
+    """
+    Runs operation(target) for every target, at most workers at once. operation can return a commandResult, a
+    return code or True/False. An exception counts as a failure for that target only.
+    Returns a fanOutResult with the results in the same order as targets.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    started = time.time()
+    if not targets:
+        return fanOutResult([], 0.0)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as executor:
+        futures = [executor.submit(runOnTarget, target, operation) for target in targets]
+        results = [future.result() for future in futures]
+    return fanOutResult(results, time.time() - started)
@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetCompression.py
+#NBD image compression advisor used by pinet-functions-python.py.
+#ltsp-update-image builds the NBD image with whatever compression mksquashfs defaults to. A smaller image means less
+#to send over the network, but a Raspberry Pi's CPU has to decompress it, and heavier compression makes every image
+#rebuild slower. The advisor copies a sample of the chroot (hard links, so it is quick and takes no space) and builds
+#trial images from it with several compressors and block sizes, a few at once. It times each build, measures the
+#size, and times decompressing it again on one core. From those it estimates, for the whole chroot, how long a
+#rebuild would take and how long a Pi would spend loading what it reads while booting. The best profile is saved
+#to ltsp-update-image's config file so later image builds use it. The live image is never touched.
+
+import os
+import stat
+import time
+
+from pinetRunner import runCommand
+
+RESULTS_FILEPATH = "/var/lib/pinet/compression.json"
+LTSP_UPDATE_IMAGE_CONF = "/etc/ltsp/ltsp-update-image.conf"
+SAMPLE_BYTES = 200 * 1024 * 1024
+PROFILES = [("gzip", "128K"), ("lzo", "128K"), ("lz4", "128K"), ("xz", "256K"), ("xz", "1M"), ("zstd", "128K"), ("zstd", "1M")]
+BOOT_READ_BYTES = 160 * 1024 * 1024  #Roughly what a Pi reads from the image while booting, see pinetBootStorm.py
+NETWORK_BYTES_PER_SECOND = 11 * 1024 * 1024  #A Raspberry Pi's 100Mbit ethernet
+PI_SLOWDOWN = 6.0  #How many times slower one Raspberry Pi core decompresses than one server core, roughly
+MAX_BUILD_TIME = 15 * 60  #Profiles that would make a full rebuild slower than this aren't recommended
+TRIAL_TIMEOUT = 30 * 60
+PROFILE_MARKER = "#PiNet compression profile"
+
+
+def profileName(compressor, blockSize):
+    return compressor + " " + blockSize
+
+
+def profileOptions(compressor, blockSize):
+    return "-comp " + compressor + " -b " + blockSize
+
+
+def availableCompressors(helpText):
+    """
+    The compressors listed under "Compressors available" in mksquashfs -help.
+    """
+    compressors = []
+    listing = None  #How many tabs the "Compressors available" line is indented by, once found
+    for line in helpText.splitlines():
+        tabs = len(line) - len(line.lstrip("\t"))
+        if listing is None:
+            if "compressors available" in line.lower():
+                listing = tabs
+        elif line.strip() and tabs <= listing:
+            break
+        elif tabs == listing + 1 and line.strip() and line[tabs] not in " -":
+            compressors.append(line.split()[0])
+    return compressors
+
+
+#---------------- Sample -------------------
+
+def chrootFiles(chrootPath):
+    """
+    Every regular file in the chroot (without crossing into other filesystems) as (relative path, size).
+    """
+    device = os.lstat(chrootPath).st_dev
+    files = []
+    for root, folders, names in os.walk(chrootPath):
+        folders[:] = sorted(folder for folder in folders if os.lstat(os.path.join(root, folder)).st_dev == device)
+        for name in sorted(names):
+            filepath = os.path.join(root, name)
+            try:
+                info = os.lstat(filepath)
+            except OSError:
+                continue
+            if stat.S_ISREG(info.st_mode):
+                files.append((os.path.relpath(filepath, chrootPath), info.st_size))
+    return files
+
+
+def sampleChroot(chrootPath, destination, sampleBytes=SAMPLE_BYTES):
+    """
+    Fills destination with an evenly spread sample of the chroot's files (every nth file, so every part of the chroot
+    is in it), hard linked where possible. Returns (bytes in the sample, bytes in the whole chroot).
+    """
+    import shutil
+    files = chrootFiles(chrootPath)
+    total = sum(size for relative, size in files)
+    step = max(1, int(total / max(1, sampleBytes)))
+    sampled = 0
+    for i in range(0, len(files), step):
+        relative, size = files[i]
+        source = os.path.join(chrootPath, relative)
+        target = os.path.join(destination, relative)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        try:
+            os.link(source, target)
+        except OSError:
+            try:
+                shutil.copy2(source, target)
+            except (OSError, IOError):
+                continue
+        sampled = sampled + size
+    return sampled, total
+
+
+#---------------- Trials -------------------
+
+def trialBuild(sample, workFolder, compressor, blockSize, logPath=None):
+    """
+    Builds and then unpacks a trial image of sample on one core each way.
+    Returns a dict of buildTime, size and decompressTime (seconds and bytes), or error.
+    """
+    import shutil
+    name = compressor + "-" + blockSize
+    image = os.path.join(workFolder, name + ".img")
+    unpacked = os.path.join(workFolder, name + "-unpacked")
+    trial = {"compressor": compressor, "blockSize": blockSize, "buildTime": 0.0, "size": 0, "decompressTime": 0.0, "error": ""}
+    try:
+        started = time.time()
+        result = runCommand(["mksquashfs", sample, image, "-noappend", "-no-progress", "-processors", "1", "-comp", compressor, "-b", blockSize],
+                            timeout=TRIAL_TIMEOUT, logPath=logPath, name="trial " + name)
+        trial["buildTime"] = time.time() - started
+        if not result.ok:
+            trial["error"] = "mksquashfs failed: " + result.outputText()[-200:]
+            return trial
+        trial["size"] = os.path.getsize(image)
+        started = time.time()
+        result = runCommand(["unsquashfs", "-n", "-p", "1", "-d", unpacked, image], timeout=TRIAL_TIMEOUT, logPath=logPath, name="unpack " + name)
+        trial["decompressTime"] = time.time() - started
+        if not result.ok:
+            trial["error"] = "unsquashfs failed: " + result.outputText()[-200:]
+        return trial
+    finally:
+        shutil.rmtree(unpacked, ignore_errors=True)
+        try:
+            os.remove(image)
+        except OSError:
+            pass
+
+
+def runTrials(sample, workFolder, profiles, workers=None, logPath=None):
+    from concurrent.futures import ThreadPoolExecutor
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(profiles)))) as executor:
+        futures = [executor.submit(trialBuild, sample, workFolder, compressor, blockSize, logPath) for compressor, blockSize in profiles]
+        return [future.result() for future in futures]
+
+
+def estimate(trial, sampleBytes, totalBytes, cores=None, networkSpeed=NETWORK_BYTES_PER_SECOND, piSlowdown=PI_SLOWDOWN):
+    """
+    Scales a trial up to the whole chroot. Adds ratio, fullSize, fullBuildTime (mksquashfs uses every core) and
+    bootLoadTime: seconds for a Pi to fetch and decompress what it reads while booting.
+    """
+    if cores is None:
+        cores = os.cpu_count() or 1
+    scale = float(totalBytes) / max(1, sampleBytes)
+    ratio = float(trial["size"]) / max(1, sampleBytes)
+    decompressSpeed = sampleBytes / max(trial["decompressTime"], 1e-6) / piSlowdown
+    estimated = dict(trial)
+    estimated["ratio"] = ratio
+    estimated["fullSize"] = int(trial["size"] * scale)
+    estimated["fullBuildTime"] = trial["buildTime"] * scale / cores
+    estimated["piDecompressSpeed"] = decompressSpeed
+    estimated["bootLoadTime"] = BOOT_READ_BYTES * ratio / networkSpeed + BOOT_READ_BYTES / decompressSpeed
+    return estimated
+
+
+def recommend(trials, sampleBytes, totalBytes, cores=None, networkSpeed=NETWORK_BYTES_PER_SECOND, maxBuildTime=MAX_BUILD_TIME):
+    """
+    Ranks the trials that worked, quickest boot load first (smaller image breaks ties). Trials that would make
+    rebuilds take longer than maxBuildTime go last. Returns the ranked estimates.
+    """
+    estimates = [estimate(trial, sampleBytes, totalBytes, cores, networkSpeed) for trial in trials if not trial["error"]]
+    return sorted(estimates, key=lambda item: (item["fullBuildTime"] > maxBuildTime, round(item["bootLoadTime"], 1), item["fullSize"]))
+
+
+def advise(chrootPath, workFolder, profiles=None, sampleBytes=SAMPLE_BYTES, workers=None, logPath=None, helpText=None):
+    """
+    Samples the chroot and runs the trials in workFolder, which is emptied afterwards.
+    Returns {"sampleBytes", "totalBytes", "ranked", "failed"}.
+    """
+    import shutil
+    if helpText is None:
+        helpText = runCommand(["mksquashfs", "-help"], timeout=60).outputText()
+    available = availableCompressors(helpText)
+    if profiles is None:
+        profiles = PROFILES
+    profiles = [profile for profile in profiles if not available or profile[0] in available]
+    sample = os.path.join(workFolder, "sample")
+    try:
+        sampled, total = sampleChroot(chrootPath, sample, sampleBytes)
+        trials = runTrials(sample, workFolder, profiles, workers, logPath)
+    finally:
+        shutil.rmtree(workFolder, ignore_errors=True)
+    return {"created": time.time(), "chroot": chrootPath, "sampleBytes": sampled, "totalBytes": total,
+            "ranked": recommend(trials, sampled, total), "failed": [trial for trial in trials if trial["error"]]}
+
+
+#---------------- Saved profile -------------------
+
+def saveProfile(compressor, blockSize, confPath=LTSP_UPDATE_IMAGE_CONF):
+    """
+    Sets the mksquashfs options ltsp-update-image uses (its NO_COMP setting, which is passed straight to mksquashfs).
+    Other settings in the file are kept.
+    """
+    lines = []
+    try:
+        with open(confPath) as f:
+            lines = f.read().splitlines()
+    except (OSError, IOError):
+        pass
+    kept = []
+    skipNext = False
+    for line in lines:
+        if skipNext:
+            skipNext = False
+            if line.startswith("NO_COMP="):
+                continue
+        if line == PROFILE_MARKER:
+            skipNext = True
+            continue
+        kept.append(line)
+    kept.append(PROFILE_MARKER)
+    kept.append('NO_COMP="' + profileOptions(compressor, blockSize) + '"')
+    folder = os.path.dirname(confPath)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    temporary = confPath + ".new"
+    with open(temporary, "w") as f:
+        f.write("\n".join(kept) + "\n")
+    os.replace(temporary, confPath)
+
+
+def loadProfile(confPath=LTSP_UPDATE_IMAGE_CONF):
+    """
+    The (compressor, block size) saved by saveProfile, or None.
+    """
+    try:
+        with open(confPath) as f:
+            lines = f.read().splitlines()
+    except (OSError, IOError):
+        return None
+    for i in range(len(lines) - 1):
+        if lines[i] == PROFILE_MARKER and lines[i + 1].startswith("NO_COMP="):
+            words = lines[i + 1][len("NO_COMP="):].strip('"').split()
+            if len(words) == 4 and words[0] == "-comp" and words[2] == "-b":
+                return words[1], words[3]
+    return None
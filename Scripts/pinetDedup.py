@@ -0,0 +1,368 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetDedup.py
+#Deduplication of identical files across home folders, used by pinet-functions-python.py.
+#CopyToUsers and FixDesktopIcons give every user their own copy of the same files (python_games, for one), and pupils
+#download the same course files, so /home holds thousands of identical copies that backups carry again and again.
+#Files are grouped by size, then by a hash of their first and last 64K, then by a hash of the whole file, so most files
+#are never read in full. Hashing is spread across worker processes. On filesystems that can share data between files
+#(btrfs, XFS), each duplicate is then made to share the first copy's data with the FIDEDUPERANGE ioctl. This is the
+#same reflink sharing as cp --reflink, done in place: the kernel checks the bytes are the same first, and each file keeps
+#its own inode, owner and permissions. A write to a shared file only changes that user's copy. Hashes and finished files
+#are saved as the pass goes, so an interrupted pass carries on from where it was, and a later pass only hashes new or
+#changed files. A report-only pass shows how much space could be reclaimed.
+
+import os
+import time
+import hashlib
+
+from pinetFiles import writeJSONAtomic, readJSON, homeFolders
+
+HOME_ROOT = "/home"
+STATE_FILEPATH = "/var/lib/pinet/dedup/state.json"
+REPORT_FILEPATH = "/var/lib/pinet/dedup/report.json"
+MIN_SIZE = 16 * 1024  #Smaller files save little, as data is shared in whole blocks
+PARTIAL_SIZE = 64 * 1024  #Read from each end of a file for the partial hash
+BLOCK_SIZE = 1024 * 1024
+DEDUPE_CHUNK = 16 * 1024 * 1024  #Most filesystems share at most this much per ioctl call
+WORKERS = 4
+SAVE_INTERVAL = 30  #Seconds between saves of the state while a pass runs
+FIDEDUPERANGE = 0xC0189436  #_IOWR(0x94, 54, struct file_dedupe_range) from linux/fs.h
+FILE_DEDUPE_RANGE_DIFFERS = 1
+
+
+#---------------- Finding duplicates -------------------
+
+def listFiles(root, user, minSize=MIN_SIZE):
+    """
+    Regular files of at least minSize in a home folder, as (path, size, mtime_ns, inode). Symlinks aren't followed and
+    other filesystems (such as the bindfs mounts of shared folders) aren't entered.
+    """
+    import stat
+    top = os.path.join(root, user)
+    try:
+        device = os.lstat(top).st_dev
+    except OSError:
+        return []
+    files = []
+    pending = [top]
+    while pending:
+        folder = pending.pop()
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                info = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if info.st_dev != device:
+                continue
+            if stat.S_ISDIR(info.st_mode):
+                pending.append(entry.path)
+            elif stat.S_ISREG(info.st_mode) and info.st_size >= minSize:
+                files.append((entry.path, info.st_size, info.st_mtime_ns, info.st_ino))
+    return files
+
+
+def partialHash(path, size):
+    """
+    Hash of the first and last PARTIAL_SIZE bytes. For files no bigger than that twice over, this covers the whole file.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        digest.update(f.read(PARTIAL_SIZE))
+        if size > PARTIAL_SIZE:
+            f.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+            digest.update(f.read(PARTIAL_SIZE))
+    return digest.hexdigest()
+
+
+def fullHash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hashJob(job):
+    """
+    Runs in a worker process. job is (kind, path, size). Returns (path, hash), with None for the hash if the file
+    can't be read.
+    """
+    kind, path, size = job
+    try:
+        if kind == "partial":
+            return path, partialHash(path, size)
+        return path, fullHash(path)
+    except (OSError, IOError):
+        return path, None
+
+
+def groupBy(files, key):
+    groups = {}
+    for item in files:
+        value = key(item)
+        if value is not None:
+            groups.setdefault(value, []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+class dedupState():
+    """
+    What a pass has found out so far, kept between passes. hashes holds the partial and full hash of each file, for as
+    long as its size, modification time and inode stay the same. shared holds the files already made to share their
+    data with their group, so they aren't done again.
+    """
+
+    def __init__(self, filepath=STATE_FILEPATH, hashes=None, shared=None):
+        super(dedupState, self).__init__()
+        self.filepath = filepath
+        self.hashes = hashes or {}
+        self.shared = shared or {}
+        self.saved = time.time()
+
+    @classmethod
+    def load(cls, filepath=STATE_FILEPATH):
+        data = readJSON(filepath)
+        if not isinstance(data, dict):
+            return cls(filepath)
+        return cls(filepath, data.get("hashes"), data.get("shared"))
+
+    def save(self, force=True):
+        if force or time.time() - self.saved >= SAVE_INTERVAL:
+            writeJSONAtomic({"hashes": self.hashes, "shared": self.shared}, self.filepath, compact=True)
+            self.saved = time.time()
+
+    def cached(self, item, kind):
+        path, size, mtime, inode = item
+        known = self.hashes.get(path)
+        if known is None or known["signature"] != [size, mtime, inode]:
+            return None
+        return known.get(kind)
+
+    def remember(self, item, kind, value):
+        path, size, mtime, inode = item
+        known = self.hashes.get(path)
+        if known is None or known["signature"] != [size, mtime, inode]:
+            known = {"signature": [size, mtime, inode]}
+            self.hashes[path] = known
+        known[kind] = value
+
+    def isShared(self, item):
+        path, size, mtime, inode = item
+        return self.shared.get(path) == [size, mtime, inode]
+
+    def forget(self, items):
+        """
+        Drops files that are no longer there or have changed since they were looked at.
+        """
+        present = dict((path, [size, mtime, inode]) for path, size, mtime, inode in items)
+        for path in [path for path in self.hashes if self.hashes[path]["signature"] != present.get(path)]:
+            del self.hashes[path]
+        for path in [path for path in self.shared if self.shared[path] != present.get(path)]:
+            del self.shared[path]
+
+
+def hashAll(items, kind, state, workers=WORKERS):
+    """
+    Fills in the kind (partial or full) hash of each item, from the state where the file hasn't changed, otherwise
+    across worker processes. Returns {path: hash}.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    results = {}
+    needed = []
+    for item in items:
+        value = state.cached(item, kind)
+        if value is None:
+            needed.append(item)
+        else:
+            results[item[0]] = value
+    if needed:
+        byPath = dict((item[0], item) for item in needed)
+        jobs = [(kind, item[0], item[1]) for item in needed]
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+            for path, value in executor.map(hashJob, jobs, chunksize=16):
+                if value is not None:
+                    results[path] = value
+                    state.remember(byPath[path], kind, value)
+                    state.save(force=False)
+    return results
+
+
+def findDuplicates(root=HOME_ROOT, state=None, workers=WORKERS, minSize=MIN_SIZE):
+    """
+    Returns (groups, scanned), where groups is a list of lists of identical files (path, size, mtime_ns, inode) and
+    scanned is how many files were looked at. Hard links to one file count as one.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if state is None:
+        state = dedupState()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        listed = executor.map(lambda user: listFiles(root, user, minSize), homeFolders(root))
+        files = [item for userFiles in listed for item in userFiles]
+    state.forget(files)
+    inodes = {}
+    for item in sorted(files):
+        inodes.setdefault(item[3], item)
+    files = list(inodes.values())
+    bySize = [item for group in groupBy(files, lambda item: item[1]) for item in group]
+    partial = hashAll(bySize, "partial", state, workers)
+    byPartial = groupBy(bySize, lambda item: (item[1], partial.get(item[0])) if item[0] in partial else None)
+    candidates = [item for group in byPartial for item in group]
+    full = {}
+    for item in candidates:
+        if item[1] <= 2 * PARTIAL_SIZE:
+            full[item[0]] = partial[item[0]]  #The partial hash already covered the whole file
+    full.update(hashAll([item for item in candidates if item[0] not in full], "full", state, workers))
+    groups = groupBy(candidates, lambda item: (item[1], full.get(item[0])) if item[0] in full else None)
+    state.save()
+    return [sorted(group) for group in sorted(groups, key=lambda group: -group[0][1] * (len(group) - 1))], len(files)
+
+
+#---------------- Sharing data -------------------
+
+def dedupeRange(sourceFd, destinationFd, offset, length):
+    """
+    Asks the kernel to share length bytes at offset between two open files, if they are the same.
+    Returns the bytes shared, 0 if they differ. Raises OSError if the filesystem can't share data.
+    """
+    import fcntl
+    import struct
+    request = bytearray(struct.pack("=QQHHI", offset, length, 1, 0, 0) + struct.pack("=qQQiI", destinationFd, offset, 0, 0, 0))
+    fcntl.ioctl(sourceFd, FIDEDUPERANGE, request)
+    bytesDeduped, status = struct.unpack_from("=Qi", request, 24 + 16)
+    if status < 0:
+        raise OSError(-status, os.strerror(-status))
+    if status == FILE_DEDUPE_RANGE_DIFFERS:
+        return 0
+    return bytesDeduped
+
+
+def shareFile(source, destination, size):
+    """
+    Makes destination share source's data. Returns the bytes shared, which is less than size if the files differ.
+    """
+    sourceFd = os.open(source, os.O_RDONLY)
+    try:
+        destinationFd = os.open(destination, os.O_RDWR)
+        try:
+            shared = 0
+            offset = 0
+            while offset < size:
+                length = min(DEDUPE_CHUNK, size - offset)
+                done = dedupeRange(sourceFd, destinationFd, offset, length)
+                if done == 0:
+                    break
+                shared = shared + done
+                offset = offset + done
+            return shared
+        finally:
+            os.close(destinationFd)
+    finally:
+        os.close(sourceFd)
+
+
+def sharingSupported(folder):
+    """
+    Tries sharing the data of two small identical files in folder.
+    """
+    probe = os.path.join(folder, ".pinet-dedup-probe")
+    data = b"PiNet" * 4096
+    try:
+        for filepath in [probe, probe + "-copy"]:
+            with open(filepath, "wb") as f:
+                f.write(data)
+        try:
+            return shareFile(probe, probe + "-copy", len(data)) > 0
+        except OSError:
+            return False
+    except (OSError, IOError):
+        return False
+    finally:
+        for filepath in [probe, probe + "-copy"]:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+
+def deduplicate(groups, state):
+    """
+    Makes every file in each group share the data of the group's first file. Files changed since they were hashed
+    are left alone. Returns (files shared, bytes shared, problems).
+    """
+    files = 0
+    reclaimed = 0
+    problems = []
+    for group in groups:
+        source = group[0]
+        for item in group[1:]:
+            path, size, mtime, inode = item
+            if state.isShared(item):
+                continue
+            try:
+                info = os.lstat(path)
+                if [info.st_size, info.st_mtime_ns, info.st_ino] != [size, mtime, inode]:
+                    continue  #Changed since it was hashed, so it is looked at again next pass
+                shared = shareFile(source[0], path, size)
+            except OSError as error:
+                problems.append(path + ": " + str(error))
+                continue
+            if shared >= size:
+                files = files + 1
+                reclaimed = reclaimed + size
+                state.shared[path] = [size, mtime, inode]
+                state.save(force=False)
+    state.save()
+    return files, reclaimed, problems
+
+
+#---------------- Passes -------------------
+
+def run(root=HOME_ROOT, apply=False, statePath=STATE_FILEPATH, reportPath=REPORT_FILEPATH, workers=WORKERS, minSize=MIN_SIZE, now=None):
+    """
+    One deduplication pass over root. apply=False only reports. Returns the report, which is also saved to reportPath.
+    """
+    if now is None:
+        now = time.time()
+    started = time.time()
+    state = dedupState.load(statePath)
+    groups, scanned = findDuplicates(root, state, workers, minSize)
+    supported = sharingSupported(root)
+    files, reclaimed, problems = 0, 0, []
+    if apply and supported:
+        files, reclaimed, problems = deduplicate(groups, state)
+    duplicateSize = sum(group[0][1] * (len(group) - 1) for group in groups)
+    alreadyShared = sum(item[1] for group in groups for item in group[1:] if state.isShared(item))
+    report = {"date": now, "duration": time.time() - started, "scanned": scanned, "groups": len(groups),
+              "duplicates": sum(len(group) - 1 for group in groups), "duplicateSize": duplicateSize,
+              "alreadyShared": alreadyShared - reclaimed, "sharedFiles": files, "reclaimed": reclaimed, "applied": bool(apply and supported),
+              "supported": supported, "problems": problems[:50],
+              "largest": [{"size": group[0][1], "copies": len(group), "paths": [item[0] for item in group[:5]]} for group in groups[:10]]}
+    writeJSONAtomic(report, reportPath, compact=True)
+    return report
+
+
+def formatReport(report, formatSize, root=HOME_ROOT):
+    lines = ["%d files looked at in %.0fs, %d groups of identical files, %d copies too many taking %s" % (
+        report["scanned"], report["duration"], report["groups"], report["duplicates"], formatSize(report["duplicateSize"]))]
+    if not report["supported"]:
+        lines.append("The filesystem " + root + " is on can't share data between files (it needs btrfs or XFS), so nothing can be reclaimed")
+    elif report["applied"]:
+        lines.append("%d files now share their data, reclaiming %s" % (report["sharedFiles"], formatSize(report["reclaimed"])))
+        if report["alreadyShared"]:
+            lines.append(formatSize(report["alreadyShared"]) + " was already shared by an earlier pass")
+    else:
+        lines.append("Sharing the copies would reclaim up to " + formatSize(report["duplicateSize"] - report["alreadyShared"]))
+    for group in report["largest"]:
+        lines.append("  %s x %d: %s" % (formatSize(group["size"]), group["copies"], ", ".join(os.path.relpath(path, root) for path in group["paths"][:3])))
+    for problem in report["problems"]:
+        lines.append("  " + problem)
+    return lines
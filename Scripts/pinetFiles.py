@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetFiles.py
+#File helpers shared by the PiNet Python modules.
+#State, indexes and reports are kept as JSON files that are written to a temporary file and renamed into place, so a
+#reader never sees half a file and a crash leaves the previous one. Each write has its own temporary file, so threads
+#or processes writing the same file at once can't rename each other's half written copy.
+
+import os
+import json
+
+
+def writeTextAtomic(text, filepath, private=False):
+    """
+    Writes text to a temporary file next to filepath, flushes it to disk and renames it over filepath. The file keeps
+    the mode it had, or gets 0644 (0600 with private, which also makes a missing folder 0700).
+    """
+    import tempfile
+    folder = os.path.dirname(filepath) or "."
+    if not os.path.isdir(folder):
+        os.makedirs(folder, 0o700 if private else 0o777)
+    mode = 0o600
+    if not private:
+        try:
+            mode = os.stat(filepath).st_mode & 0o7777
+        except OSError:
+            mode = 0o644
+    descriptor, temporary = tempfile.mkstemp(prefix="." + os.path.basename(filepath) + ".", suffix=".new", dir=folder)
+    try:
+        with os.fdopen(descriptor, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temporary, mode)
+        os.replace(temporary, filepath)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def writeJSONAtomic(data, filepath, compact=False, sortKeys=False, private=False):
+    """
+    Writes data to filepath as JSON, see writeTextAtomic. compact leaves out the whitespace, for big files. private
+    makes the file readable by its owner only, and a missing folder too.
+    """
+    if compact:
+        text = json.dumps(data, separators=(",", ":"), sort_keys=sortKeys)
+    else:
+        text = json.dumps(data, indent=1, sort_keys=sortKeys)
+    writeTextAtomic(text, filepath, private)
+
+
+def readJSON(filepath):
+    """
+    The data in a JSON file, or None if it is missing or damaged.
+    """
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def homeFolders(root):
+    """
+    The names of the folders in root, normally one for each user. Hidden folders are skipped, as the .pinet-retiring
+    staging folder of retired users is kept there.
+    """
+    folders = []
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False) and not entry.name.startswith("."):
+            folders.append(entry.name)
+    return sorted(folders)
+
+
+def runAs(user, function, *args):
+    """
+    Runs function(*args) in a child process with the user's uid and gid, and no other groups, and returns what it
+    returns. Used as root, so files in a user's home folder are only read or written with their own rights and a
+    symlink they leave there can't point root anywhere else. Raises OSError if function failed.
+    """
+    import pwd
+    import pickle
+    entry = pwd.getpwnam(user)
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(reader)
+        status = 1
+        try:
+            os.setgroups([])
+            os.setgid(entry.pw_gid)
+            os.setuid(entry.pw_uid)
+            data = pickle.dumps(function(*args))
+            with os.fdopen(writer, "wb") as f:
+                f.write(data)
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(writer)
+    with os.fdopen(reader, "rb") as f:
+        data = f.read()
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise OSError("failed running as " + user)
+    return pickle.loads(data)
@@ -0,0 +1,386 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetGallery.py
+#Screenshot gallery for teachers, used by pinet-functions-python.py.
+#pinet-screenshot.sh keeps each capture in ~/Screenshots with the time it was taken in its name, rather than
+#overwriting ~/screenshot.png. The gallery is a contact sheet for a group: one page with the latest captures of every
+#member as small thumbnails, each linking to the full capture. Thumbnails are kept in a cache keyed by the capture's
+#path, modification time and size, so only new captures are ever shrunk, and they are made across worker processes.
+#Captures older than a number of days, or over a pupil's quota, are removed by a nightly pass.
+
+import os
+import re
+import time
+import hashlib
+
+HOME_ROOT = "/home"
+CAPTURE_FOLDER = "Screenshots"
+CAPTURE_PATTERN = re.compile(r"^screenshot-(\d{8}-\d{6})\.png$")  #As named by pinet-screenshot.sh
+CACHE_FOLDER = "/var/cache/pinet/thumbnails"
+GALLERY_FOLDER = "Screenshot-gallery"  #In the teacher's home folder, one folder for each group
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 80
+PER_USER = 8  #Latest captures shown for each member of a group
+MAX_AGE = 30  #Days a capture is kept, ScreenshotMaxAge in /etc/pinet
+QUOTA = 100 * 1024 * 1024  #Bytes of captures kept for each user, ScreenshotQuota (in MB) in /etc/pinet
+WORKERS = 4
+PASSWD_FILEPATH = "/etc/passwd"
+GROUP_FILEPATH = "/etc/group"
+
+
+def groupMembers(group, passwdPath=PASSWD_FILEPATH, groupPath=GROUP_FILEPATH):
+    """
+    Returns {user: home folder} for everyone in group.
+    """
+    from pinetHandin import readPupils
+    return readPupils(passwdPath, groupPath, group)
+
+
+def allUsers(passwdPath=PASSWD_FILEPATH, homeRoot=HOME_ROOT):
+    """
+    Returns {user: home folder} for every user with a home folder under homeRoot.
+    """
+    users = {}
+    try:
+        with open(passwdPath) as f:
+            for line in f:
+                fields = line.rstrip("\n").split(":")
+                if len(fields) >= 7 and os.path.dirname(os.path.normpath(fields[5])) == os.path.normpath(homeRoot):
+                    users[fields[0]] = fields[5]
+    except (OSError, IOError):
+        pass
+    return users
+
+
+#---------------- Captures -------------------
+
+def openCaptureFolder(home):
+    """
+    Opens home/Screenshots, returning its file descriptor, or None unless it is a real folder owned by the owner of
+    home. The nightly pass runs as root, so a pupil mustn't be able to point it at someone else's files.
+    """
+    import stat
+    try:
+        owner = os.lstat(home).st_uid
+        fd = os.open(os.path.join(home, CAPTURE_FOLDER), os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    info = os.fstat(fd)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != owner:
+        os.close(fd)
+        return None
+    return fd
+
+
+def findCaptures(users):
+    """
+    Returns [(user, path, mtime, size)] for every capture in the users' Screenshots folders, newest first.
+    Symlinks are ignored, so a pupil can't point the gallery at someone else's files.
+    """
+    import stat
+    captures = []
+    for user in sorted(users):
+        folder = os.path.join(users[user], CAPTURE_FOLDER)
+        fd = openCaptureFolder(users[user])
+        if fd is None:
+            continue
+        try:
+            for name in os.listdir(fd):
+                if CAPTURE_PATTERN.match(name) is None:
+                    continue
+                try:
+                    info = os.stat(name, dir_fd=fd, follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISREG(info.st_mode):
+                    captures.append((user, os.path.join(folder, name), info.st_mtime, info.st_size))
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    captures.sort(key=lambda capture: (-capture[2], capture[1]))
+    return captures
+
+
+def pruneCaptures(captures, now=None, maxAge=MAX_AGE, quota=QUOTA):
+    """
+    Deletes captures older than maxAge days, then each user's oldest captures until what is left fits in quota bytes.
+    Returns the captures that were kept.
+    """
+    if now is None:
+        now = time.time()
+    kept = []
+    used = {}
+    for capture in sorted(captures, key=lambda capture: -capture[2]):  #Newest first, so the oldest go over the quota
+        user, path, mtime, size = capture
+        if now - mtime > maxAge * 86400 or used.get(user, 0) + size > quota:
+            if not removeCapture(path):
+                kept.append(capture)
+            continue
+        used[user] = used.get(user, 0) + size
+        kept.append(capture)
+    return kept
+
+
+def removeCapture(path):
+    """
+    Deletes a capture without following a symlink put in place of its folder since it was found. Returns True if it
+    was deleted.
+    """
+    fd = openCaptureFolder(os.path.dirname(os.path.dirname(path)))
+    if fd is None:
+        return False
+    try:
+        os.remove(os.path.basename(path), dir_fd=fd)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+#---------------- Thumbnails -------------------
+
+def thumbnailKey(path, mtime, size):
+    return hashlib.sha1(("%s\0%r\0%d" % (path, mtime, size)).encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def thumbnailPath(key, cacheFolder=CACHE_FOLDER):
+    return os.path.join(cacheFolder, key[:2], key + ".jpg")
+
+
+def thumbnailMethod():
+    """
+    pil if python3-pil is installed, otherwise convert if ImageMagick is, otherwise None.
+    """
+    import shutil
+    try:
+        import PIL.Image
+        return "pil"
+    except ImportError:
+        pass
+    if shutil.which("convert") is not None:
+        return "convert"
+    return None
+
+
+def thumbnailData(source, method="pil", size=THUMBNAIL_SIZE):
+    """
+    Returns source shrunk to fit in size x size, as JPEG data. Only PNG is read, whatever the file holds, as
+    ImageMagick would otherwise pick a reader (MVG, SVG or MSL, for example) from what a pupil put in it.
+    """
+    if method == "pil":
+        import io
+        import PIL.Image
+        output = io.BytesIO()
+        with PIL.Image.open(source, formats=["PNG"]) as image:
+            image.draft("RGB", (size, size))
+            image = image.convert("RGB")
+            image.thumbnail((size, size))
+            image.save(output, "JPEG", quality=THUMBNAIL_QUALITY)
+        return output.getvalue()
+    from subprocess import run, PIPE, DEVNULL
+    result = run(["convert", "png:" + source + "[0]", "-thumbnail", "%dx%d" % (size, size), "-quality", str(THUMBNAIL_QUALITY), "jpg:-"],
+                 stdout=PIPE, stderr=DEVNULL)
+    if result.returncode != 0 or not result.stdout:
+        raise OSError("convert could not read " + source)
+    return result.stdout
+
+
+def makeThumbnail(source, destination, method="pil", size=THUMBNAIL_SIZE, user=None):
+    """
+    Shrinks source to fit in size x size as a JPEG, written next to destination and renamed over it. When run as
+    root, the capture is read and shrunk as user, its owner (see pinetFiles.runAs).
+    """
+    if user is not None and os.geteuid() == 0:
+        from pinetFiles import runAs
+        data = runAs(user, thumbnailData, source, method, size)
+    else:
+        data = thumbnailData(source, method, size)
+    temporary = destination + ".new"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, destination)
+
+
+def thumbnailJob(job):
+    """
+    Runs in a worker process. Returns (destination, error or None).
+    """
+    source, destination, method, user = job
+    try:
+        makeThumbnail(source, destination, method, user=user)
+        return destination, None
+    except Exception as error:  #A damaged or half written capture, for example
+        try:
+            os.remove(destination + ".new")
+        except OSError:
+            pass
+        return destination, str(error)
+
+
+def updateCache(captures, cacheFolder=CACHE_FOLDER, workers=WORKERS, method=None, prune=False, make=None):
+    """
+    Makes the thumbnails missing from the cache. Returns ({capture path: thumbnail path}, made, errors). With prune,
+    thumbnails of captures that aren't in captures any more are deleted. make(source, destination) replaces the worker
+    processes, for callers with their own way of shrinking images.
+    """
+    thumbnails = {}
+    jobs = []
+    for user, path, mtime, size in captures:
+        destination = thumbnailPath(thumbnailKey(path, mtime, size), cacheFolder)
+        thumbnails[path] = destination
+        if not os.path.isfile(destination):
+            jobs.append((path, destination, user))
+    errors = []
+    if jobs:
+        if method is None and make is None:
+            method = thumbnailMethod()
+        if method is None and make is None:
+            return dict((path, thumbnail) for path, thumbnail in thumbnails.items() if os.path.isfile(thumbnail)), 0, ["Install python3-pil or imagemagick to make thumbnails"]
+        for folder in set(os.path.dirname(destination) for source, destination, user in jobs):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        if make is not None:
+            results = []
+            for source, destination, user in jobs:
+                try:
+                    make(source, destination)
+                    results.append((destination, None))
+                except OSError as error:
+                    results.append((destination, str(error)))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+                results = list(executor.map(thumbnailJob, [(source, destination, method, user) for source, destination, user in jobs], chunksize=4))
+        errors = [os.path.basename(destination) + ": " + error for destination, error in results if error]
+    if prune:
+        wanted = set(thumbnails.values())
+        for folder, folders, files in os.walk(cacheFolder):
+            for name in files:
+                if os.path.join(folder, name) not in wanted:
+                    os.remove(os.path.join(folder, name))
+    made = sum(1 for source, destination, user in jobs if os.path.isfile(destination))
+    return dict((path, thumbnail) for path, thumbnail in thumbnails.items() if os.path.isfile(thumbnail)), made, errors
+
+
+#---------------- Contact sheets -------------------
+
+def escape(text):
+    import html
+    return html.escape(text, quote=True)
+
+
+def captureTime(path, mtime):
+    match = CAPTURE_PATTERN.match(os.path.basename(path))
+    if match is not None:
+        try:
+            return time.mktime(time.strptime(match.group(1), "%Y%m%d-%H%M%S"))
+        except ValueError:
+            pass
+    return mtime
+
+
+def linkOrCopy(source, destination):
+    import shutil
+    if os.path.exists(destination):
+        return
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def writeContactSheet(group, members, captures, thumbnails, outputFolder, perUser=PER_USER, now=None):
+    """
+    Writes outputFolder/index.html, with a row for each member of the group holding their latest perUser captures.
+    The thumbnails it uses are linked (or copied) into outputFolder/thumbs, and ones it no longer uses are removed.
+    Returns the number of captures shown.
+    """
+    if now is None:
+        now = time.time()
+    thumbs = os.path.join(outputFolder, "thumbs")
+    if not os.path.isdir(thumbs):
+        os.makedirs(thumbs)
+    byUser = {}
+    for capture in captures:
+        byUser.setdefault(capture[0], []).append(capture)
+    used = set()
+    shown = 0
+    rows = []
+    for user in sorted(members):
+        latest = byUser.get(user, [])[:perUser]
+        cells = []
+        for owner, path, mtime, size in latest:
+            taken = time.strftime("%d/%m %H:%M", time.localtime(captureTime(path, mtime)))
+            if path in thumbnails:
+                name = os.path.basename(thumbnails[path])
+                linkOrCopy(thumbnails[path], os.path.join(thumbs, name))
+                used.add(name)
+                picture = '<img src="thumbs/%s" alt="%s" loading="lazy">' % (escape(name), escape(taken))
+            else:
+                picture = '<span class="missing">no thumbnail</span>'
+            cells.append('<a href="file://%s">%s<br>%s</a>' % (escape(path), picture, escape(taken)))
+            shown = shown + 1
+        count = len(byUser.get(user, []))
+        if not cells:
+            cells.append('<span class="missing">no screenshots</span>')
+        rows.append('<tr><th>%s<br><small>%d saved</small></th><td>%s</td></tr>' % (escape(user), count, "".join(cells)))
+    page = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>Screenshots - %s</title>' % escape(group),
+            '<style>body{font-family:sans-serif}th{text-align:left;vertical-align:top;padding-right:1em}'
+            'td a{display:inline-block;margin:0 6px 6px 0;text-align:center;font-size:small;color:inherit}'
+            'img{max-width:%dpx;max-height:%dpx;border:1px solid #ccc}.missing{color:#888}</style></head><body>' % (THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+            '<h1>Screenshots - %s</h1>' % escape(group),
+            '<p>%d members, %d screenshots shown. Made %s.</p>' % (len(members), shown, escape(time.strftime("%d/%m/%Y %H:%M", time.localtime(now)))),
+            '<table>'] + rows + ['</table></body></html>']
+    temporary = os.path.join(outputFolder, "index.html.new")
+    with open(temporary, "w") as f:
+        f.write("\n".join(page) + "\n")
+    os.replace(temporary, os.path.join(outputFolder, "index.html"))
+    for name in os.listdir(thumbs):
+        if name not in used:
+            os.remove(os.path.join(thumbs, name))
+    return shown
+
+
+def build(group, outputFolder, cacheFolder=CACHE_FOLDER, workers=WORKERS, perUser=PER_USER, members=None, make=None, now=None):
+    """
+    Brings the thumbnails for a group up to date and writes its contact sheet. Returns a summary dictionary.
+    """
+    started = time.time()
+    if members is None:
+        members = groupMembers(group)
+    captures = findCaptures(members)
+    latest = []
+    counts = {}
+    for capture in captures:  #Only the captures that will be shown need thumbnails
+        counts[capture[0]] = counts.get(capture[0], 0) + 1
+        if counts[capture[0]] <= perUser:
+            latest.append(capture)
+    thumbnails, made, errors = updateCache(latest, cacheFolder, workers, make=make)
+    shown = writeContactSheet(group, members, captures, thumbnails, outputFolder, perUser, now)
+    return {"members": len(members), "captures": len(captures), "shown": shown, "made": made, "errors": errors,
+            "duration": time.time() - started, "page": os.path.join(outputFolder, "index.html")}
+
+
+def maintain(users=None, cacheFolder=CACHE_FOLDER, workers=WORKERS, maxAge=MAX_AGE, quota=QUOTA, make=None, now=None):
+    """
+    The nightly pass: removes old captures and those over quota, makes thumbnails for the latest of each user's
+    captures and removes thumbnails nothing uses any more. Returns a summary dictionary.
+    """
+    if users is None:
+        users = allUsers()
+    captures = findCaptures(users)
+    kept = pruneCaptures(captures, now, maxAge, quota)
+    latest = []
+    counts = {}
+    for capture in kept:
+        counts[capture[0]] = counts.get(capture[0], 0) + 1
+        if counts[capture[0]] <= PER_USER:
+            latest.append(capture)
+    thumbnails, made, errors = updateCache(latest, cacheFolder, workers, prune=True, make=make)
+    return {"captures": len(kept), "removed": len(captures) - len(kept), "made": made, "thumbnails": len(thumbnails), "errors": errors}
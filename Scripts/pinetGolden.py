@@ -0,0 +1,367 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetGolden.py
+#Golden chroot cache, used by pinet-functions-python.py.
+#buildClient runs ltsp-build-client, a debootstrap of Raspbian under qemu followed by package installs. It is the
+#longest part of a full install, and a school rebuilding a server gets the same chroot from the same ltsp-raspbian.conf
+#each time. After a real build, the fresh chroot is exported to the cache as several compressed tar archives, with a
+#manifest holding their checksums and how long the build took. The cache entry is keyed by the build config, the
+#fingerprints of the keys in the keyring it was built with, the architecture and the version of ltsp-server. When
+#buildClient finds an entry with the same key, the archives are unpacked side by side (one process per archive, each
+#checked against its checksum as it is read) into a folder next to the chroot, which is only moved into place once every
+#archive has checked out. Otherwise, a real build runs. The cache folder can be on a USB drive or network share, so it
+#survives reinstalling the server.
+
+import os
+import time
+import shutil
+import hashlib
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+CACHE_FOLDER = "/var/cache/pinet/golden"
+CACHE_FORMAT = 1  #Part of the key, so a change to how entries are stored doesn't pick up old ones
+PARTS = 4  #Archives per entry, and so how many are unpacked at once
+KEEP = 2  #Entries kept per architecture
+PLAN_DEPTH = 3  #How deep into the chroot folders may be split between archives
+BLOCK_SIZE = 1024 * 1024
+TAR_OPTIONS = ["--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls"]
+#name: (compress, decompress, extension). Each archive is handled by its own process, so they use one thread each
+COMPRESSORS = {
+    "zstd": (["zstd", "-q", "-c", "-6"], ["zstd", "-q", "-d", "-c"], ".tar.zst"),
+    "gzip": (["gzip", "-c", "-6"], ["gzip", "-d", "-c"], ".tar.gz"),
+}
+COMPRESSOR_PREFERENCE = ["zstd", "gzip"]
+
+
+def fileHash(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def keyringFingerprints(keyring):
+    """
+    Fingerprints of the keys in keyring, sorted. The keyring is appended to each time buildClient runs, so the keys in
+    it are used rather than its contents. If gpg can't read it, its hash is used instead.
+    """
+    from subprocess import check_output, CalledProcessError, DEVNULL
+    if not os.path.isfile(keyring):
+        return []
+    try:
+        output = check_output(["gpg", "--no-default-keyring", "--keyring", os.path.abspath(keyring), "--with-colons", "--fingerprint"], stderr=DEVNULL)
+    except (OSError, CalledProcessError):
+        output = b""
+    fingerprints = sorted(set(line.split(":")[9] for line in output.decode("utf-8", "replace").splitlines() if line.startswith("fpr:")))
+    if not fingerprints:
+        return ["sha256:" + fileHash(keyring)]
+    return fingerprints
+
+
+def packageVersion(package):
+    from subprocess import check_output, CalledProcessError, DEVNULL
+    try:
+        return check_output(["dpkg-query", "-W", "-f=${Version}", package], stderr=DEVNULL).decode().strip()
+    except (OSError, CalledProcessError):
+        return ""
+
+
+def cacheKey(configPath, keyringPath, arch, ltspVersion=None):
+    """
+    Returns (key, details). details is kept in the manifest, so it is clear what an entry was built from.
+    """
+    with open(configPath) as f:
+        config = f.read()
+    if ltspVersion is None:
+        ltspVersion = packageVersion("ltsp-server")
+    details = {"arch": arch, "config": config, "fingerprints": keyringFingerprints(keyringPath), "ltspVersion": ltspVersion, "format": CACHE_FORMAT}
+    text = "\0".join([str(CACHE_FORMAT), arch, config, ",".join(details["fingerprints"]), ltspVersion])
+    return arch + "-" + hashlib.sha256(text.encode()).hexdigest()[:24], details
+
+
+def chooseCompressor():
+    for name in COMPRESSOR_PREFERENCE:
+        if shutil.which(COMPRESSORS[name][0][0]):
+            return name
+    raise RuntimeError("No compressor found, tried " + ", ".join(COMPRESSOR_PREFERENCE))
+
+
+def measureChroot(chroot, depth=PLAN_DEPTH):
+    """
+    Returns (sizes, children). sizes has the total size of everything down to depth folders deep, and children the
+    entries of each folder above that depth. Hard links are counted once.
+    """
+    import stat
+    sizes = {}
+    children = {"": []}
+    seen = set()
+    for folder, folders, files in os.walk(chroot):
+        relativeFolder = os.path.relpath(folder, chroot)
+        if relativeFolder == ".":
+            relativeFolder = ""
+        level = relativeFolder.count(os.sep) + 1 if relativeFolder else 0
+        for name in folders + files:
+            relative = os.path.join(relativeFolder, name)
+            try:
+                info = os.lstat(os.path.join(folder, name))
+            except OSError:
+                continue
+            isFolder = stat.S_ISDIR(info.st_mode)
+            if level < depth:
+                children[relativeFolder].append(relative)
+                sizes.setdefault(relative, 0)
+                if isFolder:
+                    children[relative] = []
+            if isFolder:
+                continue
+            if info.st_nlink > 1:
+                if (info.st_dev, info.st_ino) in seen:
+                    continue
+                seen.add((info.st_dev, info.st_ino))
+            parts = relative.split(os.sep)
+            for i in range(1, min(len(parts), depth) + 1):  #Itself and the folders above it that are measured
+                ancestor = os.sep.join(parts[:i])
+                sizes[ancestor] = sizes.get(ancestor, 0) + info.st_size
+    return sizes, children
+
+
+def planParts(chroot, parts=PARTS, depth=PLAN_DEPTH):
+    """
+    Splits the chroot into at most parts lists of paths of about the same size. Folders too big for one part are split
+    into what is in them. Returns (folders, bins), where folders are the split folders (archived on their own, without
+    what is in them) and bins the lists of paths for each archive.
+    """
+    sizes, children = measureChroot(chroot, depth)
+    units = [(relative, sizes.get(relative, 0)) for relative in children[""]]
+    limit = sum(size for relative, size in units) / float(max(1, parts))
+    folders = []
+    while True:
+        big = [unit for unit in units if unit[1] > limit and children.get(unit[0])]
+        if not big:
+            break
+        unit = max(big, key=lambda unit: unit[1])
+        units.remove(unit)
+        folders.append(unit[0])
+        units.extend((relative, sizes.get(relative, 0)) for relative in children[unit[0]])
+    bins = [[] for i in range(max(1, parts))]
+    binSizes = [0] * len(bins)
+    for relative, size in sorted(units, key=lambda unit: (-unit[1], unit[0])):
+        smallest = binSizes.index(min(binSizes))
+        bins[smallest].append(relative)
+        binSizes[smallest] = binSizes[smallest] + size
+    return sorted(folders), [sorted(paths) for paths in bins if paths]
+
+
+def mountedUnder(chroot, mountsPath="/proc/mounts"):
+    chroot = os.path.realpath(chroot).rstrip("/") + "/"
+    try:
+        with open(mountsPath) as f:
+            mounts = [line.split()[1].replace("\\040", " ") for line in f if len(line.split()) > 1]
+    except (OSError, IOError):
+        return []
+    return [mount for mount in mounts if (mount.rstrip("/") + "/").startswith(chroot)]
+
+
+def writePart(chroot, paths, filepath, compressor, recursive=True):
+    """
+    Archives paths (relative to chroot) into filepath, hashing the compressed archive as it is written.
+    Returns (sha256, size).
+    """
+    import tempfile
+    from subprocess import Popen, PIPE
+    compress = COMPRESSORS[compressor][0]
+    with tempfile.TemporaryFile() as listFile, tempfile.TemporaryFile() as errors:
+        listFile.write(b"\0".join(path.encode() for path in paths))
+        listFile.seek(0)
+        command = ["tar", "--create", "--file=-", "--directory=" + chroot] + TAR_OPTIONS
+        if not recursive:
+            command.append("--no-recursion")
+        command = command + ["--null", "--files-from=-"]  #Newer versions of tar want --no-recursion before the list
+        tar = Popen(command, stdin=listFile, stdout=PIPE, stderr=errors)
+        compression = Popen(compress, stdin=tar.stdout, stdout=PIPE, stderr=errors)
+        tar.stdout.close()
+        digest = hashlib.sha256()
+        size = 0
+        with open(filepath, "wb") as f:
+            for block in iter(lambda: compression.stdout.read(BLOCK_SIZE), b""):
+                digest.update(block)
+                f.write(block)
+                size = size + len(block)
+        compression.stdout.close()
+        compression.wait()
+        tar.wait()
+        if tar.returncode != 0 or compression.returncode != 0:
+            errors.seek(0)
+            raise RuntimeError("Archiving " + os.path.basename(filepath) + " failed: " + errors.read().decode("utf-8", "replace").strip()[-500:])
+    return digest.hexdigest(), size
+
+
+def extractPart(filepath, destination, compressor, expected):
+    """
+    Unpacks filepath into destination, hashing it as it is read. Returns an error, or "" if it unpacked and its
+    checksum matched.
+    """
+    import tempfile
+    from subprocess import Popen, PIPE
+    decompress = COMPRESSORS[compressor][1]
+    with tempfile.TemporaryFile() as errors:
+        decompression = Popen(decompress, stdin=PIPE, stdout=PIPE, stderr=errors)
+        tar = Popen(["tar", "--extract", "--file=-", "--directory=" + destination, "--preserve-permissions"] + TAR_OPTIONS,
+                    stdin=decompression.stdout, stderr=errors)
+        decompression.stdout.close()
+        digest = hashlib.sha256()
+        broken = False
+        try:
+            with open(filepath, "rb") as f:
+                for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                    digest.update(block)
+                    decompression.stdin.write(block)
+        except (BrokenPipeError, IOError, OSError):
+            broken = True
+        try:
+            decompression.stdin.close()
+        except (BrokenPipeError, IOError, OSError):
+            broken = True
+        decompression.wait()
+        tar.wait()
+        if digest.hexdigest() != expected and not broken:
+            return os.path.basename(filepath) + ": checksum does not match the manifest"
+        if broken or decompression.returncode != 0 or tar.returncode != 0:
+            errors.seek(0)
+            return os.path.basename(filepath) + ": " + (errors.read().decode("utf-8", "replace").strip()[-500:] or "could not be unpacked")
+    return ""
+
+
+def entryFolder(key, cacheFolder=CACHE_FOLDER):
+    return os.path.join(cacheFolder, key)
+
+
+def loadManifest(key, cacheFolder=CACHE_FOLDER):
+    return readJSON(os.path.join(entryFolder(key, cacheFolder), "manifest.json"))
+
+
+def listEntries(cacheFolder=CACHE_FOLDER):
+    entries = []
+    if not os.path.isdir(cacheFolder):
+        return entries
+    for key in sorted(os.listdir(cacheFolder)):
+        manifest = loadManifest(key, cacheFolder)
+        if manifest is not None:
+            entries.append(manifest)
+    return sorted(entries, key=lambda manifest: manifest["created"], reverse=True)
+
+
+def prune(arch, cacheFolder=CACHE_FOLDER, keep=KEEP):
+    entries = [manifest for manifest in listEntries(cacheFolder) if manifest["details"]["arch"] == arch]
+    for manifest in entries[keep:]:
+        shutil.rmtree(entryFolder(manifest["key"], cacheFolder), ignore_errors=True)
+
+
+def export(chroot, key, details, buildDuration=0.0, cacheFolder=CACHE_FOLDER, parts=PARTS, compressor=None, now=None):
+    """
+    Archives a freshly built chroot into the cache under key. Returns the manifest.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if now is None:
+        now = time.time()
+    mounted = mountedUnder(chroot)
+    if mounted:
+        raise RuntimeError("Not exporting " + chroot + " while something is mounted in it (" + mounted[0] + ")")
+    if compressor is None:
+        compressor = chooseCompressor()
+    started = time.time()
+    folder = entryFolder(key, cacheFolder)
+    staging = folder + ".partial"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    folders, bins = planParts(chroot, parts)
+    extension = COMPRESSORS[compressor][2]
+    jobs = []
+    if folders:
+        jobs.append(("folders" + extension, folders, False))
+    for i, paths in enumerate(bins):
+        jobs.append(("part%d%s" % (i + 1, extension), paths, True))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+            futures = [executor.submit(writePart, chroot, paths, os.path.join(staging, name), compressor, recursive) for name, paths, recursive in jobs]
+            results = [future.result() for future in futures]
+    except (OSError, RuntimeError):
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    manifest = {"key": key, "details": details, "created": now, "compressor": compressor,
+                "parts": [{"file": name, "sha256": digest, "size": size, "recursive": recursive} for (name, paths, recursive), (digest, size) in zip(jobs, results)],
+                "buildDuration": float(buildDuration), "exportDuration": time.time() - started, "restores": []}
+    writeJSONAtomic(manifest, os.path.join(staging, "manifest.json"))
+    shutil.rmtree(folder, ignore_errors=True)
+    os.rename(staging, folder)
+    prune(details["arch"], cacheFolder)
+    return manifest
+
+
+def restore(chroot, key, cacheFolder=CACHE_FOLDER, now=None):
+    """
+    Unpacks the cache entry for key into chroot. Returns the manifest, or None if there is no entry for key. Raises
+    RuntimeError if the entry is damaged, in which case chroot is left as it was.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if now is None:
+        now = time.time()
+    manifest = loadManifest(key, cacheFolder)
+    if manifest is None:
+        return None
+    if os.path.lexists(chroot):
+        raise RuntimeError(chroot + " already exists")
+    if not shutil.which(COMPRESSORS[manifest["compressor"]][1][0]):
+        raise RuntimeError(manifest["compressor"] + " is needed to unpack the cached chroot")
+    started = time.time()
+    folder = entryFolder(key, cacheFolder)
+    staging = chroot.rstrip("/") + ".pinet-restore"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging, 0o755)
+    #The split folders go first, so the archives unpacked side by side find them with the right owners and permissions
+    first = [part for part in manifest["parts"] if not part["recursive"]]
+    rest = [part for part in manifest["parts"] if part["recursive"]]
+    errors = [extractPart(os.path.join(folder, part["file"]), staging, manifest["compressor"], part["sha256"]) for part in first]
+    if not any(errors):
+        with ThreadPoolExecutor(max_workers=max(1, len(rest))) as executor:
+            errors = list(executor.map(lambda part: extractPart(os.path.join(folder, part["file"]), staging, manifest["compressor"], part["sha256"]), rest))
+    errors = [error for error in errors if error]
+    if errors:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise RuntimeError("; ".join(errors))
+    os.rename(staging, chroot)
+    manifest["restores"].append({"date": now, "duration": time.time() - started})
+    writeJSONAtomic(manifest, os.path.join(folder, "manifest.json"))
+    return manifest
+
+
+def verify(manifest, cacheFolder=CACHE_FOLDER):
+    """
+    Checks every archive of an entry against the manifest. Returns a list of problems.
+    """
+    problems = []
+    folder = entryFolder(manifest["key"], cacheFolder)
+    for part in manifest["parts"]:
+        filepath = os.path.join(folder, part["file"])
+        if not os.path.isfile(filepath):
+            problems.append(part["file"] + " is missing")
+        elif fileHash(filepath) != part["sha256"]:
+            problems.append(part["file"] + " does not match its checksum")
+    return problems
+
+
+def formatEntry(manifest, formatSize):
+    size = sum(part["size"] for part in manifest["parts"])
+    line = "%s: %s, %s, built %s in %.0fs, exported in %.0fs" % (manifest["key"], formatSize(size), manifest["compressor"],
+                                                                  time.strftime("%d/%m/%Y %H:%M", time.localtime(manifest["created"])),
+                                                                  manifest["buildDuration"], manifest["exportDuration"])
+    if manifest["restores"]:
+        last = manifest["restores"][-1]
+        line = line + ", restored %d times, last in %.0fs" % (len(manifest["restores"]), last["duration"])
+    return line
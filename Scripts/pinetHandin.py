@@ -0,0 +1,412 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetHandin.py
+#Live index of work handed in by pupils, used by pinet-functions-python.py.
+#The only way to see who had handed in work used to be CollectWork, which looks at every home folder. A small
+#service now watches each pupil's handin folder with inotify and keeps, for every pupil, the number of files handed
+#in, their size and when the last one arrived. Only a pupil whose folder changed is looked at again. /etc/passwd and
+#/etc/group are watched too, so pupils who are added or removed are picked up. The index is saved to disk and can
+#be asked for over a Unix socket, so the menu gets an answer straight away. A full scan is done when the service starts.
+
+import os
+import json
+import time
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+PASSWD_FILEPATH = "/etc/passwd"
+GROUP_FILEPATH = "/etc/group"
+INDEX_FILEPATH = "/var/lib/pinet/handin-index.json"
+SOCKET_FILEPATH = "/run/pinet-handin.sock"
+PUPIL_GROUP = "pupil"
+SOCKET_GROUP = "teacher"
+HANDIN_FOLDER = "handin"
+SETTLE_TIME = 0.5  #A pupil's folder is looked at again once it has had no events for this long
+SAVE_INTERVAL = 5  #Most often the index is written to disk
+QUERY_TIMEOUT = 2
+
+#From linux/inotify.h
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+HANDIN_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+HOME_EVENTS = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR  #Only used to see a missing handin folder being made
+ETC_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR  #The shadow tools replace passwd and group by renaming a new copy over them
+
+
+#---------------- inotify -------------------
+
+class inotify():
+    """
+    Thin wrapper around the inotify system calls, using ctypes so nothing needs installing.
+    """
+
+    def __init__(self):
+        super(inotify, self).__init__()
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def addWatch(self, path, mask):
+        """
+        Returns the watch descriptor, or -1 if path can't be watched (gone, or not a folder).
+        """
+        return self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+
+    def removeWatch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def readEvents(self):
+        """
+        Returns the waiting events as (wd, mask, name) tuples.
+        """
+        import struct
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+                events.append((wd, mask, name))
+                offset = offset + 16 + length
+
+    def close(self):
+        os.close(self.fd)
+
+
+#---------------- Pupils and their handin folders -------------------
+
+def readPupils(passwdPath=PASSWD_FILEPATH, groupPath=GROUP_FILEPATH, group=PUPIL_GROUP):
+    """
+    Returns {user: home folder} for everyone in group, either listed as a member or with it as their primary group.
+    """
+    gid = None
+    members = set()
+    try:
+        with open(groupPath) as f:
+            for line in f:
+                fields = line.rstrip("\n").split(":")
+                if len(fields) >= 4 and fields[0] == group:
+                    gid = fields[2]
+                    members = set(member for member in fields[3].split(",") if member)
+    except (OSError, IOError):
+        return {}
+    pupils = {}
+    try:
+        with open(passwdPath) as f:
+            for line in f:
+                fields = line.rstrip("\n").split(":")
+                if len(fields) >= 7 and (fields[0] in members or fields[3] == gid):
+                    pupils[fields[0]] = fields[5]
+    except (OSError, IOError):
+        return {}
+    return pupils
+
+
+def scanHandin(folder):
+    """
+    Returns {"files", "size", "latest", "newest"} for a handin folder: the number of files, their total size, when
+    the most recent one was changed and its path inside the folder. Symlinks are not followed.
+    """
+    files = 0
+    size = 0
+    latest = 0
+    newest = ""
+    for root, folders, names in os.walk(folder):
+        for name in names:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            files = files + 1
+            size = size + stat.st_size
+            if stat.st_mtime > latest:
+                latest = stat.st_mtime
+                newest = os.path.relpath(os.path.join(root, name), folder)
+    return {"files": files, "size": size, "latest": latest, "newest": newest}
+
+
+#---------------- Watcher -------------------
+
+class handinWatcher():
+    """
+    Keeps index ({pupil: scanHandin result}) up to date from inotify events. Every folder in a pupil's handin folder
+    has a watch. A pupil with no handin folder has a watch on their home folder instead, to see one being made.
+    """
+
+    def __init__(self, passwdPath=PASSWD_FILEPATH, groupPath=GROUP_FILEPATH, indexPath=INDEX_FILEPATH, group=PUPIL_GROUP):
+        super(handinWatcher, self).__init__()
+        self.passwdPath = passwdPath
+        self.groupPath = groupPath
+        self.indexPath = indexPath
+        self.group = group
+        self.notify = inotify()
+        self.pupils = {}
+        self.index = {}
+        self.watches = {}  #wd: (user, folder), user is None for the folders passwd and group are in
+        self.userWatches = {}  #user: [wd]
+        self.dirty = {}  #user: time of their last event
+        self.updated = 0
+        self.saved = 0
+        self.unsaved = False
+        self.watchAccounts()
+
+    def watchAccounts(self):
+        for folder in set([os.path.dirname(self.passwdPath), os.path.dirname(self.groupPath)]):
+            wd = self.notify.addWatch(folder, ETC_EVENTS)
+            if wd >= 0:
+                self.watches[wd] = (None, folder)
+
+    def handinFolder(self, user):
+        return os.path.join(self.pupils[user], HANDIN_FOLDER)
+
+    def unwatchUser(self, user):
+        for wd in self.userWatches.pop(user, []):
+            if wd in self.watches:
+                del self.watches[wd]
+                self.notify.removeWatch(wd)
+
+    def addWatch(self, user, folder, mask):
+        wd = self.notify.addWatch(folder, mask)
+        if wd >= 0:
+            self.watches[wd] = (user, folder)
+            self.userWatches.setdefault(user, []).append(wd)
+        return wd
+
+    def watchTree(self, user, folder):
+        for root, folders, names in os.walk(folder):
+            self.addWatch(user, root, HANDIN_EVENTS)
+
+    def watchUser(self, user):
+        """
+        (Re)sets the watches for one pupil and scans their handin folder.
+        """
+        self.unwatchUser(user)
+        folder = self.handinFolder(user)
+        if os.path.isdir(folder) and not os.path.islink(folder):
+            self.watchTree(user, folder)
+        else:
+            self.addWatch(user, self.pupils[user], HOME_EVENTS)
+        self.scanUser(user)
+
+    def scanUser(self, user):
+        folder = self.handinFolder(user)
+        if os.path.isdir(folder) and not os.path.islink(folder):
+            self.index[user] = scanHandin(folder)
+        else:
+            self.index[user] = {"files": 0, "size": 0, "latest": 0, "newest": "", "missing": True}
+        self.dirty.pop(user, None)
+        self.updated = time.time()
+        self.unsaved = True
+
+    def fullScan(self):
+        for user in list(self.userWatches):
+            self.unwatchUser(user)
+        self.pupils = readPupils(self.passwdPath, self.groupPath, self.group)
+        self.index = {}
+        for user in sorted(self.pupils):
+            self.watchUser(user)
+
+    def reloadPupils(self):
+        """
+        Only pupils who were added, removed or given a new home folder are looked at again.
+        """
+        pupils = readPupils(self.passwdPath, self.groupPath, self.group)
+        for user in list(self.pupils):
+            if user not in pupils:
+                self.unwatchUser(user)
+                self.index.pop(user, None)
+                self.dirty.pop(user, None)
+                self.unsaved = True
+        changed = [user for user in pupils if self.pupils.get(user) != pupils[user]]
+        self.pupils = pupils
+        for user in changed:
+            self.watchUser(user)
+
+    def handleEvents(self, now=None):
+        if now is None:
+            now = time.time()
+        for wd, mask, name in self.notify.readEvents():
+            if mask & IN_Q_OVERFLOW:
+                self.fullScan()
+                return
+            if wd not in self.watches:
+                continue
+            user, folder = self.watches[wd]
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                if user in self.userWatches and wd in self.userWatches[user]:
+                    self.userWatches[user].remove(wd)
+                continue
+            if user is None:
+                if os.path.join(folder, name) in (self.passwdPath, self.groupPath):
+                    self.reloadPupils()
+                continue
+            if user not in self.pupils:
+                continue
+            if folder == self.pupils[user] and folder != self.handinFolder(user):
+                if name == HANDIN_FOLDER:
+                    self.watchUser(user)
+                continue
+            if folder == self.handinFolder(user) and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.watchUser(user)
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watchTree(user, os.path.join(folder, name))
+            self.dirty[user] = now
+
+    def rescanSettled(self, now=None):
+        if now is None:
+            now = time.time()
+        for user in [user for user in self.dirty if now - self.dirty[user] >= SETTLE_TIME]:
+            self.scanUser(user)
+
+    def status(self):
+        return {"updated": self.updated, "pupils": self.index}
+
+    def save(self, now=None, force=False):
+        if now is None:
+            now = time.time()
+        if self.unsaved and (force or now - self.saved >= SAVE_INTERVAL):
+            writeJSONAtomic(self.status(), self.indexPath, compact=True)
+            self.saved = now
+            self.unsaved = False
+
+    def answer(self, request):
+        """
+        request is "status" for every pupil or "user name" for one.
+        """
+        words = request.split()
+        if words and words[0] == "user" and len(words) > 1:
+            return {"updated": self.updated, "pupils": {words[1]: self.index.get(words[1])}}
+        return self.status()
+
+    def close(self):
+        self.save(force=True)
+        self.notify.close()
+
+
+def listen(socketPath=SOCKET_FILEPATH, group=SOCKET_GROUP):
+    """
+    A listening Unix socket that root and members of group can connect to.
+    """
+    import socket
+    try:
+        os.remove(socketPath)
+    except OSError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    os.chmod(socketPath, 0o660)
+    try:
+        import grp
+        os.chown(socketPath, 0, grp.getgrnam(group).gr_gid)
+    except (KeyError, OSError):
+        pass
+    server.listen(8)
+    server.setblocking(False)
+    return server
+
+
+def serveClient(server, watcher):
+    try:
+        client, address = server.accept()
+    except OSError:
+        return
+    try:
+        client.settimeout(1)
+        request = client.recv(1024).decode("utf-8", "replace")
+        client.sendall(json.dumps(watcher.answer(request)).encode() + b"\n")
+    except OSError:
+        pass
+    finally:
+        client.close()
+
+
+def watch(passwdPath=PASSWD_FILEPATH, groupPath=GROUP_FILEPATH, indexPath=INDEX_FILEPATH, socketPath=SOCKET_FILEPATH, running=None):
+    """
+    Runs the watcher until running() returns False (for ever if running is None). Starts with a full scan, since
+    anything could have changed while it wasn't running.
+    """
+    import select
+    watcher = handinWatcher(passwdPath, groupPath, indexPath)
+    watcher.fullScan()
+    watcher.save(force=True)
+    server = listen(socketPath)
+    try:
+        while running is None or running():
+            timeout = SAVE_INTERVAL
+            if watcher.dirty:
+                timeout = SETTLE_TIME
+            readable = select.select([watcher.notify.fd, server], [], [], timeout)[0]
+            if watcher.notify.fd in readable:
+                watcher.handleEvents()
+            if server in readable:
+                serveClient(server, watcher)
+            watcher.rescanSettled()
+            watcher.save()
+    finally:
+        server.close()
+        try:
+            os.remove(socketPath)
+        except OSError:
+            pass
+        watcher.close()
+
+
+#---------------- Asking -------------------
+
+def query(request="status", socketPath=SOCKET_FILEPATH, indexPath=INDEX_FILEPATH, timeout=QUERY_TIMEOUT):
+    """
+    Asks the watcher. If it isn't running, the index it last saved is used, with "live" set to False.
+    Returns None if there is neither.
+    """
+    import socket
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        try:
+            client.connect(socketPath)
+            client.sendall(request.encode())
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                data = data + chunk
+        finally:
+            client.close()
+        result = json.loads(data.decode())
+        result["live"] = True
+        return result
+    except (OSError, ValueError):
+        pass
+    result = readJSON(indexPath)
+    if not isinstance(result, dict):
+        return None
+    result["live"] = False
+    return result
+
@@ -0,0 +1,519 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetJobs.py
+#Background job scheduler for heavy maintenance work, used by pinet-functions-python.py.
+#Image rebuilds, backups, disk usage scans and the like used to run at full priority whenever they started, so one
+#landing during a lesson slowed every Raspberry Pi on the network. Long jobs are now submitted to a queue instead and
+#run by the pinet-jobs service. Each job has a kind, which sets its priority, its CPU nice and IO class, its cgroup
+#memory, IO and CPU limits (through systemd-run, where the server has cgroup v2) and the times it may start, such as
+#"not lessons". Kinds that must not run together, such as an image rebuild and a backup, wait for each other. Jobs
+#run in their own session, so restarting the service doesn't stop them, and every job is kept in a history with how
+#long it waited and ran.
+
+import os
+import time
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+SPOOL_FOLDER = "/var/lib/pinet/jobs"
+PID_FILEPATH = "/run/pinet-jobs.pid"
+POLL_INTERVAL = 5
+MAX_RUNNING = 2
+HISTORY_LENGTH = 200
+LESSON_HOURS = "mon-fri 08:30-15:30"  #What "lessons" means in a window, LessonHours in /etc/pinet
+CGROUP_CONTROLLERS = "/sys/fs/cgroup/cgroup.controllers"
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+IO_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+
+#Defaults for each kind of job. window is when a job may start, see parseWindow. memoryMax, ioWeight and cpuWeight are
+#systemd resource control properties, None leaves them unset
+KINDS = {
+    "image": {"priority": 50, "nice": 10, "ioClass": "idle", "ioLevel": 7, "memoryMax": None, "ioWeight": 20, "cpuWeight": 20, "window": "not lessons"},
+    "update": {"priority": 60, "nice": 5, "ioClass": "best-effort", "ioLevel": 7, "memoryMax": None, "ioWeight": 50, "cpuWeight": 50, "window": "not lessons"},
+    "backup": {"priority": 40, "nice": 15, "ioClass": "idle", "ioLevel": 7, "memoryMax": "1G", "ioWeight": 10, "cpuWeight": 10, "window": "not lessons"},
+    "collect": {"priority": 70, "nice": 5, "ioClass": "best-effort", "ioLevel": 4, "memoryMax": None, "ioWeight": 50, "cpuWeight": 50, "window": "any"},
+    "copy": {"priority": 30, "nice": 10, "ioClass": "best-effort", "ioLevel": 7, "memoryMax": None, "ioWeight": 30, "cpuWeight": 30, "window": "any"},
+    "scan": {"priority": 10, "nice": 19, "ioClass": "idle", "ioLevel": 7, "memoryMax": "512M", "ioWeight": 10, "cpuWeight": 10, "window": "not lessons"},
+    "other": {"priority": 20, "nice": 10, "ioClass": "best-effort", "ioLevel": 7, "memoryMax": None, "ioWeight": 50, "cpuWeight": 50, "window": "any"},
+}
+
+#Kinds that never run at the same time. Each kind also only runs one job at a time
+CONFLICTS = {
+    "image": ["backup", "update"],
+    "update": ["backup"],
+    "backup": ["scan"],
+    "collect": ["copy"],
+}
+
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+#---------------- Time windows -------------------
+
+def parseDays(text):
+    days = set()
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-", 1)
+            first, last = DAYS.index(first[:3]), DAYS.index(last[:3])
+            day = first
+            days.add(day)
+            while day != last:
+                day = (day + 1) % 7
+                days.add(day)
+        else:
+            days.add(DAYS.index(part[:3]))
+    return days
+
+
+def parseTime(text):
+    hours, minutes = text.split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 24 and 0 <= minutes < 60):
+        raise ValueError(text)
+    return hours * 60 + minutes
+
+
+def parseWindow(text, lessons=LESSON_HOURS):
+    """
+    Reads when a job may start, such as "any", "18:00-07:00", "sat,sun 09:00-17:00" or "not mon-fri 08:30-15:30".
+    Several ranges are separated by ";" and "lessons" stands for the lesson hours. Returns (negate, ranges), where
+    ranges is a list of (days, start, end) in minutes after midnight, or None for any time. Raises ValueError.
+    """
+    text = text.strip().lower().replace("–", "-")
+    negate = False
+    if text.startswith("not "):
+        negate = True
+        text = text[4:].strip()
+    if text == "lessons":
+        text = lessons.strip().lower().replace("–", "-")
+    if text in ("", "any", "always"):
+        if negate:
+            raise ValueError("A window can't be never")
+        return False, None
+    ranges = []
+    for part in text.split(";"):
+        words = part.split()
+        try:
+            if len(words) == 1:
+                days = set(range(7))
+            elif len(words) == 2:
+                days = parseDays(words[0])
+            else:
+                raise ValueError(part)
+            start, end = words[-1].split("-")
+            ranges.append((days, parseTime(start), parseTime(end)))
+        except (ValueError, IndexError):
+            raise ValueError("Can't read the time window " + part.strip())
+    return negate, ranges
+
+
+def windowOpen(window, when):
+    negate, ranges = window
+    if ranges is None:
+        return True
+    moment = time.localtime(when)
+    day = moment.tm_wday
+    minute = moment.tm_hour * 60 + moment.tm_min
+    inside = False
+    for days, start, end in ranges:
+        if start < end:
+            inside = inside or (day in days and start <= minute < end)
+        else:  #Runs past midnight into the next day
+            inside = inside or (day in days and minute >= start) or ((day - 1) % 7 in days and minute < end)
+    return inside != negate
+
+
+def nextOpen(window, now):
+    """
+    The next time from now that the window is open, to the minute, or None if it isn't within a week.
+    """
+    if windowOpen(window, now):
+        return now
+    when = now - now % 60
+    for step in range(8 * 24 * 60):
+        when = when + 60
+        if windowOpen(window, when):
+            return when
+    return None
+
+
+#---------------- Jobs -------------------
+
+def parseOptions(args):
+    """
+    Splits "--window=...", "--priority=N", "--memory=...", "--nice=N" and "--name=..." from the front of args.
+    Returns (options, command).
+    """
+    names = {"window": "window", "priority": "priority", "memory": "memoryMax", "nice": "nice", "name": "name"}
+    options = {}
+    args = list(args)
+    while args and args[0].startswith("--"):
+        option = args.pop(0)
+        if option == "--":
+            break
+        key, sep, value = option[2:].partition("=")
+        if key not in names or not sep:
+            raise ValueError("Unknown option " + option)
+        if key in ("priority", "nice"):
+            value = int(value)
+        options[names[key]] = value
+    return options, args
+
+
+def newJob(kind, command, options=None, now=None):
+    if kind not in KINDS:
+        raise ValueError("Unknown kind of job " + kind)
+    if not command:
+        raise ValueError("No command given")
+    if now is None:
+        now = time.time()
+    job = dict(KINDS[kind])
+    job.update(options or {})
+    job.setdefault("name", os.path.basename(command[0]) if len(command) == 1 else " ".join(os.path.basename(word) for word in command[:3]))
+    parseWindow(job["window"])  #Bad windows are turned away when submitted rather than left waiting
+    job.update({"id": time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + "-" + os.urandom(2).hex(), "kind": kind,
+                "command": list(command), "submitted": now, "state": "queued"})
+    return job
+
+
+def queueFolder(folder):
+    return os.path.join(folder, "queue")
+
+
+def jobPath(folder, jobId):
+    if os.path.basename(jobId) != jobId:
+        raise ValueError("Not a job " + jobId)
+    return os.path.join(queueFolder(folder), jobId + ".json")
+
+
+def cancelPath(folder, jobId):
+    return os.path.join(queueFolder(folder), jobId + ".cancel")
+
+
+def logPath(folder, jobId):
+    return os.path.join(folder, "logs", jobId + ".log")
+
+
+def submit(job, folder=SPOOL_FOLDER):
+    writeJSONAtomic(job, jobPath(folder, job["id"]), compact=True)
+    return job["id"]
+
+
+def loadJobs(folder=SPOOL_FOLDER):
+    jobs = []
+    try:
+        names = os.listdir(queueFolder(folder))
+    except OSError:
+        return jobs
+    for name in sorted(names):
+        if name.endswith(".json"):
+            job = readJSON(os.path.join(queueFolder(folder), name))
+            if isinstance(job, dict) and "id" in job:
+                jobs.append(job)
+    return jobs
+
+
+def loadHistory(folder=SPOOL_FOLDER):
+    history = readJSON(os.path.join(folder, "history.json"))
+    if not isinstance(history, list):
+        return []
+    return history
+
+
+def record(job, folder=SPOOL_FOLDER):
+    """
+    Adds a finished job to the history, with how long it waited to start and how long it ran.
+    """
+    entry = dict((key, job.get(key)) for key in ("id", "kind", "name", "state", "returncode", "submitted", "started", "finished"))
+    entry["waited"] = (job["started"] - job["submitted"]) if job.get("started") else None
+    entry["duration"] = (job["finished"] - job["started"]) if job.get("started") else None
+    history = loadHistory(folder) + [entry]
+    writeJSONAtomic(history[-HISTORY_LENGTH:], os.path.join(folder, "history.json"), compact=True)
+    return entry
+
+
+def conflicts(kind, other):
+    return kind == other or other in CONFLICTS.get(kind, []) or kind in CONFLICTS.get(other, [])
+
+
+def pickJobs(queued, running, now, maxRunning=MAX_RUNNING, lessons=LESSON_HOURS):
+    """
+    Chooses which queued jobs to start, highest priority first, then oldest. A job waits while its window is shut,
+    while a job it conflicts with is running or when maxRunning are already running. Returns (start, waiting), where
+    waiting maps the id of each job left queued to why.
+    """
+    start = []
+    waiting = {}
+    active = list(running)
+    for job in sorted(queued, key=lambda job: (-job["priority"], job["submitted"], job["id"])):
+        try:
+            window = parseWindow(job["window"], lessons)
+        except ValueError:
+            window = (False, None)
+        if not windowOpen(window, now):
+            waiting[job["id"]] = "window"
+            continue
+        blocker = next((other for other in active if conflicts(job["kind"], other["kind"])), None)
+        if blocker is not None:
+            waiting[job["id"]] = "after " + blocker["id"]
+            continue
+        if len(active) >= maxRunning:
+            waiting[job["id"]] = "busy"
+            continue
+        start.append(job)
+        active.append(job)
+    return start, waiting
+
+
+def cgroupsAvailable():
+    import shutil
+    return os.path.exists(CGROUP_CONTROLLERS) and shutil.which("systemd-run") is not None
+
+
+def wrapCommand(job, cgroups=None, ionice=None):
+    """
+    The command line that runs a job with its limits: in a systemd scope with its resource control properties where
+    cgroups are available, then under ionice and nice.
+    """
+    import shutil
+    if cgroups is None:
+        cgroups = cgroupsAvailable()
+    if ionice is None:
+        ionice = shutil.which("ionice") is not None
+    prefix = []
+    if cgroups:
+        prefix = ["systemd-run", "--scope", "--quiet", "--collect", "--unit=pinet-job-" + job["id"]]
+        for key, name in (("memoryMax", "MemoryMax"), ("ioWeight", "IOWeight"), ("cpuWeight", "CPUWeight")):
+            if job.get(key):
+                prefix = prefix + ["-p", name + "=" + str(job[key])]
+    if ionice and job.get("ioClass") in IO_CLASSES:
+        prefix = prefix + ["ionice", "-c", IO_CLASSES[job["ioClass"]]]
+        if job["ioClass"] != "idle":
+            prefix = prefix + ["-n", str(job.get("ioLevel", 4))]
+    prefix = prefix + ["nice", "-n", str(job.get("nice", 0))]
+    return prefix + list(job["command"])
+
+
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def daemonRunning(pidPath=PID_FILEPATH):
+    try:
+        with open(pidPath) as f:
+            pid = int(f.read().strip())
+    except (OSError, IOError, ValueError):
+        return False
+    return processAlive(pid)
+
+
+def requestCancel(jobId, folder=SPOOL_FOLDER, live=True, now=None):
+    """
+    Asks for a job to be cancelled. The service stops it at its next check. If the service isn't running, a queued job
+    is cancelled straight away. Returns False if there is no such job.
+    """
+    job = readJSON(jobPath(folder, jobId))
+    if not isinstance(job, dict):
+        return False
+    if live:
+        with open(cancelPath(folder, jobId), "w") as f:
+            f.write("cancel\n")
+        return True
+    if job["state"] != "queued":
+        return False
+    job.update({"state": "cancelled", "finished": now if now is not None else time.time()})
+    record(job, folder)
+    os.remove(jobPath(folder, jobId))
+    return True
+
+
+#---------------- Running jobs -------------------
+
+class scheduler():
+    """
+    Starts queued jobs when they are allowed to, and records them when they finish. step() is called every
+    POLL_INTERVAL seconds by serve().
+    """
+
+    def __init__(self, folder=SPOOL_FOLDER, maxRunning=MAX_RUNNING, lessons=LESSON_HOURS, cgroups=None, ionice=None):
+        super(scheduler, self).__init__()
+        self.folder = folder
+        self.maxRunning = maxRunning
+        self.lessons = lessons
+        self.cgroups = cgroups
+        self.ionice = ionice
+        self.running = {}  #id: (job, Popen or None for jobs started before the service was)
+        self.waiting = {}
+
+    def adopt(self, now=None):
+        """
+        Picks up jobs left running by the last run of the service. Ones whose process has gone are recorded as ended,
+        as how they finished isn't known.
+        """
+        for job in loadJobs(self.folder):
+            if job["state"] != "running":
+                continue
+            if job.get("pid") and processAlive(job["pid"]):
+                self.running[job["id"]] = (job, None)
+            else:
+                self.finish(job, None, now)
+
+    def start(self, job, now):
+        from subprocess import Popen, DEVNULL, STDOUT
+        filepath = logPath(self.folder, job["id"])
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        env = dict(os.environ)
+        env["PINET_JOB"] = job["id"]  #So work a job runs doesn't submit itself again
+        env["PINET_DATA_FILE"] = filepath[:-len(".log")] + ".data"
+        with open(filepath, "ab") as log:
+            try:
+                process = Popen(wrapCommand(job, self.cgroups, self.ionice), stdin=DEVNULL, stdout=log, stderr=STDOUT, env=env, start_new_session=True)
+            except OSError as error:
+                log.write(("Could not start: " + str(error) + "\n").encode())
+                job["started"] = now
+                self.finish(job, 127, now)
+                return
+        job.update({"state": "running", "started": now, "pid": process.pid})
+        writeJSONAtomic(job, jobPath(self.folder, job["id"]), compact=True)
+        self.running[job["id"]] = (job, process)
+
+    def finish(self, job, returncode, now=None, state=None):
+        if now is None:
+            now = time.time()
+        if state is None:
+            if job.get("cancelled"):
+                state = "cancelled"
+            elif returncode is None:
+                state = "ended"
+            else:
+                state = "done" if returncode == 0 else "failed"
+        job.update({"state": state, "returncode": returncode, "finished": now})
+        record(job, self.folder)
+        for filepath in (jobPath(self.folder, job["id"]), cancelPath(self.folder, job["id"])):
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+        self.running.pop(job["id"], None)
+
+    def cancelRequested(self, job):
+        return os.path.exists(cancelPath(self.folder, job["id"]))
+
+    def step(self, now=None):
+        import signal
+        if now is None:
+            now = time.time()
+        for jobId, (job, process) in list(self.running.items()):
+            if self.cancelRequested(job) and not job.get("cancelled"):
+                job["cancelled"] = True
+                try:
+                    os.killpg(job["pid"], signal.SIGTERM)
+                except OSError:
+                    pass
+            if process is None:
+                if not processAlive(job["pid"]):
+                    self.finish(job, None, now)
+            else:
+                returncode = process.poll()
+                if returncode is not None:
+                    self.finish(job, returncode, now)
+        queued = []
+        for job in loadJobs(self.folder):
+            if job["state"] != "queued":
+                continue
+            if self.cancelRequested(job):
+                self.finish(job, None, now, "cancelled")
+            else:
+                queued.append(job)
+        start, self.waiting = pickJobs(queued, [job for job, process in self.running.values()], now, self.maxRunning, self.lessons)
+        for job in start:
+            self.start(job, now)
+        writeJSONAtomic({"updated": now, "running": sorted(self.running), "waiting": self.waiting}, os.path.join(self.folder, "status.json"), compact=True)
+        return start
+
+
+def serve(folder=SPOOL_FOLDER, maxRunning=MAX_RUNNING, lessons=LESSON_HOURS, interval=POLL_INTERVAL, running=None):
+    """
+    Runs the scheduler until running() returns False (for ever if running is None). Jobs still running when it stops
+    carry on, and are picked up again when it next starts.
+    """
+    jobs = scheduler(folder, maxRunning, lessons)
+    jobs.adopt()
+    while running is None or running():
+        jobs.step()
+        time.sleep(interval)
+
+
+def runInline(job, folder=SPOOL_FOLDER, now=None):
+    """
+    Runs a job straight away in the foreground with its limits, for when the service isn't running. It is still
+    recorded in the history.
+    """
+    from subprocess import call
+    job.update({"state": "running", "started": time.time() if now is None else now})
+    env = dict(os.environ)
+    env["PINET_JOB"] = job["id"]
+    try:
+        returncode = call(wrapCommand(job), env=env)
+    except OSError:
+        returncode = 127
+    job.update({"state": "done" if returncode == 0 else "failed", "returncode": returncode, "finished": time.time()})
+    record(job, folder)
+    return returncode
+
+
+#---------------- Reports -------------------
+
+def formatStatus(jobs, status, now, lessons=LESSON_HOURS):
+    lines = []
+    waiting = (status or {}).get("waiting", {})
+    for job in sorted(jobs, key=lambda job: (job["state"] != "running", -job["priority"], job["submitted"])):
+        if job["state"] == "running":
+            detail = "running for " + formatDuration(now - job["started"])
+        else:
+            reason = waiting.get(job["id"], "queued")
+            if reason == "window":
+                try:
+                    opens = nextOpen(parseWindow(job["window"], lessons), now)
+                except ValueError:
+                    opens = None
+                detail = "waiting until " + (time.strftime("%a %H:%M", time.localtime(opens)) if opens else "its window opens")
+            elif reason.startswith("after "):
+                detail = "waiting for job " + reason[len("after "):]
+            elif reason == "busy":
+                detail = "waiting for a free slot"
+            else:
+                detail = "queued"
+            detail = detail + ", submitted " + formatDuration(now - job["submitted"]) + " ago"
+        lines.append("%-22s %-8s %-24s %s" % (job["id"], job["kind"], job["name"][:24], detail))
+    return lines
+
+
+def formatHistory(history, count=20):
+    lines = []
+    for entry in reversed(history[-count:]):
+        started = time.strftime("%d/%m %H:%M", time.localtime(entry["started"])) if entry.get("started") else "-"
+        waited = formatDuration(entry["waited"]) if entry.get("waited") is not None else "-"
+        ran = formatDuration(entry["duration"]) if entry.get("duration") is not None else "-"
+        lines.append("%-22s %-8s %-24s %-9s %s  waited %s, ran %s" % (entry["id"], entry["kind"], (entry.get("name") or "")[:24], entry["state"], started, waited, ran))
+    return lines
@@ -0,0 +1,203 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetJournal.py
+#Step journal for the full install, used by pinet-functions-python.py.
+#A full install takes one to two hours. It used to start from the beginning again if the connection or power dropped
+#part way through, and some steps (adding to /etc/exports, for example) did damage when run twice. Each step of
+#FullInstall now goes through the journal. Before a step runs, the journal is asked whether it is already done. After
+#it runs, the journal records when, with what inputs (the command and the settings it depends on), and a fingerprint
+#of the files it produces. When a stopped install is resumed, finished steps are skipped. The step that finished last
+#is checked again against its fingerprint, as it is the one most likely to have been cut short. A step whose inputs
+#have changed is run again, and so is every step after it.
+
+import os
+import time
+import hashlib
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+JOURNAL_FILEPATH = "/var/lib/pinet/install-journal.json"
+LTSP_CHROOT = "/opt/ltsp/armhf"
+#What each step produces (checked for its fingerprint) and which environment settings it depends on
+STEPS = {
+    "installLTSP": {"outputs": ["/usr/sbin/ltsp-update-image", "/usr/sbin/ltsp-build-client", "/usr/bin/qemu-arm-static"]},
+    "buildClient": {"outputs": ["/etc/ltsp/ltsp-raspbian.conf", LTSP_CHROOT + "/etc/debian_version", LTSP_CHROOT + "/bin/bash"], "env": ["LANG"]},
+    "OneTimeFixes": {"outputs": ["/etc/exports", "/etc/network/if-up.d/tftpd-hpa", "/etc/skel/handin"]},
+    "configFixes": {"outputs": [LTSP_CHROOT + "/etc/lts.conf", LTSP_CHROOT + "/etc/modules", LTSP_CHROOT + "/etc/asound.conf"]},
+    "FixRepo": {"outputs": [LTSP_CHROOT + "/etc/apt/sources.list"]},
+    "AddSoftware": {"outputs": [LTSP_CHROOT + "/usr/bin/scratch", LTSP_CHROOT + "/usr/bin/python3"]},
+    "EnableNBDswap": {"outputs": ["/etc/nbd-server/conf.d/swap.conf"]},
+    "UpdateSD": {"outputs": [LTSP_CHROOT + "/bootfiles/cmdline.txt"]},
+    "EnableNBD": {"outputs": ["/opt/ltsp/images/armhf.img"]},
+}
+FINGERPRINT_READ_LIMIT = 16 * 1024 * 1024  #Bigger files are fingerprinted by size and modification time only
+
+
+def fingerprintPath(path):
+    """
+    "missing", "folder", or a hash of the file (of its size and modification time if it is big).
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return "missing"
+    if os.path.isdir(path):
+        return "folder"
+    digest = hashlib.sha1()
+    if info.st_size > FINGERPRINT_READ_LIMIT:
+        digest.update(("%d %d" % (info.st_size, info.st_mtime_ns)).encode())
+        return digest.hexdigest()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    except (OSError, IOError):
+        return "unreadable"
+    return digest.hexdigest()
+
+
+def fingerprint(step, steps=STEPS):
+    return dict((path, fingerprintPath(path)) for path in steps.get(step, {}).get("outputs", []))
+
+
+def inputsHash(step, inputs, environ=None, steps=STEPS):
+    if environ is None:
+        environ = os.environ
+    values = list(inputs) + [name + "=" + environ.get(name, "") for name in steps.get(step, {}).get("env", [])]
+    return hashlib.sha1("\0".join([step] + values).encode()).hexdigest()
+
+
+class journal():
+    """
+    The steps of one full install, in the order they first ran. Each step is a dict of name, inputs, status
+    (running, done), started, finished, returncode and fingerprint. rerun is set once a step has had to run again
+    while resuming, so every step after it runs too.
+    """
+
+    def __init__(self, filepath=JOURNAL_FILEPATH, started=0.0, steps=None, complete=False, rerun=False):
+        super(journal, self).__init__()
+        self.filepath = filepath
+        self.started = started
+        self.steps = steps or []
+        self.complete = complete
+        self.rerun = rerun
+
+    @classmethod
+    def load(cls, filepath=JOURNAL_FILEPATH):
+        data = readJSON(filepath)
+        if not isinstance(data, dict):
+            return cls(filepath)
+        return cls(filepath, data.get("started", 0.0), data.get("steps", []), data.get("complete", False), data.get("rerun", False))
+
+    def save(self):
+        writeJSONAtomic({"started": self.started, "steps": self.steps, "complete": self.complete, "rerun": self.rerun}, self.filepath)
+
+    def find(self, name):
+        for step in self.steps:
+            if step["name"] == name:
+                return step
+        return None
+
+    def lastDone(self):
+        done = [step for step in self.steps if step["status"] == "done"]
+        if not done:
+            return None
+        return max(done, key=lambda step: step["finished"])
+
+    def unfinished(self):
+        """
+        The step a stopped install got to (the one running when it stopped, or the one after the last done), or None
+        if there is no install to resume.
+        """
+        if self.complete or not self.steps:
+            return None
+        for step in self.steps:
+            if step["status"] != "done":
+                return step["name"]
+        return self.steps[-1]["name"] + " (finished)"
+
+
+def start(mode="fresh", filepath=JOURNAL_FILEPATH, now=None):
+    """
+    Starts journalling a full install. fresh moves any old journal aside and starts again, resume carries on with it.
+    """
+    if now is None:
+        now = time.time()
+    current = journal.load(filepath)
+    if mode == "resume" and current.steps and not current.complete:
+        current.rerun = False
+        current.save()
+        return current
+    if current.steps:
+        os.replace(filepath, filepath + "." + time.strftime("%Y%m%d-%H%M%S", time.localtime(current.started)))
+    current = journal(filepath, now)
+    current.save()
+    return current
+
+
+def begin(name, inputs=(), filepath=JOURNAL_FILEPATH, now=None, environ=None, steps=STEPS, force=False, linear=True):
+    """
+    Returns "skip" if step name is already done with the same inputs, otherwise marks it running and returns "run".
+    The step that finished last must still match its fingerprint, earlier ones must still have all their outputs.
+    linear is for steps run one after another, where once a step runs again every step after it does too. The task
+    scheduler (pinetTasks.py) passes linear=False and sets force itself when a step's dependencies ran again.
+    """
+    if now is None:
+        now = time.time()
+    current = journal.load(filepath)
+    hashed = inputsHash(name, inputs, environ, steps)
+    step = current.find(name)
+    if step is not None and step["status"] == "done" and step["inputs"] == hashed and not force and not (linear and current.rerun):
+        currentFingerprint = fingerprint(name, steps)
+        last = current.lastDone()
+        if last is not None and last["name"] == name:
+            intact = currentFingerprint == step["fingerprint"]
+        else:
+            intact = all(value != "missing" for value in currentFingerprint.values())
+        if intact:
+            return "skip"
+    if step is None:
+        step = {"name": name}
+        current.steps.append(step)
+    if linear and any(other["status"] == "done" for other in current.steps if other is not step):
+        current.rerun = True  #From here on every step runs, as they build on this one
+    step.update({"inputs": hashed, "status": "running", "started": now, "finished": None, "returncode": None, "fingerprint": {}})
+    current.save()
+    return "run"
+
+
+def end(name, returncode=0, filepath=JOURNAL_FILEPATH, now=None, steps=STEPS):
+    """
+    Records step name as done, with its return code and the fingerprint of what it produced.
+    """
+    if now is None:
+        now = time.time()
+    current = journal.load(filepath)
+    step = current.find(name)
+    if step is None:
+        step = {"name": name, "inputs": "", "started": now}
+        current.steps.append(step)
+    step.update({"status": "done", "finished": now, "returncode": int(returncode), "fingerprint": fingerprint(name, steps)})
+    current.save()
+
+
+def finish(filepath=JOURNAL_FILEPATH):
+    current = journal.load(filepath)
+    current.complete = True
+    current.save()
+
+
+def formatJournal(current):
+    lines = []
+    for step in current.steps:
+        line = "%-28s %-8s" % (step["name"], step["status"])
+        if step.get("finished"):
+            line = line + " %s, %.0fs" % (time.strftime("%d/%m %H:%M", time.localtime(step["finished"])), step["finished"] - step["started"])
+            if step.get("returncode"):
+                line = line + ", returned " + str(step["returncode"])
+        lines.append(line)
+    return lines
@@ -0,0 +1,494 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetLayers.py
+#Layered NBD images used by pinet-functions-python.py.
+#ltsp-update-image compresses the whole chroot every time, so installing one small package means waiting for gigabytes
+#to be squashed again. With image layers turned on (ImageLayers=true in /etc/pinet), the full "base" image is built
+#only now and then, and a list of every file in the chroot at that moment is kept. Later rebuilds compare the chroot
+#with that list and squash only what changed into a small "delta" image. Deleted files become overlayfs whiteouts. The
+#delta image is shared by nbd-server as its own export. A script added to the Raspberry Pis' initrd stacks it over the
+#base with overlayfs before LTSP puts its writable tmpfs on top. The delta always holds every change since the base,
+#so there are never more than two layers. Once the delta grows past a share of the base's size, or when asked, the
+#next rebuild makes a new base and the delta starts again empty.
+
+import os
+import stat
+import time
+
+from pinetRunner import runCommand
+from pinetFiles import writeJSONAtomic, readJSON
+
+LAYERS_FOLDER = "/opt/ltsp/.pinet-layers"
+IMAGE_FOLDER = "/opt/ltsp/images"
+NBD_CONF_FOLDER = "/etc/nbd-server/conf.d"
+SQUASH_FRACTION = 0.15  #A delta bigger than this share of the base is squashed into a new base
+BUILD_TIMEOUT = 3 * 60 * 60
+INITRD_BACKUP_SUFFIX = ".pinet-original"
+CLIENT_SCRIPT_NAME = "pinet-layers"
+ORDER_PATH = "scripts/init-bottom/ORDER"
+OPAQUE_XATTR = "trusted.overlay.opaque"
+CPIO_MAGIC = b"070701"
+CPIO_TRAILER = "TRAILER!!!"
+#Runs in the Raspberry Pi's initramfs once the base image is mounted at ${rootmnt}
+CLIENT_SCRIPT = """#!/bin/sh
+#PiNet image layers (see pinetLayers.py on the server). Stacks the delta image over the base image at ${rootmnt}
+#before LTSP puts its writable tmpfs on top. Boots from the base alone if there is no delta image.
+PREREQ=""
+case "$1" in
+    prereqs) echo "$PREREQ"; exit 0;;
+esac
+EXPORT="@EXPORT@"
+for arg in $(cat /proc/cmdline); do
+    case "$arg" in
+        nbdroot=*) server="${arg#nbdroot=}"; server="${server%%:*}";;
+    esac
+done
+[ -n "$server" ] || exit 0
+nbd-client "$server" /dev/nbd1 -N "$EXPORT" >/dev/null 2>&1 || exit 0
+mkdir -p /run/pinet-layers/base /run/pinet-layers/delta
+if ! mount -t squashfs -o ro /dev/nbd1 /run/pinet-layers/delta; then
+    nbd-client -d /dev/nbd1
+    exit 0
+fi
+mount -n -o move "${rootmnt}" /run/pinet-layers/base
+if ! mount -t overlay -o ro,lowerdir=/run/pinet-layers/delta:/run/pinet-layers/base overlay "${rootmnt}"; then
+    mount -n -o move /run/pinet-layers/base "${rootmnt}"
+    umount /run/pinet-layers/delta
+    nbd-client -d /dev/nbd1
+fi
+exit 0
+"""
+
+
+def targetFolder(targetName, layersFolder=LAYERS_FOLDER):
+    return os.path.join(layersFolder, targetName)
+
+
+def baseImagePath(targetName, imageFolder=IMAGE_FOLDER):
+    return os.path.join(imageFolder, targetName + ".img")  #Where ltsp-update-image puts it
+
+
+def deltaImagePath(targetName, imageFolder=IMAGE_FOLDER):
+    return os.path.join(imageFolder, targetName + "-delta.img")
+
+
+def exportName(targetName):
+    return "ltsp_" + targetName + "_delta"
+
+
+def loadState(targetName, layersFolder=LAYERS_FOLDER):
+    state = readJSON(os.path.join(targetFolder(targetName, layersFolder), "state.json"))
+    if not isinstance(state, dict):
+        state = {}
+    return state
+
+
+def saveState(targetName, state, layersFolder=LAYERS_FOLDER):
+    writeJSONAtomic(state, os.path.join(targetFolder(targetName, layersFolder), "state.json"))
+
+
+#---------------- Finding what changed -------------------
+
+def excluded(relative, excludes):
+    import pinetSlim
+    return any(pinetSlim.matchesPattern(relative, pattern) for pattern in excludes)
+
+
+def scanTree(chrootPath, excludes=()):
+    """
+    Every file, folder, link and device in the chroot as {relative path: [kind, mode, uid, gid, size, mtime, extra]}.
+    kind is f, d, l or o (anything else), extra is the link target or device number. Doesn't cross into other
+    filesystems and leaves out what the image excludes.
+    """
+    tree = {}
+    device = os.lstat(chrootPath).st_dev
+    folders = [""]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = list(os.scandir(os.path.join(chrootPath, folder)))
+        except OSError:
+            continue
+        for entry in entries:
+            relative = folder + "/" + entry.name if folder else entry.name
+            if excludes and excluded(relative, excludes):
+                continue
+            try:
+                info = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            extra = ""
+            if stat.S_ISDIR(info.st_mode):
+                if info.st_dev != device:
+                    continue
+                kind = "d"
+                folders.append(relative)
+            elif stat.S_ISREG(info.st_mode):
+                kind = "f"
+            elif stat.S_ISLNK(info.st_mode):
+                kind = "l"
+                extra = os.readlink(entry.path)
+            else:
+                kind = "o"
+                extra = info.st_rdev
+            tree[relative] = [kind, info.st_mode, info.st_uid, info.st_gid, info.st_size, info.st_mtime_ns, extra]
+    return tree
+
+
+def entryChanged(old, new):
+    if old[0] != new[0] or old[1:4] != new[1:4]:
+        return True
+    if new[0] == "d":
+        return False  #A folder's own time changes whenever something in it does, which is already picked up
+    return old[4:] != new[4:]
+
+
+def findChanges(base, current):
+    """
+    Compares the chroot now with the base. Returns (paths new or changed, paths removed, folders that replaced
+    something else and must hide it). Only the top of a removed tree is listed.
+    """
+    changed = sorted(relative for relative in current if relative not in base or entryChanged(base[relative], current[relative]))
+    opaque = set(relative for relative in changed if current[relative][0] == "d" and relative in base and base[relative][0] != "d")
+    removed = []
+    for relative in base:
+        if relative in current:
+            continue
+        parent = os.path.dirname(relative)
+        if parent and (parent not in current or current[parent][0] != "d" or parent in opaque):
+            continue
+        removed.append(relative)
+    return changed, sorted(removed), sorted(opaque)
+
+
+#---------------- Building the delta -------------------
+
+def copyMetadata(path, entry):
+    if os.geteuid() == 0:
+        os.lchown(path, entry[2], entry[3])
+    if entry[0] != "l":
+        os.chmod(path, stat.S_IMODE(entry[1]))
+        os.utime(path, ns=(entry[5], entry[5]))
+
+
+def buildStaging(chrootPath, staging, current, changed, removed, opaque):
+    """
+    Lays out the delta in staging: changed files hard linked from the chroot, whiteouts for removed files, and the
+    folders above them with the chroot's owners and permissions (overlayfs shows the top layer's).
+    Returns how many bytes of file data it holds.
+    """
+    import shutil
+    os.makedirs(staging)
+    made = set([""])
+    folders = []
+    size = 0
+
+    def makeFolder(relative):
+        if relative in made:
+            return
+        makeFolder(os.path.dirname(relative))
+        path = os.path.join(staging, relative)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        made.add(relative)
+        folders.append(relative)
+
+    for relative in changed:
+        entry = current[relative]
+        makeFolder(os.path.dirname(relative))
+        path = os.path.join(staging, relative)
+        source = os.path.join(chrootPath, relative)
+        if entry[0] == "d":
+            makeFolder(relative)
+            if relative in opaque:
+                os.setxattr(path, OPAQUE_XATTR, b"y")
+            continue
+        if entry[0] == "f":
+            size = size + entry[4]
+            try:
+                os.link(source, path)  #The same file, so nothing to copy
+                continue
+            except OSError:
+                shutil.copy2(source, path)
+        elif entry[0] == "l":
+            os.symlink(entry[6], path)
+        else:
+            os.mknod(path, entry[1], entry[6])
+        copyMetadata(path, entry)
+    for relative in removed:
+        makeFolder(os.path.dirname(relative))
+        os.mknod(os.path.join(staging, relative), stat.S_IFCHR, os.makedev(0, 0))  #An overlayfs whiteout
+    for relative in reversed(folders):  #Deepest first, so adding to a folder doesn't change its time again
+        if relative in current:
+            copyMetadata(os.path.join(staging, relative), current[relative])
+    if "" in current:
+        copyMetadata(staging, current[""])
+    return size
+
+
+def squashCommand(source, imagePath):
+    import pinetCompression
+    command = ["mksquashfs", source, imagePath, "-noappend", "-no-progress", "-xattrs"]
+    profile = pinetCompression.loadProfile()
+    if profile is not None:
+        command = command + pinetCompression.profileOptions(*profile).split()
+    return command
+
+
+def buildDelta(chrootPath, targetName, base, excludes=(), layersFolder=LAYERS_FOLDER, imageFolder=IMAGE_FOLDER, logPath=None):
+    """
+    Squashes everything that changed since base into the delta image. Returns a dict describing the build.
+    """
+    import shutil
+    started = time.time()
+    current = scanTree(chrootPath, excludes)
+    current[""] = scanRoot(chrootPath)
+    changed, removed, opaque = findChanges(base, current)
+    staging = os.path.join(targetFolder(targetName, layersFolder), "staging")
+    shutil.rmtree(staging, ignore_errors=True)
+    imagePath = deltaImagePath(targetName, imageFolder)
+    try:
+        size = buildStaging(chrootPath, staging, current, changed, removed, opaque)
+        result = runCommand(squashCommand(staging, imagePath + ".new"), timeout=BUILD_TIMEOUT, logPath=logPath, name="delta " + targetName)
+        if not result.ok:
+            raise RuntimeError("Couldn't build the delta image for " + targetName + ": " + result.outputText()[-200:])
+        os.replace(imagePath + ".new", imagePath)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            os.remove(imagePath + ".new")
+        except OSError:
+            pass
+    return {"kind": "delta", "built": started, "duration": time.time() - started, "changed": len(changed),
+            "removed": len(removed), "dataSize": size, "imageSize": os.path.getsize(imagePath)}
+
+
+def scanRoot(chrootPath):
+    info = os.lstat(chrootPath)
+    return ["d", info.st_mode, info.st_uid, info.st_gid, 0, info.st_mtime_ns, ""]
+
+
+#---------------- Rebuilding -------------------
+
+def buildBase(target, excludes=(), layersFolder=LAYERS_FOLDER, imageFolder=IMAGE_FOLDER, logPath=None):
+    """
+    Builds the full image with ltsp-update-image and records what the chroot held, then empties the delta.
+    The chroot is listed first, so anything changed while the image builds goes into the next delta.
+    """
+    started = time.time()
+    tree = scanTree(target.path, excludes)
+    tree[""] = scanRoot(target.path)
+    result = runCommand(target.rebuildCommand(), timeout=BUILD_TIMEOUT, logPath=logPath, echo=True, name=target.name)
+    if not result.ok:
+        raise RuntimeError("ltsp-update-image failed for " + target.name)
+    writeJSONAtomic(tree, os.path.join(targetFolder(target.name, layersFolder), "base.json"), compact=True)
+    emptyDelta(target.name, imageFolder)
+    return {"kind": "base", "built": started, "duration": time.time() - started, "imageSize": os.path.getsize(baseImagePath(target.name, imageFolder))}
+
+
+def emptyDelta(targetName, imageFolder=IMAGE_FOLDER):
+    """
+    Removes the delta image. Raspberry Pis that start before there is a new one boot from the base alone.
+    """
+    try:
+        os.remove(deltaImagePath(targetName, imageFolder))
+    except OSError:
+        pass
+
+
+def rebuild(target, squash=False, excludes=None, layersFolder=LAYERS_FOLDER, imageFolder=IMAGE_FOLDER, logPath=None, fraction=SQUASH_FRACTION):
+    """
+    Brings the target's image up to date: a delta build normally, a new base if squash is set, there is no base yet,
+    or the delta has grown past fraction of the base. Returns a dict describing the build, which is also saved.
+    """
+    import pinetSlim
+    if excludes is None:
+        excludes = pinetSlim.imageExcludes()
+    state = loadState(target.name, layersFolder)
+    base = readJSON(os.path.join(targetFolder(target.name, layersFolder), "base.json"))
+    if not squash and isinstance(base, dict) and os.path.exists(baseImagePath(target.name, imageFolder)):
+        build = buildDelta(target.path, target.name, base, excludes, layersFolder, imageFolder, logPath)
+        build["baseDuration"] = state.get("base", {}).get("duration", 0.0)
+        build["baseSize"] = state.get("base", {}).get("imageSize", 0)
+        state["delta"] = build
+        saveState(target.name, state, layersFolder)
+        if build["imageSize"] <= fraction * max(1, build["baseSize"]):
+            return build
+        build = buildBase(target, excludes, layersFolder, imageFolder, logPath)
+        build["reason"] = "the delta grew past %d%% of the base" % (fraction * 100)
+    else:
+        build = buildBase(target, excludes, layersFolder, imageFolder, logPath)
+    state["base"] = build
+    state.pop("delta", None)
+    saveState(target.name, state, layersFolder)
+    return build
+
+
+def formatBuild(targetName, build, formatSize):
+    if build["kind"] == "base":
+        line = "%s: full base image, %s, built in %.0fs" % (targetName, formatSize(build["imageSize"]), build["duration"])
+        if build.get("reason"):
+            line = line + " (" + build["reason"] + ")"
+        return line
+    line = "%s: delta of %d changed and %d removed files, %s, built in %.0fs" % (targetName, build["changed"], build["removed"],
+                                                                             formatSize(build["imageSize"]), build["duration"])
+    if build.get("baseDuration"):
+        line = line + ", saving about %.0fs on a full build" % max(0.0, build["baseDuration"] - build["duration"])
+    return line
+
+
+#---------------- Serving the delta -------------------
+
+def writeExport(targetName, imageFolder=IMAGE_FOLDER, confFolder=NBD_CONF_FOLDER):
+    """
+    Shares the delta image as its own nbd-server export. nbd-server needs restarting to see it.
+    """
+    if not os.path.isdir(confFolder):
+        os.makedirs(confFolder)
+    with open(os.path.join(confFolder, exportName(targetName) + ".conf"), "w") as f:
+        f.write("[" + exportName(targetName) + "]\nexportname = " + deltaImagePath(targetName, imageFolder) + "\nreadonly = true\n")
+
+
+def removeExport(targetName, confFolder=NBD_CONF_FOLDER):
+    try:
+        os.remove(os.path.join(confFolder, exportName(targetName) + ".conf"))
+    except OSError:
+        pass
+
+
+#---------------- Client initrd -------------------
+
+def readCpio(data):
+    """
+    The entries of a newc cpio archive as [(name, fields, data)], fields being the 13 header numbers.
+    """
+    entries = []
+    offset = 0
+    while offset < len(data):
+        if data[offset:offset + 6] != CPIO_MAGIC:
+            if data[offset:].strip(b"\0"):
+                raise RuntimeError("Not a newc cpio archive")
+            break
+        fields = [int(data[offset + 6 + i * 8:offset + 14 + i * 8], 16) for i in range(13)]
+        nameSize = fields[11]
+        nameStart = offset + 110
+        name = data[nameStart:nameStart + nameSize - 1].decode("utf-8", "surrogateescape")
+        dataStart = (nameStart + nameSize + 3) & ~3
+        content = data[dataStart:dataStart + fields[6]]
+        offset = (dataStart + fields[6] + 3) & ~3
+        if name == CPIO_TRAILER:
+            break
+        entries.append((name, fields, content))
+    return entries
+
+
+def writeCpio(entries):
+    parts = []
+    length = 0
+    for name, fields, content in entries + [(CPIO_TRAILER, [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0], b"")]:
+        encoded = name.encode("utf-8", "surrogateescape") + b"\0"
+        fields = list(fields)
+        fields[6] = len(content)
+        fields[11] = len(encoded)
+        header = CPIO_MAGIC + b"".join(("%08X" % field).encode() for field in fields) + encoded
+        header = header + b"\0" * (-len(header) % 4)
+        content = content + b"\0" * (-len(content) % 4)
+        parts.append(header + content)
+        length = length + len(header) + len(content)
+    parts.append(b"\0" * (-length % 512))
+    return b"".join(parts)
+
+
+def patchInitrd(initrdPath, script, scriptName=CLIENT_SCRIPT_NAME):
+    """
+    Adds script to a gzip compressed initrd as an init-bottom script that runs before any other, so it runs before
+    LTSP's. The initrd as it came is kept next to it and is what gets patched every time.
+    """
+    import gzip
+    original = initrdPath + INITRD_BACKUP_SUFFIX
+    if not os.path.exists(original):
+        os.rename(initrdPath, original)
+    with open(original, "rb") as f:
+        data = f.read()
+    if data[:2] != b"\x1f\x8b":
+        raise RuntimeError(initrdPath + " isn't a gzip compressed initrd")
+    entries = readCpio(gzip.decompress(data))
+    names = [name for name, fields, content in entries]
+    if ORDER_PATH not in names:
+        raise RuntimeError(initrdPath + " has no " + ORDER_PATH)
+    now = int(time.time())
+    inode = max([fields[0] for name, fields, content in entries] + [0]) + 1
+    patched = []
+    for name, fields, content in entries:
+        if name == ORDER_PATH:
+            content = ('/scripts/init-bottom/' + scriptName + ' "$@"\n[ -e /conf/param.conf ] && . /conf/param.conf\n').encode() + content
+        if name != "scripts/init-bottom/" + scriptName:
+            patched.append((name, fields, content))
+    patched.append(("scripts/init-bottom/" + scriptName, [inode, stat.S_IFREG | 0o755, 0, 0, 1, now, 0, 0, 0, 0, 0, 0, 0], script.encode()))
+    temporary = initrdPath + ".new"
+    with open(temporary, "wb") as f:
+        f.write(gzip.compress(writeCpio(patched), 9))
+    os.replace(temporary, initrdPath)
+
+
+def isPatched(initrdPath, scriptName=CLIENT_SCRIPT_NAME):
+    import gzip
+    try:
+        with open(initrdPath, "rb") as f:
+            data = f.read()
+        return any(name == "scripts/init-bottom/" + scriptName for name, fields, content in readCpio(gzip.decompress(data)))
+    except (OSError, EOFError, ValueError):
+        return False
+
+
+def unpatchInitrd(initrdPath):
+    original = initrdPath + INITRD_BACKUP_SUFFIX
+    if os.path.exists(original):
+        os.replace(original, initrdPath)
+
+
+def initrds(bootFiles):
+    try:
+        names = sorted(os.listdir(bootFiles))
+    except OSError:
+        return []
+    return [os.path.join(bootFiles, name) for name in names if name.startswith("initrd") and not name.endswith(INITRD_BACKUP_SUFFIX)]
+
+
+def unpatched(target):
+    """
+    The target's initrds without the client script, for example after UpdateSD replaced the boot files.
+    """
+    return [initrdPath for initrdPath in initrds(target.bootFiles) if not isPatched(initrdPath)]
+
+
+def enable(target, imageFolder=IMAGE_FOLDER, confFolder=NBD_CONF_FOLDER):
+    """
+    Sets a target up for layered images: the delta export on the server and the client script in its initrds.
+    Returns the initrds patched.
+    """
+    found = initrds(target.bootFiles)
+    if not found:
+        raise RuntimeError("No initrd found in " + target.bootFiles)
+    for initrdPath in found:
+        if not isPatched(initrdPath) and os.path.exists(initrdPath + INITRD_BACKUP_SUFFIX):
+            os.remove(initrdPath + INITRD_BACKUP_SUFFIX)  #A new initrd was copied over the patched one, the backup is out of date
+        patchInitrd(initrdPath, CLIENT_SCRIPT.replace("@EXPORT@", exportName(target.name)))
+    writeExport(target.name, imageFolder, confFolder)
+    return found
+
+
+def disable(target, layersFolder=LAYERS_FOLDER, imageFolder=IMAGE_FOLDER, confFolder=NBD_CONF_FOLDER):
+    """
+    Puts the target back to a single image. It needs a full rebuild afterwards to pick up what was in the delta.
+    """
+    import shutil
+    for initrdPath in initrds(target.bootFiles):
+        unpatchInitrd(initrdPath)
+    removeExport(target.name, confFolder)
+    emptyDelta(target.name, imageFolder)
+    shutil.rmtree(targetFolder(target.name, layersFolder), ignore_errors=True)
@@ -0,0 +1,281 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetPasswords.py
+#Bulk password resets used by pinet-functions-python.py.
+#Resetting a class of passwords used to mean picking each user in turn and running passwd for them. A whole group,
+#a list of users or a CSV file can now be reset in one go. Passwords are generated (or given) and hashed with
+#SHA-512 crypt on a process pool. /etc/shadow is then rewritten once, under the shadow lock, by writing a new file
+#and renaming it over the old one. A slip file with everyone's new password can be printed and handed out.
+
+import os
+import time
+
+SHADOW_FILEPATH = "/etc/shadow"
+SHADOW_LOCK_FILEPATH = "/etc/.pwd.lock"  #The lock file lckpwdf, passwd and useradd use
+LOCK_TIMEOUT = 15
+PASSWORD_LENGTH = 8
+PASSWORD_CHARACTERS = "abcdefghjkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789"  #Nothing that is easily misread, like l, 1, O and 0
+SALT_CHARACTERS = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+ROUNDS = 5000
+
+
+#---------------- SHA-512 crypt -------------------
+
+#Order the bytes of the final digest are encoded in, from the SHA-crypt specification
+SHA512_ORDER = [(0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4), (47, 5, 26), (6, 27, 48),
+                (28, 49, 7), (50, 8, 29), (9, 30, 51), (31, 52, 10), (53, 11, 32), (12, 33, 54), (34, 55, 13),
+                (56, 14, 35), (15, 36, 57), (37, 58, 16), (59, 17, 38), (18, 39, 60), (40, 61, 19), (62, 20, 41)]
+
+
+def encode24(byte2, byte1, byte0, count):
+    value = (byte2 << 16) | (byte1 << 8) | byte0
+    characters = ""
+    for i in range(count):
+        characters = characters + SALT_CHARACTERS[value & 0x3f]
+        value = value >> 6
+    return characters
+
+
+def repeatTo(data, length):
+    return (data * (length // len(data) + 1))[:length]
+
+
+def sha512Crypt(password, salt, rounds=ROUNDS):
+    """
+    The $6$ password hash glibc's crypt() makes, written out so it does not depend on the crypt module
+    (deprecated, and gone in Python 3.13).
+    """
+    import hashlib
+    key = password.encode("utf-8")
+    salt = salt[:16]
+    saltBytes = salt.encode("ascii")
+    alternate = hashlib.sha512(key + saltBytes + key).digest()
+    digest = hashlib.sha512(key + saltBytes)
+    digest.update(repeatTo(alternate, len(key)))
+    length = len(key)
+    while length > 0:
+        if length & 1:
+            digest.update(alternate)
+        else:
+            digest.update(key)
+        length = length >> 1
+    digestA = digest.digest()
+    pBytes = repeatTo(hashlib.sha512(key * len(key)).digest(), len(key))
+    sBytes = repeatTo(hashlib.sha512(saltBytes * (16 + digestA[0])).digest(), len(saltBytes))
+    current = digestA
+    for i in range(rounds):
+        step = hashlib.sha512()
+        if i & 1:
+            step.update(pBytes)
+        else:
+            step.update(current)
+        if i % 3:
+            step.update(sBytes)
+        if i % 7:
+            step.update(pBytes)
+        if i & 1:
+            step.update(current)
+        else:
+            step.update(pBytes)
+        current = step.digest()
+    encoded = ""
+    for a, b, c in SHA512_ORDER:
+        encoded = encoded + encode24(current[a], current[b], current[c], 4)
+    encoded = encoded + encode24(0, 0, current[63], 2)
+    prefix = "$6$"
+    if rounds != ROUNDS:
+        prefix = prefix + "rounds=%d$" % rounds
+    return prefix + salt + "$" + encoded
+
+
+def makeSalt(length=16):
+    import random
+    generator = random.SystemRandom()
+    return "".join(generator.choice(SALT_CHARACTERS) for i in range(length))
+
+
+def hashPassword(password, salt=None):
+    if salt is None:
+        salt = makeSalt()
+    return sha512Crypt(password, salt)
+
+
+def generatePassword(length=PASSWORD_LENGTH):
+    import random
+    generator = random.SystemRandom()
+    return "".join(generator.choice(PASSWORD_CHARACTERS) for i in range(length))
+
+
+def hashAll(passwords, workers=None):
+    """
+    Hashes a list of passwords on a process pool, since every hash is deliberately slow.
+    Returns the hashes in the same order.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if len(passwords) < 4:
+        return [hashPassword(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(hashPassword, passwords, chunksize=max(1, len(passwords) // 16)))
+
+
+#---------------- Choosing users -------------------
+
+def groupMembers(group, passwdEntries):
+    """
+    Users in group, either listed as members or with it as their primary group.
+    """
+    import grp
+    entry = grp.getgrnam(group)
+    members = set(entry.gr_mem)
+    for passwdEntry in passwdEntries:
+        if str(passwdEntry[3]) == str(entry.gr_gid):
+            members.add(passwdEntry[0])
+    return sorted(members)
+
+
+def readCSV(filepath):
+    """
+    Reads username[,password] rows. Blank passwords are left as "" to be generated or filled in.
+    """
+    import csv
+    pairs = []
+    with open(filepath) as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].strip().startswith("#"):
+                continue
+            password = ""
+            if len(row) > 1:
+                password = row[1].strip()
+            pairs.append((row[0].strip(), password))
+    return pairs
+
+
+def assignPasswords(users, password=""):
+    """
+    users is a list of usernames or (username, password) pairs. Anyone without a password gets password, or a
+    generated one if that is blank too. Returns a list of (username, password) pairs.
+    """
+    pairs = []
+    for user in users:
+        given = ""
+        if isinstance(user, (tuple, list)):
+            user, given = user[0], user[1]
+        if not given:
+            given = password or generatePassword()
+        pairs.append((user, given))
+    return pairs
+
+
+#---------------- Shadow file -------------------
+
+class shadowLock():
+    """
+    Holds the same lock as lckpwdf(), so passwd, useradd and friends wait while /etc/shadow is replaced.
+    """
+
+    def __init__(self, lockPath=SHADOW_LOCK_FILEPATH, timeout=LOCK_TIMEOUT):
+        super(shadowLock, self).__init__()
+        self.path = lockPath
+        self.timeout = timeout
+        self.fd = None
+
+    def __enter__(self):
+        import fcntl
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600)
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except (OSError, IOError):
+                if time.time() > deadline:
+                    os.close(self.fd)
+                    raise RuntimeError("Timed out waiting for the password file lock " + self.path)
+                time.sleep(0.1)
+
+    def __exit__(self, *args):
+        os.close(self.fd)
+
+
+def rewriteFile(filepath, lines):
+    """
+    Replaces an account database (passwd, shadow, group...) with lines in one rename, keeping its mode and owner.
+    The previous file is kept as filepath- like the shadow tools do. Call it while holding shadowLock.
+    """
+    import shutil
+    stat = os.stat(filepath)
+    temporary = filepath + "+"
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w") as f:
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(temporary, stat.st_mode & 0o7777)
+    try:
+        os.chown(temporary, stat.st_uid, stat.st_gid)
+    except OSError:
+        pass
+    shutil.copy2(filepath, filepath + "-")
+    os.replace(temporary, filepath)
+
+
+def updateShadow(hashes, shadowPath=SHADOW_FILEPATH, lockPath=SHADOW_LOCK_FILEPATH, now=None):
+    """
+    Sets the password hash (and date last changed) of every user in hashes with one atomic rewrite of shadowPath.
+    The previous file is kept as shadowPath- like the shadow tools do. Returns the users not found in the file.
+    """
+    if now is None:
+        now = time.time()
+    today = str(int(now // 86400))
+    remaining = dict(hashes)
+    with shadowLock(lockPath):
+        with open(shadowPath) as f:
+            lines = f.read().splitlines()
+        for i in range(len(lines)):
+            fields = lines[i].split(":")
+            if len(fields) > 2 and fields[0] in remaining:
+                fields[1] = remaining.pop(fields[0])
+                fields[2] = today
+                lines[i] = ":".join(fields)
+        rewriteFile(shadowPath, lines)
+    return sorted(remaining)
+
+
+#---------------- Slips -------------------
+
+def writeSlips(pairs, filepath, title=""):
+    """
+    Writes a plain text file of cut-out slips, one per user, readable only by its owner.
+    """
+    lines = []
+    rule = "-" * 40
+    for user, password in pairs:
+        lines.append(rule)
+        if title:
+            lines.append("  " + title)
+        lines.append("  Username: " + user)
+        lines.append("  Password: " + password)
+    lines.append(rule)
+    descriptor = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return filepath
+
+
+def resetPasswords(pairs, shadowPath=SHADOW_FILEPATH, lockPath=SHADOW_LOCK_FILEPATH, dryRun=False, workers=None):
+    """
+    Hashes and applies (username, password) pairs. With dryRun nothing is hashed or written.
+    Returns (changed users, users missing from the shadow file).
+    """
+    users = [user for user, password in pairs]
+    if dryRun:
+        with open(shadowPath) as f:
+            known = set(line.split(":")[0] for line in f)
+        return [user for user in users if user in known], sorted(user for user in users if user not in known)
+    hashes = hashAll([password for user, password in pairs], workers)
+    missing = updateShadow(dict(zip(users, hashes)), shadowPath, lockPath)
+    return [user for user in users if user not in missing], missing
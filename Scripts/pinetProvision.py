@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetProvision.py
+#Lazy per-user provisioning used by pinet-functions-python.py.
+#Desktop icons, skel items and shortcuts every user should have are listed once in a versioned manifest.
+#Instead of copying them into every home folder when something changes, a PAM session hook applies the
+#manifest when each user logs in, and only if the manifest has changed since their last login.
+
+import os
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+MANIFEST_FILEPATH = "/etc/pinet-provision.json"
+STAMP_FOLDER = "/var/lib/pinet/provisioned"  #One stamp per user, owned by root so users can't point it somewhere else
+
+
+class provisionItem():
+    """
+    Something every user (or every member of one of groups) should have in their home folder.
+    source is a file or folder on the server, target is where it goes relative to the home folder.
+    version is the manifest version the item last changed in.
+    """
+
+    name = ""
+    source = ""
+    target = ""
+    version = 0
+    fingerprint = ""
+
+    def __init__(self, name, source, target, groups=None, version=0, fingerprint=""):
+        super(provisionItem, self).__init__()
+        checkTarget(target)
+        self.name = name
+        self.source = source
+        self.target = target
+        self.groups = list(groups or [])
+        self.version = version
+        self.fingerprint = fingerprint
+
+    def appliesTo(self, userGroups):
+        if not self.groups:
+            return True
+        return any(group in userGroups for group in self.groups)
+
+    def toDict(self):
+        return {"source": self.source, "target": self.target, "groups": self.groups, "version": self.version, "fingerprint": self.fingerprint}
+
+
+class provisionManifest():
+    """
+    The versioned list of provisionItems. version goes up by one whenever any item is added, changed or removed.
+    """
+
+    version = 0
+
+    def __init__(self, version=0, items=None):
+        super(provisionManifest, self).__init__()
+        self.version = version
+        self.items = items or {}
+
+    def toDict(self):
+        items = {}
+        for name in self.items:
+            items[name] = self.items[name].toDict()
+        return {"version": self.version, "items": items}
+
+
+def checkTarget(target):
+    parts = target.split("/")
+    if not target or target.startswith("/") or ".." in parts:
+        raise ValueError("Provisioning targets must be inside the home folder: " + repr(target))
+
+
+def sourceFingerprint(source):
+    """
+    Size and modification time of the source (every file in it for a folder), so re-adding an unchanged item
+    does not make every user provision again.
+    """
+    import zlib
+    if os.path.isfile(source):
+        stat = os.stat(source)
+        return "%d:%d" % (stat.st_size, int(stat.st_mtime))
+    parts = []
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            parts.append("%s:%d:%d" % (os.path.relpath(path, source), stat.st_size, int(stat.st_mtime)))
+    return "%d:%08x" % (len(parts), zlib.crc32("\n".join(parts).encode()) & 0xffffffff)
+
+
+#---------------- Manifest -------------------
+
+def loadManifest(manifestPath=MANIFEST_FILEPATH):
+    data = readJSON(manifestPath)
+    if not isinstance(data, dict):
+        return provisionManifest()
+    items = {}
+    for name, item in data.get("items", {}).items():
+        try:
+            items[name] = provisionItem(name, item["source"], item["target"], item.get("groups"), item.get("version", 0), item.get("fingerprint", ""))
+        except (KeyError, ValueError):
+            continue
+    return provisionManifest(data.get("version", 0), items)
+
+
+def saveManifest(manifest, manifestPath=MANIFEST_FILEPATH):
+    writeJSONAtomic(manifest.toDict(), manifestPath, sortKeys=True)
+
+
+def addItem(name, source, target, groups=None, manifestPath=MANIFEST_FILEPATH):
+    """
+    Adds or updates an item. This is all an admin action costs, however many users there are.
+    The manifest version only goes up if the item or the files it copies actually changed. Returns True if it did.
+    """
+    manifest = loadManifest(manifestPath)
+    item = provisionItem(name, source, target, groups, fingerprint=sourceFingerprint(source))
+    current = manifest.items.get(name)
+    if current is not None:
+        item.version = current.version
+        if current.toDict() == item.toDict():
+            return False
+    manifest.version = manifest.version + 1
+    item.version = manifest.version
+    manifest.items[name] = item
+    saveManifest(manifest, manifestPath)
+    return True
+
+
+def removeItem(name, manifestPath=MANIFEST_FILEPATH):
+    """
+    Stops an item being given to users. Copies already in home folders are left alone.
+    """
+    manifest = loadManifest(manifestPath)
+    if name not in manifest.items:
+        return False
+    del manifest.items[name]
+    manifest.version = manifest.version + 1
+    saveManifest(manifest, manifestPath)
+    return True
+
+
+#---------------- Stamps -------------------
+
+def stampPath(user, stampFolder=STAMP_FOLDER):
+    return os.path.join(stampFolder, user)
+
+
+def readStamp(user, stampFolder=STAMP_FOLDER):
+    stamp = readJSON(stampPath(user, stampFolder))
+    if not isinstance(stamp, dict):
+        return {"manifest": None, "items": {}}
+    return stamp
+
+
+def writeStamp(user, manifest, applied, stampFolder=STAMP_FOLDER):
+    writeJSONAtomic({"manifest": manifest.version, "items": applied}, stampPath(user, stampFolder), sortKeys=True)
+
+
+def resetUser(user, stampFolder=STAMP_FOLDER):
+    """
+    Makes the user be provisioned again at their next login, for example after they are added to the teacher group.
+    """
+    try:
+        os.remove(stampPath(user, stampFolder))
+    except OSError:
+        pass
+
+
+def pendingItems(manifest, stamp, userGroups):
+    pending = []
+    done = stamp.get("items", {})
+    for name in sorted(manifest.items):
+        item = manifest.items[name]
+        if item.appliesTo(userGroups) and done.get(name) != item.version:
+            pending.append(item)
+    return pending
+
+
+#---------------- Provisioning -------------------
+
+def copyItem(item, home):
+    """
+    Copies one item into a home folder. Folders are merged into whatever is already there.
+    """
+    import shutil
+    target = os.path.join(home, item.target)
+    if os.path.isdir(item.source):
+        for root, dirs, files in os.walk(item.source):
+            folder = os.path.join(target, os.path.relpath(root, item.source))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            for name in files:
+                destination = os.path.join(folder, name)
+                if os.path.islink(destination):
+                    os.remove(destination)
+                shutil.copy(os.path.join(root, name), destination)
+    else:
+        folder = os.path.dirname(target)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        if os.path.islink(target):
+            os.remove(target)
+        shutil.copy(item.source, target)
+
+
+def copyItems(items, home):
+    applied = []
+    for item in items:
+        if not os.path.exists(item.source):
+            continue  #Left out of the stamp so it is tried again once the source exists
+        try:
+            copyItem(item, home)
+        except (OSError, IOError):
+            continue
+        applied.append(item.name)
+    return applied
+
+
+def copyItemsAsUser(items, home, uid, gid, groupIDs):
+    """
+    Copies the items in a child process running as the user, so the copies belong to them and a symlink left in
+    their home folder can't be used to write anywhere they could not write themselves.
+    Returns the names of the items that were copied.
+    """
+    readFD, writeFD = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readFD)
+        status = 1
+        try:
+            os.setgroups(groupIDs)
+            os.setgid(gid)
+            os.setuid(uid)
+            applied = copyItems(items, home)
+            os.write(writeFD, "\n".join(applied).encode())
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(writeFD)
+    output = b""
+    while True:
+        chunk = os.read(readFD, 65536)
+        if not chunk:
+            break
+        output = output + chunk
+    os.close(readFD)
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        return []
+    return [name for name in output.decode().split("\n") if name]
+
+
+def needsProvisioning(user, manifestPath=MANIFEST_FILEPATH, stampFolder=STAMP_FOLDER):
+    """
+    The quick check done at every login, two small file reads.
+    """
+    manifest = loadManifest(manifestPath)
+    return readStamp(user, stampFolder).get("manifest") != manifest.version
+
+
+def provisionUser(user, manifestPath=MANIFEST_FILEPATH, stampFolder=STAMP_FOLDER, home=None):
+    """
+    Applies any items the user does not have yet (or that changed since they got them) and updates their stamp.
+    Returns the names of the items copied.
+    """
+    import pwd, grp
+    manifest = loadManifest(manifestPath)
+    stamp = readStamp(user, stampFolder)
+    if stamp.get("manifest") == manifest.version:
+        return []
+    entry = pwd.getpwnam(user)
+    if home is None:
+        home = entry.pw_dir
+    groupIDs = os.getgrouplist(user, entry.pw_gid)
+    userGroups = []
+    for groupID in groupIDs:
+        try:
+            userGroups.append(grp.getgrgid(groupID).gr_name)
+        except KeyError:
+            pass
+    pending = pendingItems(manifest, stamp, userGroups)
+    if not pending:
+        applied = []
+    elif os.geteuid() == 0 and entry.pw_uid != 0:
+        applied = copyItemsAsUser(pending, home, entry.pw_uid, entry.pw_gid, groupIDs)
+    else:
+        applied = copyItems(pending, home)
+
+    versions = {}
+    for name, version in stamp.get("items", {}).items():
+        if name in manifest.items:
+            versions[name] = version
+    for item in pending:
+        if item.name in applied:
+            versions[item.name] = item.version
+    if len(applied) == len(pending):
+        writeStamp(user, manifest, versions, stampFolder)
+    else:
+        writeStamp(user, provisionManifest(None), versions, stampFolder)  #Some items failed, try again next login
+    return applied
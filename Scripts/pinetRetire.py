@@ -0,0 +1,382 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetRetire.py
+#Bulk removal of leaving users, used by pinet-functions-python.py.
+#Removing a user used to mean userdel -rf, one user at a time, with the menu waiting while their home folder was
+#deleted. A whole year group can now be retired at once. Their entries are removed from passwd, shadow, group and
+#gshadow in one locked edit, and their home folders are renamed into a staging folder, so the accounts are gone
+#straight away. A background job then archives each home folder (several at once, at low CPU and disk priority),
+#deletes it and logs how it got on. A retired user can be restored from the archive.
+
+import os
+import time
+
+from pinetPasswords import rewriteFile, shadowLock
+from pinetRunner import runCommand, writeLog
+from pinetFiles import writeJSONAtomic, readJSON
+
+ETC_FOLDER = "/etc"
+HOME_ROOT = "/home"
+ARCHIVE_ROOT = "/var/backups/pinet-retired"
+STAGING_NAME = ".pinet-retiring"  #Inside the home root, so staging a home folder is a rename on the same disk
+WORKERS = 3
+ARCHIVE_TIMEOUT = 6 * 60 * 60
+SKEL_FILES = [".profile", ".bashrc", ".bash_logout"]  #Copied from /etc/skel when an account is created
+
+
+#---------------- Choosing users -------------------
+
+def accountCreated(home):
+    """
+    Roughly when an account was created. Linux doesn't record this, so it is taken from the files useradd copied
+    from /etc/skel, or the home folder itself if they have gone. Returns None if there is no home folder.
+    """
+    times = []
+    for name in SKEL_FILES:
+        try:
+            times.append(os.lstat(os.path.join(home, name)).st_mtime)
+        except OSError:
+            pass
+    if times:
+        return min(times)
+    try:
+        return os.lstat(home).st_mtime
+    except OSError:
+        return None
+
+
+def cohortMembers(cohort, passwdEntries):
+    """
+    Users whose accounts were created in cohort, a year ("2015") or month ("2015-09").
+    """
+    members = []
+    for entry in passwdEntries:
+        created = accountCreated(entry[5])
+        if created is not None and time.strftime("%Y-%m", time.localtime(created)).startswith(cohort):
+            members.append(entry[0])
+    return sorted(members)
+
+
+#---------------- Account databases -------------------
+
+def readLines(filepath):
+    try:
+        with open(filepath) as f:
+            return f.read().splitlines()
+    except (OSError, IOError):
+        return None
+
+
+def removeAccounts(users, etcFolder=ETC_FOLDER, lockPath=None):
+    """
+    Removes users from passwd, shadow, group and gshadow in one locked edit. Each user is taken out of every group's
+    member list, and their own group is removed if nobody else uses it.
+    Returns {user: entries}, where entries holds the removed lines and group memberships for restoreAccount.
+    """
+    if lockPath is None:
+        lockPath = os.path.join(etcFolder, ".pwd.lock")
+    paths = {}
+    for name in ["passwd", "shadow", "group", "gshadow"]:
+        paths[name] = os.path.join(etcFolder, name)
+    wanted = set(users)
+    removed = {}
+    with shadowLock(lockPath):
+        files = {}
+        for name in paths:
+            files[name] = readLines(paths[name])
+        keptPasswd = []
+        for line in files["passwd"]:
+            fields = line.split(":")
+            if fields[0] in wanted and len(fields) >= 7:
+                removed[fields[0]] = {"passwd": line, "shadow": "", "groups": [], "privateGroup": None, "privateGshadow": ""}
+            else:
+                keptPasswd.append(line)
+        stillUsedGids = set(line.split(":")[3] for line in keptPasswd if line.count(":") >= 3)
+        privateGroups = {}
+        for user in removed:
+            gid = removed[user]["passwd"].split(":")[3]
+            if gid not in stillUsedGids:
+                privateGroups[gid] = user
+        keptGroups = []
+        droppedGroups = set()
+        for line in files["group"]:
+            fields = line.split(":")
+            if len(fields) < 4:
+                keptGroups.append(line)
+                continue
+            members = [member for member in fields[3].split(",") if member]
+            for member in members:
+                if member in removed:
+                    removed[member]["groups"].append(fields[0])
+            members = [member for member in members if member not in removed]
+            owner = privateGroups.get(fields[2])
+            if owner is not None and fields[0] == owner and not members:
+                removed[owner]["privateGroup"] = line
+                droppedGroups.add(fields[0])
+                continue
+            fields[3] = ",".join(members)
+            keptGroups.append(":".join(fields))
+        if not removed:
+            return removed
+        newFiles = {"passwd": keptPasswd, "group": keptGroups}
+        keptShadow = []
+        for line in files["shadow"] or []:
+            name = line.split(":")[0]
+            if name in removed:
+                removed[name]["shadow"] = line
+            else:
+                keptShadow.append(line)
+        newFiles["shadow"] = keptShadow
+        if files["gshadow"] is not None:
+            keptGshadow = []
+            for line in files["gshadow"]:
+                fields = line.split(":")
+                if fields[0] in droppedGroups:
+                    removed[fields[0]]["privateGshadow"] = line
+                    continue
+                if len(fields) >= 4:
+                    fields[2] = ",".join(admin for admin in fields[2].split(",") if admin and admin not in removed)
+                    fields[3] = ",".join(member for member in fields[3].split(",") if member and member not in removed)
+                keptGshadow.append(":".join(fields))
+            newFiles["gshadow"] = keptGshadow
+        #shadow goes first and passwd last, so if anything fails part way a half removed account can't log in
+        for name in ["shadow", "gshadow", "group", "passwd"]:
+            if name in newFiles and files[name] is not None:
+                rewriteFile(paths[name], newFiles[name])
+    return removed
+
+
+def restoreAccount(user, entries, etcFolder=ETC_FOLDER, lockPath=None):
+    """
+    Puts back the lines removeAccounts took out for user, and adds them back to the groups they were in (if those
+    groups still exist). Raises ValueError if the username or user ID has been reused since.
+    """
+    if lockPath is None:
+        lockPath = os.path.join(etcFolder, ".pwd.lock")
+    uid = entries["passwd"].split(":")[2]
+    with shadowLock(lockPath):
+        files = {}
+        for name in ["passwd", "shadow", "group", "gshadow"]:
+            files[name] = readLines(os.path.join(etcFolder, name))
+        for line in files["passwd"]:
+            fields = line.split(":")
+            if fields[0] == user or (len(fields) > 2 and fields[2] == uid):
+                raise ValueError("The username or user ID of " + user + " is in use again")
+        groupNames = [line.split(":")[0] for line in files["group"]]
+        if entries["privateGroup"] and entries["privateGroup"].split(":")[0] not in groupNames:
+            files["group"].append(entries["privateGroup"])
+            if files["gshadow"] is not None and entries["privateGshadow"]:
+                files["gshadow"].append(entries["privateGshadow"])
+        for name in ["group", "gshadow"]:
+            if files[name] is None:
+                continue
+            for i in range(len(files[name])):
+                fields = files[name][i].split(":")
+                if len(fields) >= 4 and fields[0] in entries["groups"]:
+                    members = [member for member in fields[3].split(",") if member]
+                    if user not in members:
+                        fields[3] = ",".join(members + [user])
+                        files[name][i] = ":".join(fields)
+        files["passwd"].append(entries["passwd"])
+        if entries["shadow"]:
+            files["shadow"].append(entries["shadow"])
+        for name in ["gshadow", "group", "shadow", "passwd"]:
+            if files[name] is not None:
+                rewriteFile(os.path.join(etcFolder, name), files[name])
+
+
+#---------------- Batches -------------------
+
+def batchFolder(batch, archiveRoot=ARCHIVE_ROOT):
+    return os.path.join(archiveRoot, batch)
+
+
+def manifestPath(batch, archiveRoot=ARCHIVE_ROOT):
+    return os.path.join(batchFolder(batch, archiveRoot), "manifest.json")
+
+
+def progressLogPath(batch, archiveRoot=ARCHIVE_ROOT):
+    return os.path.join(batchFolder(batch, archiveRoot), "progress.log")
+
+
+def loadManifest(batch, archiveRoot=ARCHIVE_ROOT):
+    manifest = readJSON(manifestPath(batch, archiveRoot))
+    if not isinstance(manifest, dict):
+        raise ValueError("No retired batch called " + batch)
+    return manifest
+
+
+def saveManifest(manifest, archiveRoot=ARCHIVE_ROOT):
+    writeJSONAtomic(manifest, manifestPath(manifest["batch"], archiveRoot), private=True)
+
+
+def logProgress(batch, message, archiveRoot=ARCHIVE_ROOT):
+    writeLog([time.strftime("%Y-%m-%d %H:%M:%S") + " " + message], progressLogPath(batch, archiveRoot))
+
+
+def listBatches(archiveRoot=ARCHIVE_ROOT):
+    try:
+        names = os.listdir(archiveRoot)
+    except OSError:
+        return []
+    return sorted(name for name in names if os.path.isfile(manifestPath(name, archiveRoot)))
+
+
+def batchStatus(manifest):
+    """
+    Number of users in each state: staged (waiting to be archived), archived, removed (no home folder), failed or
+    restored.
+    """
+    counts = {}
+    for user in manifest["users"]:
+        state = manifest["users"][user]["state"]
+        counts[state] = counts.get(state, 0) + 1
+    return counts
+
+
+def retireUsers(users, etcFolder=ETC_FOLDER, lockPath=None, homeRoot=HOME_ROOT, archiveRoot=ARCHIVE_ROOT, now=None):
+    """
+    Removes the accounts of users and moves their home folders into the staging folder. Both are quick, so the
+    accounts are gone as soon as this returns. Returns the manifest of the new batch, ready for archiveBatch.
+    """
+    if now is None:
+        now = time.time()
+    batch = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    while os.path.exists(batchFolder(batch, archiveRoot)):
+        batch = batch + "x"
+    os.makedirs(batchFolder(batch, archiveRoot), 0o700)
+    staging = os.path.join(homeRoot, STAGING_NAME, batch)
+    os.makedirs(staging, 0o700)
+    removed = removeAccounts(users, etcFolder, lockPath)
+    manifest = {"batch": batch, "created": now, "staging": staging, "users": {}}
+    for user in sorted(removed):
+        home = removed[user]["passwd"].split(":")[5]
+        record = {"state": "staged", "home": home, "staged": os.path.join(staging, user), "archive": "", "error": "", "entries": removed[user]}
+        if os.path.realpath(home) == os.path.realpath(homeRoot) or not os.path.isdir(home):
+            record["state"] = "removed"  #No home folder of their own to archive
+            record["staged"] = ""
+        else:
+            try:
+                os.rename(home, record["staged"])
+            except OSError as error:
+                record["state"] = "failed"
+                record["error"] = "Home folder not moved: " + str(error)
+        manifest["users"][user] = record
+    saveManifest(manifest, archiveRoot)
+    logProgress(batch, "Retired %d accounts, %d home folders staged in %s" % (len(removed), batchStatus(manifest).get("staged", 0), staging), archiveRoot)
+    return manifest
+
+
+#---------------- Archiving -------------------
+
+def archiveHome(manifest, user, archiveRoot=ARCHIVE_ROOT):
+    """
+    Archives one staged home folder to user.tar.gz in the batch folder, then deletes it.
+    Returns (user, archive path, error).
+    """
+    import shutil
+    record = manifest["users"][user]
+    archive = os.path.join(batchFolder(manifest["batch"], archiveRoot), user + ".tar.gz")
+    partial = archive + ".part"
+    started = time.time()
+    result = runCommand(["tar", "--create", "--gzip", "--numeric-owner", "--file", partial, "--directory", manifest["staging"], user],
+                        timeout=ARCHIVE_TIMEOUT, logPath=progressLogPath(manifest["batch"], archiveRoot), name="archive " + user)
+    if not result.ok:
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        return user, "", "tar failed with return code " + str(result.returncode)
+    os.chmod(partial, 0o600)
+    os.replace(partial, archive)
+    shutil.rmtree(record["staged"], ignore_errors=True)
+    logProgress(manifest["batch"], "%s archived (%d bytes) in %.1fs" % (user, os.path.getsize(archive), time.time() - started), archiveRoot)
+    return user, archive, ""
+
+
+def archiveBatch(batch, archiveRoot=ARCHIVE_ROOT, workers=WORKERS):
+    """
+    Archives and deletes every staged home folder in batch, several at once. The manifest is saved after each one,
+    so an interrupted run carries on where it stopped. Returns the batch status.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    manifest = loadManifest(batch, archiveRoot)
+    waiting = [user for user in sorted(manifest["users"]) if manifest["users"][user]["state"] == "staged"]
+    logProgress(batch, "Archiving %d home folders" % len(waiting), archiveRoot)
+    if waiting:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(archiveHome, manifest, user, archiveRoot) for user in waiting]
+            for future in as_completed(futures):
+                user, archive, error = future.result()
+                record = manifest["users"][user]
+                if error:
+                    record["state"] = "failed"
+                    record["error"] = error
+                    logProgress(batch, user + " FAILED: " + error, archiveRoot)
+                else:
+                    record["state"] = "archived"
+                    record["archive"] = archive
+                saveManifest(manifest, archiveRoot)
+    try:
+        os.rmdir(manifest["staging"])
+    except OSError:
+        pass
+    status = batchStatus(manifest)
+    logProgress(batch, "Finished: " + ", ".join("%s %d" % (state, status[state]) for state in sorted(status)), archiveRoot)
+    return status
+
+
+def startBackgroundArchive(command):
+    """
+    Starts command (which should call archiveBatch) detached, at the lowest CPU and disk priority so lessons going
+    on at the same time aren't slowed down.
+    """
+    import shutil
+    import subprocess
+    if shutil.which("ionice"):
+        command = ["ionice", "-c", "3"] + command
+    if shutil.which("nice"):
+        command = ["nice", "-n", "19"] + command
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True, close_fds=True)
+
+
+#---------------- Restoring -------------------
+
+def restoreUser(batch, user, etcFolder=ETC_FOLDER, lockPath=None, archiveRoot=ARCHIVE_ROOT):
+    """
+    Brings a retired user back: their account entries, group memberships and home folder (from the staging folder if
+    it hasn't been archived yet, otherwise from the archive). The archive is kept.
+    """
+    manifest = loadManifest(batch, archiveRoot)
+    if user not in manifest["users"]:
+        raise ValueError(user + " was not retired in " + batch)
+    record = manifest["users"][user]
+    if record["state"] == "restored":
+        raise ValueError(user + " has already been restored")
+    home = record["home"]
+    if record["staged"] and os.path.exists(home):
+        raise ValueError(home + " already exists")
+    restoreAccount(user, record["entries"], etcFolder, lockPath)
+    if record["staged"] and os.path.isdir(record["staged"]):
+        os.rename(record["staged"], home)
+    elif record["archive"]:
+        if not os.path.isdir(manifest["staging"]):
+            os.makedirs(manifest["staging"], 0o700)
+        result = runCommand(["tar", "--extract", "--gzip", "--numeric-owner", "--preserve-permissions", "--file", record["archive"], "--directory", manifest["staging"]],
+                            timeout=ARCHIVE_TIMEOUT, logPath=progressLogPath(batch, archiveRoot), name="restore " + user)
+        if not result.ok:
+            raise RuntimeError("Couldn't extract " + record["archive"])
+        os.rename(os.path.join(manifest["staging"], user), home)
+        try:
+            os.rmdir(manifest["staging"])
+        except OSError:
+            pass
+    record["state"] = "restored"
+    saveManifest(manifest, archiveRoot)
+    logProgress(batch, user + " restored to " + home, archiveRoot)
+    return home
@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetRunner.py
+#Process runner used by pinet-functions-python.py and the other PiNet Python modules.
+#Commands are run from argument lists (no shell unless asked for), with optional timeouts,
+#retries, output streamed to a log file and only the tail of the output kept in memory.
+#Independent commands can be run as a batch across a limited number of workers.
+
+import os
+import sys
+import time
+import threading
+from collections import deque
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+
+LOG_FILEPATH = None  #Set by the caller, for example /var/log/pinet.log. None disables the log.
+OUTPUT_LINES = 200  #Number of output lines kept in memory for each command
+BATCH_WORKERS = 4
+
+logLock = threading.Lock()
+echoLock = threading.Lock()
+
+
+class retryPolicy():
+    """
+    Describes how many times a command should be attempted and how long to wait between attempts.
+    The wait is delay, then delay * backoff, then delay * backoff * backoff and so on.
+    If retryCodes is None, any failure is retried. Otherwise only the listed return codes are.
+    """
+
+    attempts = 1
+    delay = 2
+    backoff = 2
+    retryOnTimeout = True
+    retryCodes = None
+
+    def __init__(self, attempts=3, delay=2, backoff=2, retryOnTimeout=True, retryCodes=None):
+        super(retryPolicy, self).__init__()
+        self.attempts = max(1, int(attempts))
+        self.delay = delay
+        self.backoff = backoff
+        self.retryOnTimeout = retryOnTimeout
+        self.retryCodes = retryCodes
+
+    def shouldRetry(self, result, attempt):
+        if attempt >= self.attempts or result.ok:
+            return False
+        if result.timedOut:
+            return self.retryOnTimeout
+        if self.retryCodes is None:
+            return True
+        return result.returncode in self.retryCodes
+
+    def wait(self, attempt):
+        time.sleep(self.delay * (self.backoff ** (attempt - 1)))
+
+
+class commandResult():
+    """
+    Result of a single command. Only the last OUTPUT_LINES lines of output are kept, the full output is in the log.
+    """
+
+    name = ""
+    command = None
+    returncode = None
+    timedOut = False
+    duration = 0.0
+    attempts = 0
+
+    def __init__(self, command, name=""):
+        super(commandResult, self).__init__()
+        self.command = command
+        self.name = name or describeCommand(command)
+        self.output = []
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timedOut
+
+    def outputText(self):
+        return "\n".join(self.output)
+
+    def summary(self):
+        if self.timedOut:
+            status = "timed out"
+        elif self.ok:
+            status = "ok"
+        else:
+            status = "failed (" + str(self.returncode) + ")"
+        return "%s - %s - %.1fs" % (self.name, status, self.duration)
+
+
+class batchResult():
+    """
+    Combined result of a batch of commands, in the same order they were given.
+    """
+
+    duration = 0.0
+
+    def __init__(self, results, duration):
+        super(batchResult, self).__init__()
+        self.results = results
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return all(result.ok for result in self.results)
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok]
+
+    def summary(self):
+        lines = [result.summary() for result in self.results]
+        lines.append("%d of %d commands succeeded in %.1fs" % (len(self.results) - len(self.failed), len(self.results), self.duration))
+        return lines
+
+
+def describeCommand(command):
+    if isinstance(command, str):
+        return command
+    return " ".join(str(part) for part in command)
+
+
+def writeLog(lines, logPath):
+    if not logPath:
+        return
+    try:
+        with logLock:
+            with open(logPath, "a") as logFile:
+                for line in lines:
+                    logFile.write(line + "\n")
+    except (OSError, IOError):
+        pass
+
+
+def killProcess(process, group):
+    """
+    Stops a process that has run past its timeout. The whole process group is stopped where possible, so children of
+    a shell (or of ltsp-chroot) are stopped as well.
+    """
+    import signal
+    try:
+        if group:
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.terminate()
+        process.wait(5)
+    except (OSError, TimeoutExpired):
+        try:
+            if group:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+        process.wait()
+
+
+def runOnce(command, shell, timeout, logPath, echo, interactive, inputText, env, cwd, name, maxLines, attached=False):
+    result = commandResult(command, name)
+    output = deque(maxlen=maxLines)
+    started = time.time()
+    writeLog(["[" + time.strftime("%Y-%m-%d %H:%M:%S") + "] $ " + describeCommand(command)], logPath)
+
+    if attached:
+        #Left on the terminal and in the caller's session, so prompts without a newline show and Ctrl-C reaches it
+        process = Popen(command, shell=shell, env=env, cwd=cwd)
+        stream = None
+    elif interactive:
+        #Whiptail and friends draw on the terminal and hand their answer back on stderr
+        process = Popen(command, shell=shell, stderr=PIPE, env=env, cwd=cwd)
+        stream = process.stderr
+    else:
+        process = Popen(command, shell=shell, stdout=PIPE, stderr=STDOUT, stdin=PIPE if inputText is not None else None,
+                        env=env, cwd=cwd, start_new_session=True)
+        stream = process.stdout
+
+    def reader():
+        buffered = []
+        for rawLine in iter(stream.readline, b""):
+            line = rawLine.decode("utf-8", "replace").rstrip("\n")
+            output.append(line)
+            if echo:
+                with echoLock:
+                    if name:
+                        sys.stdout.write(name + ": " + line + "\n")
+                    else:
+                        sys.stdout.write(line + "\n")
+                    sys.stdout.flush()
+            buffered.append("    " + line)
+            if len(buffered) >= 50:
+                writeLog(buffered, logPath)
+                buffered = []
+        writeLog(buffered, logPath)
+        stream.close()
+
+    readerThread = threading.Thread(target=reader)
+    readerThread.daemon = True
+    if stream is not None:
+        readerThread.start()
+
+    if inputText is not None and not interactive and not attached:
+        try:
+            process.stdin.write(inputText.encode())
+            process.stdin.close()
+        except (OSError, IOError):
+            pass
+
+    try:
+        process.wait(timeout)
+    except TimeoutExpired:
+        result.timedOut = True
+        killProcess(process, not interactive and not attached)
+    if stream is not None:
+        readerThread.join(5)
+
+    result.returncode = process.returncode
+    result.duration = time.time() - started
+    result.output = list(output)
+    if result.timedOut:
+        writeLog(["    timed out after %.1fs" % result.duration], logPath)
+    else:
+        writeLog(["    exit code %s after %.1fs" % (result.returncode, result.duration)], logPath)
+    return result
+
+
+def runCommand(command, shell=False, timeout=None, retry=None, logPath=None, echo=False, interactive=False,
+               inputText=None, env=None, cwd=None, name="", maxLines=None, attached=False):
+    """
+    Runs a single command and returns a commandResult.
+    command is an argument list, unless shell is True in which case it is a string passed to /bin/sh.
+    timeout is in seconds, the command (and anything it started) is stopped once it runs past it.
+    retry is an optional retryPolicy.
+    Output is written to logPath (LOG_FILEPATH if not given) as it arrives and echoed to the terminal if echo is True.
+    interactive is for programs that use the terminal themselves (whiptail), only their stderr is captured.
+    attached leaves the command on the terminal as it is (apt and dpkg questions, Ctrl-C). Its output isn't captured,
+    only the command and its exit code are logged.
+    """
+    if logPath is None:
+        logPath = LOG_FILEPATH
+    if maxLines is None:
+        maxLines = OUTPUT_LINES
+    if isinstance(command, str) and not shell:
+        import shlex
+        command = shlex.split(command)
+    attempt = 1
+    while True:
+        try:
+            result = runOnce(command, shell, timeout, logPath, echo, interactive, inputText, env, cwd, name, maxLines, attached)
+        except OSError as error:
+            #Program not found or not executable
+            result = commandResult(command, name)
+            result.returncode = 127
+            result.output = [str(error)]
+            writeLog(["    " + str(error)], logPath)
+        result.attempts = attempt
+        if retry is None or not retry.shouldRetry(result, attempt):
+            return result
+        retry.wait(attempt)
+        attempt = attempt + 1
+
+
+def runBatch(commands, workers=None, **options):
+    """
+    Runs a batch of independent commands concurrently, with at most workers running at once.
+    Each item in commands is either a command or a (name, command) pair. The name is used to prefix echoed output.
+    Any other keyword arguments are passed on to runCommand for every command.
+    Returns a batchResult with the results in the same order as the commands.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if workers is None:
+        workers = BATCH_WORKERS
+    started = time.time()
+    jobs = []
+    for item in commands:
+        if isinstance(item, tuple):
+            jobs.append(item)
+        else:
+            jobs.append(("", item))
+    if not jobs:
+        return batchResult([], 0.0)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as executor:
+        futures = [executor.submit(runCommand, command, name=name, **options) for name, command in jobs]
+        results = [future.result() for future in futures]
+    return batchResult(results, time.time() - started)
@@ -0,0 +1,631 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetShared.py
+#Shared folder registry and bindfs mount reconciler used by pinet-functions-python.py.
+#Every shared folder is recorded once in the registry with its permission level and owner group.
+#The reconciler compares the registry with what is actually mounted (/proc/self/mountinfo) and only
+#mounts, unmounts or remounts the folders that differ. Independent mounts are run side by side.
+#A folder can instead use the acl backend, where the same permissions are given by the kernel through POSIX ACLs,
+#default ACLs and setgid folders, so pupils' file access doesn't go through a bindfs FUSE process.
+
+import os
+import re
+import struct
+
+from pinetRunner import runBatch
+from pinetFiles import writeTextAtomic
+
+SHARED_ROOT = "/home/shared"
+REGISTRY_FILEPATH = "/etc/pinet-shared"
+STATE_FILEPATH = "/run/pinet-shared.state"  #Options each folder was mounted with. /run is emptied at boot, like the mounts
+ACL_STATE_FILEPATH = "/var/lib/pinet/shared-acl.state"  #ACLs each folder was given. They stay on disk, so this does too
+MOUNTINFO_FILEPATH = "/proc/self/mountinfo"
+LEGACY_SCRIPT_FILEPATH = "/usr/local/bin/bindfs-mount"
+MOUNT_WORKERS = 8
+BINDFS = "bindfs"
+UMOUNT = "umount"
+
+LEVELS = {"read": "teacher", "write": "pupil"}  #Permission level and the group that owns the folder unless another is given
+BACKENDS = ("bindfs", "acl")
+BENCHMARK_FOLDER = ".pinet-benchmark"
+
+#From linux/posix_acl_xattr.h
+ACL_XATTR_VERSION = 2
+ACL_USER_OBJ = 0x01
+ACL_GROUP_OBJ = 0x04
+ACL_GROUP = 0x08
+ACL_MASK = 0x10
+ACL_OTHER = 0x20
+ACL_UNDEFINED_ID = 0xFFFFFFFF
+ACL_ACCESS = "system.posix_acl_access"
+ACL_DEFAULT = "system.posix_acl_default"
+
+
+class sharedFolder():
+    """
+    A single registry entry. level is "read" (pupils can only read) or "write" (pupils can read and write).
+    group is the group bindfs shows as owning everything in the folder, which is what gives the write access.
+    backend is bindfs (a FUSE mount over the folder) or acl (the folder's own group and ACLs).
+    """
+
+    name = ""
+    level = "read"
+    group = "teacher"
+    backend = "bindfs"
+
+    def __init__(self, name, level="read", group=None, backend="bindfs"):
+        super(sharedFolder, self).__init__()
+        checkFolderName(name)
+        if level not in LEVELS:
+            raise ValueError("Unknown permission level " + str(level))
+        if backend not in BACKENDS:
+            raise ValueError("Unknown shared folder backend " + str(backend))
+        self.name = name
+        self.level = level
+        self.group = group or LEVELS[level]
+        self.backend = backend
+
+    def path(self, sharedRoot=SHARED_ROOT):
+        return os.path.join(sharedRoot, self.name)
+
+    def mountOptions(self):
+        return "perms=0775,force-group=" + self.group
+
+    def aclSpec(self):
+        """
+        What the acl backend gives the folder, the same as bindfs shows: the owner and group can read and write, everyone
+        else can read.
+        """
+        return "acl,owner=rwX,group=rwX,other=rX,force-group=" + self.group
+
+    def registryLine(self):
+        fields = [self.name, self.level, self.group]
+        if self.backend != "bindfs":
+            fields.append(self.backend)  #Left off for bindfs, so older versions of PiNet still read the registry
+        return ":".join(fields)
+
+    def __eq__(self, other):
+        return isinstance(other, sharedFolder) and self.registryLine() == other.registryLine()
+
+    def __repr__(self):
+        return "sharedFolder(" + self.registryLine() + ")"
+
+
+class mountPlan():
+    """
+    What the reconciler needs to do to make the mounts match the registry. After reconcile has run, results holds
+    the pinetRunner commandResult for every command that was run.
+    """
+
+    def __init__(self):
+        super(mountPlan, self).__init__()
+        self.mount = []
+        self.remount = []
+        self.unmount = []
+        self.acl = []
+        self.results = []
+        self.aclResults = []  #(folder, number of files and folders, errors) for each folder given ACLs
+
+    @property
+    def empty(self):
+        return not (self.mount or self.remount or self.unmount or self.acl)
+
+    @property
+    def ok(self):
+        return all(result.ok for result in self.results) and not any(errors for folder, count, errors in self.aclResults)
+
+    def summary(self):
+        lines = []
+        for folder in self.mount:
+            lines.append("mount " + folder.name + " (" + folder.mountOptions() + ")")
+        for folder in self.remount:
+            lines.append("remount " + folder.name + " (" + folder.mountOptions() + ")")
+        for path in self.unmount:
+            lines.append("unmount " + os.path.basename(path))
+        for folder in self.acl:
+            lines.append("acl " + folder.name + " (" + folder.aclSpec() + ")")
+        for result in self.results:
+            if not result.ok:
+                lines.append(result.summary())
+        for folder, count, errors in self.aclResults:
+            lines.append(folder.name + " - " + str(count) + " files and folders given ACLs")
+            lines.extend("  " + error for error in errors[:10])
+        if not lines:
+            lines.append("Shared folder mounts are up to date")
+        return lines
+
+
+def checkFolderName(name):
+    if not name or name in (".", "..") or "/" in name or ":" in name or "\n" in name:
+        raise ValueError("Invalid shared folder name " + repr(name))
+
+
+def writeLinesAtomic(lines, filepath):
+    """
+    Writes the file next to its final location and renames it over, so a crash never leaves half a registry behind.
+    """
+    writeTextAtomic("".join(line + "\n" for line in lines), filepath)
+
+
+#---------------- Registry -------------------
+
+def loadRegistry(registryPath=REGISTRY_FILEPATH):
+    """
+    Returns {name: sharedFolder} for every entry in the registry. Lines are name:level:group[:backend], blank lines
+    and lines starting with # are ignored, as are lines that do not make sense.
+    """
+    folders = {}
+    if not os.path.isfile(registryPath):
+        return folders
+    with open(registryPath) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split(":")
+            try:
+                folder = sharedFolder(parts[0], parts[1] if len(parts) > 1 else "read", parts[2] if len(parts) > 2 else None, parts[3] if len(parts) > 3 else "bindfs")
+            except ValueError:
+                continue
+            folders[folder.name] = folder
+    return folders
+
+
+def saveRegistry(folders, registryPath=REGISTRY_FILEPATH):
+    lines = ["#PiNet shared folders - name:level:group[:backend]. Managed by PiNet, edit with the shared folder menu."]
+    for name in sorted(folders):
+        lines.append(folders[name].registryLine())
+    writeLinesAtomic(lines, registryPath)
+
+
+def setFolder(name, level, group=None, registryPath=REGISTRY_FILEPATH, backend=None, defaultBackend="bindfs"):
+    """
+    Adds or changes a registry entry. If backend isn't given, a folder keeps the one it has, and a new folder gets
+    defaultBackend.
+    """
+    folders = loadRegistry(registryPath)
+    if backend is None:
+        backend = folders[name].backend if name in folders else defaultBackend
+    folder = sharedFolder(name, level, group, backend)
+    folders[name] = folder
+    saveRegistry(folders, registryPath)
+    return folder
+
+
+def setBackend(backend, names=None, registryPath=REGISTRY_FILEPATH):
+    """
+    Moves the named folders (all of them if names is None) to a backend. The next reconcile unmounts or mounts bindfs
+    and gives the folders their ACLs. Returns the folders that changed.
+    """
+    folders = loadRegistry(registryPath)
+    changed = []
+    for name in sorted(folders):
+        if (names is None or name in names) and folders[name].backend != backend:
+            folder = folders[name]
+            folders[name] = sharedFolder(folder.name, folder.level, folder.group, backend)
+            changed.append(folders[name])
+    if changed:
+        saveRegistry(folders, registryPath)
+    return changed
+
+
+def removeFolder(name, registryPath=REGISTRY_FILEPATH):
+    """
+    Removes a folder from the registry. Returns False if it was not in it.
+    """
+    folders = loadRegistry(registryPath)
+    if name not in folders:
+        return False
+    del folders[name]
+    saveRegistry(folders, registryPath)
+    return True
+
+
+def unknownFolders(sharedRoot=SHARED_ROOT, registryPath=REGISTRY_FILEPATH):
+    """
+    Folders in the shared folder that have no registry entry, so nobody has said who may write to them.
+    """
+    if not os.path.isdir(sharedRoot):
+        return []
+    folders = loadRegistry(registryPath)
+    unknown = []
+    for name in sorted(os.listdir(sharedRoot)):
+        if name not in folders and os.path.isdir(os.path.join(sharedRoot, name)):
+            unknown.append(name)
+    return unknown
+
+
+def migrateLegacyScript(scriptPath=LEGACY_SCRIPT_FILEPATH, sharedRoot=SHARED_ROOT, registryPath=REGISTRY_FILEPATH):
+    """
+    Imports the "bindfs -o perms=0775,force-group=pupil /home/shared/X /home/shared/X" lines written by older versions
+    of PiNet into the registry, then renames the old script so it is only imported once. Returns the number of folders added.
+    """
+    if not os.path.isfile(scriptPath):
+        return 0
+    folders = loadRegistry(registryPath)
+    added = 0
+    pattern = re.compile(r"bindfs\s+-o\s+\S*force-group=([^,\s]+)\S*\s+" + re.escape(sharedRoot.rstrip("/")) + r"/(.+?)\s+" + re.escape(sharedRoot.rstrip("/")) + "/")
+    with open(scriptPath) as f:
+        for line in f:
+            match = pattern.search(line)
+            if match is None:
+                continue
+            group, name = match.group(1), match.group(2)
+            if name in folders:
+                continue
+            level = "write" if group == LEVELS["write"] else "read"
+            try:
+                folders[name] = sharedFolder(name, level, group)
+            except ValueError:
+                continue
+            added = added + 1
+    if added:
+        saveRegistry(folders, registryPath)
+    os.rename(scriptPath, scriptPath + ".old")
+    return added
+
+
+#---------------- Mounts -------------------
+
+def unescapeMountPath(path):
+    """
+    mountinfo writes spaces, tabs, newlines and backslashes in paths as octal escapes (\\040 and so on).
+    """
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), path)
+
+
+def readMountinfo(mountinfoPath=MOUNTINFO_FILEPATH):
+    """
+    Returns {mount point: (filesystem type, source)} from a mountinfo file.
+    """
+    mounts = {}
+    with open(mountinfoPath) as f:
+        for line in f:
+            fields = line.split()
+            if "-" not in fields:
+                continue
+            separator = fields.index("-")
+            if separator < 5 or len(fields) < separator + 3:
+                continue
+            mounts[unescapeMountPath(fields[4])] = (fields[separator + 1], fields[separator + 2])
+    return mounts
+
+
+def bindfsMounts(sharedRoot=SHARED_ROOT, mountinfoPath=MOUNTINFO_FILEPATH):
+    """
+    The set of bindfs mount points directly inside the shared folder.
+    """
+    sharedRoot = os.path.normpath(sharedRoot)
+    mounted = set()
+    for path, (filesystem, source) in readMountinfo(mountinfoPath).items():
+        if os.path.dirname(os.path.normpath(path)) != sharedRoot:
+            continue
+        if filesystem == "fuse.bindfs" or (filesystem.startswith("fuse") and source == "bindfs"):
+            mounted.add(os.path.normpath(path))
+    return mounted
+
+
+def loadState(statePath=STATE_FILEPATH):
+    state = {}
+    if not os.path.isfile(statePath):
+        return state
+    with open(statePath) as f:
+        for line in f:
+            parts = line.rstrip("\n").split(" ", 1)
+            if len(parts) == 2:
+                state[parts[1]] = parts[0]
+    return state
+
+
+def saveState(state, statePath=STATE_FILEPATH):
+    writeLinesAtomic([state[path] + " " + path for path in sorted(state)], statePath)
+
+
+def planMounts(folders, mounted, state, sharedRoot=SHARED_ROOT, aclState=None, repair=False):
+    """
+    Works out the difference between the registry (folders) and what is mounted. A mounted folder is remounted when
+    the options it was mounted with (from state) are not the ones the registry asks for, or are not known.
+    Folders using the acl backend are unmounted if bindfs is still mounted over them, and given their ACLs if aclState
+    doesn't show they have them already (or always, with repair). Registry entries whose folder does not exist are
+    left alone.
+    """
+    plan = mountPlan()
+    wanted = {}
+    for folder in folders.values():
+        path = os.path.normpath(folder.path(sharedRoot))
+        if not os.path.isdir(path):
+            continue
+        if folder.backend == "acl":
+            if repair or (aclState or {}).get(path) != folder.aclSpec():
+                plan.acl.append(folder)
+        else:
+            wanted[path] = folder
+    for path in sorted(mounted):
+        if path not in wanted:
+            plan.unmount.append(path)
+    for path in sorted(wanted):
+        folder = wanted[path]
+        if path not in mounted:
+            plan.mount.append(folder)
+        elif state.get(path) != folder.mountOptions():
+            plan.remount.append(folder)
+    return plan
+
+
+def reconcile(sharedRoot=SHARED_ROOT, registryPath=REGISTRY_FILEPATH, statePath=STATE_FILEPATH,
+              mountinfoPath=MOUNTINFO_FILEPATH, workers=None, dryRun=False, logPath=None,
+              aclStatePath=ACL_STATE_FILEPATH, repair=False):
+    """
+    Brings the bindfs mounts and ACLs in line with the registry and returns the mountPlan that was carried out.
+    Unmounts (including the first half of remounts) are run as one batch, then all the mounts as a second batch, then
+    the folders using the acl backend are given their ACLs side by side. repair gives every acl folder its ACLs again,
+    for files moved in from elsewhere, which keep the permissions they had.
+    """
+    if workers is None:
+        workers = MOUNT_WORKERS
+    folders = loadRegistry(registryPath)
+    mounted = bindfsMounts(sharedRoot, mountinfoPath)
+    state = dict((path, options) for path, options in loadState(statePath).items() if path in mounted)
+    aclState = loadState(aclStatePath)
+    plan = planMounts(folders, mounted, state, sharedRoot, aclState, repair)
+    if dryRun or plan.empty:
+        return plan
+
+    unmounts = plan.unmount + [os.path.normpath(folder.path(sharedRoot)) for folder in plan.remount]
+    stillMounted = set()
+    if unmounts:
+        batch = runBatch([(os.path.basename(path), [UMOUNT, "-l", path]) for path in unmounts], workers=workers, logPath=logPath)
+        for path, result in zip(unmounts, batch.results):
+            if result.ok:
+                state.pop(path, None)
+            else:
+                stillMounted.add(path)
+        plan.results.extend(batch.results)
+
+    mounts = plan.mount + plan.remount
+    if mounts:
+        commands = []
+        for folder in mounts:
+            path = os.path.normpath(folder.path(sharedRoot))
+            commands.append((folder.name, [BINDFS, "-o", folder.mountOptions(), path, path]))
+        batch = runBatch(commands, workers=workers, logPath=logPath)
+        for folder, result in zip(mounts, batch.results):
+            if result.ok:
+                state[os.path.normpath(folder.path(sharedRoot))] = folder.mountOptions()
+        plan.results.extend(batch.results)
+
+    saveState(state, statePath)
+    if plan.acl:
+        from concurrent.futures import ThreadPoolExecutor
+        ready = [folder for folder in plan.acl if os.path.normpath(folder.path(sharedRoot)) not in stillMounted]
+        for folder in plan.acl:
+            if folder not in ready:  #The ACLs would go through bindfs rather than onto the folder
+                plan.aclResults.append((folder, 0, ["bindfs could not be unmounted"]))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for folder, (count, errors) in zip(ready, executor.map(lambda folder: applyFolderAcl(folder, sharedRoot), ready)):
+                plan.aclResults.append((folder, count, errors))
+                if not errors:
+                    aclState[os.path.normpath(folder.path(sharedRoot))] = folder.aclSpec()
+    aclState = dict((path, spec) for path, spec in aclState.items()
+                    if os.path.basename(path) in folders and folders[os.path.basename(path)].backend == "acl")
+    saveState(aclState, aclStatePath)
+    return plan
+
+
+def unmountAll(sharedRoot=SHARED_ROOT, statePath=STATE_FILEPATH, mountinfoPath=MOUNTINFO_FILEPATH, workers=None, logPath=None):
+    """
+    Unmounts every bindfs mount in the shared folder, used when the bindfs-mount service is stopped.
+    """
+    if workers is None:
+        workers = MOUNT_WORKERS
+    mounted = sorted(bindfsMounts(sharedRoot, mountinfoPath))
+    batch = runBatch([(os.path.basename(path), [UMOUNT, "-l", path]) for path in mounted], workers=workers, logPath=logPath)
+    if os.path.isfile(statePath):
+        os.remove(statePath)
+    return batch
+
+
+#---------------- ACLs -------------------
+
+def encodeAcl(entries):
+    """
+    The system.posix_acl_* extended attribute for a list of (tag, permissions, id), which the kernel wants sorted by
+    tag and then id.
+    """
+    return struct.pack("<I", ACL_XATTR_VERSION) + b"".join(struct.pack("<HHI", tag, permissions, ident) for tag, permissions, ident in sorted(entries))
+
+
+def folderAcl(gid, mode, isFolder):
+    """
+    The access ACL that gives a file or folder the permissions bindfs -o perms=0775,force-group shows: the owner and
+    the group read and write, everyone else reads. Execute is only given to folders and files that already had it.
+    """
+    execute = 1 if isFolder or mode & 0o111 else 0
+    readWrite = 6 | execute
+    read = 4 | execute
+    return encodeAcl([(ACL_USER_OBJ, readWrite, ACL_UNDEFINED_ID), (ACL_GROUP_OBJ, readWrite, ACL_UNDEFINED_ID), (ACL_GROUP, readWrite, gid),
+                      (ACL_MASK, readWrite, ACL_UNDEFINED_ID), (ACL_OTHER, read, ACL_UNDEFINED_ID)])
+
+
+def defaultAcl(gid):
+    """
+    The default ACL given to every folder, so new files get the group's write access whatever the umask of whoever
+    made them.
+    """
+    return encodeAcl([(ACL_USER_OBJ, 7, ACL_UNDEFINED_ID), (ACL_GROUP_OBJ, 7, ACL_UNDEFINED_ID), (ACL_GROUP, 7, gid),
+                      (ACL_MASK, 7, ACL_UNDEFINED_ID), (ACL_OTHER, 5, ACL_UNDEFINED_ID)])
+
+
+def setXattr(path, name, value):
+    try:
+        if os.getxattr(path, name, follow_symlinks=False) == value:
+            return False
+    except OSError:
+        pass
+    os.setxattr(path, name, value, follow_symlinks=False)
+    return True
+
+
+def applyAcl(top, gid):
+    """
+    Gives everything in top the group gid and the ACLs bindfs would have shown, and makes every folder setgid so new
+    files are in the group too. Symlinks and other filesystems are left alone. Returns (count, errors).
+    """
+    import stat
+    count = 0
+    errors = []
+    try:
+        device = os.lstat(top).st_dev
+    except OSError as error:
+        return 0, [str(error)]
+    pending = [top]
+    while pending:
+        folder = pending.pop()
+        try:
+            entries = [folder] + [entry.path for entry in os.scandir(folder)]
+        except OSError as error:
+            errors.append(str(error))
+            continue
+        for path in entries:
+            try:
+                info = os.lstat(path)
+                if info.st_dev != device or stat.S_ISLNK(info.st_mode):
+                    continue
+                isFolder = stat.S_ISDIR(info.st_mode)
+                if isFolder and path != folder:
+                    pending.append(path)  #Done when its own contents are listed
+                    continue
+                if info.st_gid != gid:
+                    os.chown(path, -1, gid, follow_symlinks=False)
+                if isFolder and not info.st_mode & stat.S_ISGID:
+                    os.chmod(path, stat.S_IMODE(info.st_mode) | stat.S_ISGID)
+                setXattr(path, ACL_ACCESS, folderAcl(gid, info.st_mode, isFolder))
+                if isFolder:
+                    setXattr(path, ACL_DEFAULT, defaultAcl(gid))
+                count = count + 1
+            except OSError as error:
+                errors.append(path + ": " + str(error))
+    return count, errors
+
+
+def applyFolderAcl(folder, sharedRoot=SHARED_ROOT):
+    import grp
+    try:
+        gid = grp.getgrnam(folder.group).gr_gid
+    except KeyError:
+        return 0, ["There is no group " + folder.group]
+    path = os.path.normpath(folder.path(sharedRoot))
+    try:
+        os.chown(path, 0, -1)  #The top folder belongs to root, as it does with bindfs
+    except OSError as error:
+        return 0, [str(error)]
+    return applyAcl(path, gid)
+
+
+def aclSupported(folder):
+    """
+    Whether the filesystem folder is on takes POSIX ACLs (it may be mounted with noacl, for example).
+    """
+    import tempfile
+    try:
+        handle, path = tempfile.mkstemp(dir=folder, prefix=".pinet-acl-")
+    except OSError:
+        return False
+    os.close(handle)
+    try:
+        os.setxattr(path, ACL_ACCESS, folderAcl(os.getgid(), 0o644, False))
+        return True
+    except OSError:
+        return False
+    finally:
+        os.remove(path)
+
+
+#---------------- Benchmark -------------------
+
+def measure(folder, files=1000, size=4096, clock=None):
+    """
+    Times small file work in folder: creating files, looking at their metadata, listing, reading and deleting them.
+    Returns {phase: seconds}.
+    """
+    import time
+    if clock is None:
+        clock = time.perf_counter
+    data = os.urandom(size)
+    names = [os.path.join(folder, "f%05d" % i) for i in range(files)]
+    times = {}
+    start = clock()
+    for name in names:
+        with open(name, "wb") as f:
+            f.write(data)
+    times["create"] = clock() - start
+    start = clock()
+    for repeat in range(3):
+        for name in names:
+            os.stat(name)
+    times["stat"] = (clock() - start) / 3
+    start = clock()
+    for repeat in range(3):
+        len(os.listdir(folder))
+    times["list"] = (clock() - start) / 3
+    start = clock()
+    for name in names:
+        with open(name, "rb") as f:
+            f.read()
+    times["read"] = clock() - start
+    start = clock()
+    for name in names:
+        os.remove(name)
+    times["delete"] = clock() - start
+    return times
+
+
+def benchmark(sharedRoot=SHARED_ROOT, files=1000, size=4096, group=LEVELS["write"], logPath=None):
+    """
+    Runs measure() in a folder given the acl backend and in one mounted with bindfs (if it is installed), side by side
+    in the shared folder so both are on the same disk. Returns {backend: {phase: seconds}}.
+    """
+    import grp
+    import shutil
+    from pinetRunner import runCommand
+    top = os.path.join(sharedRoot, BENCHMARK_FOLDER)
+    if os.path.isdir(top):
+        shutil.rmtree(top)
+    results = {}
+    try:
+        for backend in BACKENDS:
+            folder = os.path.join(top, backend)
+            os.makedirs(folder)
+            if backend == "acl":
+                count, errors = applyAcl(folder, grp.getgrnam(group).gr_gid)
+                if errors:
+                    continue
+            else:
+                if shutil.which(BINDFS) is None:
+                    continue
+                if not runCommand([BINDFS, "-o", "perms=0775,force-group=" + group, folder, folder], logPath=logPath).ok:
+                    continue
+            try:
+                results[backend] = measure(folder, files, size)
+            finally:
+                if backend == "bindfs":
+                    runCommand([UMOUNT, folder], logPath=logPath)
+    finally:
+        shutil.rmtree(top, ignore_errors=True)
+    return results
+
+
+def formatBenchmark(results, files):
+    lines = []
+    phases = ["create", "stat", "list", "read", "delete"]
+    lines.append("%-8s" % "" + "".join("%12s" % phase for phase in phases))
+    for backend in BACKENDS:
+        if backend in results:
+            lines.append("%-8s" % backend + "".join("%10.0f/s" % (files / max(results[backend][phase], 1e-9)) for phase in phases))
+    if len(results) == len(BACKENDS):
+        lines.append("%-8s" % "acl" + "".join("%11.1fx" % (results["bindfs"][phase] / max(results["acl"][phase], 1e-9)) for phase in phases) + "  faster")
+    return lines
@@ -0,0 +1,418 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetSlim.py
+#Chroot slimming analyzer used by pinet-functions-python.py.
+#Every package added to the Raspbian chroot makes image builds and Raspberry Pi boots slower, but nothing said where
+#the space had gone. The chroot is walked in parallel and each file is matched to the package that owns it using
+#dpkg's own records (var/lib/dpkg/status and the var/lib/dpkg/info/*.list files). From that packages and folders are
+#ranked by size, and files no package owns, duplicate files, caches, documentation and other languages' translations
+#are found. Part of each group is compressed to estimate how much smaller the NBD image would be without it. The groups
+#chosen are written to the excludes file ltsp-update-image gives mksquashfs, so they are left out of image builds but
+#stay in the chroot.
+
+import os
+import stat
+import time
+
+SLIM_FOLDER = "/var/lib/pinet/slim"
+EXCLUDES_FILEPATH = "/etc/ltsp/ltsp-update-image.excludes"
+DEFAULT_EXCLUDES_FILEPATH = "/usr/share/ltsp/ltsp-update-image.excludes"  #Used by ltsp-update-image until the one in /etc exists
+EXCLUDES_START = "#PiNet slimming start"
+EXCLUDES_END = "#PiNet slimming end"
+WORKERS = 8
+DUPLICATE_MIN_SIZE = 64 * 1024
+ESTIMATE_SAMPLE_BYTES = 16 * 1024 * 1024
+ESTIMATE_BLOCK_SIZE = 128 * 1024  #The mksquashfs default block size
+TOP = 25
+#Patterns are in the mksquashfs -wildcards form ltsp-update-image uses: relative to the chroot, * doesn't match /, and a
+#pattern matching a folder leaves out everything in it
+CATEGORIES = {
+    "caches": ["var/cache/apt/archives/*.deb", "var/cache/apt/*.bin", "var/lib/apt/lists/*", "var/cache/man/*",
+               "var/cache/debconf/*-old", "root/.cache", "home/*/.cache", "tmp/*", "var/tmp/*"],
+    "docs": ["usr/share/doc/*", "usr/share/man/*", "usr/share/info/*", "usr/share/gtk-doc/*", "usr/share/help/*"],
+}
+CATEGORY_DESCRIPTIONS = {
+    "caches": "Downloaded packages, package lists and other caches",
+    "docs": "Documentation, man and info pages",
+    "locales": "Translations for languages other than the chroot's",
+}
+LOCALE_FOLDER = "usr/share/locale"
+
+
+def reportPath(targetName):
+    return os.path.join(SLIM_FOLDER, targetName + ".json")
+
+
+def matchesPattern(relative, pattern):
+    """
+    Whether mksquashfs -wildcards would leave relative out because of pattern, either itself or as part of a folder.
+    """
+    from fnmatch import fnmatchcase
+    pattern = pattern.strip("/")
+    literal = pattern.split("*")[0].split("?")[0].split("[")[0]
+    if not relative.startswith(literal):  #Quick check, as every file is tried against every pattern
+        return False
+    parts = relative.split("/")
+    patternParts = pattern.split("/")
+    if len(parts) < len(patternParts):
+        return False
+    return all(fnmatchcase(part, patternPart) for part, patternPart in zip(parts, patternParts))
+
+
+#---------------- Reading the chroot -------------------
+
+def readDpkgStatus(chrootPath):
+    """
+    The installed packages in the chroot, as {package: Installed-Size in bytes}.
+    """
+    packages = {}
+    fields = {}
+    try:
+        with open(os.path.join(chrootPath, "var", "lib", "dpkg", "status"), encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines() + [""]
+    except (OSError, IOError):
+        return packages
+    for line in lines:
+        if not line.strip():
+            if "Package" in fields and fields.get("Status", "").endswith(" installed"):
+                try:
+                    packages[fields["Package"]] = int(fields.get("Installed-Size", "0")) * 1024
+                except ValueError:
+                    packages[fields["Package"]] = 0
+            fields = {}
+        elif not line[0].isspace() and ":" in line:
+            key, value = line.split(":", 1)
+            fields[key] = value.strip()
+    return packages
+
+
+def readOwners(chrootPath):
+    """
+    Which package owns each path in the chroot, from var/lib/dpkg/info/*.list, as {relative path: package}.
+    """
+    infoFolder = os.path.join(chrootPath, "var", "lib", "dpkg", "info")
+    owners = {}
+    try:
+        names = sorted(os.listdir(infoFolder))
+    except OSError:
+        return owners
+    for name in names:
+        if not name.endswith(".list"):
+            continue
+        package = name[:-len(".list")].split(":")[0]  #libc6:armhf.list is libc6
+        try:
+            with open(os.path.join(infoFolder, name), encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    path = line.rstrip("\n").strip("/")
+                    if path and path not in owners:
+                        owners[path] = package
+        except (OSError, IOError):
+            continue
+    return owners
+
+
+def walkFolder(chrootPath, relative, device):
+    """
+    Every regular file under relative as (relative path, size, (device, inode)). Doesn't cross into other
+    filesystems, such as /proc while ltsp-chroot is running.
+    """
+    files = []
+    for root, folders, names in os.walk(os.path.join(chrootPath, relative)):
+        kept = []
+        for folder in sorted(folders):
+            try:
+                if os.lstat(os.path.join(root, folder)).st_dev == device:
+                    kept.append(folder)
+            except OSError:
+                continue
+        folders[:] = kept
+        for name in sorted(names):
+            filepath = os.path.join(root, name)
+            try:
+                info = os.lstat(filepath)
+            except OSError:
+                continue
+            if stat.S_ISREG(info.st_mode):
+                files.append((os.path.relpath(filepath, chrootPath), info.st_size, (info.st_dev, info.st_ino)))
+    return files
+
+
+def walkChroot(chrootPath, workers=WORKERS):
+    """
+    Every regular file in the chroot, walked several folders at once. Each folder two levels down (usr/share,
+    usr/lib and so on) is its own job so the big ones are split up. Hard links to a file already seen are left out.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    device = os.lstat(chrootPath).st_dev
+    files = []
+    jobs = []
+    for top in sorted(os.listdir(chrootPath)):
+        topPath = os.path.join(chrootPath, top)
+        info = os.lstat(topPath)
+        if stat.S_ISREG(info.st_mode):
+            files.append((top, info.st_size, (info.st_dev, info.st_ino)))
+        if not stat.S_ISDIR(info.st_mode) or info.st_dev != device:
+            continue
+        for name in sorted(os.listdir(topPath)):
+            filepath = os.path.join(topPath, name)
+            info = os.lstat(filepath)
+            if stat.S_ISREG(info.st_mode):
+                files.append((top + "/" + name, info.st_size, (info.st_dev, info.st_ino)))
+            elif stat.S_ISDIR(info.st_mode) and info.st_dev == device:
+                jobs.append(top + "/" + name)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for found in executor.map(lambda relative: walkFolder(chrootPath, relative, device), jobs):
+            files.extend(found)
+    seen = set()
+    unique = []
+    for relative, size, inode in files:
+        if inode not in seen:
+            seen.add(inode)
+            unique.append((relative, size, inode))
+    return unique
+
+
+def chrootLanguages(chrootPath):
+    """
+    The languages to keep translations for, from LANG in the chroot's /etc/default/locale (en_GB.UTF-8 keeps en_GB
+    and en). English is always kept.
+    """
+    languages = set(["en"])
+    try:
+        with open(os.path.join(chrootPath, "etc", "default", "locale")) as f:
+            for line in f:
+                if line.startswith("LANG="):
+                    language = line.split("=", 1)[1].strip().strip('"').split(".")[0].split("@")[0]
+                    if language and language not in ["C", "POSIX"]:
+                        languages.add(language)
+                        languages.add(language.split("_")[0])
+    except (OSError, IOError):
+        pass
+    return languages
+
+
+def localePatterns(chrootPath, keep=None):
+    """
+    One pattern for each translation folder in usr/share/locale that isn't for a language in keep.
+    """
+    if keep is None:
+        keep = chrootLanguages(chrootPath)
+    patterns = []
+    try:
+        names = sorted(os.listdir(os.path.join(chrootPath, LOCALE_FOLDER)))
+    except OSError:
+        return patterns
+    for name in names:
+        if os.path.isdir(os.path.join(chrootPath, LOCALE_FOLDER, name)) and name.split("@")[0] not in keep and name.split("_")[0].split("@")[0] not in keep:
+            patterns.append(LOCALE_FOLDER + "/" + name)
+    return patterns
+
+
+#---------------- Analysis -------------------
+
+def fileHash(filepath):
+    import hashlib
+    digest = hashlib.sha1()
+    try:
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    except (OSError, IOError):
+        return None
+    return digest.hexdigest()
+
+
+def findDuplicates(chrootPath, files, minSize=DUPLICATE_MIN_SIZE, workers=WORKERS):
+    """
+    Groups of files with the same contents, biggest waste first, as [(size, [relative paths])]. Only files of the
+    same size are read.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    bySize = {}
+    for relative, size, inode in files:
+        if size >= minSize:
+            bySize.setdefault(size, []).append(relative)
+    candidates = [relative for size in bySize if len(bySize[size]) > 1 for relative in bySize[size]]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        hashes = list(executor.map(lambda relative: fileHash(os.path.join(chrootPath, relative)), candidates))
+    sizes = dict((relative, size) for relative, size, inode in files)
+    groups = {}
+    for relative, digest in zip(candidates, hashes):
+        if digest is not None:
+            groups.setdefault((sizes[relative], digest), []).append(relative)
+    duplicates = [(size, sorted(paths)) for (size, digest), paths in groups.items() if len(paths) > 1]
+    return sorted(duplicates, key=lambda item: (-item[0] * (len(item[1]) - 1), item[1]))
+
+
+def compressionRatio(chrootPath, files, sampleBytes=ESTIMATE_SAMPLE_BYTES):
+    """
+    Compressed size over size for an even sample of files, compressed a block at a time with zlib like the default
+    mksquashfs gzip compression. 1.0 if there is nothing to sample.
+    """
+    import zlib
+    total = sum(size for relative, size in files)
+    if total == 0:
+        return 1.0
+    step = max(1, int(total / sampleBytes))
+    read = 0
+    compressed = 0
+    for relative, size in files[::step]:
+        try:
+            with open(os.path.join(chrootPath, relative), "rb") as f:
+                for block in iter(lambda: f.read(ESTIMATE_BLOCK_SIZE), b""):
+                    read = read + len(block)
+                    compressed = compressed + min(len(block), len(zlib.compress(block, 9)))  #mksquashfs stores blocks that don't shrink uncompressed
+        except (OSError, IOError):
+            continue
+    if read == 0:
+        return 1.0
+    return float(compressed) / read
+
+
+def topFolders(files, depth=3, count=TOP):
+    """
+    The biggest folders depth levels down (or less, where files are higher up), as [(relative path, size)].
+    """
+    sizes = {}
+    for relative, size, inode in files:
+        parts = relative.split("/")
+        if len(parts) > 1:
+            folder = "/".join(parts[:min(depth, len(parts) - 1)])
+            sizes[folder] = sizes.get(folder, 0) + size
+    return sorted(sizes.items(), key=lambda item: (-item[1], item[0]))[:count]
+
+
+def categoryPatterns(chrootPath, keepLanguages=None):
+    patterns = dict((name, list(CATEGORIES[name])) for name in CATEGORIES)
+    patterns["locales"] = localePatterns(chrootPath, keepLanguages)
+    return patterns
+
+
+def analyse(chrootPath, workers=WORKERS, keepLanguages=None, now=None):
+    """
+    Walks the chroot and returns a report (a dict, saved as JSON) of where the space goes and what could be left out
+    of the image.
+    """
+    if now is None:
+        now = time.time()
+    started = time.time()
+    files = walkChroot(chrootPath, workers)
+    owners = readOwners(chrootPath)
+    installed = readDpkgStatus(chrootPath)
+    total = sum(size for relative, size, inode in files)
+
+    packages = dict((package, {"name": package, "size": 0, "files": 0, "installedSize": installed[package]}) for package in installed)
+    unowned = []
+    for relative, size, inode in files:
+        package = owners.get(relative)
+        if package is None:
+            unowned.append((relative, size))
+            continue
+        if package not in packages:
+            packages[package] = {"name": package, "size": 0, "files": 0, "installedSize": 0}
+        packages[package]["size"] = packages[package]["size"] + size
+        packages[package]["files"] = packages[package]["files"] + 1
+
+    categories = {}
+    excluded = set()
+    for name, patterns in sorted(categoryPatterns(chrootPath, keepLanguages).items()):
+        matched = [(relative, size) for relative, size, inode in files if any(matchesPattern(relative, pattern) for pattern in patterns)]
+        excluded.update(relative for relative, size in matched)
+        size = sum(size for relative, size in matched)
+        categories[name] = {"patterns": patterns, "files": len(matched), "size": size,
+                            "compressedSize": int(size * compressionRatio(chrootPath, matched))}
+
+    duplicates = findDuplicates(chrootPath, files, workers=workers)
+    ratio = compressionRatio(chrootPath, [(relative, size) for relative, size, inode in files])
+    unowned = [(relative, size) for relative, size in unowned if relative not in excluded]  #Caches are mostly unowned, they're counted once
+    return {"created": now, "duration": time.time() - started, "chroot": chrootPath, "size": total, "files": len(files),
+            "estimatedImageSize": int(total * ratio),
+            "packages": sorted(packages.values(), key=lambda item: (-item["size"], item["name"]))[:TOP], "packageCount": len(packages),
+            "folders": topFolders(files), "unownedSize": sum(size for relative, size in unowned),
+            "unowned": sorted(unowned, key=lambda item: (-item[1], item[0]))[:TOP],
+            "duplicateSize": sum(size * (len(paths) - 1) for size, paths in duplicates), "duplicates": duplicates[:TOP],
+            "categories": categories}
+
+
+def formatReport(report, formatSize):
+    """
+    The report as lines of text. formatSize turns a number of bytes into text.
+    """
+    lines = [report["chroot"] + ": " + formatSize(report["size"]) + " in " + str(report["files"]) + " files, " +
+             str(report["packageCount"]) + " packages. Estimated image " + formatSize(report["estimatedImageSize"]),
+             "", "Biggest packages"]
+    for package in report["packages"]:
+        lines.append("  %-40s %9s %7d files" % (package["name"], formatSize(package["size"]), package["files"]))
+    lines = lines + ["", "Biggest folders"]
+    for folder, size in report["folders"]:
+        lines.append("  %-40s %9s" % ("/" + folder, formatSize(size)))
+    lines = lines + ["", "Files no package owns: " + formatSize(report["unownedSize"])]
+    for relative, size in report["unowned"]:
+        lines.append("  %-60s %9s" % ("/" + relative, formatSize(size)))
+    lines = lines + ["", "Duplicate files: " + formatSize(report["duplicateSize"]) + " (mksquashfs already stores these once in the image)"]
+    for size, paths in report["duplicates"]:
+        lines.append("  %9s x%d  %s" % (formatSize(size), len(paths), ", ".join("/" + path for path in paths)))
+    lines = lines + ["", "Could be left out of the image"]
+    for name in sorted(report["categories"]):
+        category = report["categories"][name]
+        lines.append("  %-10s %9s, about %s smaller image (%d files)" % (name, formatSize(category["size"]), formatSize(category["compressedSize"]), category["files"]))
+    return lines
+
+
+#---------------- Excludes file -------------------
+
+def readExcludes(excludesPath=EXCLUDES_FILEPATH):
+    """
+    The patterns PiNet has added to the excludes file.
+    """
+    try:
+        with open(excludesPath) as f:
+            lines = f.read().splitlines()
+    except (OSError, IOError):
+        return []
+    if EXCLUDES_START not in lines or EXCLUDES_END not in lines:
+        return []
+    return lines[lines.index(EXCLUDES_START) + 1:lines.index(EXCLUDES_END)]
+
+
+def imageExcludes(excludesPath=EXCLUDES_FILEPATH, defaultPath=DEFAULT_EXCLUDES_FILEPATH):
+    """
+    Every pattern ltsp-update-image leaves out of the image, from the excludes file it uses.
+    """
+    for filepath in [excludesPath, defaultPath]:
+        try:
+            with open(filepath) as f:
+                return [line.strip() for line in f.read().splitlines() if line.strip() and not line.startswith("#")]
+        except (OSError, IOError):
+            continue
+    return []
+
+
+def writeExcludes(patterns, excludesPath=EXCLUDES_FILEPATH, defaultPath=DEFAULT_EXCLUDES_FILEPATH):
+    """
+    Replaces the patterns PiNet added to the excludes file. The first time, ltsp-update-image's default excludes are
+    copied in, as the file in /etc replaces them rather than adding to them.
+    """
+    lines = []
+    for filepath in [excludesPath, defaultPath]:
+        try:
+            with open(filepath) as f:
+                lines = f.read().splitlines()
+            break
+        except (OSError, IOError):
+            continue
+    if EXCLUDES_START in lines and EXCLUDES_END in lines:
+        lines = lines[:lines.index(EXCLUDES_START)] + lines[lines.index(EXCLUDES_END) + 1:]
+    if patterns:
+        lines = lines + [EXCLUDES_START] + list(patterns) + [EXCLUDES_END]
+    folder = os.path.dirname(excludesPath)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    temporary = excludesPath + ".new"
+    with open(temporary, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary, excludesPath)
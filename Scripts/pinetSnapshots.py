@@ -0,0 +1,298 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetSnapshots.py
+#Chroot snapshots used by pinet-functions-python.py.
+#Software installs change the Raspbian chroot in place, so a broken install used to leave every Raspberry Pi in the
+#classroom broken until the chroot was rebuilt from scratch, which takes hours. A snapshot of the chroot is now
+#taken before installs and upgrades. It is made with the cheapest method the disk supports: a btrfs snapshot if the
+#chroot is a btrfs subvolume, a reflink copy if the filesystem can share file data, or otherwise a copy of the folder
+#tree made of hard links, with the folders PiNet edits itself copied. Rolling back swaps the snapshot and the chroot folders, which takes the same time however
+#big the chroot is.
+
+import os
+import time
+
+from pinetRunner import runCommand
+from pinetFiles import writeJSONAtomic, readJSON
+
+SNAPSHOT_FOLDER_NAME = ".pinet-snapshots"  #Next to the chroots, so snapshots are on the same disk and can be renamed into place
+KEEP = 3
+SNAPSHOT_TIMEOUT = 60 * 60
+METHODS = ["btrfs", "reflink", "hardlink"]
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+#Folders copied rather than hard linked, as PiNet changes files in them in place (appending to lts.conf, cp over the
+#screenshot script and icons, writeTextFile), which would change a hard linked snapshot too
+COPIED_FOLDERS = ["etc", "root", "home", "opt", "boot", "bootfiles", "usr/local", "usr/share/applications", "usr/share/images",
+                  "usr/share/ldm", "usr/share/pixmaps"]
+
+
+class snapshot():
+    """
+    One saved copy of a chroot. method is how it was made (see METHODS), duration how many seconds that took.
+    """
+
+    def __init__(self, name, target, created, method, duration=0.0, reason="", folder=""):
+        super(snapshot, self).__init__()
+        self.name = name
+        self.target = target
+        self.created = created
+        self.method = method
+        self.duration = duration
+        self.reason = reason
+        self.folder = folder
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, self.name)
+
+    def toDict(self):
+        return {"name": self.name, "target": self.target, "created": self.created, "method": self.method,
+                "duration": self.duration, "reason": self.reason}
+
+    def save(self):
+        writeJSONAtomic(self.toDict(), self.path + ".json")
+
+    @classmethod
+    def load(cls, filepath):
+        data = readJSON(filepath)
+        if not isinstance(data, dict):
+            return None
+        return cls(data["name"], data.get("target", ""), data.get("created", 0), data.get("method", "hardlink"),
+                   data.get("duration", 0.0), data.get("reason", ""), os.path.dirname(filepath))
+
+    def summary(self):
+        return "%s  %-8s %6.1fs  %s" % (self.name, self.method, self.duration, self.reason)
+
+
+def snapshotFolder(chrootPath, targetName=None):
+    if targetName is None:
+        targetName = os.path.basename(chrootPath.rstrip("/"))
+    return os.path.join(os.path.dirname(chrootPath.rstrip("/")), SNAPSHOT_FOLDER_NAME, targetName)
+
+
+#---------------- Choosing a method -------------------
+
+def mountPoints(mountsPath="/proc/self/mounts"):
+    """
+    Returns [(mount point, filesystem type)].
+    """
+    mounts = []
+    try:
+        with open(mountsPath) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    mounts.append((fields[1].replace("\\040", " "), fields[2]))
+    except (OSError, IOError):
+        pass
+    return mounts
+
+
+def filesystemType(path, mounts=None):
+    if mounts is None:
+        mounts = mountPoints()
+    path = os.path.realpath(path)
+    best = ("", "")
+    for point, kind in mounts:
+        if (path == point or path.startswith(point.rstrip("/") + "/")) and len(point) > len(best[0]):
+            best = (point, kind)
+    return best[1]
+
+
+def mountsInside(path, mounts=None):
+    """
+    Anything mounted inside path, such as the /proc ltsp-chroot mounts while it is running.
+    """
+    if mounts is None:
+        mounts = mountPoints()
+    path = os.path.realpath(path).rstrip("/") + "/"
+    return [point for point, kind in mounts if point.startswith(path)]
+
+
+def reflinkSupported(folder):
+    """
+    Tries a reflink copy of a small file in folder.
+    """
+    probe = os.path.join(folder, ".reflink-probe")
+    try:
+        with open(probe, "w") as f:
+            f.write("probe")
+        result = runCommand(["cp", "--reflink=always", probe, probe + "-copy"], timeout=30)
+        return result.ok
+    finally:
+        for filepath in [probe, probe + "-copy"]:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+
+def chooseMethod(chrootPath, folder):
+    if filesystemType(chrootPath) == "btrfs" and os.stat(chrootPath).st_ino == 256:  #256 is the root of a btrfs subvolume
+        return "btrfs"
+    if reflinkSupported(folder):
+        return "reflink"
+    return "hardlink"
+
+
+def copyCommand(method, source, destination):
+    if method == "btrfs":
+        return ["btrfs", "subvolume", "snapshot", source, destination]
+    if method == "reflink":
+        return ["cp", "-a", "-x", "--reflink=always", source, destination]
+    #Safe for the files left linked, as dpkg and apt replace files by writing a new copy and renaming it, rather than
+    #changing the file the snapshot shares. See copyFolders for the rest
+    return ["cp", "-a", "-x", "-l", source, destination]
+
+
+def copyFolders(source, destination, folders=COPIED_FOLDERS, logPath=None):
+    """
+    Replaces the hard linked folders in destination with real copies of them from source. Returns the failed
+    runCommand result, or None.
+    """
+    import shutil
+    import stat
+    for folder in folders:
+        target = os.path.join(destination, folder)
+        try:
+            if not stat.S_ISDIR(os.lstat(target).st_mode):
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(target)
+        result = runCommand(["cp", "-a", "-x", os.path.join(source, folder), target], timeout=SNAPSHOT_TIMEOUT, logPath=logPath, name="snapshot copy " + folder)
+        if not result.ok:
+            return result
+    return None
+
+
+#---------------- Taking, listing and removing snapshots -------------------
+
+def takeSnapshot(chrootPath, reason="", targetName=None, method=None, now=None, logPath=None):
+    """
+    Snapshots the chroot at chrootPath and returns the snapshot. Raises RuntimeError if it can't be made.
+    """
+    if now is None:
+        now = time.time()
+    folder = snapshotFolder(chrootPath, targetName)
+    if not os.path.isdir(folder):
+        os.makedirs(folder, 0o700)
+    if method is None:
+        method = chooseMethod(chrootPath, folder)
+    name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    while os.path.exists(os.path.join(folder, name)):
+        name = name + "x"
+    partial = os.path.join(folder, name + ".partial")
+    started = time.time()
+    result = runCommand(copyCommand(method, chrootPath, partial), timeout=SNAPSHOT_TIMEOUT, logPath=logPath, name="snapshot " + name)
+    if result.ok and method == "hardlink":
+        result = copyFolders(chrootPath, partial, logPath=logPath) or result
+    if not result.ok:
+        deleteFolder(partial, method)
+        raise RuntimeError("Couldn't snapshot " + chrootPath + " (" + method + "): " + result.outputText()[-200:])
+    os.rename(partial, os.path.join(folder, name))
+    taken = snapshot(name, targetName or os.path.basename(chrootPath.rstrip("/")), now, method, time.time() - started, reason, folder)
+    taken.save()
+    return taken
+
+
+def listSnapshots(chrootPath, targetName=None):
+    """
+    The snapshots of a chroot, oldest first.
+    """
+    folder = snapshotFolder(chrootPath, targetName)
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return []
+    snapshots = []
+    for name in names:
+        if name.endswith(".json") and os.path.isdir(os.path.join(folder, name[:-5])):
+            loaded = snapshot.load(os.path.join(folder, name))
+            if loaded is not None:
+                snapshots.append(loaded)
+    return sorted(snapshots, key=lambda item: (item.created, item.name))
+
+
+def findSnapshot(chrootPath, name, targetName=None):
+    for item in listSnapshots(chrootPath, targetName):
+        if item.name == name:
+            return item
+    raise ValueError("No snapshot called " + name)
+
+
+def deleteFolder(path, method):
+    import shutil
+    if not os.path.exists(path):
+        return
+    if method == "btrfs":
+        if runCommand(["btrfs", "subvolume", "delete", path], timeout=SNAPSHOT_TIMEOUT).ok:
+            return
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def deleteSnapshot(item):
+    try:
+        os.remove(item.path + ".json")
+    except OSError:
+        pass
+    deleteFolder(item.path, item.method)
+
+
+def pruneSnapshots(chrootPath, keep=KEEP, targetName=None):
+    """
+    Deletes all but the newest keep snapshots. Returns the names of those deleted.
+    """
+    snapshots = listSnapshots(chrootPath, targetName)
+    removed = []
+    while len(snapshots) > keep:
+        item = snapshots.pop(0)
+        deleteSnapshot(item)
+        removed.append(item.name)
+    return removed
+
+
+#---------------- Rolling back -------------------
+
+def swapFolders(first, second):
+    """
+    Swaps two folders on the same filesystem. Uses renameat2 RENAME_EXCHANGE where the kernel has it, so there is no
+    moment where neither exists, otherwise two renames.
+    """
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if libc.renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE) == 0:
+            return
+    except AttributeError:
+        pass  #glibc older than 2.28
+    spare = first + ".swap"
+    os.rename(first, spare)
+    os.rename(second, first)
+    os.rename(spare, second)
+
+
+def rollback(chrootPath, name, targetName=None, now=None):
+    """
+    Puts snapshot name back in place of the chroot. The chroot as it was is kept as a new snapshot, so a rollback can
+    itself be undone. Returns that snapshot.
+    """
+    if now is None:
+        now = time.time()
+    item = findSnapshot(chrootPath, name, targetName)
+    mounted = mountsInside(chrootPath)
+    if mounted:
+        raise RuntimeError("Something is still mounted in the chroot: " + ", ".join(mounted))
+    swapFolders(chrootPath, item.path)
+    replacedName = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + "-replaced"
+    os.rename(item.path, os.path.join(item.folder, replacedName))
+    os.remove(item.path + ".json")
+    replaced = snapshot(replacedName, item.target, now, item.method, 0.0, "Replaced by rolling back to " + name, item.folder)
+    replaced.save()
+    return replaced
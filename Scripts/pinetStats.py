@@ -0,0 +1,229 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetStats.py
+#Spool for the anonymous usage stats.
+#Sending stats used to look up the external IP address and post to the stats server while the menu waited. Now a
+#record is written to a small local queue, which takes no time. A flusher started in the background sends what is
+#queued with timeouts, a few records per connection, and backs off when the server can't be reached. Records that
+#are too old to be useful are dropped.
+
+import os
+import time
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+STATS_URL = "https://secure.pinet.org.uk/pinetstatsv1.php"
+IP_URL = "http://myip.dnsdynamic.org/"
+SPOOL_FOLDER = "/var/spool/pinet-stats"
+IP_CACHE_FILEPATH = "/var/cache/pinet/ip.json"
+IP_TTL = 24 * 60 * 60
+MAX_AGE = 14 * 24 * 60 * 60  #Records older than this are dropped unsent
+MAX_RECORDS = 50  #The oldest records are dropped if a server is offline for a long time
+BATCH_SIZE = 10
+TIMEOUT = 20
+BACKOFF_START = 60
+BACKOFF_MAX = 6 * 60 * 60
+
+
+#---------------- Spool -------------------
+
+def enqueue(fields, spoolFolder=SPOOL_FOLDER, now=None):
+    """
+    Queues a stats record. fields is a dict of the values posted to the stats server. IPAddress is filled in when
+    the record is sent. Never touches the network.
+    """
+    import random
+    if now is None:
+        now = time.time()
+    filepath = os.path.join(spoolFolder, "%017.6f-%06d.json" % (now, random.randint(0, 999999)))
+    writeJSONAtomic({"created": now, "fields": fields}, filepath, compact=True)
+    return filepath
+
+
+def queuedRecords(spoolFolder=SPOOL_FOLDER):
+    """
+    The paths of the queued records, oldest first.
+    """
+    try:
+        names = os.listdir(spoolFolder)
+    except OSError:
+        return []
+    return [os.path.join(spoolFolder, name) for name in sorted(names) if name.endswith(".json") and name[0].isdigit()]
+
+
+def pruneRecords(spoolFolder=SPOOL_FOLDER, maxAge=MAX_AGE, maxRecords=MAX_RECORDS, now=None):
+    """
+    Drops records past maxAge, unreadable records and the oldest records beyond maxRecords.
+    Returns the records left, oldest first, as (path, record) pairs.
+    """
+    if now is None:
+        now = time.time()
+    kept = []
+    for filepath in queuedRecords(spoolFolder):
+        record = readJSON(filepath)
+        if not isinstance(record, dict) or now - record.get("created", 0) > maxAge:
+            removeRecord(filepath)
+        else:
+            kept.append((filepath, record))
+    while len(kept) > maxRecords:
+        removeRecord(kept.pop(0)[0])
+    return kept
+
+
+def removeRecord(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
+
+#---------------- External IP -------------------
+
+def cachedIPAddress(url=IP_URL, cachePath=IP_CACHE_FILEPATH, ttl=IP_TTL, timeout=TIMEOUT, now=None):
+    """
+    The server's external IP address, looked up at most once every ttl seconds. Falls back to the last known
+    address, then 0.0.0.0, if the lookup fails.
+    """
+    import socket
+    import urllib.request
+    if now is None:
+        now = time.time()
+    cached = readJSON(cachePath)
+    if isinstance(cached, dict) and now - cached.get("checked", 0) < ttl:
+        return cached.get("ip", "0.0.0.0")
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            ip = response.read().decode().strip()
+        socket.inet_aton(ip)
+    except Exception:
+        if isinstance(cached, dict):
+            return cached.get("ip", "0.0.0.0")
+        return "0.0.0.0"
+    writeJSONAtomic({"ip": ip, "checked": now}, cachePath, compact=True)
+    return ip
+
+
+#---------------- Flushing -------------------
+
+def backoffDelay(failures, start=BACKOFF_START, maximum=BACKOFF_MAX):
+    if failures <= 0:
+        return 0
+    return min(maximum, start * 2 ** (failures - 1))
+
+
+def postRecords(url, bodies, timeout=TIMEOUT):
+    """
+    Posts each body (form encoded bytes) to url over one connection, stopping at the first failure.
+    Returns the number posted.
+    """
+    import http.client
+    import urllib.parse
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "https":
+        connection = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+    path = parts.path or "/"
+    if parts.query:
+        path = path + "?" + parts.query
+    sent = 0
+    try:
+        for body in bodies:
+            connection.request("POST", path, body, {"Content-Type": "application/x-www-form-urlencoded", "User-agent": "Mozilla 5.10"})
+            response = connection.getresponse()
+            response.read()
+            if response.status < 200 or response.status >= 300:
+                break
+            sent = sent + 1
+    except (OSError, http.client.HTTPException):
+        pass
+    finally:
+        connection.close()
+    return sent
+
+
+def encodeRecord(record, ipAddress):
+    import urllib.parse
+    fields = dict(record["fields"])
+    fields["IPAddress"] = ipAddress
+    return urllib.parse.urlencode(sorted(fields.items())).encode()
+
+
+class flushLock():
+    """
+    Only one flusher runs at a time.
+    """
+
+    def __init__(self, spoolFolder=SPOOL_FOLDER):
+        super(flushLock, self).__init__()
+        self.path = os.path.join(spoolFolder, "flush.lock")
+        self.file = None
+
+    def acquire(self):
+        import fcntl
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.file = open(self.path, "w")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (OSError, IOError):
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def flush(url=STATS_URL, spoolFolder=SPOOL_FOLDER, statePath=None, timeout=TIMEOUT, batchSize=BATCH_SIZE, ipLookup=None, now=None, force=False):
+    """
+    Sends up to batchSize queued records, oldest first. After a failure nothing is tried again until the backoff
+    delay has passed (unless force is set). Returns the number of records sent.
+    """
+    if statePath is None:
+        statePath = os.path.join(spoolFolder, "state.json")
+    if now is None:
+        now = time.time()
+    lock = flushLock(spoolFolder)
+    if not lock.acquire():
+        return 0
+    try:
+        state = readJSON(statePath)
+        if not isinstance(state, dict):
+            state = {"failures": 0, "nextAttempt": 0}
+        if not force and now < state.get("nextAttempt", 0):
+            return 0
+        records = pruneRecords(spoolFolder, now=now)[:batchSize]
+        if not records:
+            return 0
+        if ipLookup is None:
+            ipLookup = lambda: cachedIPAddress(timeout=timeout)
+        ipAddress = ipLookup()
+        sent = postRecords(url, [encodeRecord(record, ipAddress) for filepath, record in records], timeout)
+        for filepath, record in records[:sent]:
+            removeRecord(filepath)
+        if sent < len(records):
+            failures = state.get("failures", 0) + 1
+            state = {"failures": failures, "nextAttempt": now + backoffDelay(failures)}
+        else:
+            state = {"failures": 0, "nextAttempt": 0}
+        writeJSONAtomic(state, statePath, compact=True)
+        return sent
+    finally:
+        lock.release()
+
+
+def startBackgroundFlush(command):
+    """
+    Starts command (which should call flush) detached, so the menu never waits for the stats server.
+    """
+    import subprocess
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True, close_fds=True)
@@ -0,0 +1,347 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetTasks.py
+#Task graph scheduler for install flows, used by pinet-functions-python.py.
+#The full install used to run every step one after another, although many of them don't depend on each other. A flow
+#is now a list of tasks, each naming the tasks it needs finished first and the shared resources it uses (dpkg on the
+#server, dpkg and ltsp-chroot in the Raspbian chroot, the network, the terminal). Tasks that are ready and whose
+#resources are free run side by side, up to a worker limit, longest remaining path first. Each task is a bash function
+#run with "pinet Run-Step function". Progress is shown as tasks start and finish. At the end the critical path (the
+#chain of tasks that decided how long the flow took) is reported, with any time tasks spent waiting for a resource,
+#as that is where further speedups would have to come from. Timings are kept for the next run's ordering.
+
+import os
+import time
+import threading
+
+from pinetFiles import writeJSONAtomic, readJSON
+
+PINET_FILEPATH = "/usr/local/bin/pinet"
+PYTHON_FUNCTIONS = ["python3", "/usr/local/bin/pinet-functions-python.py"]
+HISTORY_FOLDER = "/var/lib/pinet/tasks"
+LOG_FOLDER = "/var/log/pinet-tasks"
+WORKERS = 4
+PROGRESS_INTERVAL = 30  #Seconds between progress lines while nothing starts or finishes
+DEFAULT_ESTIMATE = 60.0  #Seconds, for tasks that have never run
+#How many tasks can hold each resource at once. chroot-dpkg covers anything run with ltsp-chroot, as it mounts and
+#unmounts /proc and friends in the chroot. config covers /etc/pinet, which UpdateConfig rewrites with sed.
+LOCK_LIMITS = {"server-dpkg": 1, "chroot-dpkg": 1, "network": 2, "terminal": 1, "config": 1}
+FINISHED = ("done", "skipped")
+
+
+class task():
+    """
+    One step of a flow. command is the bash function (and its arguments) run by "pinet Run-Step", needs the names of
+    tasks that must finish first and locks the resources it uses (see LOCK_LIMITS). interactive tasks use whiptail, so
+    they get the terminal to themselves. If a required task fails, the tasks that need it are not run. Other tasks
+    report their return code but don't hold anything up, as bash functions rarely return a meaningful one.
+    """
+
+    def __init__(self, name, command=None, needs=(), locks=(), interactive=False, required=False):
+        super(task, self).__init__()
+        self.name = name
+        self.command = list(command) if command is not None else [name]
+        self.needs = list(needs)
+        self.locks = list(locks)
+        if interactive and "terminal" not in self.locks:
+            self.locks.append("terminal")
+        self.interactive = interactive
+        self.required = required
+
+
+FLOWS = {
+    #Everything in FullInstall between the questions at the start and building the NBD image at the end
+    "fullInstall": [
+        task("FetchRaspbianKey", locks=["network"]),
+        task("FetchPythonGames", locks=["network"]),
+        task("FetchTheme", locks=["network"]),
+        task("FetchBootFiles", locks=["network"]),
+        task("installLTSP", locks=["server-dpkg", "network"], required=True),
+        task("buildClient", needs=["installLTSP", "FetchRaspbianKey"], locks=["chroot-dpkg", "network"], required=True),
+        task("OneTimeFixes", needs=["installLTSP"]),
+        task("EnableNBDswap", needs=["installLTSP"]),
+        task("configFixes", needs=["buildClient"]),
+        task("FixRepo", needs=["buildClient"], locks=["chroot-dpkg"]),
+        task("RaspiTheme", needs=["buildClient", "FetchTheme"], locks=["chroot-dpkg"]),
+        task("DisableSPI", needs=["buildClient"], locks=["config"]),
+        task("SudoMenu", needs=["AddSoftware"], locks=["config"], interactive=True),
+        task("AddSoftware", needs=["FixRepo"], locks=["chroot-dpkg", "server-dpkg", "network"]),
+        task("FixDesktopIcons", needs=["AddSoftware", "FetchPythonGames", "OneTimeFixes"]),
+        task("InstallRaspberryPiUIMods", needs=["AddSoftware"], locks=["chroot-dpkg", "network"]),
+        task("installSoftwareFromFile", PYTHON_FUNCTIONS + ["installSoftwareFromFile", "fresh"], needs=["AddSoftware"], locks=["chroot-dpkg", "network"]),
+        task("addSoundcardDefault", needs=["configFixes"]),
+        task("SetupSharedStandalone", needs=["OneTimeFixes", "configFixes"]),
+        task("installKernelUpdater", ["installKernelUpdater", ""], needs=["buildClient"], locks=["chroot-dpkg"]),
+        task("checkKernelFileUpdateWeb", PYTHON_FUNCTIONS + ["checkKernelFileUpdateWeb"], locks=["network"]),
+        task("UpdateSD", needs=["FetchBootFiles", "configFixes", "RaspiTheme", "DisableSPI", "SudoMenu", "FixDesktopIcons",
+                                "InstallRaspberryPiUIMods", "installSoftwareFromFile", "addSoundcardDefault", "SetupSharedStandalone",
+                                "installKernelUpdater"], locks=["chroot-dpkg", "config"], interactive=True),
+    ],
+}
+
+
+def checkGraph(tasks):
+    """
+    Returns the tasks in an order where each comes after the ones it needs. Raises ValueError if a task needs one
+    that isn't in the flow, a name is used twice, or the needs go round in a circle.
+    """
+    byName = {}
+    for item in tasks:
+        if item.name in byName:
+            raise ValueError("Task " + item.name + " is in the flow twice")
+        byName[item.name] = item
+    for item in tasks:
+        for need in item.needs:
+            if need not in byName:
+                raise ValueError("Task " + item.name + " needs " + need + ", which isn't in the flow")
+    order = []
+    state = {}
+
+    def visit(item, path):
+        if state.get(item.name) == "done":
+            return
+        if state.get(item.name) == "visiting":
+            raise ValueError("Tasks need each other in a circle: " + " -> ".join(path + [item.name]))
+        state[item.name] = "visiting"
+        for need in item.needs:
+            visit(byName[need], path + [item.name])
+        state[item.name] = "done"
+        order.append(item)
+
+    for item in tasks:
+        visit(item, [])
+    return order
+
+
+def priorities(tasks, estimates=None):
+    """
+    The longest chain of estimated durations from the start of each task to the end of the flow. Ready tasks with the
+    longest chain go first, so the critical path isn't held up behind short tasks.
+    """
+    if estimates is None:
+        estimates = {}
+    dependents = dict((item.name, []) for item in tasks)
+    for item in tasks:
+        for need in item.needs:
+            dependents[need].append(item.name)
+    ranks = {}
+    for item in reversed(checkGraph(tasks)):
+        after = [ranks[name] for name in dependents[item.name]]
+        ranks[item.name] = estimates.get(item.name, DEFAULT_ESTIMATE) + max(after or [0.0])
+    return ranks
+
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+def runGraph(tasks, run, workers=WORKERS, limits=None, estimates=None, journalPath=None, progress=print,
+             interval=PROGRESS_INTERVAL, clock=time.time):
+    """
+    Runs a flow. run(task) is called on a worker thread for each task and returns its return code.
+    Returns a dict of started, finished and tasks, where each task has status (done, skipped, failed or blocked),
+    ready, start, finish, returncode, ran (False if the journal skipped it) and waitedFor (resources it was ready
+    but waiting for). With journalPath, each task goes through the install journal (see pinetJournal.py).
+    """
+    import queue
+    if limits is None:
+        limits = LOCK_LIMITS
+    byName = dict((item.name, item) for item in checkGraph(tasks))
+    ranks = priorities(tasks, estimates)
+    runs = dict((item.name, {"status": "waiting", "ready": None, "start": None, "finish": None, "returncode": None,
+                             "ran": False, "waitedFor": []}) for item in tasks)
+    held = dict((lock, 0) for lock in limits)
+    running = {}
+    completed = queue.Queue()
+    started = clock()
+
+    def elapsed():
+        return formatDuration(clock() - started)
+
+    def say(line):
+        if not any(byName[name].interactive for name in running):  #Leave whiptail alone on the terminal
+            progress("[" + elapsed() + "] " + line)
+
+    def worker(item):
+        try:
+            returncode = run(item)
+        except Exception as error:
+            progress(item.name + ": " + str(error))
+            returncode = 1
+        completed.put((item.name, returncode))
+
+    def noteWait(state, reason):
+        if reason not in state["waitedFor"]:
+            state["waitedFor"].append(reason)
+
+    def startReady():
+        changed = False
+        waiting = [item for item in tasks if runs[item.name]["status"] == "waiting"]
+        for item in sorted(waiting, key=lambda item: -ranks[item.name]):
+            state = runs[item.name]
+            needs = [runs[need]["status"] for need in item.needs]
+            if any(status in ("failed", "blocked") for status in needs):
+                state["status"] = "blocked"
+                state["finish"] = clock()
+                say(item.name + " not run, as a task it needs failed")
+                changed = True
+                continue
+            if not all(status in FINISHED for status in needs):
+                continue
+            if state["ready"] is None:
+                state["ready"] = max([runs[need]["finish"] for need in item.needs] or [started])
+            if len(running) >= workers:
+                noteWait(state, "workers")
+                continue
+            busy = [lock for lock in item.locks if held.get(lock, 0) >= limits.get(lock, 1)]
+            if busy:
+                for lock in busy:
+                    noteWait(state, lock)
+                continue
+            if journalPath is not None:
+                import pinetJournal
+                force = any(runs[need]["ran"] for need in item.needs)
+                if pinetJournal.begin(item.name, item.command, journalPath, force=force, linear=False) == "skip":
+                    state["status"] = "skipped"
+                    state["start"] = state["finish"] = clock()
+                    say(item.name + " already done")
+                    changed = True
+                    continue
+            for lock in item.locks:
+                held[lock] = held.get(lock, 0) + 1
+            state["status"] = "running"
+            state["start"] = clock()
+            state["ran"] = True
+            say("started " + item.name)
+            running[item.name] = threading.Thread(target=worker, args=(item,))
+            running[item.name].daemon = True
+            running[item.name].start()
+            changed = True
+        return changed
+
+    while True:
+        while startReady():
+            pass
+        if not running:
+            break
+        try:
+            name, returncode = completed.get(timeout=interval)
+        except queue.Empty:
+            say("running " + ", ".join(name + " (" + formatDuration(clock() - runs[name]["start"]) + ")" for name in sorted(running)))
+            continue
+        running.pop(name).join()
+        item = byName[name]
+        state = runs[name]
+        state["finish"] = clock()
+        state["returncode"] = returncode
+        for lock in item.locks:
+            held[lock] = held[lock] - 1
+        if returncode and item.required:
+            state["status"] = "failed"
+            say(name + " failed (returned " + str(returncode) + ") after " + formatDuration(state["finish"] - state["start"]))
+        else:
+            state["status"] = "done"
+            say("finished " + name + " in " + formatDuration(state["finish"] - state["start"]))
+        if journalPath is not None:
+            import pinetJournal
+            pinetJournal.end(name, returncode, journalPath)
+    for name, state in runs.items():
+        if state["status"] == "waiting":  #Only left if a task it needs never finished
+            state["status"] = "blocked"
+    return {"started": started, "finished": clock(), "tasks": runs}
+
+
+def criticalPath(tasks, result):
+    """
+    The chain of tasks that decided how long the flow took, from the start. It ends at the task that finished last,
+    and goes back through whichever task it needed finished last. Each step is (name, duration, wait), where wait is
+    how long the task was ready but held up by a resource or the worker limit.
+    """
+    runs = result["tasks"]
+    byName = dict((item.name, item) for item in tasks)
+    finished = [name for name in runs if runs[name]["finish"] is not None and runs[name]["start"] is not None]
+    if not finished:
+        return []
+    name = max(finished, key=lambda name: runs[name]["finish"])
+    path = []
+    while name is not None:
+        state = runs[name]
+        path.append((name, state["finish"] - state["start"], max(0.0, state["start"] - (state["ready"] or state["start"]))))
+        needs = [need for need in byName[name].needs if runs[need]["finish"] is not None]
+        name = max(needs, key=lambda need: runs[need]["finish"]) if needs else None
+    path.reverse()
+    return path
+
+
+def formatReport(tasks, result):
+    runs = result["tasks"]
+    wall = result["finished"] - result["started"]
+    ran = [state for state in runs.values() if state["ran"] and state["finish"] is not None]
+    serial = sum(state["finish"] - state["start"] for state in ran)
+    lines = ["%d tasks took %s, %s if run one after another" % (len(ran), formatDuration(wall), formatDuration(serial))]
+    for state, label in (("failed", "Failed"), ("blocked", "Not run")):
+        names = sorted(name for name in runs if runs[name]["status"] == state)
+        if names:
+            lines.append(label + ": " + ", ".join(names))
+    returned = sorted(name for name in runs if runs[name]["status"] == "done" and runs[name]["returncode"])
+    if returned:
+        lines.append("Returned an error, carried on: " + ", ".join(returned))
+    lines.append("Critical path:")
+    for name, duration, wait in criticalPath(tasks, result):
+        line = "  %-28s %8s" % (name, formatDuration(duration))
+        if wait >= 1:
+            line = line + ", waited " + formatDuration(wait) + " for " + ", ".join(runs[name]["waitedFor"])
+        lines.append(line)
+    return lines
+
+
+def historyPath(flow, historyFolder=HISTORY_FOLDER):
+    return os.path.join(historyFolder, flow + ".json")
+
+
+def loadEstimates(flow, historyFolder=HISTORY_FOLDER):
+    """
+    How long each task took the last time it ran, to order the next run by.
+    """
+    history = readJSON(historyPath(flow, historyFolder)) or {}
+    estimates = {}
+    for name, state in history.get("tasks", {}).items():
+        if state.get("ran") and state.get("finish") is not None:
+            estimates[name] = state["finish"] - state["start"]
+    return estimates
+
+
+def saveResult(flow, result, historyFolder=HISTORY_FOLDER):
+    previous = readJSON(historyPath(flow, historyFolder)) or {}
+    for name, state in previous.get("tasks", {}).items():
+        if state.get("ran") and not result["tasks"].get(name, {}).get("ran"):
+            result["tasks"][name] = state  #Keep the timing of tasks the journal skipped this time
+    writeJSONAtomic(result, historyPath(flow, historyFolder))
+
+
+def runStep(item, script=PINET_FILEPATH, logFolder=LOG_FOLDER):
+    """
+    Runs a task as "pinet Run-Step command", logging its output to its own file. Each task gets its own file to pass
+    values back to bash through (see gp), as several run at once. Interactive tasks are given the terminal as it is,
+    as the whiptail calls inside bash functions draw on stdout or stderr.
+    """
+    if not os.path.isdir(logFolder):
+        os.makedirs(logFolder)
+    env = dict(os.environ)
+    env["PINET_DATA_FILE"] = os.path.join(logFolder, item.name + ".data")
+    command = ["/bin/bash", script, "Run-Step"] + item.command  #pinet isn't executable, it is always run with bash
+    if item.interactive:
+        from subprocess import call
+        return call(command, env=env)
+    from pinetRunner import runCommand
+    result = runCommand(command, inputText="", env=env, logPath=os.path.join(logFolder, item.name + ".log"), name=item.name)
+    return result.returncode
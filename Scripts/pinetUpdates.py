@@ -0,0 +1,273 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetUpdates.py
+#Cached update checks used by pinet-functions-python.py.
+#Checking for a new PiNet release, new boot files and a new kernel updater used to be three separate downloads
+#done one after another every time the menu opened. They are now all done at once, within one shared deadline, and
+#the result is kept in a cache file. The menu always uses the cache, and a check only runs (in the background) when
+#the cache is out of date. The first check on a new server is the only one the menu waits for.
+
+import os
+import json
+import time
+
+CACHE_FOLDER = "/var/cache/pinet"
+CACHE_FILEPATH = os.path.join(CACHE_FOLDER, "updates.json")
+KERNEL_UPDATER_FILEPATH = os.path.join(CACHE_FOLDER, "kernelCheckUpdate.sh")
+CACHE_TTL = 6 * 60 * 60
+RETRY_AFTER = 15 * 60  #How long to wait before trying again after a check that failed (offline or GitHub filtered)
+DEADLINE = 20  #Seconds all the checks together are allowed
+RELEASE_HISTORY = 11  #Number of commits kept for the release history
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+
+def fetch(url, timeout):
+    """
+    Downloads url with the same browser header downloadFile uses. Raises an exception if it can't.
+    """
+    import urllib.request
+    request = urllib.request.Request(url)
+    request.add_header('User-agent', 'Mozilla 5.10')
+    with urllib.request.urlopen(request, timeout=max(1, timeout)) as response:
+        return response.read()
+
+
+#---------------- Parsers -------------------
+
+def releaseVersion(lines):
+    for line in lines:
+        if line.startswith("Release"):
+            return line[8:].rstrip()
+    return None
+
+
+def parseReleaseFeed(data):
+    """
+    Reads the GitHub commits atom feed. Returns the newest release version and the message lines of the latest
+    commits, used for the release history.
+    """
+    import xml.etree.ElementTree
+    feed = xml.etree.ElementTree.fromstring(data)
+    commits = []
+    for entry in feed.findall(ATOM + "entry")[:RELEASE_HISTORY]:
+        content = entry.find(ATOM + "content")
+        if content is None or not content.text:
+            continue
+        try:
+            text = "".join(xml.etree.ElementTree.fromstring(content.text).itertext())
+        except xml.etree.ElementTree.ParseError:
+            text = content.text
+        commits.append(text.split("\n"))
+    version = None
+    for lines in commits:
+        version = releaseVersion(lines)
+        if version:
+            break
+    if version is None:
+        raise ValueError("No release found in the commit feed")
+    return {"version": version, "commits": commits}
+
+
+def parseBootFilesVersion(data):
+    return {"version": int(data.decode().splitlines()[0].strip())}
+
+
+def parseKernelUpdater(data, filepath=None):
+    """
+    Keeps the downloaded kernel updater so it can be installed later without downloading it again.
+    """
+    if filepath is None:
+        filepath = KERNEL_UPDATER_FILEPATH
+    version = None
+    for line in data.decode().splitlines():
+        if line.startswith("version="):
+            version = int(line[8:].strip())
+            break
+    if version is None:
+        raise ValueError("No version in the kernel updater")
+    writeAtomic(data, filepath)
+    return {"version": version}
+
+
+def sourceJob(url, parser):
+    return lambda timeout: parser(fetch(url, timeout))
+
+
+def sourceJobs(sources):
+    """
+    sources holds the pinet (commit feed), bootFiles and kernelUpdater URLs for the release channel in use.
+    """
+    parsers = {"pinet": parseReleaseFeed, "bootFiles": parseBootFilesVersion, "kernelUpdater": parseKernelUpdater}
+    jobs = {}
+    for name in sources:
+        jobs[name] = sourceJob(sources[name], parsers[name])
+    return jobs
+
+
+#---------------- Cache -------------------
+
+def writeAtomic(data, filepath):
+    folder = os.path.dirname(filepath)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    temporary = filepath + ".new"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, filepath)
+
+
+def loadCache(cachePath=CACHE_FILEPATH):
+    try:
+        with open(cachePath) as f:
+            cache = json.load(f)
+    except (OSError, IOError, ValueError):
+        cache = None
+    if not isinstance(cache, dict):
+        cache = {}
+    cache.setdefault("branch", None)
+    cache.setdefault("checked", 0)
+    cache.setdefault("attempted", 0)
+    cache.setdefault("results", {})
+    cache.setdefault("errors", {})
+    return cache
+
+
+def saveCache(cache, cachePath=CACHE_FILEPATH):
+    writeAtomic(json.dumps(cache, indent=1, sort_keys=True).encode(), cachePath)
+
+
+def cachedValue(cache, name):
+    result = cache["results"].get(name)
+    if result is None:
+        return None
+    return result.get("value")
+
+
+def refreshMode(cache, branch, now=None, ttl=CACHE_TTL, retryAfter=RETRY_AFTER):
+    """
+    "wait" if there is nothing usable in the cache for this release channel yet, "background" if the cache is out
+    of date, or None if it is fine. Nothing is retried within retryAfter of the last attempt.
+    """
+    if now is None:
+        now = time.time()
+    if now - cache["attempted"] < retryAfter and cache["branch"] == branch:
+        return None
+    if cache["branch"] != branch or not cache["results"]:
+        return "wait"
+    if now - cache["checked"] >= ttl:
+        return "background"
+    return None
+
+
+#---------------- Checking -------------------
+
+def runChecks(jobs, deadline=DEADLINE):
+    """
+    Runs every job at once. Each job is called with the number of seconds left and must not take longer.
+    Returns (results, errors). Jobs still running at the deadline are reported as timed out and not waited for.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    executor = ThreadPoolExecutor(max_workers=max(1, len(jobs)))
+    futures = {}
+    for name in jobs:
+        futures[name] = executor.submit(jobs[name], deadline)
+    wait(list(futures.values()), timeout=deadline)
+    executor.shutdown(wait=False)
+    results = {}
+    errors = {}
+    for name in futures:
+        future = futures[name]
+        if not future.done():
+            errors[name] = "timed out after %ds" % deadline
+        elif future.exception() is not None:
+            errors[name] = str(future.exception()) or type(future.exception()).__name__
+        else:
+            results[name] = future.result()
+    return results, errors
+
+
+def refresh(branch, jobs, cachePath=CACHE_FILEPATH, deadline=DEADLINE):
+    """
+    Runs all the checks and saves what they found. A check that fails keeps its previous value, so a slow or
+    filtered connection never throws away what is already known.
+    If another refresh is already running, returns the cache as it is.
+    """
+    lock = refreshLock(cachePath)
+    if not lock.acquire():
+        return loadCache(cachePath)
+    try:
+        return refreshLocked(branch, jobs, cachePath, deadline)
+    finally:
+        lock.release()
+
+
+def refreshLocked(branch, jobs, cachePath, deadline):
+    cache = loadCache(cachePath)
+    if cache["branch"] != branch:
+        cache["results"] = {}
+    now = time.time()
+    results, errors = runChecks(jobs, deadline)
+    for name in results:
+        if results[name] is not None:
+            cache["results"][name] = {"value": results[name], "checked": now}
+    cache["branch"] = branch
+    cache["attempted"] = now
+    cache["errors"] = errors
+    if not errors:
+        cache["checked"] = now
+    saveCache(cache, cachePath)
+    return cache
+
+
+class refreshLock():
+    """
+    Held by a refresh running in the background, so opening the menu again doesn't start another one.
+    """
+
+    def __init__(self, cachePath=CACHE_FILEPATH):
+        super(refreshLock, self).__init__()
+        self.path = cachePath + ".lock"
+        self.file = None
+
+    def acquire(self):
+        import fcntl
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.file = open(self.path, "w")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (OSError, IOError):
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def refreshRunning(cachePath=CACHE_FILEPATH):
+    lock = refreshLock(cachePath)
+    if lock.acquire():
+        lock.release()
+        return False
+    return True
+
+
+def startBackgroundRefresh(command, cachePath=CACHE_FILEPATH):
+    """
+    Starts command (which should call refresh) detached from the menu, unless a refresh is already running.
+    """
+    import subprocess
+    if refreshRunning(cachePath):
+        return False
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True, close_fds=True)
+    return True
@@ -0,0 +1,310 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetUpgrade.py
+#Upgrade pipeline used by UpdateAll.
+#The server and the Raspbian chroot have separate dpkg databases, so their package lists are refreshed, their
+#upgrades downloaded and then applied side by side rather than one after the other. Each phase is timed, the
+#AddSoftware step is only needed if one of its packages is missing or out of date and the NBD image only
+#needs rebuilding if the chroot's dpkg database actually changed.
+
+import os
+import json
+import time
+
+from pinetRunner import runBatch, runCommand, retryPolicy, writeLog
+
+CHROOT = "/opt/ltsp/armhf"
+STATE_FILEPATH = "/tmp/pinetUpgrade.json"
+LOCK_FOLDER = "/var/lock"
+APT_UPDATE_TIMEOUT = 10 * 60
+APT_TIMEOUT = 60 * 60
+CHECK_TIMEOUT = 5 * 60
+APT_OPTIONS = ["-o", "DPkg::Lock::Timeout=300", "-o", "Dpkg::Options::=--force-confdef", "-o", "Dpkg::Options::=--force-confold"]
+
+
+class upgradeTarget():
+    """
+    Somewhere packages are upgraded, either the server itself or the chroot the Raspberry Pis boot from.
+    """
+
+    name = ""
+    root = "/"
+    prefix = []
+
+    def __init__(self, name, root="/", prefix=None):
+        super(upgradeTarget, self).__init__()
+        self.name = name
+        self.root = root
+        self.prefix = list(prefix or [])
+
+    def command(self, *args):
+        return self.prefix + list(args)
+
+    def apt(self, *args):
+        return self.command("apt-get", *args)
+
+    def dpkgStatus(self):
+        return os.path.join(self.root, "var/lib/dpkg/status")
+
+
+def serverTarget():
+    return upgradeTarget("server")
+
+
+def chrootTarget(chroot=CHROOT):
+    return upgradeTarget("chroot", chroot, ["ltsp-chroot", "--arch", "armhf"])
+
+
+class upgradeReport():
+    """
+    Timings for each phase of an upgrade run. Kept in STATE_FILEPATH between the calls bash makes, along with the
+    fingerprint of the chroot's dpkg database from before anything was changed.
+    """
+
+    def __init__(self, phases=None, chrootBefore="", started=None):
+        super(upgradeReport, self).__init__()
+        self.phases = phases or []
+        self.chrootBefore = chrootBefore
+        self.started = started or time.time()
+
+    @property
+    def ok(self):
+        return all(phase["ok"] for phase in self.phases)
+
+    def addPhase(self, name, duration, ok=True, details=None):
+        self.phases.append({"name": name, "duration": duration, "ok": ok, "details": details or []})
+
+    def addBatch(self, name, batch):
+        self.addPhase(name, batch.duration, batch.ok, [result.summary() for result in batch.results])
+        return batch.ok
+
+    def summary(self):
+        lines = ["%-28s %9s" % ("Phase", "Time")]
+        total = 0.0
+        for phase in self.phases:
+            status = ""
+            if not phase["ok"]:
+                status = "FAILED"
+            lines.append("%-28s %8.1fs %s" % (phase["name"], phase["duration"], status))
+            for detail in phase["details"]:
+                lines.append("    " + detail)
+            total = total + phase["duration"]
+        lines.append("%-28s %8.1fs" % ("Total", total))
+        return lines
+
+    def save(self, statePath=STATE_FILEPATH):
+        with open(statePath, "w") as f:
+            json.dump({"phases": self.phases, "chrootBefore": self.chrootBefore, "started": self.started}, f)
+
+    @classmethod
+    def load(cls, statePath=STATE_FILEPATH):
+        try:
+            with open(statePath) as f:
+                data = json.load(f)
+        except (OSError, IOError, ValueError):
+            return cls()
+        return cls(data.get("phases"), data.get("chrootBefore", ""), data.get("started"))
+
+
+class targetLock():
+    """
+    Stops two upgrades of the same target running at once. The server and the chroot have separate locks, so they can
+    be upgraded side by side.
+    """
+
+    def __init__(self, target, lockFolder=LOCK_FOLDER):
+        super(targetLock, self).__init__()
+        self.path = os.path.join(lockFolder, "pinet-upgrade-" + target.name + ".lock")
+        self.file = None
+
+    def __enter__(self):
+        import fcntl
+        self.file = open(self.path, "w")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (OSError, IOError):
+            self.file.close()
+            raise RuntimeError("Another upgrade is already running (" + self.path + ")")
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+def dpkgFingerprint(target):
+    """
+    A hash of the dpkg status file. It changes whenever a package is installed, upgraded or removed.
+    """
+    import hashlib
+    try:
+        with open(target.dpkgStatus(), "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (OSError, IOError):
+        return ""
+
+
+#---------------- AddSoftware check -------------------
+
+def parseAddSoftware(definition):
+    """
+    Picks the packages out of the AddSoftware bash function (as printed by "declare -f AddSoftware").
+    Returns (chroot apt packages, server apt packages, pip packages).
+    """
+    chroot, server, pip = [], [], []
+    for line in definition.splitlines():
+        line = line.split("#")[0].strip().rstrip(";")
+        words = line.split()
+        if "InstallPipPackage" in words:
+            pip.extend(words[words.index("InstallPipPackage") + 1:])
+            continue
+        if "apt-get" not in words:
+            continue
+        position = words.index("apt-get")
+        if position + 1 >= len(words) or words[position + 1] != "install":
+            continue
+        packages = []
+        skipNext = False
+        for word in words[position + 2:]:
+            if skipNext:
+                skipNext = False
+            elif word == "-o":
+                skipNext = True
+            elif not word.startswith("-") and "=" not in word and ":" not in word:
+                packages.append(word.strip("\"'"))
+        if "ltsp-chroot" in words[:position]:
+            chroot.extend(packages)
+        else:
+            server.extend(packages)
+    return uniqueList(chroot), uniqueList(server), uniqueList(pip)
+
+
+def uniqueList(items):
+    seen = set()
+    unique = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+    return unique
+
+
+def packagesToChange(target, packages, logPath=None):
+    """
+    Asks apt (without changing anything) what installing packages would do. Returns the packages apt would install
+    or upgrade, or None if apt could not work it out (for example a package that no longer exists).
+    """
+    if not packages:
+        return []
+    result = runCommand(target.apt("-s", "install", *packages), timeout=CHECK_TIMEOUT, logPath=logPath, maxLines=100000)
+    if not result.ok:
+        return None
+    changes = []
+    for line in result.output:
+        if line.startswith("Inst "):
+            changes.append(line.split()[1])
+    return changes
+
+
+def normalisePipName(name):
+    return name.lower().replace("_", "-")
+
+
+def pipPackagesToChange(target, packages, logPath=None):
+    """
+    pip packages that are missing or have a newer version available, checked for both pip and pip3.
+    Returns None if pip could not be asked.
+    """
+    if not packages:
+        return []
+    wanted = set(normalisePipName(package) for package in packages)
+    changes = set()
+    for pip in ["pip", "pip3"]:
+        installed = runCommand(target.command(pip, "list"), timeout=CHECK_TIMEOUT, logPath=logPath, maxLines=100000)
+        outdated = runCommand(target.command(pip, "list", "--outdated"), timeout=CHECK_TIMEOUT, logPath=logPath, maxLines=100000)
+        if not (installed.ok and outdated.ok):
+            return None
+        present = set(normalisePipName(line.split()[0]) for line in installed.output if line.strip())
+        changes.update(wanted - present)
+        for line in outdated.output:
+            if line.strip() and normalisePipName(line.split()[0]) in wanted:
+                changes.add(normalisePipName(line.split()[0]))
+    return sorted(changes)
+
+
+def addSoftwareNeeded(definition, server, chroot, logPath=None):
+    """
+    Returns (needed, reasons). AddSoftware is needed if any of its packages is missing or out of date, or if that
+    can't be worked out.
+    """
+    chrootPackages, serverPackages, pipPackages = parseAddSoftware(definition)
+    reasons = []
+    for target, changes in [(chroot, packagesToChange(chroot, chrootPackages, logPath)),
+                            (server, packagesToChange(server, serverPackages, logPath)),
+                            (chroot, pipPackagesToChange(chroot, pipPackages, logPath))]:
+        if changes is None:
+            reasons.append(target.name + ": unable to check packages")
+        elif changes:
+            reasons.append(target.name + ": " + " ".join(changes[:10]) + (" ..." if len(changes) > 10 else ""))
+    return bool(reasons), reasons
+
+
+#---------------- Pipeline -------------------
+
+def runPipeline(addSoftwareDefinition="", server=None, chroot=None, statePath=STATE_FILEPATH, lockFolder=LOCK_FOLDER, echo=True, logPath=None):
+    """
+    Refreshes the package lists, downloads and then applies the upgrades for the server and the chroot side by side.
+    Returns (report, addSoftwareNeeded). The report is saved to statePath so later steps can be added to it.
+    """
+    if server is None:
+        server = serverTarget()
+    if chroot is None:
+        chroot = chrootTarget()
+    targets = [server, chroot]
+    report = upgradeReport(chrootBefore=dpkgFingerprint(chroot))
+    environment = dict(os.environ)
+    environment["DEBIAN_FRONTEND"] = "noninteractive"
+    options = {"echo": echo, "logPath": logPath, "env": environment, "workers": len(targets)}
+
+    with targetLock(server, lockFolder), targetLock(chroot, lockFolder):
+        batch = runBatch([(target.name, target.apt("update", *APT_OPTIONS)) for target in targets],
+                         timeout=APT_UPDATE_TIMEOUT, retry=retryPolicy(3), **options)
+        report.addBatch("Update package lists", batch)
+        batch = runBatch([(target.name, target.apt("upgrade", "-y", "-d", *APT_OPTIONS)) for target in targets],
+                         timeout=APT_TIMEOUT, retry=retryPolicy(3), **options)
+        report.addBatch("Download upgrades", batch)
+        batch = runBatch([(target.name, target.apt("upgrade", "-y", *APT_OPTIONS)) for target in targets],
+                         timeout=APT_TIMEOUT, **options)
+        report.addBatch("Apply upgrades", batch)
+
+    started = time.time()
+    needed = True
+    reasons = ["no AddSoftware definition given"]
+    if addSoftwareDefinition:
+        needed, reasons = addSoftwareNeeded(addSoftwareDefinition, server, chroot, logPath)
+    if not needed:
+        reasons = ["all packages installed and current, skipping AddSoftware"]
+    report.addPhase("Check AddSoftware", time.time() - started, True, reasons)
+    report.save(statePath)
+    writeLog(report.summary(), logPath)
+    return report, needed
+
+
+def recordPhase(name, duration, ok=True, statePath=STATE_FILEPATH):
+    report = upgradeReport.load(statePath)
+    report.addPhase(name, float(duration), ok)
+    report.save(statePath)
+    return report
+
+
+def chrootChanged(chroot=None, statePath=STATE_FILEPATH):
+    """
+    True if the chroot's dpkg database is different from when the pipeline started, so the image needs rebuilding.
+    """
+    if chroot is None:
+        chroot = chrootTarget()
+    report = upgradeReport.load(statePath)
+    return report.chrootBefore == "" or dpkgFingerprint(chroot) != report.chrootBefore
@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+# Part of PiNet https://github.com/pinet/pinet
+#
+# See LICENSE file for copyright and license details
+
+#PiNet
+#pinetUsage.py
+#Per-user disk usage index for /home.
+#Running du over thousands of pupil home folders takes minutes, so the home folders are walked in parallel and the
+#size, file count and modification time of every folder is kept in an index. On the next scan a folder whose
+#modification time has not changed has the same files in it, so it is not listed again. Only its subfolders are checked.
+#Questions like "who are the biggest users" are then answered from the index without touching the disk.
+#Needs Python 3.5 or newer for os.scandir.
+
+import os
+import time
+
+from pinetFiles import writeJSONAtomic, readJSON, homeFolders
+
+HOME_ROOT = "/home"
+INDEX_FILEPATH = "/var/lib/pinet/usage-index.json"
+FOLDERS_FILEPATH = "/var/lib/pinet/usage-folders.json"  #Only read by the next scan, so queries stay quick
+SUMMARY_FILEPATH = "/var/lib/pinet/usage.json"  #Small summary for the status screen and backup planning
+HANDIN_FOLDER = "handin"
+WORKERS = 8
+FULL_SCAN_AGE = 7 * 24 * 60 * 60  #Files that grow in place don't change their folder's modification time, so every folder is listed again weekly
+
+
+class userUsage():
+    """
+    Disk usage of one home folder. size and handin are in bytes actually used on disk (like du), previous is size at
+    the scan before.
+    """
+
+    user = ""
+    size = 0
+    files = 0
+    handin = 0
+    previous = None
+
+    def __init__(self, user, size=0, files=0, handin=0, previous=None):
+        super(userUsage, self).__init__()
+        self.user = user
+        self.size = size
+        self.files = files
+        self.handin = handin
+        self.previous = previous
+
+    @property
+    def growth(self):
+        if self.previous is None:
+            return 0
+        return self.size - self.previous
+
+    def toDict(self):
+        return {"size": self.size, "files": self.files, "handin": self.handin, "previous": self.previous}
+
+
+class usageIndex():
+    """
+    The result of a scan. folders holds, for every folder under the home root, its modification time, the size and
+    number of the files directly in it and the names of its subfolders.
+    """
+
+    def __init__(self, users=None, folders=None, scanned=0, previousScanned=0, duration=0.0, fullScanned=0):
+        super(usageIndex, self).__init__()
+        self.users = users or {}
+        self.folders = folders or {}
+        self.scanned = scanned
+        self.previousScanned = previousScanned
+        self.duration = duration
+        self.fullScanned = fullScanned
+
+    @property
+    def total(self):
+        return sum(usage.size for usage in self.users.values())
+
+    def topUsers(self, count=10):
+        return sorted(self.users.values(), key=lambda usage: (-usage.size, usage.user))[:count]
+
+    def handinSizes(self):
+        return sorted(((usage.user, usage.handin) for usage in self.users.values() if usage.handin), key=lambda item: (-item[1], item[0]))
+
+    def growth(self, count=10):
+        growing = [usage for usage in self.users.values() if usage.growth > 0]
+        return sorted(growing, key=lambda usage: (-usage.growth, usage.user))[:count]
+
+    def summary(self, count=10):
+        return {"scanned": self.scanned,
+                "previousScanned": self.previousScanned,
+                "duration": round(self.duration, 2),
+                "total": self.total,
+                "users": len(self.users),
+                "top": [[usage.user, usage.size] for usage in self.topUsers(count)],
+                "growth": [[usage.user, usage.growth] for usage in self.growth(count)],
+                "handin": [list(item) for item in self.handinSizes()[:count]]}
+
+    def toDict(self):
+        users = {}
+        for name in self.users:
+            users[name] = self.users[name].toDict()
+        return {"scanned": self.scanned, "previousScanned": self.previousScanned, "duration": self.duration,
+                "fullScanned": self.fullScanned, "users": users}
+
+    def save(self, indexPath=INDEX_FILEPATH, foldersPath=FOLDERS_FILEPATH, summaryPath=SUMMARY_FILEPATH):
+        writeJSONAtomic(self.folders, foldersPath, compact=True)
+        writeJSONAtomic(self.toDict(), indexPath, compact=True)
+        if summaryPath:
+            writeJSONAtomic(self.summary(), summaryPath, compact=True)
+
+    @classmethod
+    def load(cls, indexPath=INDEX_FILEPATH, foldersPath=None):
+        """
+        Loads the per-user figures. The per-folder index is only loaded if foldersPath is given.
+        """
+        data = readJSON(indexPath)
+        if not isinstance(data, dict):
+            return cls()
+        users = {}
+        for name, usage in data.get("users", {}).items():
+            users[name] = userUsage(name, usage.get("size", 0), usage.get("files", 0), usage.get("handin", 0), usage.get("previous"))
+        folders = {}
+        if foldersPath:
+            folders = readJSON(foldersPath)
+            if not isinstance(folders, dict):
+                folders = {}
+        return cls(users, folders, data.get("scanned", 0), data.get("previousScanned", 0), data.get("duration", 0.0), data.get("fullScanned", 0))
+
+
+def formatSize(size):
+    if abs(size) < 1024:
+        return "%dB" % size
+    for unit in ["K", "M", "G", "T"]:
+        size = size / 1024.0
+        if abs(size) < 1024 or unit == "T":
+            return "%.1f%s" % (size, unit)
+
+
+#---------------- Scanning -------------------
+
+def listFolder(path):
+    """
+    Returns (bytes used by the files directly in path, number of files, names of subfolders).
+    Symlinks are counted as files and never followed.
+    """
+    size = 0
+    files = 0
+    folders = []
+    for entry in os.scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.name)
+            else:
+                size = size + entry.stat(follow_symlinks=False).st_blocks * 512
+                files = files + 1
+        except OSError:
+            continue
+    return size, files, sorted(folders)
+
+
+def scanFolder(root, relative, old, new, device, full=False):
+    """
+    Adds relative (and everything below it) to new, reusing what old knows about any folder that has not changed.
+    Does not cross into other filesystems, such as the bindfs mounts of shared folders.
+    Returns (size, files) for the whole tree.
+    """
+    path = os.path.join(root, relative)
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return 0, 0
+    if stat.st_dev != device:
+        return 0, 0
+    known = old.get(relative)
+    if not full and known is not None and known["mtime"] == stat.st_mtime_ns:
+        entry = known
+    else:
+        try:
+            size, files, folders = listFolder(path)
+        except OSError:
+            return 0, 0
+        entry = {"mtime": stat.st_mtime_ns, "size": size + stat.st_blocks * 512, "files": files, "folders": folders}
+    new[relative] = entry
+    size = entry["size"]
+    files = entry["files"]
+    for name in entry["folders"]:
+        childSize, childFiles = scanFolder(root, os.path.join(relative, name), old, new, device, full)
+        size = size + childSize
+        files = files + childFiles
+    return size, files
+
+
+def scanHome(root, user, old, device, full=False):
+    """
+    Scans one home folder. Returns (user, folders, size, files, handin size).
+    """
+    new = {}
+    size, files = scanFolder(root, user, old, new, device, full)
+    handin = 0
+    handinFolder = os.path.join(user, HANDIN_FOLDER)
+    if handinFolder in new:
+        handin = sum(new[folder]["size"] for folder in new if folder == handinFolder or folder.startswith(handinFolder + os.sep))
+    return user, new, size, files, handin
+
+
+def scanHomes(root=HOME_ROOT, indexPath=INDEX_FILEPATH, foldersPath=FOLDERS_FILEPATH, summaryPath=SUMMARY_FILEPATH, workers=WORKERS, full=False):
+    """
+    Scans every folder in root (normally one per user), several at once, and saves the index.
+    full=True lists every folder again instead of trusting unchanged modification times. That also happens if the
+    last full scan is older than FULL_SCAN_AGE.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    started = time.time()
+    previous = usageIndex.load(indexPath, foldersPath)
+    if started - previous.fullScanned > FULL_SCAN_AGE:
+        full = True
+    device = os.lstat(root).st_dev
+    index = usageIndex(scanned=started, previousScanned=previous.scanned, fullScanned=previous.fullScanned)
+    if full:
+        index.fullScanned = started
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(scanHome, root, user, previous.folders, device, full) for user in homeFolders(root)]
+        for future in futures:
+            user, folders, size, files, handin = future.result()
+            before = None
+            if user in previous.users:
+                before = previous.users[user].size
+            index.users[user] = userUsage(user, size, files, handin, before)
+            index.folders.update(folders)
+    index.duration = time.time() - started
+    index.save(indexPath, foldersPath, summaryPath)
+    return index
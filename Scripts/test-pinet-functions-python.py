@@ -2,17 +2,18 @@
 import os, sys
 import shutil
 import tempfile
+import subprocess
 import unittest
 
+pinet_functions = __import__("pinet-functions-python")
+SCRIPT_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pinet-functions-python.py")
+
 #
-# Hackety-hack: as it stands the code expects this
-# to be present when the module is imported
+# Bash runs the quick commands many times in a row, so they must not
+# import anything beyond what the interpreter itself already has
 #
-PINET_CONF_FILEPATH = "/etc/pinet"
-if not os.path.exists(PINET_CONF_FILEPATH): 
-    os.makedirs(os.path.dirname(PINET_CONF_FILEPATH))
-open(PINET_CONF_FILEPATH, "w").close()
-pinet_functions = __import__("pinet-functions-python")
+STARTUP_BUDGET_MS = 10
+HEAVY_MODULES = ["logging", "subprocess", "shutil", "gettext", "random", "pwd", "grp", "copy", "threading", "pinetRunner"]
 
 def _internet_is_available():
     from urllib import request, error
@@ -187,5 +188,117 @@ class TestFileOperations(TestPiNet):
         pinet_functions.checkIfFileContains(self.filepath, "Line X")
         self.assertEqual(self.read_data(), "0")
 
+class TestUsers(TestPiNet):
+
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.passwd = os.path.join(self.folder, "passwd")
+        with open(self.passwd, "w") as f:
+            f.write("root:x:0:0:root:/root:/bin/bash\n")
+            f.write("pupil1:x:1001:1001:,,,:/home/pupil1:/bin/bash\n")
+            f.write("Pupil2:x:1002:1002:,,,:/home/Pupil2:/bin/bash\n")
+        self.home = os.path.join(self.folder, "home")
+        os.makedirs(os.path.join(self.home, "pupil1"))
+        os.makedirs(os.path.join(self.home, "pupil2"))
+
+    def test_getUsers_passwdFile(self):
+        self.assertEqual(pinet_functions.getUsers(passwdFile=self.passwd), ["pupil1", "pupil2"])
+
+    def test_importFromCSV_dryRun(self):
+        csvPath = os.path.join(self.folder, "users.csv")
+        with open(csvPath, "w") as f:
+            f.write("pupil1,secret\npupil2,\npupil3\n")
+        self.assertEqual(pinet_functions.importFromCSV(csvPath, "default", dryRun=True),
+                         [["pupil1", "secret"], ["pupil2", "default"], ["pupil3", "default"]])
+
+    def test_previousImport(self):
+        move = os.path.join(self.folder, "move")
+        etc = os.path.join(self.folder, "etc")
+        os.makedirs(move)
+        os.makedirs(etc)
+        for item in ["passwd", "group", "shadow", "gshadow"]:
+            with open(os.path.join(etc, item), "w") as f:
+                f.write("root:x:0:\n")
+            with open(os.path.join(move, item + ".mig"), "w") as f:
+                f.write("root:x:0:\npupil1:x:1001:\n")
+        pinet_functions.previousImport(move, etc)
+        with open(os.path.join(etc, "passwd")) as f:
+            self.assertEqual(f.read().split(), ["root:x:0:", "pupil1:x:1001:"])
+
+    def test_copyToUsers(self):
+        source = os.path.join(self.folder, "source")
+        os.makedirs(source)
+        with open(os.path.join(source, "game.py"), "w") as f:
+            f.write("print('hello')\n")
+        copied = pinet_functions.copyToUsers(source, "python_games", homeRoot=self.home, passwdFile=self.passwd, chown=False)
+        self.assertEqual(copied, 2)
+        for user in ["pupil1", "pupil2"]:
+            self.assertTrue(os.path.isfile(os.path.join(self.home, user, "python_games", "game.py")))
+        copied = pinet_functions.copyToUsers(source, "", delete=False, homeRoot=self.home, passwdFile=self.passwd, chown=False)
+        self.assertEqual(copied, 2)
+        copied = pinet_functions.copyToUsers(source, "", delete=False, homeRoot=self.home, passwdFile=self.passwd, chown=False)
+        self.assertEqual(copied, 2)  #Copying over the folder again is fine
+
+    def test_copyToUsers_symlink(self):
+        source = os.path.join(self.folder, "bookmarks")
+        with open(source, "w") as f:
+            f.write("file:///home/shared\n")
+        secret = os.path.join(self.folder, "shadow")
+        with open(secret, "w") as f:
+            f.write("root:secret\n")
+        os.symlink(secret, os.path.join(self.home, "pupil1", ".gtk-bookmarks"))
+        copied = pinet_functions.copyToUsers(source, ".gtk-bookmarks", delete=False, homeRoot=self.home, passwdFile=self.passwd, chown=False)
+        self.assertEqual(copied, 1)
+        with open(secret) as f:
+            self.assertEqual(f.read(), "root:secret\n")
+        copied = pinet_functions.copyToUsers(source, ".gtk-bookmarks", homeRoot=self.home, passwdFile=self.passwd, chown=False)
+        self.assertEqual(copied, 2)
+        self.assertFalse(os.path.islink(os.path.join(self.home, "pupil1", ".gtk-bookmarks")))
+        with open(secret) as f:
+            self.assertEqual(f.read(), "root:secret\n")
+
+class TestStartup(TestPiNet):
+
+    def import_times(self, *args):
+        """
+        Returns {module: cumulative microseconds} for the top level imports reported by -X importtime.
+        """
+        process = subprocess.Popen([sys.executable, "-X", "importtime"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=tempfile.gettempdir())
+        stdout, stderr = process.communicate()
+        modules = {}
+        for line in stderr.decode().splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            parts = line[len("import time:"):].split("|")
+            if not parts[0].strip().isdigit():
+                continue
+            modules[parts[2].strip()] = (int(parts[1]), not parts[2][1:].startswith(" "))
+        return modules
+
+    def check_startup(self, *args):
+        baseline = self.import_times("-c", "pass")
+        modules = self.import_times(SCRIPT_FILEPATH, *args)
+        extra = dict((name, value) for name, value in modules.items() if name not in baseline)
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, extra)
+        total = sum(cumulative for cumulative, topLevel in extra.values() if topLevel) / 1000
+        self.assertLess(total, STARTUP_BUDGET_MS, "Imports over budget: " + ", ".join(sorted(extra)))
+
+    def test_startup_CompareVersion(self):
+        self.check_startup("CompareVersion", "1.0.0", "1.0.1")
+
+    def test_startup_checkIfFileContainsString(self):
+        self.check_startup("checkIfFileContainsString", SCRIPT_FILEPATH, "registerCommand")
+
+    def test_unknown_command(self):
+        pinet_functions.main(["pinet-functions-python.py", "notACommand"])
+        self.assertEqual(self.read_data(), "")
+
+    def test_dispatch(self):
+        pinet_functions.main(["pinet-functions-python.py", "CompareVersion", "1.0.0", "1.0.1"])
+        self.assertEqual(self.read_data(), "1")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,151 @@
+#!python3
+import os
+import asyncio
+import socketserver
+import struct
+import threading
+import unittest
+
+import pinetFiles
+import pinetBootStorm
+import testHelpers
+
+IMAGE = bytes(range(256)) * 4096  #1MB
+
+class nbdHandler(socketserver.BaseRequestHandler):
+    """
+    Just enough of an NBD server (fixed newstyle, export name option, reads) to test against.
+    """
+
+    def receive(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data = data + chunk
+        return data
+
+    def handle(self):
+        try:
+            self.request.sendall(b"NBDMAGIC" + struct.pack(">QH", pinetBootStorm.NBD_OPTS_MAGIC, 3))
+            clientFlags, magic, option, length = struct.unpack(">IQII", self.receive(20))
+            name = self.receive(length).decode()
+            if name != "ltsp_armhf":
+                return
+            reply = struct.pack(">QH", len(IMAGE), 1)
+            if not clientFlags & pinetBootStorm.NBD_FLAG_NO_ZEROES:
+                reply = reply + b"\0" * 124
+            self.request.sendall(reply)
+            while True:
+                magic, flags, command, handle, offset, length = struct.unpack(">IHHQQI", self.receive(28))
+                if command == pinetBootStorm.NBD_CMD_DISC:
+                    return
+                self.request.sendall(struct.pack(">IIQ", pinetBootStorm.NBD_REPLY_MAGIC, 0, handle) + IMAGE[offset:offset + length])
+        except (EOFError, OSError):
+            pass
+
+class TestBootStorm(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.image = os.path.join(self.folder, "armhf.img")
+        with open(self.image, "wb") as f:
+            f.write(IMAGE)
+        self.bootFiles = os.path.join(self.folder, "bootfiles")
+        os.makedirs(os.path.join(self.bootFiles, "overlays"))
+        with open(os.path.join(self.bootFiles, "cmdline.txt"), "w") as f:
+            f.write("root=/dev/nbd0 nbdroot=10.0.0.1:ltsp_armhf\n")
+        with open(os.path.join(self.bootFiles, "overlays", "kernel7.img"), "wb") as f:
+            f.write(b"k" * 5000)
+        self.bootBytes = 5000 + len("root=/dev/nbd0 nbdroot=10.0.0.1:ltsp_armhf\n")
+        self.pattern = pinetBootStorm.syntheticPattern(len(IMAGE), 256 * 1024, 16 * 1024)
+
+    def startServer(self):
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), nbdHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def storm(self, source, levels):
+        return pinetBootStorm.runStorm(source, levels, self.bootFiles, self.pattern, coldCache=False)
+
+class TestPatterns(TestBootStorm):
+
+    def test_syntheticPattern(self):
+        self.assertEqual(self.pattern, pinetBootStorm.syntheticPattern(len(IMAGE), 256 * 1024, 16 * 1024))
+        self.assertEqual(sum(length for offset, length in self.pattern), 256 * 1024)
+        self.assertTrue(all(offset + length <= len(IMAGE) for offset, length in self.pattern))
+        self.assertGreater(len(set(offset for offset, length in self.pattern)), 4)
+
+    def test_loadPattern(self):
+        filepath = os.path.join(self.folder, "pattern.txt")
+        with open(filepath, "w") as f:
+            f.write("179,2    0       12     0.004  231  Q   R 2048 + 8 [systemd]\n4096 512\nnonsense\n")
+        self.assertEqual(pinetBootStorm.loadPattern(filepath), [(2048 * 512, 8 * 512), (4096, 512)])
+        with open(filepath, "w") as f:
+            f.write("[[0, 4096], [8192, 100]]")
+        self.assertEqual(pinetBootStorm.loadPattern(filepath), [(0, 4096), (8192, 100)])
+
+class TestStorm(TestBootStorm):
+
+    def test_file_source(self):
+        result = self.storm(self.image, [1, 4])
+        self.assertEqual(result["transport"], "file")
+        self.assertEqual(result["bootFiles"], 2)
+        self.assertEqual([level["clients"] for level in result["levels"]], [1, 4])
+        for level in result["levels"]:
+            self.assertEqual(level["errors"], 0)
+            self.assertEqual(level["bytes"], level["clients"] * (256 * 1024 + self.bootBytes))
+            self.assertGreater(level["throughput"], 0)
+            self.assertLessEqual(level["readP50"], level["readP99"])
+            self.assertLessEqual(level["loginP50"], level["loginMax"])
+
+    def test_nbd_source(self):
+        port = self.startServer()
+        source = "nbd://127.0.0.1:%d/ltsp_armhf" % port
+        result = self.storm(source, [3])
+        self.assertEqual(result["transport"], "nbd")
+        self.assertEqual(result["levels"][0]["errors"], 0)
+        self.assertEqual(result["levels"][0]["bytes"], 3 * (256 * 1024 + self.bootBytes))
+        async def readBack():
+            client = pinetBootStorm.nbdSource("127.0.0.1", port, "ltsp_armhf")
+            loop = asyncio.get_event_loop()
+            await client.open(loop)
+            data = await client.read(loop, 1000, 300)
+            await client.close(loop)
+            return client.size(), data
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.assertEqual(loop.run_until_complete(readBack()), (len(IMAGE), IMAGE[1000:1300]))
+
+    def test_nbd_unknown_export(self):
+        port = self.startServer()
+        result = self.storm("nbd://127.0.0.1:%d/ltsp_missing" % port, [2])
+        self.assertEqual(result["levels"][0]["errors"], 2)
+        self.assertIn("ltsp_missing", result["levels"][0]["firstError"])
+
+class TestResults(TestBootStorm):
+
+    def test_save_and_compare(self):
+        results = os.path.join(self.folder, "results")
+        before = self.storm(self.image, [1, 2])
+        after = dict(before)
+        after["created"] = before["created"] + 60
+        after["levels"] = [dict(level, loginP95=level["loginP95"] * 2) for level in before["levels"]]
+        pinetBootStorm.saveResult(before, results)
+        pinetBootStorm.saveResult(after, results)
+        saved = pinetBootStorm.listResults(results)
+        self.assertEqual(len(saved), 2)
+        lines = pinetBootStorm.compareResults(pinetFiles.readJSON(saved[0]), pinetFiles.readJSON(saved[1]))
+        self.assertEqual(len(lines), 3)
+        self.assertIn("+100%", lines[1])
+        self.assertEqual(len(pinetBootStorm.formatResult(before)), 4)
+
+if __name__ == '__main__':
+    unittest.main()
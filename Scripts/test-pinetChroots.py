@@ -0,0 +1,84 @@
+#!python3
+import os
+import time
+import unittest
+
+import pinetChroots
+import pinetRunner
+import testHelpers
+
+class TestChroots(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.registry = os.path.join(self.folder, "pinet-chroots.json")
+
+class TestRegistry(TestChroots):
+
+    def test_default(self):
+        targets = pinetChroots.loadTargets(self.registry)
+        self.assertEqual([target.name for target in targets], ["armhf"])
+        self.assertEqual(targets[0].path, "/opt/ltsp/armhf")
+        self.assertEqual(targets[0].command("apt-get", "update"), ["ltsp-chroot", "--arch", "armhf", "apt-get", "update"])
+        self.assertEqual(targets[0].file("/etc/init.d/kernelCheckUpdate.sh"), "/opt/ltsp/armhf/etc/init.d/kernelCheckUpdate.sh")
+
+    def test_add_and_select(self):
+        pinetChroots.addTarget(pinetChroots.defaultTarget(), self.registry)
+        pinetChroots.addTarget(pinetChroots.chrootTarget("pilot", nbd=False), self.registry)
+        pinetChroots.addTarget(pinetChroots.chrootTarget("buster", "armhf", "/srv/buster"), self.registry)
+        self.assertEqual([target.name for target in pinetChroots.selectTargets("all", self.registry)], ["armhf", "pilot", "buster"])
+        self.assertEqual([target.name for target in pinetChroots.selectTargets("default", self.registry)], ["armhf"])
+        selected = pinetChroots.selectTargets("buster,pilot", self.registry)
+        self.assertEqual([target.name for target in selected], ["pilot", "buster"])
+        self.assertFalse(selected[0].nbd)
+        self.assertEqual(selected[1].rebuildCommand(), ["ltsp-update-image", "/srv/buster"])
+        self.assertRaises(ValueError, pinetChroots.selectTargets, "nothere", self.registry)
+
+    def test_remove(self):
+        pinetChroots.addTarget(pinetChroots.defaultTarget(), self.registry)
+        pinetChroots.addTarget(pinetChroots.chrootTarget("pilot"), self.registry)
+        self.assertRaises(ValueError, pinetChroots.removeTarget, "armhf", self.registry)
+        self.assertTrue(pinetChroots.removeTarget("pilot", self.registry))
+        self.assertFalse(pinetChroots.removeTarget("pilot", self.registry))
+        self.assertEqual([target.name for target in pinetChroots.loadTargets(self.registry)], ["armhf"])
+
+    def test_bad_name(self):
+        self.assertRaises(ValueError, pinetChroots.chrootTarget, "../etc")
+
+class TestFanOut(TestChroots):
+
+    def targets(self, count):
+        return [pinetChroots.chrootTarget("image%d" % i) for i in range(count)]
+
+    def test_bounded_parallelism(self):
+        running = []
+        highest = []
+        def operation(target):
+            running.append(target.name)
+            highest.append(len(running))
+            time.sleep(0.2)
+            running.remove(target.name)
+            return True
+        started = time.time()
+        report = pinetChroots.fanOut(self.targets(4), operation, workers=2)
+        self.assertLess(time.time() - started, 0.7)
+        self.assertEqual(max(highest), 2)
+        self.assertTrue(report.ok)
+        self.assertEqual([result.name for result in report.results], ["image0", "image1", "image2", "image3"])
+
+    def test_results_per_target(self):
+        def operation(target):
+            if target.name == "image0":
+                return 0
+            if target.name == "image1":
+                return pinetRunner.runCommand(["false"])
+            raise RuntimeError("no space left")
+        report = pinetChroots.fanOut(self.targets(3), operation)
+        self.assertFalse(report.ok)
+        self.assertTrue(report.result("image0").ok)
+        self.assertFalse(report.result("image1").ok)
+        self.assertEqual(report.result("image2").error, "no space left")
+        self.assertIn("FAILED (no space left)", "\n".join(report.summary()))
+
+if __name__ == '__main__':
+    unittest.main()
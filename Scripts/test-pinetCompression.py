@@ -0,0 +1,102 @@
+#!python3
+import os
+import shutil
+import unittest
+
+import pinetCompression
+import testHelpers
+
+HELP = """SYNTAX:mksquashfs source1 source2 ...  dest [options]
+
+Filesystem build options:
+-comp <comp>\t\tselect <comp> compression
+\t\t\tCompressors available:
+\t\t\t\tgzip (default)
+\t\t\t\tlzo
+\t\t\t\txz
+"""
+
+HELP_43 = """Compressors available and compressor specific options:
+\tgzip (default)
+\t  -Xcompression-level <compression-level>
+\t\t<compression-level> should be 1 .. 9 (default 9)
+\tlz4
+\t  -Xhc
+\txz
+\t  -Xbcj filter1,filter2,...,filterN
+"""
+
+def trial(compressor, blockSize, buildTime, size, decompressTime, error=""):
+    return {"compressor": compressor, "blockSize": blockSize, "buildTime": buildTime, "size": size, "decompressTime": decompressTime, "error": error}
+
+class TestCompression(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.chroot = os.path.join(self.folder, "armhf")
+        for i in range(40):
+            filepath = os.path.join(self.chroot, "usr", "lib", "part%d" % (i % 4), "file%02d" % i)
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            with open(filepath, "wb") as f:
+                f.write((b"raspbian %d " % i) * 1000)
+
+class TestAdvisor(TestCompression):
+
+    def test_availableCompressors(self):
+        self.assertEqual(pinetCompression.availableCompressors(HELP_43), ["gzip", "lz4", "xz"])
+        self.assertEqual(pinetCompression.availableCompressors(HELP), ["gzip", "lzo", "xz"])
+        self.assertEqual(pinetCompression.availableCompressors("nothing useful"), [])
+
+    def test_sampleChroot(self):
+        sample = os.path.join(self.folder, "sample")
+        sampled, total = pinetCompression.sampleChroot(self.chroot, sample, sampleBytes=totalBytes(self.chroot) // 4)
+        self.assertEqual(total, totalBytes(self.chroot))
+        files = [os.path.join(root, name) for root, folders, names in os.walk(sample) for name in names]
+        self.assertEqual(len(files), 10)
+        self.assertEqual(sampled, sum(os.path.getsize(filepath) for filepath in files))
+        self.assertEqual(len(set(os.path.basename(os.path.dirname(filepath)) for filepath in files)), 4)  #Spread across the chroot
+        relative = os.path.relpath(files[0], sample)
+        self.assertEqual(os.stat(files[0]).st_ino, os.stat(os.path.join(self.chroot, relative)).st_ino)
+
+    def test_recommend(self):
+        mb = 1024 * 1024
+        trials = [trial("gzip", "128K", 10.0, 40 * mb, 1.0),
+                  trial("xz", "1M", 60.0, 30 * mb, 1.5),
+                  trial("lz4", "128K", 2.0, 55 * mb, 0.2),
+                  trial("zstd", "1M", 4000.0, 20 * mb, 0.5),
+                  trial("lzo", "128K", 0.0, 0, 0.0, "mksquashfs failed")]
+        ranked = pinetCompression.recommend(trials, 100 * mb, 1000 * mb, cores=4)
+        self.assertEqual([item["compressor"] for item in ranked], ["lz4", "gzip", "xz", "zstd"])  #zstd 1M builds too slowly
+        self.assertAlmostEqual(ranked[0]["ratio"], 0.55)
+        self.assertEqual(ranked[0]["fullSize"], 550 * mb)
+        self.assertAlmostEqual(ranked[0]["fullBuildTime"], 5.0)
+        slowNetwork = pinetCompression.recommend(trials, 100 * mb, 1000 * mb, cores=4, networkSpeed=mb)
+        self.assertEqual(slowNetwork[0]["compressor"], "xz")
+
+    def test_profile(self):
+        conf = os.path.join(self.folder, "ltsp-update-image.conf")
+        self.assertIsNone(pinetCompression.loadProfile(conf))
+        with open(conf, "w") as f:
+            f.write('IMAGE_EXCLUDES="/var/cache"\n')
+        pinetCompression.saveProfile("xz", "1M", conf)
+        pinetCompression.saveProfile("lz4", "128K", conf)
+        with open(conf) as f:
+            self.assertEqual(f.read(), 'IMAGE_EXCLUDES="/var/cache"\n' + pinetCompression.PROFILE_MARKER + '\nNO_COMP="-comp lz4 -b 128K"\n')
+        self.assertEqual(pinetCompression.loadProfile(conf), ("lz4", "128K"))
+
+    @unittest.skipUnless(shutil.which("mksquashfs") and shutil.which("unsquashfs"), "needs squashfs-tools")
+    def test_advise(self):
+        work = os.path.join(self.folder, "trial")
+        result = pinetCompression.advise(self.chroot, work, profiles=[("gzip", "128K"), ("nonsense", "128K")], sampleBytes=10 ** 9,
+                                         helpText=HELP + "\t\t\t\tnonsense\n")
+        self.assertEqual([item["compressor"] for item in result["ranked"]], ["gzip"])
+        self.assertEqual([item["compressor"] for item in result["failed"]], ["nonsense"])
+        self.assertLess(result["ranked"][0]["ratio"], 0.5)
+        self.assertFalse(os.path.exists(work))
+
+def totalBytes(folder):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, folders, names in os.walk(folder) for name in names)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!python3
+import os
+import unittest
+
+import pinetFiles
+import pinetDedup
+import testHelpers
+
+class TestDedup(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.home = os.path.join(self.folder, "home")
+        self.statePath = os.path.join(self.folder, "state.json")
+        self.reportPath = os.path.join(self.folder, "report.json")
+        game = os.urandom(40000)
+        big = os.urandom(300000)
+        for user in ("alice", "bob", "carol"):
+            self.write(user + "/python_games/wormy.py", game)
+            self.write(user + "/small.txt", b"s" * 100)  #Under MIN_SIZE
+        self.write("alice/course/notes.pdf", big)
+        self.write("bob/Downloads/notes.pdf", big)
+        self.write("carol/Downloads/notes-edited.pdf", big[:150000] + b"X" + big[150001:])  #Same size and ends, different middle
+        self.write("carol/other.bin", b"o" * 40000)  #Same size as the games, different start
+        os.link(os.path.join(self.home, "alice", "course", "notes.pdf"), os.path.join(self.home, "alice", "notes-link.pdf"))
+        self.write(".pinet-retiring/dave/python_games/wormy.py", game)
+
+    def write(self, relative, data):
+        filepath = os.path.join(self.home, relative)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "wb") as f:
+            f.write(data)
+
+    def relative(self, groups):
+        return [[os.path.relpath(item[0], self.home) for item in group] for group in groups]
+
+class TestFinding(TestDedup):
+
+    def test_findDuplicates(self):
+        state = pinetDedup.dedupState(self.statePath)
+        groups, scanned = pinetDedup.findDuplicates(self.home, state, workers=2)
+        self.assertEqual(scanned, 7)  #The hard link counts once, small files and the retiring folder not at all
+        self.assertEqual(self.relative(groups), [["alice/course/notes.pdf", "bob/Downloads/notes.pdf"],
+                                                 ["alice/python_games/wormy.py", "bob/python_games/wormy.py", "carol/python_games/wormy.py"]])
+        carol = os.path.join(self.home, "carol", "Downloads", "notes-edited.pdf")
+        self.assertIn("partial", state.hashes[carol])  #Its partial hash matched the other notes, so it was read in full
+        self.assertIn("full", state.hashes[carol])
+        self.assertNotIn("full", state.hashes[os.path.join(self.home, "carol", "other.bin")])
+
+    def test_state_is_reused(self):
+        state = pinetDedup.dedupState(self.statePath)
+        pinetDedup.findDuplicates(self.home, state, workers=2)
+        state = pinetDedup.dedupState.load(self.statePath)
+        self.assertEqual(len(state.hashes), 7)  #Every file that shares its size with another
+        notes = os.path.join(self.home, "bob", "Downloads", "notes.pdf")
+        with open(notes, "ab") as f:
+            f.write(b"changed")
+        os.remove(os.path.join(self.home, "carol", "other.bin"))
+        groups, scanned = pinetDedup.findDuplicates(self.home, state, workers=2)
+        self.assertEqual(len(groups), 1)
+        self.assertNotIn(os.path.join(self.home, "carol", "other.bin"), state.hashes)
+        self.assertNotIn(notes, state.hashes)  #Changed, and now a different size to the others, so not hashed again
+
+    def test_report_only(self):
+        report = pinetDedup.run(self.home, apply=False, statePath=self.statePath, reportPath=self.reportPath, workers=2)
+        self.assertEqual((report["groups"], report["duplicates"]), (2, 3))
+        self.assertEqual(report["duplicateSize"], 300000 + 2 * 40000)
+        self.assertEqual(report["reclaimed"], 0)
+        self.assertFalse(report["applied"])
+        self.assertEqual(pinetFiles.readJSON(self.reportPath)["groups"], 2)
+        lines = pinetDedup.formatReport(report, str, self.home)
+        self.assertIn("300000 x 2: alice/course/notes.pdf, bob/Downloads/notes.pdf", lines[-2])
+
+class TestSharing(TestDedup):
+
+    def test_deduplicate(self):
+        if not pinetDedup.sharingSupported(self.home):
+            self.skipTest("needs a filesystem that can share data between files, such as btrfs or XFS")
+        report = pinetDedup.run(self.home, apply=True, statePath=self.statePath, reportPath=self.reportPath, workers=2)
+        self.assertEqual(report["sharedFiles"], 3)
+        self.assertEqual(report["reclaimed"], 300000 + 2 * 40000)
+        with open(os.path.join(self.home, "bob", "Downloads", "notes.pdf"), "ab") as f:
+            f.write(b"private")  #Writes stay in that user's copy
+        with open(os.path.join(self.home, "alice", "course", "notes.pdf"), "rb") as f:
+            self.assertEqual(len(f.read()), 300000)
+        report = pinetDedup.run(self.home, apply=True, statePath=self.statePath, reportPath=self.reportPath, workers=2)
+        self.assertEqual(report["sharedFiles"], 0)  #Already shared by the first pass
+        self.assertEqual(report["alreadyShared"], 2 * 40000)
+
+if __name__ == '__main__':
+    unittest.main()
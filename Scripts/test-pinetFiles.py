@@ -0,0 +1,66 @@
+#!python3
+import os
+import stat
+import unittest
+
+import pinetFiles
+import testHelpers
+
+class TestFiles(testHelpers.TempFolderTest):
+
+    def test_json(self):
+        filepath = os.path.join(self.folder, "state", "index.json")
+        pinetFiles.writeJSONAtomic({"b": [1, 2], "a": None}, filepath)
+        self.assertEqual(pinetFiles.readJSON(filepath), {"a": None, "b": [1, 2]})
+        self.assertFalse(os.path.exists(filepath + ".new"))
+        pinetFiles.writeJSONAtomic({"b": [1, 2], "a": None}, filepath, compact=True, sortKeys=True)
+        with open(filepath) as f:
+            self.assertEqual(f.read(), '{"a":null,"b":[1,2]}')
+        with open(filepath, "w") as f:
+            f.write('{"half')
+        self.assertIsNone(pinetFiles.readJSON(filepath))
+        self.assertIsNone(pinetFiles.readJSON(os.path.join(self.folder, "missing.json")))
+
+    def test_concurrent_writers(self):
+        import threading
+        filepath = os.path.join(self.folder, "status.json")
+        errors = []
+        def write(number):
+            try:
+                for i in range(50):
+                    pinetFiles.writeJSONAtomic({"writer": number, "padding": "x" * 20000}, filepath)
+            except OSError as error:
+                errors.append(error)
+        threads = [threading.Thread(target=write, args=(number,)) for number in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIn(pinetFiles.readJSON(filepath)["writer"], range(4))
+        self.assertEqual(os.listdir(self.folder), ["status.json"])  #No temporary files left behind
+        self.assertEqual(stat.S_IMODE(os.stat(filepath).st_mode), 0o644)
+
+    def test_private(self):
+        filepath = os.path.join(self.folder, "retiring", "manifest.json")
+        pinetFiles.writeJSONAtomic([], filepath, private=True)
+        self.assertEqual(stat.S_IMODE(os.stat(filepath).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(filepath)).st_mode) & 0o077, 0)
+
+    def test_homeFolders(self):
+        for name in ("bob", "alice", ".pinet-retiring"):
+            os.makedirs(os.path.join(self.folder, name))
+        open(os.path.join(self.folder, "notes.txt"), "w").close()
+        os.symlink(os.path.join(self.folder, "alice"), os.path.join(self.folder, "carol"))
+        self.assertEqual(pinetFiles.homeFolders(self.folder), ["alice", "bob"])
+
+    @unittest.skipUnless(os.geteuid() == 0, "needs root")
+    def test_runAs(self):
+        import pwd
+        nobody = pwd.getpwnam("nobody")
+        self.assertEqual(pinetFiles.runAs("nobody", lambda: (os.getuid(), os.getgid(), os.getgroups())), (nobody.pw_uid, nobody.pw_gid, []))
+        with self.assertRaises(OSError):
+            pinetFiles.runAs("nobody", os.listdir, "/root")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!python3
+import os
+import shutil
+import struct
+import time
+import unittest
+import zlib
+
+import pinetGallery
+import testHelpers
+
+def png(width, height):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    rows = b"".join(b"\0" + b"".join(bytes((x % 256, y % 256, 128)) for x in range(width)) for y in range(height))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+class TestGallery(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = os.path.join(self.folder, "cache")
+        self.users = {}
+        self.now = time.time()
+        for user, ages in (("alice", [1, 2, 3]), ("bob", [40]), ("carol <b>", [])):
+            home = os.path.join(self.folder, "home", user)
+            os.makedirs(os.path.join(home, pinetGallery.CAPTURE_FOLDER))
+            self.users[user] = home
+            for days in ages:
+                self.capture(user, days)
+        os.symlink("/etc/passwd", os.path.join(self.users["bob"], pinetGallery.CAPTURE_FOLDER, "screenshot-20240101-120000.png"))
+        with open(os.path.join(self.users["alice"], pinetGallery.CAPTURE_FOLDER, "holiday.png"), "wb") as f:
+            f.write(b"not a capture")
+        self.made = []
+
+    def capture(self, user, days, size=1000):
+        when = self.now - days * 86400
+        path = os.path.join(self.users[user], pinetGallery.CAPTURE_FOLDER, "screenshot-" + time.strftime("%Y%m%d-%H%M%S", time.localtime(when)) + ".png")
+        with open(path, "wb") as f:
+            f.write(b"p" * size)
+        os.utime(path, (when, when))
+        return path
+
+    def make(self, source, destination):
+        self.made.append(source)
+        shutil.copyfile(source, destination)
+
+class TestCaptures(TestGallery):
+
+    def test_findCaptures(self):
+        captures = pinetGallery.findCaptures(self.users)
+        self.assertEqual([(user, round((self.now - mtime) / 86400)) for user, path, mtime, size in captures], [("alice", 1), ("alice", 2), ("alice", 3), ("bob", 40)])
+
+    def test_capture_folder_must_be_the_users(self):
+        home = os.path.join(self.folder, "home", "mallory")
+        os.makedirs(home)
+        os.symlink(os.path.join(self.users["alice"], pinetGallery.CAPTURE_FOLDER), os.path.join(home, pinetGallery.CAPTURE_FOLDER))
+        captures = pinetGallery.findCaptures({"mallory": home})
+        self.assertEqual(captures, [])
+        old = [(user, path, mtime - 90 * 86400, size) for user, path, mtime, size in pinetGallery.findCaptures({"alice": self.users["alice"]})]
+        pinetGallery.pruneCaptures([("mallory", os.path.join(home, pinetGallery.CAPTURE_FOLDER, os.path.basename(path)), mtime, size)
+                                    for user, path, mtime, size in old], self.now)
+        self.assertEqual(len(pinetGallery.findCaptures({"alice": self.users["alice"]})), 3)  #Not deleted through the link
+        if os.geteuid() == 0:
+            os.chown(os.path.join(self.users["bob"], pinetGallery.CAPTURE_FOLDER), 4242, 4242)
+            self.assertEqual(pinetGallery.findCaptures({"bob": self.users["bob"]}), [])
+
+    def test_pruneCaptures(self):
+        self.capture("alice", 4, size=3000)
+        kept = pinetGallery.pruneCaptures(pinetGallery.findCaptures(self.users), self.now, maxAge=30, quota=3500)
+        self.assertEqual([(user, round((self.now - mtime) / 86400)) for user, path, mtime, size in kept], [("alice", 1), ("alice", 2), ("alice", 3)])
+        self.assertEqual(len(pinetGallery.findCaptures(self.users)), 3)  #Bob's was too old and alice's oldest over the quota
+
+class TestThumbnails(TestGallery):
+
+    def test_updateCache(self):
+        captures = pinetGallery.findCaptures(self.users)
+        thumbnails, made, errors = pinetGallery.updateCache(captures, self.cache, make=self.make)
+        self.assertEqual((len(thumbnails), made, errors), (4, 4, []))
+        thumbnails, made, errors = pinetGallery.updateCache(captures, self.cache, make=self.make)
+        self.assertEqual(made, 0)  #Nothing new
+        path = captures[0][1]
+        os.utime(path, (self.now + 5, self.now + 5))
+        thumbnails, made, errors = pinetGallery.updateCache(pinetGallery.findCaptures(self.users), self.cache, make=self.make, prune=True)
+        self.assertEqual(made, 1)
+        self.assertEqual(self.made[-1], path)
+        self.assertEqual(sum(len(files) for folder, folders, files in os.walk(self.cache)), 4)  #The old thumbnail of the changed capture is gone
+
+    @unittest.skipUnless(pinetGallery.thumbnailMethod(), "needs python3-pil or imagemagick")
+    def test_makeThumbnail(self):
+        source = os.path.join(self.folder, "big.png")
+        with open(source, "wb") as f:
+            f.write(png(800, 600))
+        destination = os.path.join(self.folder, "small.jpg")
+        pinetGallery.makeThumbnail(source, destination, pinetGallery.thumbnailMethod())
+        with open(destination, "rb") as f:
+            self.assertEqual(f.read(2), b"\xff\xd8")
+
+class TestContactSheet(TestGallery):
+
+    def test_build(self):
+        output = os.path.join(self.folder, "gallery", "pupil")
+        summary = pinetGallery.build("pupil", output, self.cache, perUser=2, members=self.users, make=self.make)
+        self.assertEqual((summary["members"], summary["captures"], summary["shown"], summary["made"]), (3, 4, 3, 3))
+        with open(summary["page"]) as f:
+            page = f.read()
+        self.assertIn("carol &lt;b&gt;", page)
+        self.assertIn("no screenshots", page)
+        self.assertIn("3 saved", page)
+        self.assertEqual(len(os.listdir(os.path.join(output, "thumbs"))), 3)
+        summary = pinetGallery.build("pupil", output, self.cache, perUser=1, members=self.users, make=self.make)
+        self.assertEqual(summary["made"], 0)
+        self.assertEqual(len(os.listdir(os.path.join(output, "thumbs"))), 2)  #Thumbnails no longer shown are removed
+
+    def test_maintain(self):
+        summary = pinetGallery.maintain(self.users, self.cache, maxAge=30, make=self.make, now=self.now)
+        self.assertEqual((summary["captures"], summary["removed"], summary["made"]), (3, 1, 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!python3
+import os
+import shutil
+import unittest
+
+import pinetGolden
+import testHelpers
+
+class TestGolden(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.chroot = os.path.join(self.folder, "armhf")
+        self.cache = os.path.join(self.folder, "cache")
+        self.write("etc/hostname", "pi\n")
+        self.write("bin/bash", "b" * 3000)
+        for name in ("bin", "lib", "share", "games"):
+            for i in range(3):
+                self.write("usr/%s/file%d" % (name, i), name[0] * 5000)
+        self.write("usr/share/doc/README", "d" * 20000)
+        os.symlink("bash", os.path.join(self.chroot, "bin", "sh"))
+        os.chmod(os.path.join(self.chroot, "usr", "games"), 0o750)
+        self.config = os.path.join(self.folder, "ltsp-raspbian.conf")
+        with open(self.config, "w") as f:
+            f.write("DIST=wheezy\nLOCALE=\"en_GB.UTF-8 UTF-8\"\n")
+        self.keyring = os.path.join(self.folder, "raspbian.public.key.gpg")
+        with open(self.keyring, "wb") as f:
+            f.write(b"not really a key")
+
+    def write(self, relative, text):
+        filepath = os.path.join(self.chroot, relative)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as f:
+            f.write(text)
+
+class TestPlanning(TestGolden):
+
+    def test_planParts(self):
+        folders, bins = pinetGolden.planParts(self.chroot, parts=3)
+        self.assertEqual(folders, ["usr", "usr/share"])  #Too big for one archive, so split up
+        paths = sorted(path for paths in bins for path in paths)
+        self.assertEqual(paths, sorted(["bin", "etc", "usr/bin", "usr/games", "usr/lib", "usr/share/doc", "usr/share/file0", "usr/share/file1", "usr/share/file2"]))
+        self.assertEqual(len(bins), 3)
+        sizes, children = pinetGolden.measureChroot(self.chroot)
+        self.assertEqual(sizes["usr"], 20000 + 4 * 15000)
+        self.assertEqual(sizes["bin"], 3000 + len("bash"))  #The symlink counts as its own length
+
+    def test_cacheKey(self):
+        key, details = pinetGolden.cacheKey(self.config, self.keyring, "armhf", ltspVersion="5.5.4")
+        self.assertTrue(key.startswith("armhf-"))
+        self.assertEqual(details["config"], "DIST=wheezy\nLOCALE=\"en_GB.UTF-8 UTF-8\"\n")
+        self.assertEqual(pinetGolden.cacheKey(self.config, self.keyring, "armhf", ltspVersion="5.5.4")[0], key)
+        self.assertNotEqual(pinetGolden.cacheKey(self.config, self.keyring, "armhf", ltspVersion="5.5.5")[0], key)
+        with open(self.config, "a") as f:
+            f.write("MIRROR=http://example.com/raspbian\n")
+        self.assertNotEqual(pinetGolden.cacheKey(self.config, self.keyring, "armhf", ltspVersion="5.5.4")[0], key)
+
+    def test_mountedUnder(self):
+        mounts = os.path.join(self.folder, "mounts")
+        with open(mounts, "w") as f:
+            f.write("proc /proc proc rw 0 0\nproc %s/proc proc rw 0 0\n/dev/sda1 %s2 ext4 rw 0 0\n" % (self.chroot, self.chroot))
+        self.assertEqual(pinetGolden.mountedUnder(self.chroot, mounts), [self.chroot + "/proc"])
+
+@unittest.skipUnless(shutil.which("tar") and shutil.which("gzip"), "needs tar and gzip")
+class TestCache(TestGolden):
+
+    def export(self):
+        key, details = pinetGolden.cacheKey(self.config, self.keyring, "armhf", ltspVersion="5.5.4")
+        manifest = pinetGolden.export(self.chroot, key, details, 1800.0, self.cache, parts=3, compressor="gzip", now=1000)
+        return key, manifest
+
+    def test_export_and_restore(self):
+        key, manifest = self.export()
+        self.assertEqual([part["file"] for part in manifest["parts"]], ["folders.tar.gz", "part1.tar.gz", "part2.tar.gz", "part3.tar.gz"])
+        self.assertEqual(pinetGolden.verify(manifest, self.cache), [])
+        restored = os.path.join(self.folder, "restored")
+        manifest = pinetGolden.restore(restored, key, self.cache, now=2000)
+        self.assertEqual(len(manifest["restores"]), 1)
+        with open(os.path.join(restored, "usr", "share", "doc", "README")) as f:
+            self.assertEqual(f.read(), "d" * 20000)
+        self.assertEqual(os.readlink(os.path.join(restored, "bin", "sh")), "bash")
+        self.assertEqual(os.stat(os.path.join(restored, "usr", "games")).st_mode & 0o777, 0o750)
+        original = sorted(os.path.relpath(os.path.join(folder, name), self.chroot) for folder, folders, files in os.walk(self.chroot) for name in folders + files)
+        copy = sorted(os.path.relpath(os.path.join(folder, name), restored) for folder, folders, files in os.walk(restored) for name in folders + files)
+        self.assertEqual(copy, original)
+        self.assertIn("restored 1 times", pinetGolden.formatEntry(pinetGolden.loadManifest(key, self.cache), str))
+        with self.assertRaises(RuntimeError):
+            pinetGolden.restore(restored, key, self.cache)  #Never unpacked over an existing chroot
+        self.assertIsNone(pinetGolden.restore(os.path.join(self.folder, "other"), "armhf-unknown", self.cache))
+
+    def test_damaged_archive(self):
+        key, manifest = self.export()
+        with open(os.path.join(self.cache, key, "part2.tar.gz"), "r+b") as f:
+            f.seek(40)
+            f.write(b"damaged")
+        self.assertEqual(pinetGolden.verify(manifest, self.cache), ["part2.tar.gz does not match its checksum"])
+        restored = os.path.join(self.folder, "restored")
+        with self.assertRaises(RuntimeError):
+            pinetGolden.restore(restored, key, self.cache)
+        self.assertFalse(os.path.exists(restored))
+        self.assertFalse(os.path.exists(restored + ".pinet-restore"))
+
+    def test_prune(self):
+        for i in range(3):
+            with open(self.config, "a") as f:
+                f.write("#%d\n" % i)
+            self.export()
+        self.assertEqual(len(pinetGolden.listEntries(self.cache)), pinetGolden.KEEP)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!python3
+import os
+import shutil
+import threading
+import time
+import unittest
+
+import pinetHandin
+import testHelpers
+
+class TestHandin(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.etc = os.path.join(self.folder, "etc")
+        self.homes = os.path.join(self.folder, "home")
+        os.makedirs(self.etc)
+        self.passwd = os.path.join(self.etc, "passwd")
+        self.group = os.path.join(self.etc, "group")
+        self.index = os.path.join(self.folder, "handin-index.json")
+        self.users = [("teacher", 1000), ("alice", 1001), ("bob", 1002)]
+        self.writeAccounts()
+        self.write("group", "teacher:x:1000:\npupil:x:1500:alice\n")
+        for user, uid in self.users:
+            os.makedirs(os.path.join(self.homes, user, "handin"))
+
+    def write(self, name, text):
+        temporary = os.path.join(self.etc, name + "+")
+        with open(temporary, "w") as f:
+            f.write(text)
+        os.replace(temporary, os.path.join(self.etc, name))
+
+    def writeAccounts(self):
+        lines = []
+        for user, uid in self.users:
+            gid = uid
+            if user == "bob":
+                gid = 1500  #A pupil through their primary group
+            lines.append("%s:x:%d:%d::%s:/bin/bash" % (user, uid, gid, os.path.join(self.homes, user)))
+        self.write("passwd", "\n".join(lines) + "\n")
+
+    def handIn(self, user, name, text="work"):
+        filepath = os.path.join(self.homes, user, "handin", name)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as f:
+            f.write(text)
+
+    def watcher(self):
+        watcher = pinetHandin.handinWatcher(self.passwd, self.group, self.index)
+        self.addCleanup(watcher.notify.close)
+        watcher.fullScan()
+        return watcher
+
+    def settle(self, watcher):
+        watcher.handleEvents(now=0)
+        watcher.rescanSettled(now=pinetHandin.SETTLE_TIME)
+
+class TestPupils(TestHandin):
+
+    def test_readPupils(self):
+        self.assertEqual(sorted(pinetHandin.readPupils(self.passwd, self.group)), ["alice", "bob"])
+
+    def test_scanHandin(self):
+        self.handIn("alice", "essay.txt", "12345")
+        self.handIn("alice", "project/main.py", "123")
+        result = pinetHandin.scanHandin(os.path.join(self.homes, "alice", "handin"))
+        self.assertEqual((result["files"], result["size"]), (2, 8))
+
+class TestWatcher(TestHandin):
+
+    def test_changes_rescan_only_that_pupil(self):
+        watcher = self.watcher()
+        self.assertEqual(watcher.index["alice"]["files"], 0)
+        scanned = []
+        original = watcher.scanUser
+        watcher.scanUser = lambda user: scanned.append(user) or original(user)
+        self.handIn("alice", "essay.txt", "12345")
+        self.handIn("alice", "new folder/drawing.png", "1234567")
+        self.handIn("alice", "new folder/more/notes.txt", "1")
+        self.settle(watcher)
+        self.assertEqual(scanned, ["alice"])
+        self.assertEqual(watcher.index["alice"]["files"], 3)
+        self.assertEqual(watcher.index["alice"]["size"], 13)
+        self.handIn("alice", "new folder/more/late.txt", "22")
+        self.settle(watcher)
+        self.assertEqual(watcher.index["alice"]["files"], 4)
+        self.assertEqual(watcher.index["alice"]["newest"], os.path.join("new folder", "more", "late.txt"))
+
+    def test_handin_folder_made_later(self):
+        shutil.rmtree(os.path.join(self.homes, "bob", "handin"))
+        watcher = self.watcher()
+        self.assertTrue(watcher.index["bob"]["missing"])
+        self.handIn("bob", "late.txt")
+        self.settle(watcher)
+        self.handIn("bob", "later.txt")
+        self.settle(watcher)
+        self.assertEqual(watcher.index["bob"]["files"], 2)
+        self.assertNotIn("missing", watcher.index["bob"])
+
+    def test_pupils_added_and_removed(self):
+        watcher = self.watcher()
+        self.users.append(("carol", 1003))
+        os.makedirs(os.path.join(self.homes, "carol", "handin"))
+        self.handIn("carol", "essay.txt")
+        self.writeAccounts()
+        self.write("group", "teacher:x:1000:\npupil:x:1500:carol\n")
+        self.settle(watcher)
+        self.assertEqual(sorted(watcher.index), ["bob", "carol"])
+        self.assertEqual(watcher.index["carol"]["files"], 1)
+        self.handIn("alice", "ignored.txt")
+        self.settle(watcher)
+        self.assertNotIn("alice", watcher.index)
+
+class TestQuery(TestHandin):
+
+    def test_socket_and_fallback(self):
+        socketPath = os.path.join(self.folder, "handin.sock")
+        self.handIn("bob", "essay.txt", "12345")
+        stop = threading.Event()
+        thread = threading.Thread(target=pinetHandin.watch, args=(self.passwd, self.group, self.index, socketPath, lambda: not stop.is_set()))
+        thread.start()
+        for i in range(50):
+            if os.path.exists(socketPath):
+                break
+            time.sleep(0.05)
+        result = pinetHandin.query("status", socketPath, self.index)
+        self.assertTrue(result["live"])
+        self.assertEqual(result["pupils"]["bob"]["size"], 5)
+        self.assertEqual(list(pinetHandin.query("user alice", socketPath, self.index)["pupils"]), ["alice"])
+        stop.set()
+        thread.join(pinetHandin.SAVE_INTERVAL + 2)
+        result = pinetHandin.query("status", socketPath, self.index)
+        self.assertFalse(result["live"])
+        self.assertEqual(result["pupils"]["bob"]["files"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
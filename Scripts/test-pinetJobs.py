@@ -0,0 +1,123 @@
+#!python3
+import sys
+import time
+import unittest
+
+import pinetJobs
+import testHelpers
+
+MONDAY_10AM = time.mktime((2024, 1, 8, 10, 0, 0, 0, 0, -1))
+MONDAY_4PM = time.mktime((2024, 1, 8, 16, 0, 0, 0, 0, -1))
+
+class TestWindows(unittest.TestCase):
+
+    def test_lessons(self):
+        window = pinetJobs.parseWindow("not lessons")
+        self.assertFalse(pinetJobs.windowOpen(window, MONDAY_10AM))
+        self.assertTrue(pinetJobs.windowOpen(window, MONDAY_4PM))
+        self.assertTrue(pinetJobs.windowOpen(window, MONDAY_10AM + 5 * 86400))  #Saturday
+        self.assertEqual(pinetJobs.nextOpen(window, MONDAY_10AM), time.mktime((2024, 1, 8, 15, 30, 0, 0, 0, -1)))
+        self.assertEqual(pinetJobs.parseWindow("not lessons", "mon-fri 09:00–12:00")[1][0][1:], (540, 720))
+
+    def test_ranges(self):
+        overnight = pinetJobs.parseWindow("22:00-06:00")
+        self.assertTrue(pinetJobs.windowOpen(overnight, MONDAY_10AM - 8 * 3600))  #Monday 02:00
+        self.assertFalse(pinetJobs.windowOpen(overnight, MONDAY_4PM))
+        weekend = pinetJobs.parseWindow("sat,sun 09:00-17:00; wed 18:00-20:00")
+        self.assertTrue(pinetJobs.windowOpen(weekend, MONDAY_10AM - 86400))  #Sunday
+        self.assertTrue(pinetJobs.windowOpen(weekend, MONDAY_4PM + 2 * 86400 + 7200))  #Wednesday 18:00
+        self.assertFalse(pinetJobs.windowOpen(weekend, MONDAY_10AM))
+        self.assertTrue(pinetJobs.windowOpen(pinetJobs.parseWindow("any"), MONDAY_10AM))
+        for text in ("not any", "mon-fri", "someday 08:00-09:00", "25:00-26:00"):
+            with self.assertRaises(ValueError):
+                pinetJobs.parseWindow(text)
+
+class TestPlanning(unittest.TestCase):
+
+    def job(self, kind, submitted=0):
+        job = pinetJobs.newJob(kind, ["true"], now=MONDAY_10AM - 3600 + submitted)
+        job["id"] = kind
+        return job
+
+    def test_pickJobs(self):
+        queued = [self.job(kind) for kind in ("image", "backup", "collect", "copy")]
+        start, waiting = pinetJobs.pickJobs(queued, [], MONDAY_4PM)
+        self.assertEqual([job["kind"] for job in start], ["collect", "image"])
+        self.assertEqual(waiting, {"backup": "after image", "copy": "after collect"})
+        start, waiting = pinetJobs.pickJobs(queued, [], MONDAY_10AM)
+        self.assertEqual([job["kind"] for job in start], ["collect"])  #Image rebuilds and backups wait for the end of lessons
+        self.assertEqual(waiting["image"], "window")
+        start, waiting = pinetJobs.pickJobs([self.job("other")], [self.job("copy"), self.job("scan")], MONDAY_4PM)
+        self.assertEqual((start, waiting), ([], {"other": "busy"}))
+
+    def test_options(self):
+        options, command = pinetJobs.parseOptions(["--window=not 08:00-16:00", "--priority=90", "--", "--not-an-option"])
+        self.assertEqual(options, {"window": "not 08:00-16:00", "priority": 90})
+        self.assertEqual(command, ["--not-an-option"])
+        job = pinetJobs.newJob("backup", ["/bin/sh", "/usr/local/bin/pinet-backup.sh"], options, now=MONDAY_10AM)
+        self.assertEqual((job["priority"], job["window"], job["nice"], job["name"]), (90, "not 08:00-16:00", 15, "sh pinet-backup.sh"))
+        with self.assertRaises(ValueError):
+            pinetJobs.newJob("backup", ["true"], {"window": "tea time"})
+        with self.assertRaises(ValueError):
+            pinetJobs.newJob("knitting", ["true"])
+
+    def test_wrapCommand(self):
+        job = self.job("backup")
+        self.assertEqual(pinetJobs.wrapCommand(job, cgroups=True, ionice=True),
+                         ["systemd-run", "--scope", "--quiet", "--collect", "--unit=pinet-job-backup", "-p", "MemoryMax=1G", "-p", "IOWeight=10",
+                          "-p", "CPUWeight=10", "ionice", "-c", "3", "nice", "-n", "15", "true"])
+        self.assertEqual(pinetJobs.wrapCommand(self.job("collect"), cgroups=False, ionice=True), ["ionice", "-c", "2", "-n", "4", "nice", "-n", "5", "true"])
+
+class TestScheduler(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.scheduler = pinetJobs.scheduler(self.folder, cgroups=False, ionice=False)
+
+    def submit(self, kind, code):
+        return pinetJobs.submit(pinetJobs.newJob(kind, [sys.executable, "-c", code]), self.folder)
+
+    def waitFor(self, jobId):
+        job, process = self.scheduler.running[jobId]
+        process.wait(timeout=30)
+        self.scheduler.step()
+
+    def test_run(self):
+        first = self.submit("copy", "print('copied')")
+        second = self.submit("copy", "import sys; sys.exit(3)")
+        started = self.scheduler.step()
+        self.assertEqual([job["id"] for job in started], [first])  #Only one copy at a time
+        self.waitFor(first)
+        self.assertIn(second, self.scheduler.running)
+        self.waitFor(second)
+        history = pinetJobs.loadHistory(self.folder)
+        self.assertEqual([(entry["id"], entry["state"], entry["returncode"]) for entry in history], [(first, "done", 0), (second, "failed", 3)])
+        self.assertIsNotNone(history[1]["waited"])
+        with open(pinetJobs.logPath(self.folder, first)) as f:
+            self.assertEqual(f.read(), "copied\n")
+        self.assertEqual(pinetJobs.loadJobs(self.folder), [])
+        self.assertIn(first, pinetJobs.formatHistory(history)[1])
+
+    def test_cancel(self):
+        running = self.submit("other", "import time; time.sleep(60)")
+        queued = self.submit("other", "pass")
+        self.scheduler.step()
+        pinetJobs.requestCancel(running, self.folder)
+        pinetJobs.requestCancel(queued, self.folder)
+        self.scheduler.step()
+        self.waitFor(running)
+        self.assertEqual(sorted((entry["id"], entry["state"]) for entry in pinetJobs.loadHistory(self.folder)), sorted([(running, "cancelled"), (queued, "cancelled")]))
+        offline = self.submit("other", "pass")
+        self.assertTrue(pinetJobs.requestCancel(offline, self.folder, live=False))
+        self.assertFalse(pinetJobs.requestCancel(offline, self.folder, live=False))
+
+    def test_adopt(self):
+        job = pinetJobs.newJob("image", ["true"])
+        job.update({"state": "running", "started": time.time(), "pid": 2 ** 22 + 1})  #Above pid_max, so never alive
+        pinetJobs.submit(job, self.folder)
+        self.scheduler.adopt()
+        self.assertEqual(pinetJobs.loadHistory(self.folder)[0]["state"], "ended")
+        self.assertEqual(pinetJobs.loadJobs(self.folder), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!python3
+import os
+import unittest
+
+import pinetJournal
+import testHelpers
+
+class TestJournal(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.journalPath = os.path.join(self.folder, "install-journal.json")
+        self.steps = {"installLTSP": {"outputs": [self.path("ltsp-update-image")]},
+                      "buildClient": {"outputs": [self.path("chroot/etc/debian_version")], "env": ["LANG"]},
+                      "OneTimeFixes": {"outputs": [self.path("exports")]}}
+        self.environ = {"LANG": "en_GB.UTF-8"}
+
+    def path(self, relative):
+        return os.path.join(self.folder, relative)
+
+    def write(self, relative, text):
+        if not os.path.isdir(os.path.dirname(self.path(relative))):
+            os.makedirs(os.path.dirname(self.path(relative)))
+        with open(self.path(relative), "w") as f:
+            f.write(text)
+
+    def run_step(self, name, inputs=(), output=None, finish=True, now=1000):
+        decision = pinetJournal.begin(name, inputs, self.journalPath, now, self.environ, self.steps)
+        if decision == "run" and finish:
+            if output is not None:
+                self.write(output[0], output[1])
+            pinetJournal.end(name, 0, self.journalPath, now + 10, self.steps)
+        return decision
+
+    def firstInstall(self):
+        pinetJournal.start("fresh", self.journalPath, now=900)
+        self.assertEqual(self.run_step("installLTSP", output=("ltsp-update-image", "binary")), "run")
+        self.assertEqual(self.run_step("buildClient", output=("chroot/etc/debian_version", "7.8"), now=2000), "run")
+        self.assertEqual(self.run_step("OneTimeFixes", finish=False, now=3000), "run")  #Power cut
+
+class TestResume(TestJournal):
+
+    def test_resume_skips_done_steps(self):
+        self.firstInstall()
+        self.assertEqual(pinetJournal.journal.load(self.journalPath).unfinished(), "OneTimeFixes")
+        pinetJournal.start("resume", self.journalPath)
+        self.assertEqual(self.run_step("installLTSP"), "skip")
+        self.assertEqual(self.run_step("buildClient"), "skip")
+        self.assertEqual(self.run_step("OneTimeFixes", output=("exports", "/home *(rw)\n"), now=4000), "run")
+        self.assertEqual(self.run_step("configFixes", now=5000), "run")
+        pinetJournal.finish(self.journalPath)
+        self.assertIsNone(pinetJournal.journal.load(self.journalPath).unfinished())
+
+    def test_last_step_is_verified(self):
+        self.firstInstall()
+        self.write("chroot/etc/debian_version", "cut short")  #The last finished step's output has changed since
+        pinetJournal.start("resume", self.journalPath)
+        self.assertEqual(self.run_step("installLTSP"), "skip")
+        self.assertEqual(self.run_step("buildClient"), "run")
+
+    def test_changed_inputs_run_again_and_everything_after(self):
+        self.firstInstall()
+        pinetJournal.start("resume", self.journalPath)
+        self.environ["LANG"] = "de_DE.UTF-8"
+        self.assertEqual(self.run_step("installLTSP"), "skip")
+        self.assertEqual(self.run_step("buildClient", output=("chroot/etc/debian_version", "7.8")), "run")
+        self.environ["LANG"] = "en_GB.UTF-8"
+        self.assertEqual(self.run_step("OneTimeFixes"), "run")
+
+    def test_missing_earlier_output(self):
+        self.firstInstall()
+        os.remove(self.path("ltsp-update-image"))
+        pinetJournal.start("resume", self.journalPath)
+        self.assertEqual(self.run_step("installLTSP", output=("ltsp-update-image", "binary")), "run")
+        self.assertEqual(self.run_step("buildClient"), "run")
+
+    def test_fresh_keeps_old_journal(self):
+        self.firstInstall()
+        pinetJournal.start("fresh", self.journalPath, now=5000)
+        self.assertEqual(len([name for name in os.listdir(self.folder) if name.startswith("install-journal.json.")]), 1)
+        self.assertEqual(self.run_step("installLTSP", output=("ltsp-update-image", "binary")), "run")
+        lines = pinetJournal.formatJournal(pinetJournal.journal.load(self.journalPath))
+        self.assertEqual(len(lines), 1)
+        self.assertIn("done", lines[0])
+
+if __name__ == '__main__':
+    unittest.main()
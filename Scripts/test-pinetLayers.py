@@ -0,0 +1,151 @@
+#!python3
+import os
+import gzip
+import shutil
+import stat
+import unittest
+
+import pinetChroots
+import pinetLayers
+import testHelpers
+
+class TestLayers(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.chroot = os.path.join(self.folder, "armhf")
+        self.write("etc/hostname", "pi\n")
+        self.write("usr/bin/python", "python 2\n")
+        self.write("usr/share/doc/python/README", "docs\n")
+        self.write("opt/old/thing", "old\n")
+        self.write("var/lib/changes", "becomes a folder\n")
+        os.symlink("python", os.path.join(self.chroot, "usr", "bin", "python-link"))
+
+    def write(self, relative, text):
+        filepath = os.path.join(self.chroot, relative)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as f:
+            f.write(text)
+
+    def changeChroot(self):
+        os.utime(os.path.join(self.chroot, "etc", "hostname"), ns=(1, 1))
+        self.write("usr/bin/python", "python 3, longer\n")
+        self.write("usr/bin/bluej", "bluej\n")
+        self.write("usr/share/doc/python/NEWS", "excluded\n")
+        shutil.rmtree(os.path.join(self.chroot, "opt", "old"))
+        os.remove(os.path.join(self.chroot, "var", "lib", "changes"))
+        self.write("var/lib/changes/inside", "now a folder\n")
+
+class TestChanges(TestLayers):
+
+    def test_findChanges(self):
+        base = pinetLayers.scanTree(self.chroot, ["usr/share/doc/*"])
+        self.assertEqual(base["usr/bin/python-link"][6], "python")
+        self.assertNotIn("usr/share/doc/python", base)
+        self.changeChroot()
+        current = pinetLayers.scanTree(self.chroot, ["usr/share/doc/*"])
+        changed, removed, opaque = pinetLayers.findChanges(base, current)
+        self.assertEqual(changed, ["etc/hostname", "usr/bin/bluej", "usr/bin/python", "var/lib/changes", "var/lib/changes/inside"])
+        self.assertEqual(removed, ["opt/old"])
+        self.assertEqual(opaque, ["var/lib/changes"])
+
+    def test_buildStaging(self):
+        base = pinetLayers.scanTree(self.chroot)
+        self.changeChroot()
+        os.chmod(os.path.join(self.chroot, "usr", "bin"), 0o750)
+        current = pinetLayers.scanTree(self.chroot)
+        changed, removed, opaque = pinetLayers.findChanges(base, current)
+        staging = os.path.join(self.folder, "staging")
+        size = pinetLayers.buildStaging(self.chroot, staging, current, changed, removed, opaque)
+        self.assertEqual(size, sum(current[relative][4] for relative in changed if current[relative][0] == "f"))
+        self.assertEqual(os.stat(os.path.join(staging, "usr", "bin", "bluej")).st_ino, os.stat(os.path.join(self.chroot, "usr", "bin", "bluej")).st_ino)
+        self.assertFalse(os.path.exists(os.path.join(staging, "usr", "bin", "python-link")))  #Unchanged
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(staging, "usr", "bin")).st_mode), 0o750)
+        whiteout = os.lstat(os.path.join(staging, "opt", "old"))
+        self.assertTrue(stat.S_ISCHR(whiteout.st_mode))
+        self.assertEqual(whiteout.st_rdev, os.makedev(0, 0))
+        self.assertFalse(os.path.exists(os.path.join(staging, "usr", "share", "doc", "python", "README")))
+        if os.geteuid() == 0:
+            try:
+                self.assertEqual(os.getxattr(os.path.join(staging, "var", "lib", "changes"), pinetLayers.OPAQUE_XATTR), b"y")
+            except OSError:
+                pass  #trusted xattrs aren't supported on every filesystem tests run on
+
+class TestInitrd(TestLayers):
+
+    def makeInitrd(self, path):
+        entries = [("scripts", [1, stat.S_IFDIR | 0o755, 0, 0, 2, 0, 0, 0, 0, 0, 0, 0, 0], b""),
+                   ("scripts/init-bottom/ltsp", [2, stat.S_IFREG | 0o755, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0], b"#!/bin/sh\nltsp\n"),
+                   (pinetLayers.ORDER_PATH, [3, stat.S_IFREG | 0o644, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+                    b'/scripts/init-bottom/ltsp "$@"\n[ -e /conf/param.conf ] && . /conf/param.conf\n')]
+        with open(path, "wb") as f:
+            f.write(gzip.compress(pinetLayers.writeCpio(entries)))
+        return entries
+
+    def readInitrd(self, path):
+        with open(path, "rb") as f:
+            return dict((name, content) for name, fields, content in pinetLayers.readCpio(gzip.decompress(f.read())))
+
+    def test_cpio_round_trip(self):
+        entries = self.makeInitrd(os.path.join(self.folder, "initrd.img"))
+        data = pinetLayers.writeCpio(entries)
+        self.assertEqual(len(data) % 512, 0)
+        self.assertEqual([(name, content) for name, fields, content in pinetLayers.readCpio(data)], [(name, content) for name, fields, content in entries])
+
+    def test_enable_and_disable(self):
+        bootFiles = os.path.join(self.chroot, "bootfiles")
+        os.makedirs(bootFiles)
+        initrd = os.path.join(bootFiles, "initrd.img-3.18.0-trunk-rpi2")
+        self.makeInitrd(initrd)
+        with open(initrd, "rb") as f:
+            original = f.read()
+        target = pinetChroots.chrootTarget("armhf", path=self.chroot)
+        conf = os.path.join(self.folder, "conf.d")
+        images = os.path.join(self.folder, "images")
+        for i in range(2):  #Enabling twice doesn't add the script twice
+            self.assertEqual(pinetLayers.enable(target, images, conf), [initrd])
+        files = self.readInitrd(initrd)
+        order = files[pinetLayers.ORDER_PATH].decode().splitlines()
+        self.assertEqual(order[0], '/scripts/init-bottom/pinet-layers "$@"')
+        self.assertEqual(order.count('/scripts/init-bottom/pinet-layers "$@"'), 1)
+        self.assertEqual(order[2], '/scripts/init-bottom/ltsp "$@"')
+        self.assertIn(b'EXPORT="ltsp_armhf_delta"', files["scripts/init-bottom/pinet-layers"])
+        with open(os.path.join(conf, "ltsp_armhf_delta.conf")) as f:
+            self.assertIn("exportname = " + os.path.join(images, "armhf-delta.img"), f.read())
+        self.assertEqual(pinetLayers.unpatched(target), [])
+        self.makeInitrd(initrd)  #UpdateSD copies new boot files over the patched ones
+        self.assertEqual(pinetLayers.unpatched(target), [initrd])
+        pinetLayers.enable(target, images, conf)
+        self.assertEqual(pinetLayers.unpatched(target), [])
+        shutil.rmtree(bootFiles)  #Or removes them and copies them again
+        os.makedirs(bootFiles)
+        self.makeInitrd(initrd)
+        self.assertEqual(pinetLayers.unpatched(target), [initrd])
+        pinetLayers.enable(target, images, conf)
+        pinetLayers.disable(target, os.path.join(self.folder, "layers"), images, conf)
+        with open(initrd, "rb") as f:
+            self.assertEqual(f.read(), original)
+        self.assertEqual(os.listdir(conf), [])
+
+class TestRebuild(TestLayers):
+
+    def test_formatBuild(self):
+        build = {"kind": "delta", "changed": 12, "removed": 1, "imageSize": 2048, "duration": 9.0, "baseDuration": 300.0}
+        self.assertEqual(pinetLayers.formatBuild("armhf", build, str), "armhf: delta of 12 changed and 1 removed files, 2048, built in 9s, saving about 291s on a full build")
+
+    @unittest.skipUnless(shutil.which("mksquashfs"), "needs squashfs-tools")
+    def test_delta_build(self):
+        layers = os.path.join(self.folder, "layers")
+        images = os.path.join(self.folder, "images")
+        os.makedirs(images)
+        base = pinetLayers.scanTree(self.chroot)
+        base[""] = pinetLayers.scanRoot(self.chroot)
+        self.changeChroot()
+        build = pinetLayers.buildDelta(self.chroot, "armhf", base, layersFolder=layers, imageFolder=images)
+        self.assertEqual((build["changed"], build["removed"]), (6, 1))
+        self.assertTrue(os.path.exists(pinetLayers.deltaImagePath("armhf", images)))
+        self.assertFalse(os.path.exists(os.path.join(layers, "armhf", "staging")))
+
+if __name__ == '__main__':
+    unittest.main()
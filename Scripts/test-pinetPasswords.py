@@ -0,0 +1,133 @@
+#!python3
+import os, sys
+import stat
+import subprocess
+import unittest
+import warnings
+
+import pinetPasswords
+import testHelpers
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        import crypt
+except ImportError:
+    crypt = None
+
+SHADOW = """root:!:19000:0:99999:7:::
+daemon:*:19000:0:99999:7:::
+alice:$6$old$hash:19000:0:99999:7:::
+bob:$6$old$hash:19000:0:99999:7:::
+carol:$6$old$hash:19000:0:99999:7:::
+"""
+
+class TestPasswords(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.shadow = os.path.join(self.folder, "shadow")
+        self.lock = os.path.join(self.folder, ".pwd.lock")
+        with open(self.shadow, "w") as f:
+            f.write(SHADOW)
+        os.chmod(self.shadow, 0o640)
+
+    def read_shadow(self):
+        entries = {}
+        with open(self.shadow) as f:
+            for line in f:
+                fields = line.rstrip("\n").split(":")
+                entries[fields[0]] = fields
+        return entries
+
+class TestHashing(TestPasswords):
+
+    def test_specification_vectors(self):
+        self.assertEqual(pinetPasswords.sha512Crypt("Hello world!", "saltstring"),
+                         "$6$saltstring$svn8UoSVapNtMuq1ukKS4tPQd8iKwSMHWjl/O817G3uBnIFNjnQJuesI68u4OTLiBFdcbYEdFCoEOfaS35inz1")
+        self.assertEqual(pinetPasswords.sha512Crypt("Hello world!", "saltstringsaltstring", 10000),
+                         "$6$rounds=10000$saltstringsaltst$OW1/O6BYHV6BcXZu8QVeXbDWra3Oeqh0sbHbbMCVNSnCM/UrjmM0Dp8vOuZeHBy/YTBmSK6H9qs/y3RnOaw5v.")
+
+    @unittest.skipIf(crypt is None, "No crypt module")
+    def test_matches_crypt(self):
+        for password in ["", "a", "pupil2016", "x" * 80, "pässwörd"]:
+            self.assertEqual(pinetPasswords.sha512Crypt(password, "Q9xYz"), crypt.crypt(password, "$6$Q9xYz"))
+
+    def test_hashAll(self):
+        passwords = ["password%d" % i for i in range(6)]
+        hashes = pinetPasswords.hashAll(passwords, workers=2)
+        for password, hashed in zip(passwords, hashes):
+            salt = hashed.split("$")[2]
+            self.assertEqual(len(salt), 16)
+            self.assertEqual(pinetPasswords.sha512Crypt(password, salt), hashed)
+
+    def test_generatePassword(self):
+        password = pinetPasswords.generatePassword()
+        self.assertEqual(len(password), pinetPasswords.PASSWORD_LENGTH)
+        self.assertTrue(all(character in pinetPasswords.PASSWORD_CHARACTERS for character in password))
+
+class TestChoosingUsers(TestPasswords):
+
+    def test_readCSV(self):
+        filepath = os.path.join(self.folder, "class.csv")
+        with open(filepath, "w") as f:
+            f.write("alice,Secret1\nbob\n# a comment\n\ncarol, \n")
+        self.assertEqual(pinetPasswords.readCSV(filepath), [("alice", "Secret1"), ("bob", ""), ("carol", "")])
+
+    def test_assignPasswords(self):
+        pairs = pinetPasswords.assignPasswords([("alice", "Secret1"), "bob"], "Class7")
+        self.assertEqual(pairs, [("alice", "Secret1"), ("bob", "Class7")])
+        pairs = dict(pinetPasswords.assignPasswords(["alice", "bob"]))
+        self.assertNotEqual(pairs["alice"], pairs["bob"])
+
+class TestShadow(TestPasswords):
+
+    def test_updateShadow(self):
+        missing = pinetPasswords.updateShadow({"alice": "$6$a$new", "carol": "$6$c$new", "nobody": "$6$n$new"}, self.shadow, self.lock, now=86400 * 20000)
+        self.assertEqual(missing, ["nobody"])
+        entries = self.read_shadow()
+        self.assertEqual(entries["alice"][1:3], ["$6$a$new", "20000"])
+        self.assertEqual(entries["carol"][1], "$6$c$new")
+        self.assertEqual(entries["bob"][1:3], ["$6$old$hash", "19000"])
+        self.assertEqual(entries["root"], ["root", "!", "19000", "0", "99999", "7", "", "", ""])
+        self.assertEqual(stat.S_IMODE(os.stat(self.shadow).st_mode), 0o640)
+        with open(self.shadow + "-") as f:
+            self.assertEqual(f.read(), SHADOW)
+        self.assertFalse(os.path.exists(self.shadow + "+"))
+
+    def test_lock_held(self):
+        holder = subprocess.Popen([sys.executable, "-c", "import fcntl, os, sys, time\n"
+                                   "fd = os.open(sys.argv[1], os.O_WRONLY | os.O_CREAT)\n"
+                                   "fcntl.lockf(fd, fcntl.LOCK_EX)\n"
+                                   "print('locked', flush=True)\n"
+                                   "time.sleep(5)\n", self.lock], stdout=subprocess.PIPE)
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.kill)
+        self.assertEqual(holder.stdout.readline().strip(), b"locked")
+        holder.stdout.close()
+        with self.assertRaises(RuntimeError):
+            with pinetPasswords.shadowLock(self.lock, timeout=0.3):
+                pass
+
+    def test_resetPasswords(self):
+        pairs = [("alice", "Secret1"), ("bob", "Secret2"), ("ghost", "Secret3")]
+        changed, missing = pinetPasswords.resetPasswords(pairs, self.shadow, self.lock, dryRun=True)
+        self.assertEqual((changed, missing), (["alice", "bob"], ["ghost"]))
+        with open(self.shadow) as f:
+            self.assertEqual(f.read(), SHADOW)
+        changed, missing = pinetPasswords.resetPasswords(pairs, self.shadow, self.lock)
+        self.assertEqual((changed, missing), (["alice", "bob"], ["ghost"]))
+        hashed = self.read_shadow()["bob"][1]
+        self.assertEqual(pinetPasswords.sha512Crypt("Secret2", hashed.split("$")[2]), hashed)
+
+    def test_writeSlips(self):
+        filepath = pinetPasswords.writeSlips([("alice", "Secret1"), ("bob", "Secret2")], os.path.join(self.folder, "slips.txt"), "7B")
+        self.assertEqual(stat.S_IMODE(os.stat(filepath).st_mode), 0o600)
+        with open(filepath) as f:
+            text = f.read()
+        self.assertIn("Username: bob", text)
+        self.assertIn("Password: Secret1", text)
+        self.assertEqual(text.count("7B"), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!python3
+import os
+import pwd
+import unittest
+
+import pinetProvision
+import testHelpers
+
+class TestProvision(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.manifest = os.path.join(self.folder, "pinet-provision.json")
+        self.stamps = os.path.join(self.folder, "provisioned")
+        self.home = os.path.join(self.folder, "home")
+        os.makedirs(self.home)
+        self.user = pwd.getpwuid(os.geteuid()).pw_name
+        self.skel = os.path.join(self.folder, "skel")
+        os.makedirs(os.path.join(self.skel, "python_games"))
+        self.write(os.path.join(self.skel, "pinet-password.desktop"), "[Desktop Entry]\n")
+        self.write(os.path.join(self.skel, "python_games", "launcher.sh"), "echo games\n")
+
+    def write(self, filepath, text):
+        with open(filepath, "w") as f:
+            f.write(text)
+
+    def provision(self):
+        return pinetProvision.provisionUser(self.user, self.manifest, self.stamps, self.home)
+
+class TestManifest(TestProvision):
+
+    def test_addItem_bumps_version(self):
+        self.assertTrue(pinetProvision.addItem("password", os.path.join(self.skel, "pinet-password.desktop"), "Desktop/pinet-password.desktop", manifestPath=self.manifest))
+        self.assertTrue(pinetProvision.addItem("games", os.path.join(self.skel, "python_games"), "python_games", manifestPath=self.manifest))
+        manifest = pinetProvision.loadManifest(self.manifest)
+        self.assertEqual(manifest.version, 2)
+        self.assertEqual(manifest.items["password"].version, 1)
+        self.assertEqual(manifest.items["games"].version, 2)
+
+    def test_addItem_unchanged(self):
+        source = os.path.join(self.skel, "pinet-password.desktop")
+        pinetProvision.addItem("password", source, "Desktop/pinet-password.desktop", manifestPath=self.manifest)
+        self.assertFalse(pinetProvision.addItem("password", source, "Desktop/pinet-password.desktop", manifestPath=self.manifest))
+        self.assertEqual(pinetProvision.loadManifest(self.manifest).version, 1)
+
+    def test_removeItem(self):
+        pinetProvision.addItem("password", os.path.join(self.skel, "pinet-password.desktop"), "Desktop/pinet-password.desktop", manifestPath=self.manifest)
+        self.assertTrue(pinetProvision.removeItem("password", self.manifest))
+        self.assertFalse(pinetProvision.removeItem("password", self.manifest))
+        manifest = pinetProvision.loadManifest(self.manifest)
+        self.assertEqual(manifest.version, 2)
+        self.assertEqual(manifest.items, {})
+
+    def test_target_outside_home(self):
+        self.assertRaises(ValueError, pinetProvision.provisionItem, "bad", "/etc/passwd", "../../etc/passwd")
+        self.assertRaises(ValueError, pinetProvision.provisionItem, "bad", "/etc/passwd", "/etc/passwd")
+
+class TestProvisionUser(TestProvision):
+
+    def test_provision_once(self):
+        pinetProvision.addItem("password", os.path.join(self.skel, "pinet-password.desktop"), "Desktop/pinet-password.desktop", manifestPath=self.manifest)
+        pinetProvision.addItem("games", os.path.join(self.skel, "python_games"), "python_games", manifestPath=self.manifest)
+        self.assertTrue(pinetProvision.needsProvisioning(self.user, self.manifest, self.stamps))
+        self.assertEqual(sorted(self.provision()), ["games", "password"])
+        self.assertTrue(os.path.isfile(os.path.join(self.home, "Desktop", "pinet-password.desktop")))
+        self.assertTrue(os.path.isfile(os.path.join(self.home, "python_games", "launcher.sh")))
+        self.assertFalse(pinetProvision.needsProvisioning(self.user, self.manifest, self.stamps))
+        self.assertEqual(self.provision(), [])
+
+    def test_only_changed_items(self):
+        source = os.path.join(self.skel, "pinet-password.desktop")
+        pinetProvision.addItem("password", source, "Desktop/pinet-password.desktop", manifestPath=self.manifest)
+        pinetProvision.addItem("games", os.path.join(self.skel, "python_games"), "python_games", manifestPath=self.manifest)
+        self.provision()
+        self.write(source, "[Desktop Entry]\nVersion=1.2\n")
+        os.utime(source, (0, 0))
+        pinetProvision.addItem("password", source, "Desktop/pinet-password.desktop", manifestPath=self.manifest)
+        self.assertEqual(self.provision(), ["password"])
+        with open(os.path.join(self.home, "Desktop", "pinet-password.desktop")) as f:
+            self.assertIn("Version=1.2", f.read())
+
+    def test_groups(self):
+        pinetProvision.addItem("teacher-only", os.path.join(self.skel, "pinet-password.desktop"), "Desktop/pinet.desktop", ["no-such-group-here"], manifestPath=self.manifest)
+        self.assertEqual(self.provision(), [])
+        self.assertFalse(os.path.exists(os.path.join(self.home, "Desktop", "pinet.desktop")))
+        self.assertFalse(pinetProvision.needsProvisioning(self.user, self.manifest, self.stamps))
+
+    def test_resetUser(self):
+        pinetProvision.addItem("password", os.path.join(self.skel, "pinet-password.desktop"), "Desktop/pinet-password.desktop", manifestPath=self.manifest)
+        self.provision()
+        pinetProvision.resetUser(self.user, self.stamps)
+        self.assertTrue(pinetProvision.needsProvisioning(self.user, self.manifest, self.stamps))
+
+    def test_missing_source_is_retried(self):
+        pinetProvision.addItem("later", os.path.join(self.skel, "later.desktop"), "Desktop/later.desktop", manifestPath=self.manifest)
+        self.assertEqual(self.provision(), [])
+        self.assertTrue(pinetProvision.needsProvisioning(self.user, self.manifest, self.stamps))
+        self.write(os.path.join(self.skel, "later.desktop"), "[Desktop Entry]\n")
+        self.assertEqual(self.provision(), ["later"])
+
+    @unittest.skipUnless(os.geteuid() == 0, "Needs root to switch user")
+    def test_copy_as_user(self):
+        nobody = pwd.getpwnam("nobody")
+        os.chown(self.home, nobody.pw_uid, nobody.pw_gid)
+        os.chmod(self.folder, 0o755)
+        item = pinetProvision.provisionItem("password", os.path.join(self.skel, "pinet-password.desktop"), "Desktop/pinet-password.desktop")
+        applied = pinetProvision.copyItemsAsUser([item], self.home, nobody.pw_uid, nobody.pw_gid, [nobody.pw_gid])
+        self.assertEqual(applied, ["password"])
+        self.assertEqual(os.stat(os.path.join(self.home, "Desktop", "pinet-password.desktop")).st_uid, nobody.pw_uid)
+
+if __name__ == '__main__':
+    unittest.main()
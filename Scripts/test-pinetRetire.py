@@ -0,0 +1,144 @@
+#!python3
+import os
+import shutil
+import time
+import unittest
+
+import pinetRetire
+import testHelpers
+
+PASSWD = """root:x:0:0:root:/root:/bin/bash
+teacher:x:1000:1000::/home/teacher:/bin/bash
+alice:x:1001:1001::/home/alice:/bin/bash
+bob:x:1002:1002::/home/bob:/bin/bash
+carol:x:1003:100::/home/carol:/bin/bash
+"""
+
+SHADOW = """root:!:19000:0:99999:7:::
+teacher:$6$t$hash:19000:0:99999:7:::
+alice:$6$a$hash:19000:0:99999:7:::
+bob:$6$b$hash:19000:0:99999:7:::
+carol:$6$c$hash:19000:0:99999:7:::
+"""
+
+GROUP = """root:x:0:
+users:x:100:
+audio:x:29:teacher,alice,bob
+pupil:x:1500:alice,bob,carol
+teacher:x:1000:
+alice:x:1001:
+bob:x:1002:
+"""
+
+GSHADOW = """root:*::
+users:*::
+audio:*::teacher,alice,bob
+pupil:!:teacher:alice,bob,carol
+teacher:!::
+alice:!::
+bob:!::
+"""
+
+class TestRetire(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.etc = os.path.join(self.folder, "etc")
+        self.homes = os.path.join(self.folder, "home")
+        self.archives = os.path.join(self.folder, "archives")
+        os.makedirs(self.etc)
+        for name, text in [("passwd", PASSWD), ("shadow", SHADOW), ("group", GROUP), ("gshadow", GSHADOW)]:
+            with open(os.path.join(self.etc, name), "w") as f:
+                f.write(text.replace("/home/", self.homes + "/"))
+        for user in ["teacher", "alice", "bob", "carol"]:
+            os.makedirs(os.path.join(self.homes, user, "work"))
+            with open(os.path.join(self.homes, user, "work", "project.py"), "w") as f:
+                f.write("print('" + user + "')\n")
+
+    def read(self, name):
+        with open(os.path.join(self.etc, name)) as f:
+            return f.read()
+
+    def retire(self, users):
+        return pinetRetire.retireUsers(users, self.etc, homeRoot=self.homes, archiveRoot=self.archives)
+
+class TestAccounts(TestRetire):
+
+    def test_removeAccounts(self):
+        removed = pinetRetire.removeAccounts(["alice", "bob", "nobody"], self.etc)
+        self.assertEqual(sorted(removed), ["alice", "bob"])
+        self.assertEqual(removed["alice"]["groups"], ["audio", "pupil"])
+        self.assertNotIn("alice", self.read("passwd"))
+        self.assertNotIn("bob", self.read("shadow"))
+        self.assertIn("audio:x:29:teacher\n", self.read("group"))
+        self.assertIn("pupil:x:1500:carol\n", self.read("group"))
+        self.assertNotIn("\nalice:", self.read("group"))
+        self.assertIn("pupil:!:teacher:carol\n", self.read("gshadow"))
+        self.assertNotIn("\nbob:", self.read("gshadow"))
+        self.assertIn("users:x:100:\n", self.read("group"))
+        with open(os.path.join(self.etc, "passwd-")) as f:
+            self.assertIn("alice", f.read())
+
+    def test_restoreAccount(self):
+        removed = pinetRetire.removeAccounts(["alice"], self.etc)
+        pinetRetire.restoreAccount("alice", removed["alice"], self.etc)
+        self.assertEqual(sorted(self.read("passwd").splitlines()), sorted(PASSWD.replace("/home/", self.homes + "/").splitlines()))
+        self.assertEqual(sorted(self.read("shadow").splitlines()), sorted(SHADOW.splitlines()))
+        self.assertIn("audio:x:29:teacher,bob,alice\n", self.read("group"))
+        self.assertIn("alice:x:1001:\n", self.read("group"))
+        self.assertIn("alice:!::\n", self.read("gshadow"))
+
+    def test_restore_reused_uid(self):
+        removed = pinetRetire.removeAccounts(["alice"], self.etc)
+        with open(os.path.join(self.etc, "passwd"), "a") as f:
+            f.write("dave:x:1001:1001::/home/dave:/bin/bash\n")
+        with self.assertRaises(ValueError):
+            pinetRetire.restoreAccount("alice", removed["alice"], self.etc)
+
+    def test_cohortMembers(self):
+        entries = [line.split(":") for line in self.read("passwd").splitlines()]
+        september = time.mktime((2015, 9, 3, 12, 0, 0, 0, 0, -1))
+        for user in ["alice", "bob"]:
+            profile = os.path.join(self.homes, user, ".profile")
+            open(profile, "w").close()
+            os.utime(profile, (september, september))
+        self.assertEqual(pinetRetire.cohortMembers("2015", entries), ["alice", "bob"])
+        self.assertEqual(pinetRetire.cohortMembers("2015-09", entries), ["alice", "bob"])
+        self.assertEqual(pinetRetire.cohortMembers("2015-10", entries), [])
+
+class TestBatches(TestRetire):
+
+    def test_retire_archive_restore(self):
+        manifest = self.retire(["alice", "bob"])
+        batch = manifest["batch"]
+        self.assertFalse(os.path.exists(os.path.join(self.homes, "alice")))
+        self.assertTrue(os.path.isdir(os.path.join(self.homes, pinetRetire.STAGING_NAME, batch, "alice", "work")))
+        self.assertEqual(pinetRetire.batchStatus(manifest), {"staged": 2})
+        self.assertEqual(pinetRetire.archiveBatch(batch, self.archives, workers=2), {"archived": 2})
+        self.assertFalse(os.path.exists(os.path.join(self.homes, pinetRetire.STAGING_NAME, batch)))
+        self.assertTrue(os.path.isfile(os.path.join(self.archives, batch, "bob.tar.gz")))
+        with open(pinetRetire.progressLogPath(batch, self.archives)) as f:
+            self.assertIn("bob archived", f.read())
+        self.assertEqual(pinetRetire.listBatches(self.archives), [batch])
+        home = pinetRetire.restoreUser(batch, "bob", self.etc, archiveRoot=self.archives)
+        with open(os.path.join(home, "work", "project.py")) as f:
+            self.assertEqual(f.read(), "print('bob')\n")
+        self.assertIn("bob:x:1002", self.read("passwd"))
+        self.assertEqual(pinetRetire.batchStatus(pinetRetire.loadManifest(batch, self.archives)), {"archived": 1, "restored": 1})
+
+    def test_restore_before_archiving(self):
+        batch = self.retire(["carol"])["batch"]
+        pinetRetire.restoreUser(batch, "carol", self.etc, archiveRoot=self.archives)
+        self.assertTrue(os.path.isfile(os.path.join(self.homes, "carol", "work", "project.py")))
+        self.assertIn("pupil:x:1500:alice,bob,carol\n", self.read("group"))
+        self.assertEqual(pinetRetire.archiveBatch(batch, self.archives), {"restored": 1})
+        with self.assertRaises(ValueError):
+            pinetRetire.restoreUser(batch, "carol", self.etc, archiveRoot=self.archives)
+
+    def test_missing_home(self):
+        shutil.rmtree(os.path.join(self.homes, "alice"))
+        manifest = self.retire(["alice"])
+        self.assertEqual(pinetRetire.batchStatus(manifest), {"removed": 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!python3
+import os, sys
+import tempfile
+import time
+import unittest
+
+import pinetRunner
+
+class TestRunner(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.logpath = tempfile.mktemp()
+        self.addCleanup(self.remove, self.logpath)
+
+    def remove(self, filepath):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    def read_log(self):
+        with open(self.logpath) as f:
+            return f.read()
+
+class TestRunCommand(TestRunner):
+
+    def test_argument_list(self):
+        result = pinetRunner.runCommand([sys.executable, "-c", "print('hello world')"])
+        self.assertTrue(result.ok)
+        self.assertEqual(["hello world"], result.output)
+
+    def test_argument_list_is_not_shell(self):
+        result = pinetRunner.runCommand(["echo", "$HOME;", "true"])
+        self.assertEqual(["$HOME; true"], result.output)
+
+    def test_shell(self):
+        result = pinetRunner.runCommand("echo one && echo two", shell=True)
+        self.assertEqual(["one", "two"], result.output)
+
+    def test_returncode(self):
+        result = pinetRunner.runCommand([sys.executable, "-c", "import sys; sys.exit(3)"])
+        self.assertFalse(result.ok)
+        self.assertEqual(3, result.returncode)
+
+    def test_missing_program(self):
+        result = pinetRunner.runCommand(["pinet-does-not-exist"])
+        self.assertEqual(127, result.returncode)
+
+    def test_input(self):
+        result = pinetRunner.runCommand(["cat"], inputText="typed\n")
+        self.assertEqual(["typed"], result.output)
+
+    def test_timeout(self):
+        started = time.time()
+        result = pinetRunner.runCommand("sleep 10; echo finished", shell=True, timeout=0.5)
+        self.assertTrue(result.timedOut)
+        self.assertFalse(result.ok)
+        self.assertLess(time.time() - started, 5)
+        self.assertNotIn("finished", result.output)
+
+    def test_output_is_bounded_but_logged(self):
+        result = pinetRunner.runCommand(["seq", "1", "1000"], logPath=self.logpath, maxLines=10)
+        self.assertEqual([str(i) for i in range(991, 1001)], result.output)
+        log = self.read_log()
+        self.assertIn("$ seq 1 1000", log)
+        self.assertIn("    1\n", log)
+        self.assertIn("    1000\n", log)
+        self.assertIn("exit code 0", log)
+
+    def test_attached(self):
+        code = "import os, sys; sys.exit(0 if os.getsid(0) == %d else 1)" % os.getsid(0)
+        result = pinetRunner.runCommand([sys.executable, "-c", code], logPath=self.logpath, attached=True)
+        self.assertTrue(result.ok)  #Still in our session, so Ctrl-C reaches it
+        self.assertEqual([], result.output)
+        self.assertIn("exit code 0", self.read_log())
+        result = pinetRunner.runCommand("sleep 10", shell=True, timeout=0.5, attached=True)
+        self.assertTrue(result.timedOut)
+
+class TestRetry(TestRunner):
+
+    def test_retry_until_success(self):
+        counter = tempfile.mktemp()
+        self.addCleanup(self.remove, counter)
+        script = "import os, sys\n" \
+                 "n = int(open(%r).read()) if os.path.exists(%r) else 0\n" \
+                 "open(%r, 'w').write(str(n + 1))\n" \
+                 "sys.exit(0 if n >= 2 else 1)\n" % (counter, counter, counter)
+        result = pinetRunner.runCommand([sys.executable, "-c", script], retry=pinetRunner.retryPolicy(attempts=5, delay=0.01))
+        self.assertTrue(result.ok)
+        self.assertEqual(3, result.attempts)
+
+    def test_retry_gives_up(self):
+        result = pinetRunner.runCommand(["false"], retry=pinetRunner.retryPolicy(attempts=2, delay=0.01))
+        self.assertFalse(result.ok)
+        self.assertEqual(2, result.attempts)
+
+    def test_retry_codes(self):
+        policy = pinetRunner.retryPolicy(attempts=3, delay=0.01, retryCodes=[100])
+        result = pinetRunner.runCommand(["false"], retry=policy)
+        self.assertEqual(1, result.attempts)
+
+class TestBatch(TestRunner):
+
+    def test_batch_runs_concurrently(self):
+        started = time.time()
+        batch = pinetRunner.runBatch([("a", ["sleep", "0.5"]), ("b", ["sleep", "0.5"]), ("c", ["sleep", "0.5"])], workers=3)
+        self.assertLess(time.time() - started, 1.4)
+        self.assertTrue(batch.ok)
+        self.assertEqual(["a", "b", "c"], [result.name for result in batch.results])
+
+    def test_batch_combined_result(self):
+        batch = pinetRunner.runBatch([["true"], ["false"], "echo shell"], workers=2, shell=False)
+        self.assertFalse(batch.ok)
+        self.assertEqual(1, len(batch.failed))
+        self.assertEqual(["shell"], batch.results[2].output)
+        self.assertIn("2 of 3 commands succeeded", batch.summary()[-1])
+
+if __name__ == '__main__':
+    unittest.main()
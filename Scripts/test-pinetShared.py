@@ -0,0 +1,189 @@
+#!python3
+import os
+import unittest
+
+import pinetShared
+import testHelpers
+
+MOUNTINFO = """\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw
+40 22 0:35 / /home/shared/Maths rw,nosuid,nodev,relatime shared:20 - fuse bindfs rw,user_id=0,group_id=0,default_permissions,allow_other
+41 22 0:36 / /home/shared/Year\\0407 rw,nosuid,nodev,relatime shared:21 - fuse.bindfs bindfs rw,user_id=0,group_id=0
+42 22 0:37 / /home/shared/Old rw,nosuid,nodev,relatime shared:22 - fuse bindfs rw,user_id=0,group_id=0
+43 22 0:38 / /home/shared/Other rw,relatime shared:23 - nfs server:/export rw
+44 22 0:39 / /home/other/Maths rw,relatime shared:24 - fuse bindfs rw
+"""
+
+class TestShared(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.shared = os.path.join(self.folder, "shared")
+        self.registry = os.path.join(self.folder, "pinet-shared")
+        self.state = os.path.join(self.folder, "run", "pinet-shared.state")
+        self.mountinfo = os.path.join(self.folder, "mountinfo")
+        for name in ["Maths", "Year 7", "Science"]:
+            os.makedirs(os.path.join(self.shared, name))
+        with open(self.mountinfo, "w") as f:
+            f.write(MOUNTINFO.replace("/home/shared", self.shared))
+
+class TestRegistry(TestShared):
+
+    def test_round_trip(self):
+        pinetShared.setFolder("Maths", "write", registryPath=self.registry)
+        pinetShared.setFolder("Year 7", "read", "year7", registryPath=self.registry)
+        folders = pinetShared.loadRegistry(self.registry)
+        self.assertEqual(folders["Maths"], pinetShared.sharedFolder("Maths", "write", "pupil"))
+        self.assertEqual(folders["Year 7"].mountOptions(), "perms=0775,force-group=year7")
+
+    def test_remove(self):
+        pinetShared.setFolder("Maths", "read", registryPath=self.registry)
+        self.assertTrue(pinetShared.removeFolder("Maths", self.registry))
+        self.assertFalse(pinetShared.removeFolder("Maths", self.registry))
+        self.assertEqual(pinetShared.loadRegistry(self.registry), {})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, pinetShared.sharedFolder, "a/b")
+        self.assertRaises(ValueError, pinetShared.sharedFolder, "Maths", "everything")
+
+    def test_unknownFolders(self):
+        pinetShared.setFolder("Maths", "read", registryPath=self.registry)
+        self.assertEqual(pinetShared.unknownFolders(self.shared, self.registry), ["Science", "Year 7"])
+
+    def test_migrateLegacyScript(self):
+        script = os.path.join(self.folder, "bindfs-mount")
+        with open(script, "w") as f:
+            f.write("bindfs -o perms=0775,force-group=pupil /home/shared/Maths /home/shared/Maths\n")
+            f.write("\n")
+            f.write("bindfs -o perms=0775,force-group=teacher /home/shared/Year 7 /home/shared/Year 7\n")
+        pinetShared.setFolder("Maths", "read", registryPath=self.registry)
+        self.assertEqual(pinetShared.migrateLegacyScript(script, "/home/shared", self.registry), 1)
+        folders = pinetShared.loadRegistry(self.registry)
+        self.assertEqual(folders["Maths"].level, "read")
+        self.assertEqual(folders["Year 7"], pinetShared.sharedFolder("Year 7", "read", "teacher"))
+        self.assertFalse(os.path.exists(script))
+        self.assertEqual(pinetShared.migrateLegacyScript(script, "/home/shared", self.registry), 0)
+
+class TestMounts(TestShared):
+
+    def test_bindfsMounts(self):
+        mounted = pinetShared.bindfsMounts(self.shared, self.mountinfo)
+        self.assertEqual(mounted, set(os.path.join(self.shared, name) for name in ["Maths", "Year 7", "Old"]))
+
+    def test_plan(self):
+        pinetShared.setFolder("Maths", "write", registryPath=self.registry)
+        pinetShared.setFolder("Year 7", "read", registryPath=self.registry)
+        pinetShared.setFolder("Science", "read", registryPath=self.registry)
+        pinetShared.setFolder("Missing", "read", registryPath=self.registry)
+        state = {os.path.join(self.shared, "Maths"): "perms=0775,force-group=pupil",
+                 os.path.join(self.shared, "Year 7"): "perms=0775,force-group=pupil"}
+        plan = pinetShared.planMounts(pinetShared.loadRegistry(self.registry), pinetShared.bindfsMounts(self.shared, self.mountinfo), state, self.shared)
+        self.assertEqual([folder.name for folder in plan.mount], ["Science"])
+        self.assertEqual([folder.name for folder in plan.remount], ["Year 7"])
+        self.assertEqual(plan.unmount, [os.path.join(self.shared, "Old")])
+
+    def test_reconcile(self):
+        self.addCleanup(setattr, pinetShared, "BINDFS", pinetShared.BINDFS)
+        self.addCleanup(setattr, pinetShared, "UMOUNT", pinetShared.UMOUNT)
+        pinetShared.BINDFS = "true"
+        pinetShared.UMOUNT = "true"
+        pinetShared.setFolder("Maths", "write", registryPath=self.registry)
+        pinetShared.setFolder("Science", "read", registryPath=self.registry)
+        plan = pinetShared.reconcile(self.shared, self.registry, self.state, self.mountinfo)
+        self.assertTrue(plan.ok)
+        self.assertEqual(len(plan.results), 5)
+        state = pinetShared.loadState(self.state)
+        self.assertEqual(state[os.path.join(self.shared, "Maths")], "perms=0775,force-group=pupil")
+        self.assertEqual(state[os.path.join(self.shared, "Science")], "perms=0775,force-group=teacher")
+        self.assertNotIn(os.path.join(self.shared, "Old"), state)
+
+    def test_reconcile_nothing_to_do(self):
+        pinetShared.setFolder("Maths", "write", registryPath=self.registry)
+        pinetShared.setFolder("Year 7", "read", registryPath=self.registry)
+        with open(self.mountinfo, "w") as f:
+            f.write(MOUNTINFO.replace("/home/shared", self.shared).replace("/Old", "/Gone").replace(self.shared + "/Gone", "/mnt/Gone"))
+        pinetShared.saveState({os.path.join(self.shared, "Maths"): "perms=0775,force-group=pupil",
+                               os.path.join(self.shared, "Year 7"): "perms=0775,force-group=teacher"}, self.state)
+        plan = pinetShared.reconcile(self.shared, self.registry, self.state, self.mountinfo)
+        self.assertTrue(plan.empty)
+        self.assertEqual(plan.results, [])
+
+class TestAcl(TestShared):
+
+    def test_backend(self):
+        pinetShared.setFolder("Maths", "write", registryPath=self.registry, defaultBackend="acl")
+        pinetShared.setFolder("Science", "read", registryPath=self.registry)
+        pinetShared.setFolder("Maths", "read", registryPath=self.registry)  #Keeps its backend
+        folders = pinetShared.loadRegistry(self.registry)
+        self.assertEqual(folders["Maths"].registryLine(), "Maths:read:teacher:acl")
+        self.assertEqual(folders["Science"].registryLine(), "Science:read:teacher")
+        self.assertEqual([folder.name for folder in pinetShared.setBackend("acl", registryPath=self.registry)], ["Science"])
+        self.assertRaises(ValueError, pinetShared.sharedFolder, "Maths", "read", None, "nfs")
+
+    def test_plan(self):
+        pinetShared.setFolder("Maths", "write", registryPath=self.registry, backend="acl")
+        pinetShared.setFolder("Science", "read", registryPath=self.registry, backend="acl")
+        aclState = {os.path.join(self.shared, "Science"): pinetShared.sharedFolder("Science", "read").aclSpec()}
+        plan = pinetShared.planMounts(pinetShared.loadRegistry(self.registry), pinetShared.bindfsMounts(self.shared, self.mountinfo), {}, self.shared, aclState)
+        self.assertEqual([folder.name for folder in plan.acl], ["Maths"])
+        self.assertEqual(plan.mount, [])
+        self.assertIn(os.path.join(self.shared, "Maths"), plan.unmount)  #bindfs comes off first
+        plan = pinetShared.planMounts(pinetShared.loadRegistry(self.registry), set(), {}, self.shared, aclState, repair=True)
+        self.assertEqual([folder.name for folder in plan.acl], ["Maths", "Science"])
+
+    def test_measure(self):
+        times = pinetShared.measure(os.path.join(self.shared, "Science"), files=20, size=100)
+        self.assertEqual(sorted(times), ["create", "delete", "list", "read", "stat"])
+        self.assertEqual(os.listdir(os.path.join(self.shared, "Science")), [])
+        lines = pinetShared.formatBenchmark({"acl": times, "bindfs": times}, 20)
+        self.assertIn("1.0x", lines[-1])
+
+@unittest.skipUnless(hasattr(os, "geteuid") and os.geteuid() == 0, "needs root to change groups")
+class TestApplyAcl(TestShared):
+
+    def setUp(self):
+        super().setUp()
+        self.maths = os.path.join(self.shared, "Maths")
+        if not pinetShared.aclSupported(self.maths):
+            self.skipTest("needs a filesystem with POSIX ACLs")
+        os.makedirs(os.path.join(self.maths, "worksheets"))
+        for name, mode in (("notes.txt", 0o644), ("worksheets/game.py", 0o755)):
+            with open(os.path.join(self.maths, name), "w") as f:
+                f.write("x")
+            os.chmod(os.path.join(self.maths, name), mode)
+        os.symlink("/etc/passwd", os.path.join(self.maths, "link"))
+
+    def test_applyAcl(self):
+        count, errors = pinetShared.applyAcl(self.maths, 4321)
+        self.assertEqual((count, errors), (4, []))
+        self.assertEqual(os.stat(os.path.join(self.maths, "worksheets")).st_mode & 0o7777, 0o2775)
+        self.assertEqual(os.stat(os.path.join(self.maths, "notes.txt")).st_mode & 0o777, 0o664)  #Group write, no execute added
+        self.assertEqual(os.stat(os.path.join(self.maths, "worksheets", "game.py")).st_mode & 0o777, 0o775)
+        self.assertEqual(os.stat(os.path.join(self.maths, "notes.txt")).st_gid, 4321)
+        self.assertNotEqual(os.lstat(os.path.join(self.maths, "link")).st_gid, 4321)
+        self.assertEqual(os.getxattr(self.maths, pinetShared.ACL_DEFAULT), pinetShared.defaultAcl(4321))
+        previous = os.umask(0o022)
+        try:
+            with open(os.path.join(self.maths, "worksheets", "new.txt"), "w") as f:
+                f.write("x")
+        finally:
+            os.umask(previous)
+        info = os.stat(os.path.join(self.maths, "worksheets", "new.txt"))
+        self.assertEqual((info.st_gid, info.st_mode & 0o777), (4321, 0o664))  #From the setgid folder and default ACL, whatever the umask
+
+    def test_reconcile(self):
+        self.addCleanup(setattr, pinetShared, "UMOUNT", pinetShared.UMOUNT)
+        pinetShared.UMOUNT = "true"
+        aclState = os.path.join(self.folder, "shared-acl.state")
+        pinetShared.setFolder("Maths", "write", "root", registryPath=self.registry, backend="acl")
+        plan = pinetShared.reconcile(self.shared, self.registry, self.state, self.mountinfo, aclStatePath=aclState)
+        self.assertTrue(plan.ok)
+        self.assertEqual([(folder.name, count) for folder, count, errors in plan.aclResults], [("Maths", 4)])
+        with open(self.mountinfo, "w") as f:
+            f.write(MOUNTINFO.splitlines()[0] + "\n")  #bindfs is no longer mounted over it
+        self.assertTrue(pinetShared.reconcile(self.shared, self.registry, self.state, self.mountinfo, aclStatePath=aclState).empty)
+        plan = pinetShared.reconcile(self.shared, self.registry, self.state, self.mountinfo, aclStatePath=aclState, repair=True)
+        self.assertEqual([folder.name for folder in plan.acl], ["Maths"])
+
+if __name__ == '__main__':
+    unittest.main()
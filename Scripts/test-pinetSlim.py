@@ -0,0 +1,111 @@
+#!python3
+import os
+import unittest
+
+import pinetSlim
+import testHelpers
+
+STATUS = """Package: libc6
+Status: install ok installed
+Architecture: armhf
+Installed-Size: 10
+Description: GNU C Library
+ Shared libraries.
+
+Package: wolfram-engine
+Status: install ok installed
+Installed-Size: 500
+
+Package: old-thing
+Status: deinstall ok config-files
+Installed-Size: 7
+"""
+
+class TestSlim(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.chroot = os.path.join(self.folder, "armhf")
+        self.write("var/lib/dpkg/status", STATUS)
+        self.write("var/lib/dpkg/info/libc6:armhf.list", "/.\n/lib\n/lib/libc.so.6\n/usr/share/doc/libc6/changelog.gz\n/usr/share/locale/de/LC_MESSAGES/libc.mo\n")
+        self.write("var/lib/dpkg/info/wolfram-engine.list", "/opt/Wolfram/kernel\n/opt/Wolfram/kernel-copy\n")
+        self.write("etc/default/locale", 'LANG="en_GB.UTF-8"\n')
+        self.write("lib/libc.so.6", "c" * 3000)
+        self.write("usr/share/doc/libc6/changelog.gz", "z" * 500)
+        self.write("usr/share/locale/de/LC_MESSAGES/libc.mo", "d" * 200)
+        self.write("usr/share/locale/en_GB/LC_MESSAGES/libc.mo", "e" * 200)
+        self.write("usr/share/locale/locale.alias", "alias\n")
+        self.write("opt/Wolfram/kernel", "w" * 100000)
+        self.write("opt/Wolfram/kernel-copy", "w" * 100000)
+        self.write("var/cache/apt/archives/wolfram-engine.deb", "deb" * 1000)
+        self.write("home/pi/stray.img", "s" * 4000)
+        os.link(os.path.join(self.chroot, "home", "pi", "stray.img"), os.path.join(self.chroot, "home", "pi", "stray-link.img"))
+
+    def write(self, relative, text):
+        filepath = os.path.join(self.chroot, relative)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as f:
+            f.write(text)
+
+class TestReading(TestSlim):
+
+    def test_dpkg(self):
+        self.assertEqual(pinetSlim.readDpkgStatus(self.chroot), {"libc6": 10240, "wolfram-engine": 512000})
+        owners = pinetSlim.readOwners(self.chroot)
+        self.assertEqual(owners["lib/libc.so.6"], "libc6")
+        self.assertEqual(owners["opt/Wolfram/kernel"], "wolfram-engine")
+
+    def test_walkChroot(self):
+        files = pinetSlim.walkChroot(self.chroot, workers=3)
+        paths = [relative for relative, size, inode in files]
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertIn("opt/Wolfram/kernel", paths)
+        self.assertEqual(len([path for path in paths if path.startswith("home/pi/stray")]), 1)  #Hard links counted once
+
+    def test_patterns(self):
+        self.assertTrue(pinetSlim.matchesPattern("usr/share/doc/libc6/changelog.gz", "usr/share/doc/*"))
+        self.assertTrue(pinetSlim.matchesPattern("var/cache/apt/archives/a.deb", "var/cache/apt/archives/*.deb"))
+        self.assertFalse(pinetSlim.matchesPattern("var/cache/apt/archives/partial/a.txt", "var/cache/apt/archives/*.deb"))
+        self.assertFalse(pinetSlim.matchesPattern("usr/share/locale/de_AT/x.mo", "usr/share/locale/de"))
+        self.assertEqual(pinetSlim.chrootLanguages(self.chroot), set(["en", "en_GB"]))
+        self.assertEqual(pinetSlim.localePatterns(self.chroot), ["usr/share/locale/de"])
+
+class TestAnalysis(TestSlim):
+
+    def test_analyse(self):
+        report = pinetSlim.analyse(self.chroot, workers=2)
+        self.assertEqual(report["packages"][0]["name"], "wolfram-engine")
+        self.assertEqual(report["packages"][0]["size"], 200000)
+        self.assertEqual(report["packages"][0]["installedSize"], 512000)
+        self.assertEqual(report["duplicateSize"], 100000)
+        self.assertEqual(report["duplicates"][0][1], ["opt/Wolfram/kernel", "opt/Wolfram/kernel-copy"])
+        unowned = [relative for relative, size in report["unowned"]]
+        self.assertEqual(unowned[0], "home/pi/stray-link.img")  #Whichever of the hard links was seen first
+        self.assertEqual(report["unowned"][0][1], 4000)
+        self.assertNotIn("var/cache/apt/archives/wolfram-engine.deb", unowned)  #Counted as a cache instead
+        self.assertEqual(report["categories"]["caches"]["size"], 3000)
+        self.assertEqual(report["categories"]["docs"]["size"], 500)
+        self.assertEqual(report["categories"]["locales"]["size"], 200)
+        self.assertLess(report["categories"]["caches"]["compressedSize"], 3000)
+        self.assertLess(report["estimatedImageSize"], report["size"])
+        self.assertEqual(report["folders"][0][0], "opt/Wolfram")
+        self.assertTrue(pinetSlim.formatReport(report, str))
+
+    def test_excludes(self):
+        default = os.path.join(self.folder, "default.excludes")
+        excludes = os.path.join(self.folder, "etc", "ltsp-update-image.excludes")
+        with open(default, "w") as f:
+            f.write("proc/*\nsys/*\n")
+        self.assertEqual(pinetSlim.readExcludes(excludes), [])
+        pinetSlim.writeExcludes(["usr/share/doc/*"], excludes, default)
+        pinetSlim.writeExcludes(["usr/share/man/*", "usr/share/locale/de"], excludes, default)
+        with open(excludes) as f:
+            self.assertEqual(f.read().splitlines(), ["proc/*", "sys/*", pinetSlim.EXCLUDES_START, "usr/share/man/*", "usr/share/locale/de", pinetSlim.EXCLUDES_END])
+        self.assertEqual(pinetSlim.readExcludes(excludes), ["usr/share/man/*", "usr/share/locale/de"])
+        pinetSlim.writeExcludes([], excludes, default)
+        with open(excludes) as f:
+            self.assertEqual(f.read(), "proc/*\nsys/*\n")
+
+if __name__ == '__main__':
+    unittest.main()
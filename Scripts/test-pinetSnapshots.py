@@ -0,0 +1,104 @@
+#!python3
+import os
+import shutil
+import unittest
+
+import pinetSnapshots
+import testHelpers
+
+class TestSnapshots(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.chroot = os.path.join(self.folder, "ltsp", "armhf")
+        self.write("etc/hostname", "pi\n")
+        self.write("usr/bin/bluej", "version 1\n")
+        os.symlink("bluej", os.path.join(self.chroot, "usr", "bin", "bluej-link"))
+
+    def write(self, relative, text):
+        filepath = os.path.join(self.chroot, relative)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(filepath + ".tmp", filepath)  #The way dpkg replaces files
+
+    def read(self, relative, root=None):
+        with open(os.path.join(root or self.chroot, relative)) as f:
+            return f.read()
+
+    def snapshot(self, reason="", method=None, now=1500000000):
+        return pinetSnapshots.takeSnapshot(self.chroot, reason, method=method, now=now)
+
+class TestTaking(TestSnapshots):
+
+    def test_hardlink_snapshot_survives_changes(self):
+        taken = self.snapshot("before BlueJ", method="hardlink")
+        self.assertEqual(taken.folder, os.path.join(self.folder, "ltsp", pinetSnapshots.SNAPSHOT_FOLDER_NAME, "armhf"))
+        self.assertEqual(os.stat(os.path.join(taken.path, "usr", "bin", "bluej")).st_ino, os.stat(os.path.join(self.chroot, "usr", "bin", "bluej")).st_ino)
+        self.write("usr/bin/bluej", "version 2\n")
+        self.assertEqual(self.read("usr/bin/bluej", taken.path), "version 1\n")
+        self.assertTrue(os.path.islink(os.path.join(taken.path, "usr", "bin", "bluej-link")))
+        self.assertFalse(os.path.exists(taken.path + ".partial"))
+
+    def test_hardlink_snapshot_survives_edits_in_place(self):
+        self.write("usr/local/bin/pinet-screenshot.sh", "version=1\n")
+        taken = self.snapshot("before update", method="hardlink")
+        with open(os.path.join(self.chroot, "etc", "hostname"), "a") as f:
+            f.write("LDM_AUTOLOGIN=True\n")  #The way pinet adds to lts.conf
+        shutil.copyfile(os.path.join(self.chroot, "etc", "hostname"), os.path.join(self.chroot, "usr", "local", "bin", "pinet-screenshot.sh"))  #cp over a file
+        self.assertEqual(self.read("etc/hostname", taken.path), "pi\n")
+        self.assertEqual(self.read("usr/local/bin/pinet-screenshot.sh", taken.path), "version=1\n")
+
+    def test_default_method(self):
+        taken = self.snapshot()
+        self.assertIn(taken.method, pinetSnapshots.METHODS)
+        self.assertEqual(self.read("etc/hostname", taken.path), "pi\n")
+
+    def test_list_and_prune(self):
+        for i in range(5):
+            self.snapshot("install %d" % i, method="hardlink", now=1500000000 + i * 60)
+        snapshots = pinetSnapshots.listSnapshots(self.chroot)
+        self.assertEqual([item.reason for item in snapshots], ["install %d" % i for i in range(5)])
+        self.assertTrue(all(item.duration >= 0 for item in snapshots))
+        removed = pinetSnapshots.pruneSnapshots(self.chroot, keep=2)
+        self.assertEqual(removed, [item.name for item in snapshots[:3]])
+        self.assertEqual([item.reason for item in pinetSnapshots.listSnapshots(self.chroot)], ["install 3", "install 4"])
+        self.assertFalse(os.path.exists(snapshots[0].path))
+
+    def test_failed_snapshot(self):
+        with self.assertRaises(RuntimeError):
+            pinetSnapshots.takeSnapshot(os.path.join(self.folder, "ltsp", "missing"), method="hardlink")
+        self.assertEqual(os.listdir(os.path.join(self.folder, "ltsp", pinetSnapshots.SNAPSHOT_FOLDER_NAME, "missing")), [])
+
+class TestRollback(TestSnapshots):
+
+    def test_rollback(self):
+        taken = self.snapshot("before BlueJ", method="hardlink")
+        self.write("usr/bin/bluej", "broken\n")
+        self.write("usr/lib/broken.so", "broken\n")
+        replaced = pinetSnapshots.rollback(self.chroot, taken.name, now=1500000600)
+        self.assertEqual(self.read("usr/bin/bluej"), "version 1\n")
+        self.assertFalse(os.path.exists(os.path.join(self.chroot, "usr", "lib", "broken.so")))
+        self.assertEqual(self.read("usr/lib/broken.so", replaced.path), "broken\n")
+        self.assertEqual([item.name for item in pinetSnapshots.listSnapshots(self.chroot)], [replaced.name])
+        with self.assertRaises(ValueError):
+            pinetSnapshots.rollback(self.chroot, taken.name)
+
+    def test_swapFolders(self):
+        first = os.path.join(self.folder, "first")
+        second = os.path.join(self.folder, "second")
+        os.makedirs(os.path.join(first, "a"))
+        os.makedirs(os.path.join(second, "b"))
+        pinetSnapshots.swapFolders(first, second)
+        self.assertEqual(os.listdir(first), ["b"])
+        self.assertEqual(os.listdir(second), ["a"])
+
+    def test_mounts(self):
+        mounts = [("/", "ext4"), ("/opt/ltsp", "btrfs"), ("/opt/ltsp/armhf/proc", "proc"), ("/opt/ltsp/armhf2", "ext4")]
+        self.assertEqual(pinetSnapshots.filesystemType("/opt/ltsp/armhf", mounts), "btrfs")
+        self.assertEqual(pinetSnapshots.filesystemType("/home", mounts), "ext4")
+        self.assertEqual(pinetSnapshots.mountsInside("/opt/ltsp/armhf", mounts), ["/opt/ltsp/armhf/proc"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!python3
+import os
+import http.server
+import json
+import threading
+import time
+import unittest
+import urllib.parse
+
+import pinetStats
+import testHelpers
+
+class statsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append(dict(urllib.parse.parse_qsl(body.decode())))
+        self.server.connections.add(self.client_address)
+        status = self.server.status
+        if self.server.failAfter is not None and len(self.server.received) > self.server.failAfter:
+            status = 500
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.ipLookups = self.server.ipLookups + 1
+        body = b"203.0.113.7"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestStats(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.spool = os.path.join(self.folder, "spool")
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), statsHandler)
+        self.server.received = []
+        self.server.connections = set()
+        self.server.status = 200
+        self.server.failAfter = None
+        self.server.ipLookups = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:%d/pinetstatsv1.php" % self.server.server_address[1]
+
+    def flush(self, **options):
+        options.setdefault("ipLookup", lambda: "192.0.2.1")
+        return pinetStats.flush(self.url, self.spool, timeout=5, **options)
+
+class TestSpool(TestStats):
+
+    def test_enqueue_is_local(self):
+        started = time.time()
+        pinetStats.enqueue({"ServerID": "1"}, self.spool)
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(len(pinetStats.queuedRecords(self.spool)), 1)
+        self.assertEqual(self.server.received, [])
+
+    def test_prune(self):
+        now = time.time()
+        pinetStats.enqueue({"ServerID": "old"}, self.spool, now - pinetStats.MAX_AGE - 10)
+        for i in range(5):
+            pinetStats.enqueue({"ServerID": str(i)}, self.spool, now + i)
+        with open(os.path.join(self.spool, "9999999999.000000-000001.json"), "w") as f:
+            f.write("not json")
+        kept = pinetStats.pruneRecords(self.spool, maxRecords=3, now=now + 10)
+        self.assertEqual([record["fields"]["ServerID"] for filepath, record in kept], ["2", "3", "4"])
+        self.assertEqual(len(pinetStats.queuedRecords(self.spool)), 3)
+
+class TestFlush(TestStats):
+
+    def test_flush_sends_batch_on_one_connection(self):
+        for i in range(3):
+            pinetStats.enqueue({"ServerID": "42", "Users": str(i)}, self.spool, time.time() + i)
+        self.assertEqual(self.flush(), 3)
+        self.assertEqual([record["Users"] for record in self.server.received], ["0", "1", "2"])
+        self.assertEqual(self.server.received[0]["IPAddress"], "192.0.2.1")
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(pinetStats.queuedRecords(self.spool), [])
+
+    def test_batch_size(self):
+        for i in range(5):
+            pinetStats.enqueue({"Users": str(i)}, self.spool, time.time() + i)
+        self.assertEqual(self.flush(batchSize=2), 2)
+        self.assertEqual(len(pinetStats.queuedRecords(self.spool)), 3)
+
+    def test_backoff(self):
+        self.server.failAfter = 1
+        pinetStats.enqueue({"Users": "1"}, self.spool, time.time())
+        pinetStats.enqueue({"Users": "2"}, self.spool, time.time() + 1)
+        now = time.time()
+        self.assertEqual(self.flush(now=now), 1)
+        self.assertEqual(len(pinetStats.queuedRecords(self.spool)), 1)
+        self.server.failAfter = None
+        self.assertEqual(self.flush(now=now + 10), 0)
+        self.assertEqual(self.flush(now=now + pinetStats.BACKOFF_START + 1), 1)
+        with open(os.path.join(self.spool, "state.json")) as f:
+            self.assertEqual(json.load(f)["failures"], 0)
+
+    def test_unreachable(self):
+        pinetStats.enqueue({"Users": "1"}, self.spool)
+        started = time.time()
+        self.assertEqual(pinetStats.flush("http://127.0.0.1:9/", self.spool, timeout=2, ipLookup=lambda: "0.0.0.0"), 0)
+        self.assertLess(time.time() - started, 3)
+        self.assertEqual(len(pinetStats.queuedRecords(self.spool)), 1)
+
+    def test_backoffDelay(self):
+        self.assertEqual(pinetStats.backoffDelay(0), 0)
+        self.assertEqual(pinetStats.backoffDelay(3), pinetStats.BACKOFF_START * 4)
+        self.assertEqual(pinetStats.backoffDelay(50), pinetStats.BACKOFF_MAX)
+
+class TestIPAddress(TestStats):
+
+    def test_cached(self):
+        cache = os.path.join(self.folder, "ip.json")
+        ipURL = self.url.replace("pinetstatsv1.php", "ip")
+        self.assertEqual(pinetStats.cachedIPAddress(ipURL, cache, timeout=5), "203.0.113.7")
+        self.assertEqual(pinetStats.cachedIPAddress(ipURL, cache, timeout=5), "203.0.113.7")
+        self.assertEqual(self.server.ipLookups, 1)
+        self.assertEqual(pinetStats.cachedIPAddress("http://127.0.0.1:9/", cache, timeout=2, now=time.time() + pinetStats.IP_TTL), "203.0.113.7")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!python3
+import os
+import threading
+import time
+import unittest
+
+import pinetTasks
+from pinetTasks import task
+import testHelpers
+
+class TestTasks(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.lock = threading.Lock()
+        self.ran = []
+        self.active = set()
+        self.overlaps = []
+        self.returncodes = {}
+
+    def run_task(self, item):
+        with self.lock:
+            self.overlaps.append((item.name, set(self.active)))
+            self.active.add(item.name)
+            self.ran.append(item.name)
+        time.sleep(0.05)
+        with self.lock:
+            self.active.discard(item.name)
+        return self.returncodes.get(item.name, 0)
+
+    def runGraph(self, tasks, **options):
+        return pinetTasks.runGraph(tasks, self.run_task, progress=lambda line: None, **options)
+
+class TestGraph(TestTasks):
+
+    def test_checkGraph(self):
+        order = [item.name for item in pinetTasks.checkGraph([task("c", needs=["b"]), task("b", needs=["a"]), task("a")])]
+        self.assertEqual(order, ["a", "b", "c"])
+        with self.assertRaises(ValueError):
+            pinetTasks.checkGraph([task("a", needs=["b"]), task("b", needs=["a"])])
+        with self.assertRaises(ValueError):
+            pinetTasks.checkGraph([task("a", needs=["missing"])])
+        for flow in pinetTasks.FLOWS.values():
+            pinetTasks.checkGraph(flow)
+
+    def test_priorities(self):
+        tasks = [task("long"), task("short"), task("after", needs=["long"])]
+        ranks = pinetTasks.priorities(tasks, {"long": 100, "short": 5, "after": 50})
+        self.assertEqual(ranks, {"long": 150, "short": 5, "after": 50})
+
+class TestScheduler(TestTasks):
+
+    def test_dependencies_and_locks(self):
+        tasks = [task("installLTSP", locks=["server-dpkg"]),
+                 task("fetch", locks=["network"]),
+                 task("buildClient", needs=["installLTSP"], locks=["chroot-dpkg"]),
+                 task("theme", needs=["installLTSP"], locks=["chroot-dpkg"]),
+                 task("icons", needs=["buildClient", "fetch"])]
+        result = self.runGraph(tasks, workers=4)
+        self.assertTrue(all(state["status"] == "done" for state in result["tasks"].values()))
+        self.assertLess(self.ran.index("installLTSP"), self.ran.index("buildClient"))
+        self.assertGreater(self.ran.index("icons"), self.ran.index("fetch"))
+        overlaps = dict(self.overlaps)
+        self.assertTrue("fetch" in overlaps["installLTSP"] or "installLTSP" in overlaps["fetch"])  #Independent, so run side by side
+        self.assertNotIn("buildClient", overlaps["theme"])  #Both use the chroot
+        self.assertNotIn("theme", overlaps["buildClient"])
+        waited = result["tasks"]["theme"]["waitedFor"] + result["tasks"]["buildClient"]["waitedFor"]
+        self.assertEqual(waited, ["chroot-dpkg"])
+
+    def test_worker_limit(self):
+        result = self.runGraph([task(str(i)) for i in range(4)], workers=1)
+        self.assertTrue(all(not active for name, active in self.overlaps))
+        self.assertEqual(sum(state["waitedFor"] == ["workers"] for state in result["tasks"].values()), 3)
+
+    def test_failures(self):
+        self.returncodes = {"required": 1, "optional": 1}
+        tasks = [task("required", required=True), task("optional"), task("needsRequired", needs=["required"]),
+                 task("later", needs=["needsRequired"]), task("needsOptional", needs=["optional"])]
+        result = self.runGraph(tasks)
+        statuses = dict((name, state["status"]) for name, state in result["tasks"].items())
+        self.assertEqual(statuses, {"required": "failed", "optional": "done", "needsRequired": "blocked", "later": "blocked", "needsOptional": "done"})
+        lines = pinetTasks.formatReport(tasks, result)
+        self.assertIn("Not run: later, needsRequired", lines)
+        self.assertIn("Returned an error, carried on: optional", lines)
+
+    def test_journal(self):
+        journalPath = os.path.join(self.folder, "journal.json")
+        tasks = [task("first"), task("second", needs=["first"]), task("other")]
+        self.runGraph(tasks, journalPath=journalPath)
+        self.ran = []
+        result = self.runGraph(tasks, journalPath=journalPath)
+        self.assertEqual(self.ran, [])
+        self.assertEqual(set(state["status"] for state in result["tasks"].values()), set(["skipped"]))
+        tasks[0].command = ["first", "changed"]  #Its inputs changed, so it runs again, and so does the task that needs it
+        self.ran = []
+        self.runGraph(tasks, journalPath=journalPath)
+        self.assertEqual(sorted(self.ran), ["first", "second"])
+
+class TestReport(TestTasks):
+
+    def test_criticalPath(self):
+        tasks = [task("a"), task("b", needs=["a"]), task("c"), task("d", needs=["b", "c"])]
+        runs = {"a": {"ready": 0, "start": 0, "finish": 10, "waitedFor": [], "ran": True, "status": "done", "returncode": 0},
+                "b": {"ready": 10, "start": 15, "finish": 40, "waitedFor": ["chroot-dpkg"], "ran": True, "status": "done", "returncode": 0},
+                "c": {"ready": 0, "start": 0, "finish": 30, "waitedFor": [], "ran": True, "status": "done", "returncode": 0},
+                "d": {"ready": 40, "start": 40, "finish": 45, "waitedFor": [], "ran": True, "status": "done", "returncode": 0}}
+        result = {"started": 0, "finished": 45, "tasks": runs}
+        self.assertEqual(pinetTasks.criticalPath(tasks, result), [("a", 10, 0), ("b", 25, 5), ("d", 5, 0)])
+        lines = pinetTasks.formatReport(tasks, result)
+        self.assertEqual(lines[0], "4 tasks took 45s, 1m10s if run one after another")
+        self.assertIn("waited 5s for chroot-dpkg", lines[-2])
+
+    def test_history(self):
+        tasks = [task("a"), task("b")]
+        result = self.runGraph(tasks)
+        result["tasks"]["b"]["ran"] = False  #As if the journal had skipped it
+        pinetTasks.saveResult("test", {"started": 0, "finished": 1, "tasks": {"b": {"ran": True, "start": 0, "finish": 20}}}, self.folder)
+        pinetTasks.saveResult("test", result, self.folder)
+        estimates = pinetTasks.loadEstimates("test", self.folder)
+        self.assertEqual(estimates["b"], 20)
+        self.assertLess(estimates["a"], 5)
+
+class TestRunStep(TestTasks):
+
+    def test_runStep(self):
+        script = os.path.join(self.folder, "pinet")
+        with open(script, "w") as f:
+            f.write('echo "$@"\necho done > "$PINET_DATA_FILE"\n')
+        os.chmod(script, 0o644)  #As installed
+        logs = os.path.join(self.folder, "logs")
+        self.assertEqual(pinetTasks.runStep(task("installLTSP", ["installLTSP", "armhf"]), script, logs), 0)
+        with open(os.path.join(logs, "installLTSP.log")) as f:
+            self.assertIn("Run-Step installLTSP armhf", f.read())
+        with open(os.path.join(logs, "installLTSP.data")) as f:
+            self.assertEqual(f.read(), "done\n")
+        self.assertEqual(pinetTasks.runStep(task("ask", interactive=True), script, logs), 0)
+
+if __name__ == '__main__':
+    unittest.main()
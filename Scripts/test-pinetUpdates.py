@@ -0,0 +1,123 @@
+#!python3
+import os
+import time
+import unittest
+
+import pinetUpdates
+import testHelpers
+
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <entry>
+    <title>Fix typo</title>
+    <content type="html">&lt;pre style='white-space:pre-wrap;width:81ex'&gt;Fix typo in menu&lt;/pre&gt;</content>
+  </entry>
+  <entry>
+    <title>Release 1.2.3</title>
+    <content type="html">&lt;pre style='white-space:pre-wrap;width:81ex'&gt;Release 1.2.3
+Faster update checks&lt;/pre&gt;</content>
+  </entry>
+  <entry>
+    <title>Release 1.2.2</title>
+    <content type="html">&lt;pre&gt;Release 1.2.2&lt;/pre&gt;</content>
+  </entry>
+</feed>
+"""
+
+class TestUpdates(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = os.path.join(self.folder, "updates.json")
+
+    def jobs(self, **values):
+        jobs = {}
+        for name in values:
+            jobs[name] = self.job(values[name])
+        return jobs
+
+    def job(self, value, delay=0):
+        def run(timeout):
+            time.sleep(delay)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        return run
+
+class TestParsers(TestUpdates):
+
+    def test_release_feed(self):
+        release = pinetUpdates.parseReleaseFeed(FEED.encode())
+        self.assertEqual(release["version"], "1.2.3")
+        self.assertEqual(release["commits"][0], ["Fix typo in menu"])
+        self.assertEqual(release["commits"][1], ["Release 1.2.3", "Faster update checks"])
+
+    def test_release_feed_without_release(self):
+        self.assertRaises(ValueError, pinetUpdates.parseReleaseFeed, b'<feed xmlns="http://www.w3.org/2005/Atom"></feed>')
+
+    def test_kernel_updater(self):
+        filepath = os.path.join(self.folder, "kernelCheckUpdate.sh")
+        self.assertEqual(pinetUpdates.parseKernelUpdater(b"#!/bin/sh\nversion=7\n", filepath), {"version": 7})
+        with open(filepath) as f:
+            self.assertIn("version=7", f.read())
+        self.assertEqual(pinetUpdates.parseBootFilesVersion(b"151\n"), {"version": 151})
+
+class TestChecks(TestUpdates):
+
+    def test_checks_run_together(self):
+        jobs = {"pinet": self.job({"version": "1.0"}, 0.3), "bootFiles": self.job({"version": 1}, 0.3), "stats": self.job(None, 0.3)}
+        started = time.time()
+        results, errors = pinetUpdates.runChecks(jobs, deadline=5)
+        self.assertLess(time.time() - started, 0.8)
+        self.assertEqual(errors, {})
+        self.assertEqual(results["bootFiles"], {"version": 1})
+
+    def test_shared_deadline(self):
+        jobs = {"pinet": self.job({"version": "1.0"}), "bootFiles": self.job({"version": 1}, 3)}
+        started = time.time()
+        results, errors = pinetUpdates.runChecks(jobs, deadline=0.5)
+        self.assertLess(time.time() - started, 1.5)
+        self.assertIn("pinet", results)
+        self.assertIn("timed out", errors["bootFiles"])
+
+    def test_failed_check_keeps_old_value(self):
+        pinetUpdates.refresh("master", self.jobs(pinet={"version": "1.0"}, bootFiles={"version": 1}), self.cache)
+        cache = pinetUpdates.refresh("master", self.jobs(pinet=OSError("filtered"), bootFiles={"version": 2}), self.cache)
+        self.assertEqual(pinetUpdates.cachedValue(cache, "pinet"), {"version": "1.0"})
+        self.assertEqual(pinetUpdates.cachedValue(cache, "bootFiles"), {"version": 2})
+        self.assertEqual(cache["errors"], {"pinet": "filtered"})
+        self.assertLess(cache["checked"], cache["attempted"])
+
+    def test_new_branch_drops_results(self):
+        pinetUpdates.refresh("master", self.jobs(pinet={"version": "1.0"}), self.cache)
+        cache = pinetUpdates.refresh("dev", self.jobs(pinet=OSError("offline")), self.cache)
+        self.assertIsNone(pinetUpdates.cachedValue(cache, "pinet"))
+
+    def test_refresh_already_running(self):
+        lock = pinetUpdates.refreshLock(self.cache)
+        self.assertTrue(lock.acquire())
+        self.addCleanup(lock.release)
+        self.assertTrue(pinetUpdates.refreshRunning(self.cache))
+        cache = pinetUpdates.refresh("master", self.jobs(pinet={"version": "1.0"}), self.cache)
+        self.assertEqual(cache["results"], {})
+        self.assertFalse(pinetUpdates.startBackgroundRefresh(["false"], self.cache))
+
+class TestRefreshMode(TestUpdates):
+
+    def test_modes(self):
+        cache = pinetUpdates.loadCache(self.cache)
+        self.assertEqual(pinetUpdates.refreshMode(cache, "master"), "wait")
+        cache = pinetUpdates.refresh("master", self.jobs(pinet={"version": "1.0"}), self.cache)
+        now = cache["checked"]
+        self.assertIsNone(pinetUpdates.refreshMode(cache, "master", now + 60))
+        self.assertEqual(pinetUpdates.refreshMode(cache, "master", now + pinetUpdates.CACHE_TTL), "background")
+        self.assertEqual(pinetUpdates.refreshMode(cache, "dev", now + 60), "wait")
+
+    def test_offline_not_retried_straight_away(self):
+        cache = pinetUpdates.refresh("master", self.jobs(pinet=OSError("offline")), self.cache)
+        now = cache["attempted"]
+        self.assertIsNone(pinetUpdates.refreshMode(cache, "master", now + 60))
+        self.assertEqual(pinetUpdates.refreshMode(cache, "master", now + pinetUpdates.RETRY_AFTER), "wait")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!python3
+import os
+import subprocess
+import time
+import unittest
+
+import pinetUpgrade
+import testHelpers
+
+PINET_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pinet")
+
+ADD_SOFTWARE = """AddSoftware ()
+{
+    ltsp-chroot --arch armhf apt-get install -y idle idle3 python-dev;
+    ltsp-chroot --arch armhf apt-get install -y --no-install-recommends cifs-utils midori;
+    ltsp-chroot --arch armhf apt-get install -y -o Dpkg::Options::="--force-confnew" raspberrypi-net-mods;
+    ltsp-chroot --arch armhf update-rc.d nfs-common disable;
+    ltsp-chroot --arch armhf apt-get install -y libjpeg-dev # Required due to a dependancy issue with pillow
+    sudo DEBIAN_FRONTEND=noninteractive ltsp-chroot --arch armhf apt-get install -y sonic-pi;
+    InstallPipPackage gpiozero;
+    apt-get install -y bindfs python3-feedparser ntp
+}
+"""
+
+class TestUpgrade(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.state = os.path.join(self.folder, "pinetUpgrade.json")
+        self.root = os.path.join(self.folder, "armhf")
+        os.makedirs(os.path.join(self.root, "var", "lib", "dpkg"))
+        self.write_status("Package: idle\nStatus: install ok installed\n")
+
+    def write_status(self, text):
+        with open(os.path.join(self.root, "var", "lib", "dpkg", "status"), "w") as f:
+            f.write(text)
+
+    def fake_target(self, name, command="true"):
+        #Everything the target is asked to run becomes arguments to a shell that ignores them
+        return pinetUpgrade.upgradeTarget(name, self.root, ["sh", "-c", command, "sh"])
+
+class TestParseAddSoftware(TestUpgrade):
+
+    def test_parse(self):
+        chroot, server, pip = pinetUpgrade.parseAddSoftware(ADD_SOFTWARE)
+        self.assertEqual(chroot, ["idle", "idle3", "python-dev", "cifs-utils", "midori", "raspberrypi-net-mods", "libjpeg-dev", "sonic-pi"])
+        self.assertEqual(server, ["bindfs", "python3-feedparser", "ntp"])
+        self.assertEqual(pip, ["gpiozero"])
+
+    def test_parse_pinet(self):
+        script = "source <(sed -n '/^AddSoftware()/,/^}/p' %s); declare -f AddSoftware" % PINET_FILEPATH
+        definition = subprocess.check_output(["bash", "-c", script]).decode()
+        chroot, server, pip = pinetUpgrade.parseAddSoftware(definition)
+        self.assertIn("sonic-pi", chroot)
+        self.assertIn("raspberrypi-net-mods", chroot)
+        self.assertNotIn("Dpkg::Options::=--force-confnew", chroot)
+        self.assertIn("bindfs", server)
+        self.assertIn("pgzero", pip)
+
+class TestPipeline(TestUpgrade):
+
+    def test_phases_run_side_by_side(self):
+        server = self.fake_target("server", "sleep 0.4")
+        chroot = self.fake_target("chroot", "sleep 0.4")
+        started = time.time()
+        report, needed = pinetUpgrade.runPipeline("", server, chroot, self.state, self.folder, echo=False)
+        self.assertLess(time.time() - started, 2.2)
+        self.assertTrue(report.ok)
+        self.assertEqual([phase["name"] for phase in report.phases],
+                         ["Update package lists", "Download upgrades", "Apply upgrades", "Check AddSoftware"])
+        self.assertTrue(needed)
+
+    def test_addSoftware_skipped_when_current(self):
+        definition = ADD_SOFTWARE.replace("InstallPipPackage gpiozero;", "")
+        report, needed = pinetUpgrade.runPipeline(definition, self.fake_target("server"), self.fake_target("chroot"), self.state, self.folder, echo=False)
+        self.assertFalse(needed)
+
+    def test_addSoftware_needed_when_apt_would_install(self):
+        chroot = self.fake_target("chroot", "echo 'Inst sonic-pi (2.0 Raspbian:stable [armhf])'")
+        needed, reasons = pinetUpgrade.addSoftwareNeeded(ADD_SOFTWARE.replace("InstallPipPackage gpiozero;", ""), self.fake_target("server"), chroot)
+        self.assertTrue(needed)
+        self.assertEqual(reasons, ["chroot: sonic-pi"])
+
+    def test_addSoftware_needed_when_check_fails(self):
+        needed, reasons = pinetUpgrade.addSoftwareNeeded(ADD_SOFTWARE, self.fake_target("server", "exit 100"), self.fake_target("chroot"))
+        self.assertTrue(needed)
+
+    def test_chrootChanged(self):
+        chroot = self.fake_target("chroot")
+        pinetUpgrade.runPipeline("", self.fake_target("server"), chroot, self.state, self.folder, echo=False)
+        self.assertFalse(pinetUpgrade.chrootChanged(chroot, self.state))
+        self.write_status("Package: idle\nStatus: install ok installed\nVersion: 2\n")
+        self.assertTrue(pinetUpgrade.chrootChanged(chroot, self.state))
+
+    def test_recordPhase(self):
+        pinetUpgrade.runPipeline("", self.fake_target("server"), self.fake_target("chroot"), self.state, self.folder, echo=False)
+        report = pinetUpgrade.recordPhase("Rebuild image", "42", statePath=self.state)
+        self.assertEqual(report.phases[-1]["name"], "Rebuild image")
+        self.assertIn("Rebuild image", "\n".join(pinetUpgrade.upgradeReport.load(self.state).summary()))
+
+    def test_lock(self):
+        chroot = self.fake_target("chroot")
+        with pinetUpgrade.targetLock(chroot, self.folder):
+            self.assertRaises(RuntimeError, pinetUpgrade.runPipeline, "", self.fake_target("server"), chroot, self.state, self.folder, False)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!python3
+import os
+import json
+import shutil
+import unittest
+
+import pinetUsage
+import testHelpers
+
+class TestUsage(testHelpers.TempFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.home = os.path.join(self.folder, "home")
+        self.index = os.path.join(self.folder, "usage-index.json")
+        self.folders = os.path.join(self.folder, "usage-folders.json")
+        self.summary = os.path.join(self.folder, "usage.json")
+        self.write("alice/handin/essay.txt", 20000)
+        self.write("alice/Documents/notes.txt", 5000)
+        self.write("bob/Documents/project/main.py", 100000)
+        self.write("carol/.bashrc", 100)
+        self.listed = []
+        listFolder = pinetUsage.listFolder
+        def countingListFolder(path):
+            self.listed.append(os.path.relpath(path, self.home))
+            return listFolder(path)
+        pinetUsage.listFolder = countingListFolder
+        self.addCleanup(setattr, pinetUsage, "listFolder", listFolder)
+
+    def write(self, relative, size):
+        filepath = os.path.join(self.home, relative)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "wb") as f:
+            f.write(os.urandom(size))
+
+    def du(self, relative):
+        total = 0
+        for root, dirs, files in os.walk(os.path.join(self.home, relative)):
+            for name in dirs + files:
+                total = total + os.lstat(os.path.join(root, name)).st_blocks * 512
+        return total + os.lstat(os.path.join(self.home, relative)).st_blocks * 512
+
+    def scan(self, full=False):
+        self.listed = []
+        return pinetUsage.scanHomes(self.home, self.index, self.folders, self.summary, workers=4, full=full)
+
+    def test_sizes_match_du(self):
+        index = self.scan()
+        for user in ["alice", "bob", "carol"]:
+            self.assertEqual(index.users[user].size, self.du(user))
+        self.assertEqual(index.users["alice"].files, 2)
+        self.assertEqual(index.users["alice"].handin, self.du("alice/handin"))
+        self.assertEqual(index.users["bob"].handin, 0)
+
+    def test_top_users(self):
+        index = self.scan()
+        self.assertEqual([usage.user for usage in index.topUsers(2)], ["bob", "alice"])
+        self.assertEqual(index.handinSizes(), [("alice", self.du("alice/handin"))])
+
+    def test_unchanged_folders_not_listed(self):
+        self.scan()
+        self.assertEqual(len(self.listed), 7)
+        self.write("bob/Documents/project/extra.py", 50000)
+        index = self.scan()
+        self.assertEqual(self.listed, [os.path.join("bob", "Documents", "project")])
+        self.assertEqual(index.users["bob"].size, self.du("bob"))
+
+    def test_growth(self):
+        self.scan()
+        self.write("carol/video.mp4", 300000)
+        index = self.scan()
+        growth = index.growth()
+        self.assertEqual([usage.user for usage in growth], ["carol"])
+        self.assertGreaterEqual(growth[0].growth, 300000)
+        self.assertEqual(pinetUsage.usageIndex.load(self.index).users["carol"].growth, growth[0].growth)
+
+    def test_full_scan(self):
+        self.scan()
+        index = self.scan(full=True)
+        self.assertEqual(len(self.listed), 7)
+        self.assertEqual(index.fullScanned, index.scanned)
+
+    def test_removed_user(self):
+        self.scan()
+        shutil.rmtree(os.path.join(self.home, "carol"))
+        index = self.scan()
+        self.assertNotIn("carol", index.users)
+        self.assertFalse(any(folder.startswith("carol") for folder in pinetUsage.usageIndex.load(self.index, self.folders).folders))
+
+    def test_summary(self):
+        index = self.scan()
+        with open(self.summary) as f:
+            summary = json.load(f)
+        self.assertEqual(summary["users"], 3)
+        self.assertEqual(summary["total"], index.total)
+        self.assertEqual(summary["top"][0], ["bob", index.users["bob"].size])
+
+    def test_formatSize(self):
+        self.assertEqual(pinetUsage.formatSize(512), "512B")
+        self.assertEqual(pinetUsage.formatSize(1536), "1.5K")
+        self.assertEqual(pinetUsage.formatSize(3 * 1024 ** 3), "3.0G")
+
+if __name__ == '__main__':
+    unittest.main()
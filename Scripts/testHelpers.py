@@ -0,0 +1,12 @@
+#!python3
+import shutil
+import tempfile
+import unittest
+
+class TempFolderTest(unittest.TestCase):
+    """Each test gets its own scratch folder, removed again afterwards"""
+
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)